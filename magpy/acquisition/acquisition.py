@@ -8,6 +8,8 @@ Additional requirements:
 2) 
 Usage:
 sudo python acquisition.py
+With supervise = True each sensor is read by a worker process
+(python acquisition.py --worker SENSORNAME, started by the supervisor).
 
 """
 
@@ -62,6 +64,10 @@ from serial import SEVENBITS
 #from magpy.acquisition.arduinoprotocol import ArduinoProtocol
 #from palmacqprotocol import PalmAcqProtocol
 from gsm19protocol import GSM19Protocol
+from ringbuffer import RingBufferStore, RingBufferRpc
+from decimation import DecimationStore
+from publishpolicy import parsepolicy
+from workersupervisor import AcquisitionSupervisor, ForwardingFactory
 
 # Other possible protocals are: lemiprotocol, pos1protocol, envprotocol, csprotocol, gsm90protocol
 # SELECT DIRECTORY FOR BUFFER FILES
@@ -75,15 +81,25 @@ wsurl = "ws://localhost:9100"   # WebSocket port to use for embedded WebSocket $
 owport = 'u' 			# u for usb
 serialport = '/dev/tty' 	# dev/tty for linux like systems
 # ONEWIRE SPECIFIC
-timeoutow = 30.0		# Defining a measurement frequency in secs (should be >= amount of sensors connected)
+timeoutow = 30.0		# Defining a measurement frequency in secs (poll interval of each sensor, bus scan interval)
+owintervals = {}		# Poll intervals in secs of single sensors, e.g. {'A6B154010000': 5.0} (or seventh column of owlist.csv)
+owstatsinterval = 3600.0	# Log poll latencies of the sensors every ... secs (0: never)
 timeoutser = 60.0		# Defining a measurement frequency in secs (should be >= amount of sensors connected)
+# RING BUFFER (recent data provided to collectors by RPC)
+bufferhours = 4.0		# Hours of data kept in memory for each sensor
+# FILTERED PRODUCTS (IAGA one second and one minute values, published and stored)
+decimation = ['sec','min']	# [] for raw data only
+# PROCESS ISOLATION (each sensor/bus read by its own worker process, posix only)
+supervise = False		# True: workers are restarted automatically after failures
+workertimeout = 600.0		# Restart workers without readings for this amount of seconds (0: never, > timeoutow/timeoutser)
+workerstatsinterval = 3600.0	# Log events and restarts of the workers every ... secs (0: never)
  
 
 # -------------------------------------------------------------------
 # Read data of sensors attached to PC:
 # 
 # "Sensors.txt" should have the following format:
-# SENSORNAME	SENSORPORT	SENSORBAUDRATE
+# SENSORNAME	SENSORPORT	SENSORBAUDRATE	[PUBLICATIONPOLICY]
 # e.g:
 # LEMI036_1_0001	USB0	57600
 # POS1_N432_0001	S0	9600
@@ -91,14 +107,18 @@ timeoutser = 60.0		# Defining a measurement frequency in secs (should be >= amou
 # SERIAL		S0	115200   -> for specific calls
 # OW			-	-
 #
+# ENV05_1_0001	USB0	9600	deadband=0.05:0.5:0.05;heartbeat=300;summary
+#
 # Notes: OneWire devices do not need this data, all others do.
+# The optional publication policy (ENV, KERN) publishes changed readings
+# only (see publishpolicy), OneWire policies are set in owlist.csv.
 # -------------------------------------------------------------------
 
 def GetSensors():
     sensors = open(os.path.join(homedir,'MARTAS','sensors.txt'),'r')
     sensordata = sensors.readlines()
     sensorlist = []
-    baudratedict, portdict = {}, {}
+    baudratedict, portdict, policydict = {}, {}, {}
 
     for item in sensordata:
         try:
@@ -111,14 +131,115 @@ def GetSensors():
             except:
                 # no float, assuming ow
                 baudratedict[sensorname] = 0.0
+            if len(bits) > 3:
+                try:
+                    policydict[sensorname] = parsepolicy(bits[3])
+                except ValueError as e:
+                    print "Invalid publication policy of", sensorname, e
         except:
             # Possible issue - empty line
             pass
 
     print "Found", sensorlist, portdict, baudratedict
-    return sensorlist, portdict, baudratedict
+    return sensorlist, portdict, baudratedict, policydict
 
 
+# -------------------------------------------------------------------
+# Protocols and ports of the sensors
+# -------------------------------------------------------------------
+
+def CreateProtocols(factory, sensors):
+    """
+    Creates the protocols of the sensors as attributes of factory
+    (WsMcuFactory or ForwardingFactory of a worker process).
+    """
+    for sensor in sensors:
+        if sensor[:3].upper() == 'ENV':
+            factory.envProtocol = EnvProtocol(factory,sensor.strip(), outputdir, policy=policydict.get(sensor))
+        if sensor[:2].upper() == 'OW':
+            factory.owProtocol = OwProtocol(factory,owport,outputdir,interval=timeoutow,intervals=owintervals,statsinterval=owstatsinterval)
+        if sensor[:3].upper() == 'POS':
+            factory.pos1Protocol = Pos1Protocol(factory,sensor.strip(), outputdir)
+        if sensor[:3].upper() == 'KER':
+            print "Test1:", sensor.strip
+            factory.kernProtocol = KernProtocol(factory,sensor.strip(), outputdir, policy=policydict.get(sensor))
+        if sensor[:3].upper() == 'ARD':
+            factory.arduinoProtocol = ArduinoProtocol(factory, sensor.strip(), outputdir)
+        if sensor[:3].upper() == 'SER':
+            port = serialport+portdict[sensor]
+            baudrate = baudratedict[sensor]
+            factory.callProtocol = CallProtocol(factory,sensor.strip(), outputdir,port,baudrate)
+        if sensor[:3].upper() == 'PAL':
+            factory.palmacqProtocol = PalmAcqProtocol(factory, sensor.strip(), outputdir)
+        if sensor[:3].upper() == 'LEM':
+            factory.lemiProtocol = LemiProtocol(factory,sensor.strip(),sensor[0]+sensor[4:7], outputdir)
+        if sensor[:3].upper() == 'G82':
+            factory.csProtocol = CsProtocol(factory,sensor.strip(), outputdir)
+        if sensor[:3].upper() == 'GSM':
+            factory.gsm90Protocol = GSM90Protocol(factory,sensor.strip(), outputdir)
+        if sensor[:3].upper() == 'G19':
+            factory.gsm19Protocol = GSM19Protocol(factory,sensor.strip(), outputdir)
+
+def ConnectSensors(factory, sensors):
+    """
+    Opens the serial ports of the protocols created by CreateProtocols
+    (OW and SER sensors are polled). Returns False if a port or the
+    OneWire bus is not available.
+    """
+    connected = True
+    for sensor in sensors:
+        port = serialport+portdict[sensor]
+        baudrate = baudratedict[sensor]
+
+        if sensor[:3].upper() == 'LEM':
+            protocol = factory.lemiProtocol
+        if sensor[:3].upper() == 'POS':
+            protocol = factory.pos1Protocol
+        if sensor[:3].upper() == 'G82':
+            protocol = factory.csProtocol
+        if sensor[:3].upper() == 'GSM':
+            protocol = factory.gsm90Protocol
+        if sensor[:3].upper() == 'G19':
+            protocol = factory.gsm19Protocol
+        if sensor[:3].upper() == 'ENV':
+            protocol = factory.envProtocol
+        if sensor[:3].upper() == 'KER':
+            protocol = factory.kernProtocol
+        if sensor[:3].upper() == 'ARD':
+            protocol = factory.arduinoProtocol
+        if sensor[:3].upper() == 'PAL':
+            protocol = factory.palmacqProtocol
+
+        if sensor[:3].upper() == 'SER':
+            try:
+                log.msg('Serial Call: Initiating sensor and sending commands...')
+                # eventually define a command list
+                sprot = task.LoopingCall(factory.callProtocol.sendCommands)
+                sprot.start(timeoutser)
+            except:
+                log.msg('Serial Call: Not available.')
+                connected = False
+        elif sensor[:2].upper() == 'OW':
+            try:
+                log.msg('OneWire: Initiating sensor...')
+                oprot = task.LoopingCall(factory.owProtocol.owConnected)
+                oprot.start(timeoutow)
+            except:
+                log.msg('OneWire: Not available.')
+                connected = False
+        else:
+            try:
+                log.msg('%s: Attempting to open port %s [%d baud]...' % (sensor, port, baudrate))
+                if sensor.startswith('KER'):
+                    serialPort = SerialPort(protocol,port,reactor, baudrate=baudrate,bytesize=SEVENBITS,parity=PARITY_EVEN)
+                else:
+                    serialPort = SerialPort(protocol, port, reactor, baudrate = baudrate)
+                    log.msg('%s: Port %s [%d baud] connected' % (sensor, port, baudrate))
+            except:
+                log.msg('%s: Port %s [%d baud] not available' % (sensor, port, baudrate))
+                connected = False
+    return connected
+
 # -------------------------------------------------------------------
 # WS-MCU protocol:
 # -------------------------------------------------------------------
@@ -133,7 +254,8 @@ class WsMcuProtocol(WampServerProtocol):
         	self.registerForPubSub("http://example.com/"+hostname+"/env#", True)
        		## register methods for RPC
 		## does not work in python 2.6.5 (fine in 2.7.3)
-       		if sys.version_info >= (2, 7):
+       		## (protocols of supervised workers are not available)
+       		if sys.version_info >= (2, 7) and hasattr(self.factory, 'envProtocol'):
            	    self.registerForRpc(self.factory.envProtocol, "http://example.com/"+hostname+"/env-control#")
        		    #else:
        		    #    self.registerMethodForRpc("http://example.com/"+hostname+"/mcu-control#",self.factory.mcuProtocol,McuProtocol.add)
@@ -159,6 +281,9 @@ class WsMcuProtocol(WampServerProtocol):
        		self.registerForPubSub("http://example.com/"+hostname+"/gsm#", True)
 	    else:
 	        log.msg('Sensor type %s is not supported.' % (sensor))
+        ## recent data of all sensors (get-range, sensors)
+        if sys.version_info >= (2, 7):
+            self.registerForRpc(self.factory.ringBufferRpc, "http://example.com/"+hostname+"/buffer#")
 
 # -------------------------------------------------------------------
 # WS-MCU factory
@@ -167,34 +292,26 @@ class WsMcuProtocol(WampServerProtocol):
 class WsMcuFactory(WampServerFactory):
 
     protocol = WsMcuProtocol
-    def __init__(self, url):
+    def __init__(self, url, protocols=True):
+        # protocols=False: sensors are read by supervised worker processes
         WampServerFactory.__init__(self, url)
-        for sensor in sensorlist:
-            if sensor[:3].upper() == 'ENV':
-                self.envProtocol = EnvProtocol(self,sensor.strip(), outputdir)
-	    if sensor[:2].upper() == 'OW':
-	        self.owProtocol = OwProtocol(self,owport,outputdir)
-            if sensor[:3].upper() == 'POS':
-                self.pos1Protocol = Pos1Protocol(self,sensor.strip(), outputdir)
-            if sensor[:3].upper() == 'KER':
-                print "Test1:", sensor.strip
-                self.kernProtocol = KernProtocol(self,sensor.strip(), outputdir)
-            if sensor[:3].upper() == 'ARD':
-                self.arduinoProtocol = ArduinoProtocol(self, sensor.strip(), outputdir)
-	    if sensor[:3].upper() == 'SER':
-                port = serialport+portdict[sensor]
-                baudrate = baudratedict[sensor]
-                self.callProtocol = CallProtocol(self,sensor.strip(), outputdir,port,baudrate)
-            if sensor[:3].upper() == 'PAL':
-                self.palmacqProtocol = PalmAcqProtocol(self, sensor.strip(), outputdir)
-            if sensor[:3].upper() == 'LEM':
-                self.lemiProtocol = LemiProtocol(self,sensor.strip(),sensor[0]+sensor[4:7], outputdir)
-	    if sensor[:3].upper() == 'G82':
-                self.csProtocol = CsProtocol(self,sensor.strip(), outputdir)
-	    if sensor[:3].upper() == 'GSM':
-       		self.gsm90Protocol = GSM90Protocol(self,sensor.strip(), outputdir)
-	    if sensor[:3].upper() == 'G19':
-       		self.gsm19Protocol = GSM19Protocol(self,sensor.strip(), outputdir)
+        self.ringBuffer = RingBufferStore(hours=bufferhours, path=os.path.join(outputdir,hostname))
+        self.sequence = {}
+        self.ringBufferRpc = RingBufferRpc(self.ringBuffer)
+        if decimation:
+            self.decimation = DecimationStore(decimation, path=os.path.join(outputdir,hostname), dispatch=self.dispatch)
+            self.ringBuffer.observers.append(self.decimation.sample)
+        if protocols:
+            CreateProtocols(self, sensorlist)
+
+    def dispatch(self, topic, event, exclude=[], eligible=None):
+        # sequence numbers of batches (collectors detect lost batches)
+        if isinstance(event, dict) and 'ids' in event:
+            self.sequence[topic] = self.sequence.get(topic, 0) + 1
+            event['seq'] = self.sequence[topic]
+        # keep all published data in the ring buffers
+        self.ringBuffer.event(topic, event)
+        return WampServerFactory.dispatch(self, topic, event, exclude, eligible)
 
 #####################################################################
 # MAIN PROGRAM
@@ -203,7 +320,22 @@ class WsMcuFactory(WampServerFactory):
 if __name__ == '__main__':
 
 
-    sensorlist, portdict, baudratedict = GetSensors()
+    sensorlist, portdict, baudratedict, policydict = GetSensors()
+
+    if '--worker' in sys.argv:
+        ## worker process of one sensor (see workersupervisor): events are
+        ## forwarded to the supervisor, which publishes them
+        sensorlist = [sys.argv[sys.argv.index('--worker')+1]]
+        logfile = os.path.join(homedir,'MARTAS','Logs','martas_'+sensorlist[0]+'.log')
+        log.startLogging(open(logfile,'a'))
+        workerFactory = ForwardingFactory()
+        CreateProtocols(workerFactory, sensorlist)
+        workerFactory.connect()
+        if not ConnectSensors(workerFactory, sensorlist):
+            # the supervisor retries later
+            sys.exit(1)
+        reactor.run()
+        sys.exit(0)
 
     ##  Start Twisted logging system
     ##
@@ -213,59 +345,21 @@ if __name__ == '__main__':
 
     ## create Serial2Ws gateway factory
     ##
-    wsMcuFactory = WsMcuFactory(wsurl)
+    wsMcuFactory = WsMcuFactory(wsurl, protocols=not supervise)
     listenWS(wsMcuFactory)
    
     ## create serial port and serial port protocol; modify this according to attached sensors
+    ## (or start one supervised worker process per sensor)
     ##
-    for sensor in sensorlist:
-	port = serialport+portdict[sensor]
-	baudrate = baudratedict[sensor]
-
-        if sensor[:3].upper() == 'LEM':
-	    protocol = wsMcuFactory.lemiProtocol
-        if sensor[:3].upper() == 'POS':
-	    protocol = wsMcuFactory.pos1Protocol
-        if sensor[:3].upper() == 'G82':
-	    protocol = wsMcuFactory.csProtocol
-        if sensor[:3].upper() == 'GSM':
-	    protocol = wsMcuFactory.gsm90Protocol
-        if sensor[:3].upper() == 'G19':
-	    protocol = wsMcuFactory.gsm19Protocol
-        if sensor[:3].upper() == 'ENV':
-	    protocol = wsMcuFactory.envProtocol
-        if sensor[:3].upper() == 'KER':
-	    protocol = wsMcuFactory.kernProtocol
-        if sensor[:3].upper() == 'ARD':
-	    protocol = wsMcuFactory.arduinoProtocol
-        if sensor[:3].upper() == 'PAL':
-            protocol = wsMcuFactory.palmacqProtocol
-
-        if sensor[:3].upper() == 'SER':
-	    try:
-	        log.msg('Serial Call: Initiating sensor and sending commands...')
-                # eventually define a command list
-                sprot = task.LoopingCall(wsMcuFactory.callProtocol.sendCommands)
-                sprot.start(timeoutser)
-            except:
-                log.msg('Serial Call: Not available.')
-        elif sensor[:2].upper() == 'OW':
-	    try:
-	        log.msg('OneWire: Initiating sensor...')
-                oprot = task.LoopingCall(wsMcuFactory.owProtocol.owConnected)
-                oprot.start(timeoutow)
-            except:
-                log.msg('OneWire: Not available.')
-        else:
-    	    try:
-        	log.msg('%s: Attempting to open port %s [%d baud]...' % (sensor, port, baudrate))
-                if sensor.startswith('KER'):
-                    serialPort = SerialPort(protocol,port,reactor, baudrate=baudrate,bytesize=SEVENBITS,parity=PARITY_EVEN)    
-                else:
-   	       	    serialPort = SerialPort(protocol, port, reactor, baudrate = baudrate)
-              	    log.msg('%s: Port %s [%d baud] connected' % (sensor, port, baudrate))
-    	    except:
-        	log.msg('%s: Port %s [%d baud] not available' % (sensor, port, baudrate))
+    if supervise:
+        if workertimeout and workertimeout <= max(timeoutow, timeoutser):
+            # slow sensors would be restarted between their readings
+            print "workertimeout needs to exceed the poll intervals - using", 2*max(timeoutow, timeoutser)
+            workertimeout = 2*max(timeoutow, timeoutser)
+        supervisor = AcquisitionSupervisor(wsMcuFactory, os.path.abspath(__file__), sensorlist, timeout=workertimeout, statsinterval=workerstatsinterval)
+        supervisor.start()
+    else:
+        ConnectSensors(wsMcuFactory, sensorlist)
 
 
     ## create embedded web server for static files
@@ -8,6 +8,10 @@ from twisted.python import usage, log
 from twisted.internet.serialport import SerialPort
 from twisted.web.server import Site
 from twisted.web.static import File
+try:
+    from filewriter import dailyfilewriter
+except ImportError:
+    from magpy.acquisition.filewriter import dailyfilewriter
 
 try: # version > 0.8.0
     from autobahn.wamp1.protocol import exportRpc
@@ -62,17 +66,8 @@ def dataToFile(outputdir, sensorid, filedate, bindata, header):
     try:
         hostname = socket.gethostname()
         path = os.path.join(outputdir,hostname,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if not os.path.isfile(savefile):
-            with open(savefile, "wb") as myfile:
-                myfile.write(header + "\n")
-                myfile.write(bindata + "\n")
-        else:
-            with open(savefile, "a") as myfile:
-                myfile.write(bindata + "\n")
+        # buffered, one handle per sensor and day (see filewriter)
+        dailyfilewriter.write(path, sensorid, filedate, bindata + "\n", header + "\n")
     except:
         log.err("Arduino - Protocol: Error while saving file")
 
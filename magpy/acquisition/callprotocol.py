@@ -1,9 +1,6 @@
 import sys, time, os, socket
-import serial
 import struct, binascii, re, csv
 from datetime import datetime, timedelta
-from matplotlib.dates import date2num, num2date
-import numpy as np
 
 # Twisted
 from twisted.protocols.basic import LineReceiver
@@ -12,18 +9,31 @@ from twisted.python import usage, log
 from twisted.internet.serialport import SerialPort
 from twisted.web.server import Site
 from twisted.web.static import File
+try:
+    from filewriter import dailyfilewriter
+except ImportError:
+    from magpy.acquisition.filewriter import dailyfilewriter
+try:
+    from pollscheduler import LatencyStats
+except ImportError:
+    from magpy.acquisition.pollscheduler import LatencyStats
 
 call = True
 if call:
-    class CallProtocol():
+    class CallProtocol(LineReceiver):
         """
         Protocol to read one wire data from usb DS unit
         All connected sensors are listed and data is distributed in dependency of sensor id
         Dipatch url links are defined by channel 'ow' and id+'value'
         Save path ? folders ?
+        Commands are sent through a twisted SerialPort and responses are
+        framed by the eol character (LineReceiver). The next command is sent
+        commanddelay seconds after the response (or after timeout seconds
+        without response), so the reactor is never blocked.
+        Latencies per command: self.latency.stats()
 
         """
-        def __init__(self, wsMcuFactory, source, outputdir,port,baudrate):
+        def __init__(self, wsMcuFactory, source, outputdir,port,baudrate,timeout=10.,commanddelay=2.):
             self.wsMcuFactory = wsMcuFactory
             self.source = source
             self.hostname = socket.gethostname()
@@ -34,25 +44,29 @@ if call:
             self.commands = ['11TR00005','12TR00002']
             #eol = '\x00'
             self.eol = '\r'
+            self.delimiter = self.eol
+            self.hexcommands = False
+            self.timeout = timeout
+            self.commanddelay = commanddelay
+            self.serialport = None
+            self.queue = []
+            self.pending = None     # [command, sendtime, timeoutcall]
+            self.serialnum = None   # serial number of the anemometer
+            self.latency = LatencyStats()
             #print source
 
-        def lineread(self, ser,eol):
-            # FUNCTION 'LINEREAD'
-            # Does the same as readline(), but does not require a standard
-            # linebreak character ('\r' in hex) to know when a line ends.
-            # Variable 'eol' determines the end-of-line char: '\x00'
-            # for the POS-1 magnetometer, '\r' for the envir. sensor.
-            # (Note: required for POS-1 because readline() cannot detect
-            # a linebreak and reads a never-ending line.)
-
-            ser_str = ''
-            while True:
-                char = ser.read()
-                #print char
-                if char == eol:
-                    break
-                ser_str += char
-            return ser_str
+        def connect(self):
+            if self.serialport is None:
+                self.serialport = SerialPort(self, self.port, reactor, baudrate=int(self.baudrate))
+
+        def connectionLost(self, reason):
+            log.msg('SerialCall: Connection lost')
+            self.serialport = None
+            self.queue = []
+            if self.pending:
+                if self.pending[2].active():
+                    self.pending[2].cancel()
+                self.pending = None
 
         def hexify_command(self, command,eol):
             # FUNCTION 'HEXIFY_COMMAND'
@@ -70,36 +84,62 @@ if call:
 
             return command_hex
 
-
-        def send_command(self, ser,command,eol,hex=False):
+        def send_command(self, command, eol, hex=False):
             if hex:
                 command = self.hexify_command(command,eol)
             else:
                 command = eol+command+eol
-            #print 'Command:  %s \n ' % command.replace(eol,'')
-            sendtime = date2num(datetime.utcnow())
-            ser.write(command)
-            response = self.lineread(ser,eol)
-            receivetime = date2num(datetime.utcnow())
-            meantime = np.mean([receivetime,sendtime])
-            #print "Timediff", (receivetime-sendtime)*3600*24
-            return response, num2date(meantime).replace(tzinfo=None)
+            self.transport.write(command)
 
         def sendCommands(self):
-            #print "Connecting ..."
+            # Starts a command cycle (called periodically by a LoopingCall)
+            if self.queue or self.pending:
+                log.msg('SerialCall: previous command cycle not yet finished - skipping')
+                self.latency.count(self.source, 'skipped')
+                return
             try:
-                ser = serial.Serial(self.port, baudrate=self.baudrate , parity='N', bytesize=8, stopbits=1)
-                #print 'Connection made.'
+                self.connect()
             except:
                 print 'SerialCall: Connection flopped.'
-
-            for item in self.commands:
-                answer, actime = self.send_command(ser,item,self.eol,hex=False)
-                success = self.analyzeResponse(answer, actime)
-                time.sleep(2)
+                return
+            self.queue = list(self.commands)
+            if not self.serialnum and [el for el in self.commands if el.startswith('12')]:
+                # serial number of the anemometer is requested until known
+                self.queue.insert(0, '12SH')
+            self.sendNext()
+
+        def sendNext(self):
+            if not self.queue or self.serialport is None:
+                return
+            command = self.queue.pop(0)
+            sendtime = datetime.utcnow()
+            self.send_command(command, self.eol, hex=self.hexcommands)
+            self.pending = [command, sendtime, reactor.callLater(self.timeout, self.commandTimeout)]
+
+        def commandTimeout(self):
+            command = self.pending[0]
+            self.pending = None
+            self.latency.count(command, 'timeouts')
+            log.msg('SerialCall: No response to %s within %.1f sec' % (command, self.timeout))
+            reactor.callLater(self.commanddelay, self.sendNext)
+
+        def lineReceived(self, line):
+            if not self.pending or not line.strip():
+                return
+            command, sendtime, timer = self.pending
+            self.pending = None
+            timer.cancel()
+            receivetime = datetime.utcnow()
+            self.latency.record(command, (receivetime-sendtime).total_seconds())
+            # time of the response: mean of send and receive time
+            actime = sendtime + (receivetime-sendtime)/2
+            if command.endswith('SH'):
+                self.serialnum = line.replace('!12SH','').strip('\x03').strip('\x02')
+            else:
+                success = self.analyzeResponse(line, actime)
                 if not success:
-                    log.msg('SerialCall: Could not interpret response of system when sending %s' % item)
-            ser.close()
+                    log.msg('SerialCall: Could not interpret response of system when sending %s' % command)
+            reactor.callLater(self.commanddelay, self.sendNext)
 
 
         def analyzeResponse(self,answer, actime):
@@ -134,16 +174,8 @@ if call:
             # File Operations
             try:
                 path = os.path.join(self.outputdir,self.hostname,sensorid)
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-                if not os.path.isfile(savefile):
-                    with open(savefile, "wb") as myfile:
-                        myfile.write(header + "\n")
-                        myfile.write(bindata + "\n")
-                else:
-                    with open(savefile, "a") as myfile:
-                        myfile.write(bindata + "\n")
+                # buffered, one handle per sensor and day (see filewriter)
+                dailyfilewriter.write(path, sensorid, filedate, bindata + "\n", header + "\n")
             except:
                 log.err("SERIAL - datatofile: Error while saving file")
 
@@ -257,16 +289,13 @@ if call:
 
         def writeAnemometer(self, line, actime):
 
-            # 1. Get serial number:
+            # 1. Get serial number (requested by sendCommands):
             sensor = 'ULTRASONICDSP'
             revision = '0001'
-            try:
-                ser = serial.Serial(self.port, baudrate=self.baudrate , parity='N', bytesize=8, stopbits=1)
-                answer, tmptime = self.send_command(ser,'12SH',self.eol,hex=False)
-                ser.close()
-                serialnum = answer.replace('!12SH','').strip('\x03').strip('\x02')
-            except:
+            serialnum = self.serialnum
+            if not serialnum:
                 print 'writeAnemometer: Failed to get Serial number.'
+                return
 
 
             sensorid = sensor + '_' + serialnum + '_' + revision
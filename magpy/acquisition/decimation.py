@@ -0,0 +1,256 @@
+'''
+Filename:               decimation
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Real-time filtered products of MARTAS nodes. Samples of each sensor
+        are filtered incrementally to one second and one minute values
+        using the gaussian filter recommended by IAGA/INTERMAGNET (window
+        width 1.86506 * period as used by DataStream.filter, values
+        centered on full seconds/minutes, at least 90 % of the samples
+        required). One minute values of high rate sensors are calculated
+        from the one second values.
+
+        Products are published as batch events (see wampbatch) on the topics
+            module#sensorid-sec-batch   and   module#sensorid-min-batch
+        and stored as MagPyBin daily files in
+            outputdir/hostname/sensorid-sec/sensorid-sec_YYYY-MM-DD.bin
+        Collectors with small bandwidth subscribe to these topics instead of
+        the raw data. Ranges are available from the ring buffer (get-range
+        with sensorid-sec).
+
+CONTAINS:
+        productid:       (Func) sensor id of a product
+        GaussianFilter:  (Class) incremental gaussian filter of one period
+        DecimationChain: (Class) filters of one sensor
+        DecimationStore: (Class) products of all sensors of a node
+'''
+
+import os
+import struct
+from collections import deque
+from datetime import timedelta
+import numpy as np
+
+from twisted.python import log
+try:
+    from wampbatch import EPOCH, packbatch
+    from filewriter import dailyfilewriter
+except ImportError:
+    from magpy.acquisition.wampbatch import EPOCH, packbatch
+    from magpy.acquisition.filewriter import dailyfilewriter
+
+# product name: period in seconds
+DECIMATIONPRODUCTS = {'sec': 1, 'min': 60}
+# window width relative to the period (DataStream.filter, IAGA 45 sec window)
+GAUSSIANFACTOR = 1.86506
+# minimal fraction of samples within the window
+MINCOVERAGE = 0.9
+# column keys of the event ids (first key of duplicates is stored in files)
+DECIMATIONKEYS = {10:'f',11:'x',12:'y',13:'z',14:'df',
+                  20:'x',21:'y',22:'z',23:'dx',24:'dy',25:'dz',
+                  30:'t1',31:'t1',32:'t2',33:'var1',34:'t2',35:'x',36:'x',37:'y',38:'var1',39:'f',
+                  40:'var1',50:'var1',51:'var2',60:'var2',61:'var3',62:'var4'}
+
+
+def productid(sensorid, product):
+    """
+    Sensor id of a product, e.g. LEMI036_1_0001-sec
+    """
+    return sensorid + '-' + product
+
+
+class GaussianFilter(object):
+    """
+    DEFINITION:
+        Incremental gaussian filter providing one value per period at
+        multiples of period. Samples (epoch ns, list of floats) are added
+        in time order. As soon as the window of an output time is complete
+        the filtered values are returned. Weights are calculated from the
+        time differences, so gaps and jitter are considered. Columns
+        with less than mincoverage of the expected samples are NaN, output
+        times without any data are skipped.
+    """
+    def __init__(self, period, factor=GAUSSIANFACTOR, mincoverage=MINCOVERAGE):
+        self.period = int(period*1e9)
+        self.half = int(factor*period*1e9/2.)
+        # standard deviation (seconds) of DataStream.filter's gaussian window
+        self.sigma = 0.83255461*factor*period/(2*np.pi)
+        self.mincoverage = mincoverage
+        self.times = deque()
+        self.values = deque()
+        self.next = None
+        self.sampling = None
+
+    def _first(self, t):
+        # first output time with a window containing t
+        return -((self.half - t)//self.period)*self.period
+
+    def add(self, t, values):
+        """
+        Adds a sample and returns a list of (time, values) of completed
+        output times.
+        """
+        if len(self.times) > 0 and t <= self.times[-1]:
+            return []
+        self.times.append(t)
+        self.values.append(values)
+        if self.next is None:
+            self.next = self._first(t)
+        results = []
+        while t >= self.next + self.half:
+            result = self._filter(self.next)
+            if result is not None:
+                results.append(result)
+            self.next += self.period
+            while len(self.times) > 0 and self.times[0] < self.next - self.half:
+                self.times.popleft()
+                self.values.popleft()
+            if len(self.times) > 0 and self.times[0] > self.next + self.half:
+                # gap: continue with the first window containing data
+                self.next = max(self.next, self._first(self.times[0]))
+        return results
+
+    def _filter(self, center):
+        times = np.array(self.times, dtype=np.int64)
+        inside = np.abs(times - center) <= self.half
+        if not inside.any():
+            return None
+        if inside.sum() > 1:
+            diffs = np.diff(times[inside])
+            self.sampling = float(np.median(diffs))/1e9
+        if not self.sampling:
+            return None
+        values = np.array(self.values, dtype=np.float64)[inside]
+        dt = (times[inside] - center)/1e9
+        weights = np.exp(-0.5*(dt/self.sigma)**2)
+        valid = ~np.isnan(values)
+        expected = 2.*self.half/1e9/self.sampling
+        colweights = (weights[:, None]*valid).sum(axis=0)
+        coverage = valid.sum(axis=0)/expected
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = (weights[:, None]*np.where(valid, values, 0.)).sum(axis=0)/colweights
+        result[coverage < self.mincoverage] = np.nan
+        if np.isnan(result).all():
+            return None
+        return center, result.tolist()
+
+
+class DecimationChain(object):
+    """
+    DEFINITION:
+        Filters of one sensor. The sampling period is estimated from the
+        first samples. Products are calculated if the sampling period
+        is at most a third of their period (one second values for 10 Hz
+        sensors, one minute values for sensors sampling at least every
+        20 sec). One minute values are calculated from the one second
+        values, if available.
+    """
+    def __init__(self, ids, products=['sec', 'min'], probe=10):
+        self.ids = list(ids)
+        self.products = products
+        self.probe = probe
+        self.pending = []
+        self.stages = None
+
+    def _setup(self):
+        times = [el[0] for el in self.pending]
+        sampling = float(np.median(np.diff(times)))/1e9
+        self.stages = []
+        for product in sorted(self.products, key=lambda el: DECIMATIONPRODUCTS[el]):
+            period = DECIMATIONPRODUCTS[product]
+            if sampling <= period/3.:
+                self.stages.append((product, GaussianFilter(period)))
+        log.msg("Decimation: sampling period %.3f sec - products %s" % (sampling, [el[0] for el in self.stages]))
+
+    def add(self, t, values):
+        """
+        Returns a list of (product, time, values).
+        """
+        if self.stages is None:
+            self.pending.append((t, values))
+            if len(self.pending) < self.probe:
+                return []
+            self._setup()
+            pending, self.pending = self.pending, []
+        else:
+            pending = [(t, values)]
+        results = []
+        for sample in pending:
+            samples = [sample]
+            for product, stage in self.stages:
+                # the output of each stage is the input of the next one
+                filtered = []
+                for el in samples:
+                    filtered.extend(stage.add(el[0], el[1]))
+                results.extend([(product, el[0], el[1]) for el in filtered])
+                samples = filtered
+        return results
+
+
+class DecimationStore(object):
+    """
+    DEFINITION:
+        Filtered products of all sensors of a node. Samples are provided by
+        the ring buffers (RingBufferStore.observers), products are published
+        by dispatch and stored in daily files below path.
+
+    APPLICATION:
+        decimation = DecimationStore(['sec','min'], path=os.path.join(outputdir,hostname), dispatch=factory.dispatch)
+        ringbuffer.observers.append(decimation.sample)
+    """
+    def __init__(self, products=['sec', 'min'], path=None, dispatch=None):
+        self.products = [el for el in products if el in DECIMATIONPRODUCTS]
+        self.path = path
+        self.dispatch = dispatch
+        self.chains = {}
+        self.headers = {}
+
+    def sample(self, topic, sensorid, ids, t, values):
+        """
+        Adds a sample (primary time t in epoch ns, values of ids) of the
+        sensor published on topic.
+        """
+        if '-' in sensorid:
+            # products are published as well
+            return
+        chain = self.chains.get(sensorid)
+        if chain is None or not chain.ids == list(ids):
+            chain = self.chains[sensorid] = DecimationChain(ids, self.products)
+        for product, ptime, pvalues in chain.add(t, values):
+            try:
+                self.publish(topic, sensorid, ids, product, ptime, pvalues)
+            except:
+                log.err("Decimation: Error while publishing %s of %s" % (product, sensorid))
+
+    def publish(self, topic, sensorid, ids, product, t, values):
+        pid = productid(sensorid, product)
+        if self.path:
+            self.store(pid, ids, t, values)
+        if self.dispatch:
+            event = packbatch([1] + list(ids), [[t]] + [[None if np.isnan(el) else el] for el in values])
+            event['period'] = DECIMATIONPRODUCTS[product]
+            self.dispatch(topic.split('#')[0] + '#' + pid + '-batch', event)
+
+    def _header(self, pid, ids):
+        # MagPyBin header of the product, values are stored as doubles
+        keys, columns = [], []
+        for i, el in enumerate(ids):
+            key = DECIMATIONKEYS.get(el)
+            if key and not key in keys:
+                keys.append(key)
+                columns.append(i)
+        packcode = '6hL' + 'd'*len(keys)
+        header = "# MagPyBin %s %s %s %s %s %s %d" % (pid, '['+','.join(keys)+']', '['+','.join(keys)+']',
+                     '['+','.join(['-']*len(keys))+']', '['+','.join(['1']*len(keys))+']', packcode, struct.calcsize('<'+packcode))
+        return header, struct.Struct('<'+packcode), columns
+
+    def store(self, pid, ids, t, values):
+        entry = self.headers.get(pid)
+        if entry is None or not entry[0] == list(ids):
+            entry = self.headers[pid] = (list(ids),) + self._header(pid, ids)
+        header, packer, columns = entry[1:]
+        dt = EPOCH + timedelta(microseconds=t//1000)
+        data = packer.pack(*([dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond] + [values[i] for i in columns]))
+        dailyfilewriter.write(os.path.join(self.path, pid), pid, dt.strftime("%Y-%m-%d"), data + b"\n", header + "\n")
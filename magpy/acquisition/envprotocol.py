@@ -9,6 +9,12 @@ from twisted.python import usage, log
 from twisted.internet.serialport import SerialPort
 from twisted.web.server import Site
 from twisted.web.static import File
+try:
+    from filewriter import dailyfilewriter
+    from publishpolicy import applypolicy
+except ImportError:
+    from magpy.acquisition.filewriter import dailyfilewriter
+    from magpy.acquisition.publishpolicy import applypolicy
 
 try: # version > 0.8.0
     from autobahn.wamp1.protocol import exportRpc
@@ -36,17 +42,8 @@ def dataToFile(outputdir, sensorid, filedate, bindata, header):
     try:
         hostname = socket.gethostname()
         path = os.path.join(outputdir,hostname,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if not os.path.isfile(savefile):
-            with open(savefile, "wb") as myfile:
-                myfile.write(header + "\n")
-                myfile.write(bindata + "\n")
-        else:
-            with open(savefile, "a") as myfile:
-                myfile.write(bindata + "\n")
+        # buffered, one handle per sensor and day (see filewriter)
+        dailyfilewriter.write(path, sensorid, filedate, bindata + "\n", header + "\n")
     except:
         log.err("OW - Protocol: Error while saving file")
 
@@ -65,11 +62,13 @@ class EnvProtocol(LineReceiver):
 
     ## need a reference to our WS-MCU gateway factory to dispatch PubSub events
     ##
-    def __init__(self, wsMcuFactory, sensor, outputdir):
+    def __init__(self, wsMcuFactory, sensor, outputdir, policy=None):
         self.wsMcuFactory = wsMcuFactory
         self.sensor = sensor
         self.hostname = socket.gethostname()
         self.outputdir = outputdir
+        # publication policy (deadband/heartbeat, see publishpolicy)
+        self.policy = policy
         print self.sensor
 
     @exportRpc("control-led")
@@ -154,6 +153,9 @@ class EnvProtocol(LineReceiver):
             data = line.split()
             if len(data) == 3:
                 evt0,evt1,evt3,evt30,evt33,evt34,evt99 = self.processEnvData(data)
+                # unchanged readings are stored but not published
+                if not applypolicy(self.policy, self.wsMcuFactory, dispatch_url, evt1['value'], [30,33,34], [evt30['value'],evt33['value'],evt34['value']]):
+                    return
             else:
                 print 'Data error'
 
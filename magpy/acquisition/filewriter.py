@@ -0,0 +1,197 @@
+"""
+Buffered daily file writer for MARTAS acquisition protocols
+
+Acquisition protocols store every sample in a daily binary file
+(outputdir/hostname/sensorid/sensorid_YYYY-MM-DD.bin). Opening, writing
+and closing the file for each sample is expensive on small nodes with SD
+cards. DailyFileWriter keeps one handle per sensor and day, collects
+records in memory and writes them when the buffer exceeds flushsize bytes
+or its oldest record is older than flushinterval seconds. Files are
+fsynced every fsyncinterval seconds and closed at the change of the day
+(rollover) or when not used for idletime seconds. If writing fails (e.g.
+full or removed storage), the records are kept (up to maxbuffer bytes)
+and written with the next flush.
+
+All protocols share the module instance dailyfilewriter:
+    from filewriter import dailyfilewriter
+    dailyfilewriter.write(path, sensorid, filedate, bindata + "\\n", header + "\\n")
+"""
+import os
+import time
+from twisted.internet import reactor, task
+from twisted.python import log
+
+
+class DailyFileWriter(object):
+    """
+    DEFINITION:
+        Buffered writer for daily data files.
+
+    PARAMETERS:
+    Kwargs:
+        - flushsize:      (int) write buffer to disk if it exceeds flushsize bytes (default 16384)
+        - flushinterval:  (float) write buffer to disk if its oldest record is
+                          older than flushinterval seconds (default 5)
+        - fsyncinterval:  (float) fsync open files every fsyncinterval seconds (default 60)
+        - idletime:       (float) close files not written for idletime seconds (default 600)
+        - maxbuffer:      (int) maximal bytes kept per file while writing fails, the
+                          oldest records are dropped beyond (default 1048576)
+
+    APPLICATION:
+        writer = DailyFileWriter(flushinterval=2)
+        writer.write(path, sensorid, filedate, data, header)
+    """
+    def __init__(self, flushsize=16384, flushinterval=5., fsyncinterval=60., idletime=600., maxbuffer=1048576):
+        self.flushsize = flushsize
+        self.maxbuffer = maxbuffer
+        self.flushinterval = flushinterval
+        self.fsyncinterval = fsyncinterval
+        self.idletime = idletime
+        self.files = {}   # (path, sensorid, extension) : file entry
+        self.timer = None
+
+    def _start(self):
+        # periodic flush for sensors with low sampling rates
+        if self.timer is None:
+            self.timer = task.LoopingCall(self.tick)
+            self.timer.start(min(1., self.flushinterval), now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _open(self, path, sensorid, filedate, header, extension):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        filename = os.path.join(path, sensorid+'_'+filedate+'.'+extension)
+        entry = {'date': filedate, 'name': filename, 'buffer': [], 'size': 0, 'header': False,
+                 'first': None, 'lastwrite': time.time(), 'lastsync': time.time(), 'dropped': 0}
+        newfile = not os.path.isfile(filename)
+        # size of completely written data (see _reopen)
+        entry['written'] = 0 if newfile else os.path.getsize(filename)
+        entry['handle'] = open(filename, 'ab')
+        if newfile and header:
+            entry['buffer'].append(header)
+            entry['size'] += len(header)
+            entry['header'] = True
+        return entry
+
+    def _reopen(self, entry):
+        # removes partially written data of a failed write and opens the
+        # file again - the records are written again with the next flush
+        try:
+            if entry['handle']:
+                entry['handle'].close()
+        except (IOError, OSError):
+            pass
+        entry['handle'] = None
+        try:
+            if os.path.isfile(entry['name']) and os.path.getsize(entry['name']) > entry['written']:
+                with open(entry['name'], 'r+b') as datafile:
+                    datafile.truncate(entry['written'])
+            entry['handle'] = open(entry['name'], 'ab')
+        except (IOError, OSError):
+            pass
+
+    def write(self, path, sensorid, filedate, data, header=None, extension='bin'):
+        """
+        DEFINITION:
+            Appends data to the daily file path/sensorid_filedate.extension.
+            Header is written in front, if the file is not yet existing.
+            Newlines are not added - the record is written as provided.
+        """
+        key = (path, sensorid, extension)
+        entry = self.files.get(key)
+        if entry is not None and not entry['date'] == filedate:
+            # rollover: close the file of the previous day
+            self._close(entry)
+            entry = None
+        if entry is None:
+            entry = self.files[key] = self._open(path, sensorid, filedate, header, extension)
+            self._start()
+        now = time.time()
+        if not entry['first']:
+            entry['first'] = now
+        entry['buffer'].append(data)
+        entry['size'] += len(data)
+        entry['lastwrite'] = now
+        if entry['size'] >= self.flushsize or now - entry['first'] >= self.flushinterval:
+            self._flush(entry)
+
+    def _flush(self, entry, fsync=False):
+        if len(entry['buffer']) > 0:
+            data = b''.join(entry['buffer'])
+            try:
+                if entry['handle'] is None:
+                    raise IOError("file could not be opened")
+                entry['handle'].write(data)
+                entry['handle'].flush()
+                entry['written'] += len(data)
+                entry['buffer'] = []
+                entry['size'] = 0
+                entry['first'] = None
+                entry['header'] = False
+            except (IOError, OSError) as e:
+                log.err("DailyFileWriter: Error while saving file %s: %s" % (entry['name'], e))
+                self._reopen(entry)
+                # keep the records for the next flush, drop the oldest
+                # ones (but not the header of a new file) beyond maxbuffer
+                first = 1 if entry['header'] else 0
+                while entry['size'] > self.maxbuffer and len(entry['buffer']) > first+1:
+                    entry['size'] -= len(entry['buffer'].pop(first))
+                    entry['dropped'] += 1
+                return
+        now = time.time()
+        if entry['handle'] is not None and (fsync or now - entry['lastsync'] >= self.fsyncinterval):
+            try:
+                os.fsync(entry['handle'].fileno())
+            except (IOError, OSError):
+                pass
+            entry['lastsync'] = now
+
+    def _close(self, entry):
+        self._flush(entry, fsync=True)
+        if len(entry['buffer']) > 0:
+            log.msg("DailyFileWriter: %d records of %s could not be saved" % (len(entry['buffer']), entry['name']))
+        if entry['dropped'] > 0:
+            log.msg("DailyFileWriter: %d records of %s were dropped" % (entry['dropped'], entry['name']))
+        try:
+            if entry['handle']:
+                entry['handle'].close()
+        except (IOError, OSError):
+            pass
+
+    def tick(self):
+        """
+        DEFINITION:
+            Flushes buffers exceeding flushinterval, fsyncs on schedule and
+            closes idle files. Called periodically by the reactor.
+        """
+        now = time.time()
+        for key in list(self.files.keys()):
+            entry = self.files[key]
+            if entry['first'] and now - entry['first'] >= self.flushinterval:
+                self._flush(entry)
+            elif now - entry['lastsync'] >= self.fsyncinterval:
+                self._flush(entry)
+            if now - entry['lastwrite'] >= self.idletime:
+                self._close(entry)
+                del self.files[key]
+
+    def flush(self):
+        """
+        DEFINITION:
+            Writes all buffers to disk and fsyncs the files.
+        """
+        for entry in self.files.values():
+            self._flush(entry, fsync=True)
+
+    def close(self):
+        """
+        DEFINITION:
+            Writes all buffers and closes all files.
+        """
+        for entry in self.files.values():
+            self._close(entry)
+        self.files = {}
+
+
+# Writer shared by all protocols of an acquisition process
+dailyfilewriter = DailyFileWriter()
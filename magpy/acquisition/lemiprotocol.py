@@ -11,7 +11,7 @@ CONTAINS:
         *LemiProtocol:  (Class - twisted.protocols.basic.LineReceiver)
                         Class for handling data acquisition of LEMI variometers.
                         Includes internal class functions: processLemiData
-        _timeToArray:   (Func) ... utility function for LemiProtocol.
+        publish:        (Func) ... publishes data as batch and/or legacy events.
         h2d:            (Func) ... utility function for LemiProtocol.
                         Convert hexadecimal to decimal.
 
@@ -27,8 +27,8 @@ CALLED BY:
 '''
 
 import sys, time, os, socket
-import sys, time, os, socket
-import struct, binascii, re, csv
+import struct, binascii, re, csv, calendar
+from collections import deque
 from datetime import datetime, timedelta
 
 # Twisted
@@ -38,6 +38,14 @@ from twisted.python import usage, log
 from twisted.internet.serialport import SerialPort
 from twisted.web.server import Site
 from twisted.web.static import File
+try:
+    from filewriter import dailyfilewriter
+except ImportError:
+    from magpy.acquisition.filewriter import dailyfilewriter
+try:
+    from wampbatch import BATCHVERSION, ns2string, hassubscribers
+except ImportError:
+    from magpy.acquisition.wampbatch import BATCHVERSION, ns2string, hassubscribers
 
 try: # version > 0.8.0
     from autobahn.wamp1.protocol import exportRpc
@@ -45,6 +53,13 @@ except:
     from autobahn.wamp import exportRpc
 
 
+## Lemi frames: tag, BCD time, temperatures, bias, 10 x (x,y,z), vdd, gpsstate
+LEMIFRAME = struct.Struct("<4cB6B8hb30f3BcB")
+LEMIFRAMESIZE = LEMIFRAME.size     # 153
+LEMITIME = struct.Struct('6hL')    # time of reception appended in raw files
+LEMISAMPLENS = 100000000           # 10 Hz
+LEMIBATCHIDS = [1,4,11,12,13,31,32,60]
+
 ## Lemi protocol
 ## -------------
 
@@ -55,13 +70,21 @@ class LemiProtocol(LineReceiver):
     def __init__(self, wsMcuFactory, sensor, soltag, outputdir):
         self.wsMcuFactory = wsMcuFactory
         self.sensor = sensor
-        self.buffer = ''
+        self.buffer = bytearray()
         self.soltag = soltag    # Start-of-line-tag
         self.hostname = socket.gethostname()
         self.outputdir = outputdir
         self.gpsstate1 = 'A'
         self.gpsstate2 = 'P'
-        self.gpsstatelst = []
+        self.gpsstatelst = deque(maxlen=10)
+        self.gpsstatecount = {}
+        packcode = "<4cb6B8hb30f3BcBcc5hL"
+        self.fileheader = "LemiBin %s %s %s %s %s %s %d\n" % (self.sensor, '[x,y,z,t1,t2]', '[X,Y,Z,T_sensor,T_elec]', '[nT,nT,nT,deg_C,deg_C]', '[0.001,0.001,0.001,100,100]', packcode, struct.calcsize(packcode))
+        # WAMP event format: 'auto' (batches, legacy events while subscribed),
+        # 'batch', 'legacy' - see wampbatch
+        self.eventformat = 'auto'
+        self.batchframes = 1    # frames (10 samples each) per batch event
+        self.batch = []
         flag = 0
 
     @exportRpc("control-led")
@@ -95,244 +118,156 @@ class LemiProtocol(LineReceiver):
         y = int(x/16)*10 + x%16
         return y
 
-    def _timeToArray(self,timestring):
+    def _gpsState(self, gpsstat):
         '''
-        Converts time string of format 2013-12-12T23:12:23.122324
-        to an array similiar to a datetime object
+        Returns the most frequent gpsstate of the last 10 frames
+        (counts are updated incrementally).
         '''
+        if len(self.gpsstatelst) == self.gpsstatelst.maxlen:
+            self.gpsstatecount[self.gpsstatelst[0]] -= 1
+        self.gpsstatelst.append(gpsstat)
+        self.gpsstatecount[gpsstat] = self.gpsstatecount.get(gpsstat, 0) + 1
+        return max(self.gpsstatecount, key=self.gpsstatecount.get)
 
-        try:
-            splittedfull = timestring.split(' ')
-            splittedday = splittedfull[0].split('-')
-            splittedsec = splittedfull[1].split('.')
-            splittedtime = splittedsec[0].split(':')
-            datearray = splittedday + splittedtime
-            datearray.append(splittedsec[1])
-            datearray = map(int,datearray)
-            return datearray
-        except:
-            log.msg('Error while extracting time array')
-            return []
-
-
-    def processLemiData(self, data):
-        """Convert raw ADC counts into SI units as per datasheets"""
-        if len(data) != 153:
-            log.err('LEMI - Protocol: Unable to parse data of length %i' % len(data))
-
+    def processLemiData(self, buf, offset=0):
+        """
+        Decodes the frame at offset of buf (153 bytes, no copy) and saves it.
+        Times are returned as integer epoch nanoseconds.
+        """
         """ TIMESHIFT between serial output (and thus NTP time) and GPS timestamp """
-        timedelay = 0.0   ## in sec, most likely in order of 0.1 sec
-
-        currenttime = datetime.utcnow()
-        date = datetime.strftime(currenttime, "%Y-%m-%d")
-        #actualtime = datetime.strftime(currenttime, "%Y-%m-%dT%H:%M:%S.%f")
-        timestamp = datetime.strftime(currenttime, "%Y-%m-%d %H:%M:%S.%f")
-        outtime = datetime.strftime(currenttime, "%H:%M:%S")
+        timedelay = 0   ## in nanosec, most likely in order of 0.1 sec
 
-        datearray = self._timeToArray(timestamp)
-        date_bin = struct.pack('6hL',datearray[0]-2000,datearray[1],datearray[2],datearray[3],datearray[4],datearray[5],datearray[6])
+        currentns = int(time.time()*1000000)*1000
+        currenttime = datetime.utcfromtimestamp(currentns//1000000000)
+        microsecond = (currentns//1000) % 1000000
+        date = "%04d-%02d-%02d" % (currenttime.year, currenttime.month, currenttime.day)
+        date_bin = LEMITIME.pack(currenttime.year-2000,currenttime.month,currenttime.day,currenttime.hour,currenttime.minute,currenttime.second,microsecond)
 
-        # define pathname for local file storage (default dir plus hostname plus sensor plus year) and create if not existing
+        # define pathname for local file storage (default dir plus hostname plus sensor plus year) - created by the file writer
         path = os.path.join(self.outputdir,self.hostname,self.sensor)
-        if not os.path.exists(path):
-            os.makedirs(path)
 
-        packcode = "<4cb6B8hb30f3BcBcc5hL"
-        header = "LemiBin %s %s %s %s %s %s %d\n" % (self.sensor, '[x,y,z,t1,t2]', '[X,Y,Z,T_sensor,T_elec]', '[nT,nT,nT,deg_C,deg_C]', '[0.001,0.001,0.001,100,100]', packcode, struct.calcsize(packcode))
-
-        # save binary raw data to file
-        lemipath = os.path.join(path,self.sensor+'_'+date+".bin")
-        if not os.path.exists(lemipath):
-            with open(lemipath, "ab") as myfile:
-                myfile.write(header)
+        # save binary raw data to file (buffered, one handle per sensor and day)
         try:
-            with open(lemipath, "ab") as myfile:
-                myfile.write(data+date_bin)
-            pass
+            dailyfilewriter.write(path, self.sensor, date, bytes(buf[offset:offset+LEMIFRAMESIZE])+date_bin, self.fileheader)
         except:
             log.err('LEMI - Protocol: Could not write data to file.')
 
-        # unpack data and extract time and first field values
-        try:
-            data_array = struct.unpack("<4cB6B8hb30f3BcB", data)
-        except:
-            log.err("LEMI - Protocol: Bit error while reading.")
-
-        try:
-            newtime = []
-            #for i in range (5,11):
-            #    newtime.append(self.correct_bin_time(data_array[i]))
-            #time = datetime(2000+newtime[0],newtime[1],newtime[2],newtime[3],newtime[4],int(newtime[5]),int(newtime[6]*1000000))
-            biasx = float(data_array[16])/400.
-            biasy = float(data_array[17])/400.
-            biasz = float(data_array[18])/400.
-            x = (data_array[20])*1000.
-            xarray = [elem * 1000. for elem in data_array[20:50:3]]
-            y = (data_array[21])*1000.
-            yarray = [elem * 1000. for elem in data_array[21:50:3]]
-            z = (data_array[22])*1000.
-            zarray = [elem * 1000. for elem in data_array[22:50:3]]
-            temp_sensor = data_array[11]/100.
-            temp_el = data_array[12]/100.
-            vdd = float(data_array[52])/10.
-            gpsstat = data_array[53]
-            gps_array = datetime(2000+self.h2d(data_array[5]),self.h2d(data_array[6]),self.h2d(data_array[7]),self.h2d(data_array[8]),self.h2d(data_array[9]),self.h2d(data_array[10]))-timedelta(microseconds=300000)
-            gps_time = datetime.strftime(gps_array, "%Y-%m-%d %H:%M:%S")
-        except:
-            log.err("LEMI - Protocol: Number conversion error.")
+        # unpack data directly from the buffer and extract time and field values
+        data_array = LEMIFRAME.unpack_from(buf, offset)
+        #biasx, biasy, biasz = data_array[16]/400., data_array[17]/400., data_array[18]/400.
+        xarray = [elem * 1000. for elem in data_array[20:50:3]]
+        yarray = [elem * 1000. for elem in data_array[21:50:3]]
+        zarray = [elem * 1000. for elem in data_array[22:50:3]]
+        temp_sensor = data_array[11]/100.
+        temp_el = data_array[12]/100.
+        vdd = float(data_array[52])/10.
+        gpsstat = data_array[53]
+        h2d = self.h2d
+        gpsns = (calendar.timegm((2000+h2d(data_array[5]),h2d(data_array[6]),h2d(data_array[7]),h2d(data_array[8]),h2d(data_array[9]),h2d(data_array[10])))*1000000000) - 300000000
 
         # get the most frequent gpsstate of the last 10 secs
         # this avoids error messages for singular one sec state changes
-        self.gpsstatelst.append(gpsstat)
-        self.gpsstatelst = self.gpsstatelst[-10:]
-        self.gpsstate1 = max(set(self.gpsstatelst),key=self.gpsstatelst.count)
+        self.gpsstate1 = self._gpsState(gpsstat)
         if not self.gpsstate1 == self.gpsstate2:
             log.msg('LEMI - Protocol: GPSSTATE changed to %s .'  % gpsstat)
         self.gpsstate2 = self.gpsstate1
 
-        #print "GPSSTAT", gpsstat
         # important !!! change outtime to lemi reading when GPS is running
-        try:
-            if self.gpsstate2 == 'P':
-                ## passive mode - no GPS connection -> use ntptime as primary with correction
-                evt1 = currenttime-timedelta(seconds=timedelay)
-                evt4 = gps_array
-            else:
-                ## active mode - GPS time is used as primary
-                evt4 = currenttime-timedelta(seconds=timedelay)
-                evt1 = gps_array
-            evt3 = {'id': 3, 'value': outtime}
-            #evt1 = {'id': 1, 'value': timestamp}
-            #evt4 = {'id': 4, 'value': gps_time}
-            evt11 = xarray
-            evt12 = yarray
-            evt13 = zarray
-            #evt11 = {'id': 11, 'value': x}
-            #evt12 = {'id': 12, 'value': y}
-            #evt13 = {'id': 13, 'value': z}
-            evt31 = {'id': 31, 'value': temp_sensor}
-            evt32 = {'id': 32, 'value': temp_el}
-            evt60 = {'id': 60, 'value': vdd}
-            evt99 = {'id': 99, 'value': 'eol'}
-        except:
-            log.err('LEMI - Protocol: Error assigning "evt" values.')
+        if self.gpsstate2 == 'P':
+            ## passive mode - no GPS connection -> use ntptime as primary with correction
+            t1, t4 = currentns-timedelay, gpsns
+        else:
+            ## active mode - GPS time is used as primary
+            t1, t4 = gpsns, currentns-timedelay
 
-        return evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99
+        return t1, t4, xarray, yarray, zarray, temp_sensor, temp_el, vdd
 
     def dataReceived(self, data):
-        #print "Lemi data here!", self.buffer
-        dispatch_url =  "http://example.com/"+self.hostname+"/lemi#"+self.sensor+"-value"
-        flag = 0
-        WSflag = 0
-        debug = False
-
         """
-        # Test range
-        self.buffer = self.buffer + data
-        if not (self.buffer).startswith(self.soltag):
-            lemisearch = (self.buffer).find(self.soltag, 6)
-            if not lemisearch == -1:
-                print "Lemiserach", lemisearch, self.buffer
-                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-        if len(self.buffer) == 153:
-            # Process data
-            print self.buffer
-            self.buffer = ''
+        Collects data in a bytearray and decodes all complete frames.
+        Frames start with soltag and have a fixed length of 153 bytes.
+        Bytes in front of a start tag are dropped (lost bits, bit errors).
+        A frame containing another start tag is incomplete (lost bytes)
+        unless it is followed by a start tag: decoding continues at the
+        inner tag. Consumed bytes are removed once per call.
         """
-
+        dispatch_url =  "http://example.com/"+self.hostname+"/lemi#"+self.sensor+"-value"
+        buf = self.buffer
+        buf.extend(data)
+        soltag = self.soltag
+        pos = 0
         try:
-            if (self.buffer).startswith(self.soltag) and len(self.buffer) == 153:
-                currdata = self.buffer
-                self.buffer = ''
-                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(currdata)
-                WSflag = 2
-
-            ### Note: this code for fixing data is more complex than the POS fix code
-            ### due to the LEMI device having a start code rather than an EOL code.
-            ### It can handle and deal with multiple errors:
-            ###  - multiple data parts arriving at once
-            ###  - databits being lost. Bad string is then deleted.
-            ###  - bad bits infiltrating the data. Bad string is deleted.
-
-            if len(self.buffer) > 153:
-                if debug:
-                    log.msg('LEMI - Protocol: Warning: Bufferlength (%s) exceeds 153 characters, fixing...' % len(self.buffer))
-                lemisearch = (self.buffer).find(self.soltag)
-                #print '1', lemisearch
-                if (self.buffer).startswith(self.soltag):
-                    datatest = len(self.buffer)%153
-                    dataparts = int(len(self.buffer)/153)
-                    if datatest == 0:
-                        if debug:
-                            log.msg('LEMI - Protocol: It appears multiple parts came in at once, # of parts:', dataparts)
-                        for i in range(dataparts):
-                            split_data_string = self.buffer[0:153]
-                            if (split_data_string).startswith(self.soltag):
-                                if debug:
-                                    log.msg('LEMI - Protocol: Processing data part # %s in string...' % (str(i+1)))
-                                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            else:
-                                flag = 1
-                                break
-                    else:
-                        for i in range(dataparts):
-                            lemisearch = (self.buffer).find(self.soltag, 6)
-                            if lemisearch >= 153:
-                                split_data_string = self.buffer[0:153]
-                                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            elif lemisearch == -1:
-                                log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                                self.buffer = ''
-                            else:
-                                log.msg('LEMI - Protocol: String contains bad data (%s bits). Deleting.' % len(self.buffer[:lemisearch]))
-                                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                                flag = 1
-                                break
-
-                else:
-                    log.msg('LEMI - Protocol: Incorrect header. Attempting to fix buffer... Bufferlength:', len(self.buffer))
-                    lemisearch = (self.buffer).find(self.soltag, 6)
-                    #lemisearch = repr(self.buffer).find(self.soltag)
-                    if lemisearch == -1:
-                        log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                        self.buffer = ''
-                    else:
-                        log.msg('LEMI - Protocol: Bad data (%s bits) deleted. New bufferlength: %s' % (lemisearch,len(self.buffer)))
-                        self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                        flag = 1
-
-            if flag == 0:
-                self.buffer = self.buffer + data
-
+            while True:
+                start = buf.find(soltag, pos)
+                if start == -1:
+                    # keep a possibly incomplete start tag
+                    pos = max(pos, len(buf)-len(soltag)+1)
+                    break
+                if start > pos:
+                    log.msg('LEMI - Protocol: Bad data (%s bytes) deleted.' % (start-pos))
+                pos = start
+                if len(buf) - pos < LEMIFRAMESIZE:
+                    break
+                nexttag = buf.find(soltag, pos+len(soltag), pos+LEMIFRAMESIZE)
+                if not nexttag == -1 and not buf[pos+LEMIFRAMESIZE:pos+LEMIFRAMESIZE+len(soltag)] == soltag:
+                    if len(buf) - pos < LEMIFRAMESIZE + len(soltag):
+                        # wait for the following tag to decide
+                        break
+                    log.msg('LEMI - Protocol: String contains bad data (%s bytes). Deleting.' % (nexttag-pos))
+                    pos = nexttag
+                    continue
+                try:
+                    frame = self.processLemiData(buf, pos)
+                except:
+                    log.err('LEMI - Protocol: Bit error while reading.')
+                    frame = None
+                pos += LEMIFRAMESIZE
+                if frame:
+                    self.publish(dispatch_url, *frame)
         except:
             log.err('LEMI - Protocol: Error while parsing data.')
+        del buf[:pos]
 
-        ## publish event to all clients subscribed to topic
-        if WSflag == 2:
-            for ind, elem in enumerate(evt11):
-                t1 = evt1+timedelta(seconds=0.1*ind)
-                t2 = evt4+timedelta(seconds=0.1*ind)
-                #print t1, t2
-                evt1a = {'id': 1, 'value': datetime.strftime(t1,"%Y-%m-%d %H:%M:%S.%f")}
-                #evt3a = {'id': 1, 'value': datetime.strftime(t1,"%H:%M:%S.%f")}
-                evt4a = {'id': 4, 'value': datetime.strftime(t2,"%Y-%m-%d %H:%M:%S.%f")}
-                evt11a = {'id': 11, 'value': evt11[ind]}
-                evt12a = {'id': 12, 'value': evt12[ind]}
-                evt13a = {'id': 13, 'value': evt13[ind]}
+    def publish(self, dispatch_url, t1, t4, x, y, z, temp_sensor, temp_el, vdd):
+        """
+        Publishes one LEMI frame (10 samples, times in epoch nanoseconds).
+        Batch events contain all samples of batchframes frames in one
+        message on topic ...-batch, legacy events are dispatched for
+        each value on ...-value.
+        """
+        samples = len(x)
+        t1 = [t1 + LEMISAMPLENS*ind for ind in range(samples)]
+        t4 = [t4 + LEMISAMPLENS*ind for ind in range(samples)]
+        if not self.eventformat == 'legacy':
+            self.batch.append([t1, t4, x, y, z, [temp_sensor]*samples, [temp_el]*samples, [vdd]*samples])
+            if len(self.batch) >= self.batchframes:
+                columns = [sum([frame[i] for frame in self.batch], []) for i in range(8)]
+                self.batch = []
                 try:
-                    self.wsMcuFactory.dispatch(dispatch_url, evt1a)
-                    #self.wsMcuFactory.dispatch(dispatch_url, evt3a)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt4a)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt11a)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt12a)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt13a)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt31)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt32)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt60)
-                    self.wsMcuFactory.dispatch(dispatch_url, evt99)
+                    self.wsMcuFactory.dispatch(dispatch_url.replace('-value','-batch'), {'v': BATCHVERSION, 'ids': LEMIBATCHIDS, 'data': columns})
                 except:
-                    log.err('LEMI - Protocol: wsMcuFactory error while dispatching data.')
+                    log.err('LEMI - Protocol: wsMcuFactory error while dispatching batch.')
+        if self.eventformat == 'batch' or (self.eventformat == 'auto' and not hassubscribers(self.wsMcuFactory, dispatch_url)):
+            return
+        evt31 = {'id': 31, 'value': temp_sensor}
+        evt32 = {'id': 32, 'value': temp_el}
+        evt60 = {'id': 60, 'value': vdd}
+        evt99 = {'id': 99, 'value': 'eol'}
+        for ind in range(samples):
+            evt1a = {'id': 1, 'value': ns2string(t1[ind], rounding=False)}
+            evt4a = {'id': 4, 'value': ns2string(t4[ind], rounding=False)}
+            evt11a = {'id': 11, 'value': x[ind]}
+            evt12a = {'id': 12, 'value': y[ind]}
+            evt13a = {'id': 13, 'value': z[ind]}
+            try:
+                self.wsMcuFactory.dispatch(dispatch_url, evt1a)
+                self.wsMcuFactory.dispatch(dispatch_url, evt4a)
+                self.wsMcuFactory.dispatch(dispatch_url, evt11a)
+                self.wsMcuFactory.dispatch(dispatch_url, evt12a)
+                self.wsMcuFactory.dispatch(dispatch_url, evt13a)
+                self.wsMcuFactory.dispatch(dispatch_url, evt31)
+                self.wsMcuFactory.dispatch(dispatch_url, evt32)
+                self.wsMcuFactory.dispatch(dispatch_url, evt60)
+                self.wsMcuFactory.dispatch(dispatch_url, evt99)
+            except:
+                log.err('LEMI - Protocol: wsMcuFactory error while dispatching data.')
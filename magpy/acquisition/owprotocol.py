@@ -13,11 +13,21 @@ from datetime import datetime, timedelta
 
 # Twisted
 from twisted.protocols.basic import LineReceiver
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.python import usage, log
 from twisted.internet.serialport import SerialPort
 from twisted.web.server import Site
 from twisted.web.static import File
+try:
+    from filewriter import dailyfilewriter
+except ImportError:
+    from magpy.acquisition.filewriter import dailyfilewriter
+try:
+    from pollscheduler import PollScheduler
+    from publishpolicy import parsepolicy, applypolicy
+except ImportError:
+    from magpy.acquisition.pollscheduler import PollScheduler
+    from magpy.acquisition.publishpolicy import parsepolicy, applypolicy
 
 if onewire:
     class OwProtocol():
@@ -26,9 +36,17 @@ if onewire:
         All connected sensors are listed and data is distributed in dependency of sensor id
         Dipatch url links are defined by channel 'ow' and id+'value'
         Save path ? folders ?
+        Bus scans and sensor reads are executed in a thread pool (see
+        pollscheduler), so that slow 1-Wire reads do not block the reactor.
+        Every sensor is polled with its own interval (intervals dictionary or
+        seventh column of owlist.csv, default interval) and timeout.
+        Latencies: self.scheduler.stats(), logged every statsinterval seconds.
+        Publication policies (deadband/heartbeat, see publishpolicy) are
+        read from the sixth column of owlist.csv or given as policies
+        dictionary (sensor id : PublishPolicy).
 
         """
-        def __init__(self, wsMcuFactory, source, outputdir):
+        def __init__(self, wsMcuFactory, source, outputdir, interval=30., timeout=10., intervals=None, maxthreads=2, policies=None, statsinterval=0.):
             self.wsMcuFactory = wsMcuFactory
             #self.sensor = 'ow'
             self.source = source
@@ -38,6 +56,13 @@ if onewire:
             # TODO: create outputdir if not existing
             self.outputdir = outputdir
             self.reconnectcount = 0
+            self.interval = interval
+            self.timeout = timeout
+            self.intervals = intervals or {}   # sensor id : poll interval in sec
+            self.policies = policies or {}     # sensor id : publication policy
+            self.scheduler = PollScheduler(maxthreads=maxthreads, name='OneWire', statsinterval=statsinterval)
+            self.scanning = False
+            self.plist = []
             #self.plist = ["A6B154010000"]
             #self.hlist = ["DACF54010000"]
 
@@ -54,27 +79,48 @@ if onewire:
             return owlist
 
         def owConnected(self):
+            # Scans the bus for (changed) sensors - in a thread of the scheduler
+            if self.scanning:
+                return
+            self.scanning = True
+            self.scheduler.start()
+            d = threads.deferToThreadPool(reactor, self.scheduler.pool, self.scanBus)
+            d.addCallbacks(self.busScanned, self.busLost)
+
+        def scanBus(self):
+            # blocking part of owConnected
             global owsensorlist
-            try:
-                self.root = ow.Sensor('/').sensorList()
-
-                if not (self.root == owsensorlist):
-                    log.msg('Rereading sensor list')
-                    ow.init(self.source)
-                    self.root = ow.Sensor('/').sensorList()
-                    owsensorlist = self.root
-                    self.connectionMade(self.root)
-                self.reconnectcount = 0
-            except:
-                self.reconnectcount = self.reconnectcount + 1
-                log.msg('Reconnection event triggered - Number: %d' % self.reconnectcount)
-                time.sleep(2)
-                if self.reconnectcount < 10:
-                    self.owConnected()
-                else:
-                    print "owConnect: reconnection not possible"
-
-            self.oneWireInstruments(self.root)
+            root = ow.Sensor('/').sensorList()
+            if not (root == owsensorlist):
+                ow.init(self.source)
+                root = ow.Sensor('/').sensorList()
+                owsensorlist = root
+                return root, True
+            return root, False
+
+        def busScanned(self, result):
+            self.scanning = False
+            self.reconnectcount = 0
+            self.root, changed = result
+            if changed:
+                log.msg('Rereading sensor list')
+                self.connectionMade(self.root)
+            self.oneWireInstruments(self.root, changed=changed)
+
+        def busLost(self, failure):
+            self.scanning = False
+            self.reconnectcount = self.reconnectcount + 1
+            log.msg('Reconnection event triggered - Number: %d' % self.reconnectcount)
+            if self.reconnectcount < 10:
+                reactor.callLater(2, self.owConnected)
+            else:
+                print "owConnect: reconnection not possible"
+
+        def sensorLost(self, failure):
+            log.msg('OW - Lost sensor (%s) -- reconnecting' % failure.getErrorMessage())
+            global owsensorlist
+            owsensorlist = []
+            self.owConnected()
 
 
         def connectionMade(self,root):
@@ -95,6 +141,19 @@ if onewire:
             self.vlist = [elem[0] for elem in owlist if elem[2] == 'voltage']
             if len(owlist) > 0:
                 idlist = [el[0] for el in owlist]
+            for elem in owlist:
+                if len(elem) > 5 and not elem[0] in self.policies:
+                    try:
+                        policy = parsepolicy(elem[5])
+                        if policy:
+                            self.policies[elem[0]] = policy
+                    except ValueError as e:
+                        log.msg('One Wire: Invalid publication policy of %s: %s' % (elem[0], e))
+                if len(elem) > 6 and elem[6].strip() and not elem[0] in self.intervals:
+                    try:
+                        self.intervals[elem[0]] = float(elem[6])
+                    except ValueError:
+                        log.msg('One Wire: Invalid poll interval of %s: %s' % (elem[0], elem[6]))
             log.msg('One Wire module initialized - found the following sensors:')
             for sensor in root:
                 log.msg('Type: %s, ID: %s' % (sensor.type, sensor.id))
@@ -118,26 +177,32 @@ if onewire:
                 pass
 
 
-        def oneWireInstruments(self,root):
-            try:
-                for sensor in root:
-                    if sensor.type == 'DS18B20':
-                        #sensor.useCache( False ) # Important for below 15 sec resolution (by default a 15 sec cache is used))
-                        self.readTemperature(sensor)
-                    #if sensor.type == 'DS2406':
-                    #    self.readSHT(sensor)
-                    elif sensor.type == 'DS2438':
-                        #sensor.useCache( False ) # Important for below 15 sec resolution (by default a 15 sec cache is used))
-                        # test for sensorids and provide sensortypus to function (e.g. humidity, pressure, none, etc)
-                        if sensor.id in self.plist:
-                            sensortypus = "pressure"
-                        else:
-                            sensortypus = "voltage"
-                        self.readBattery(sensor, sensortypus)
-            except:
-                global owsensorlist
-                owsensorlist = []
-                self.owConnected()
+        def oneWireInstruments(self, root, changed=False):
+            # (Re)schedule polls of all sensors on the bus, remove vanished ones
+            ids = []
+            for sensor in root:
+                if sensor.type == 'DS18B20':
+                    #sensor.useCache( False ) # Important for below 15 sec resolution (by default a 15 sec cache is used))
+                    read, publish, args = self.readTemperature, self.publishTemperature, (sensor,)
+                #if sensor.type == 'DS2406':
+                #    self.readSHT(sensor)
+                elif sensor.type == 'DS2438':
+                    #sensor.useCache( False ) # Important for below 15 sec resolution (by default a 15 sec cache is used))
+                    # test for sensorids and provide sensortypus to function (e.g. humidity, pressure, none, etc)
+                    if sensor.id in self.plist:
+                        sensortypus = "pressure"
+                    else:
+                        sensortypus = "voltage"
+                    read, publish, args = self.readBattery, self.publishBattery, (sensor, sensortypus)
+                else:
+                    continue
+                ids.append(sensor.id)
+                if changed or not sensor.id in self.scheduler.names():
+                    interval = float(self.intervals.get(sensor.id, self.interval))
+                    self.scheduler.add(sensor.id, read, publish, interval, timeout=self.timeout, args=args, errback=self.sensorLost)
+            for name in self.scheduler.names():
+                if not name in ids:
+                    self.scheduler.remove(name)
 
         def alias(self, sensorid):
             #define a alias dictionary
@@ -205,26 +270,19 @@ if onewire:
             # File Operations
             try:
                 path = os.path.join(self.outputdir,self.hostname,sensorid)
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-                if not os.path.isfile(savefile):
-                    with open(savefile, "wb") as myfile:
-                        myfile.write(header + "\n")
-                        myfile.write(bindata + "\n")
-                else:
-                    with open(savefile, "a") as myfile:
-                        myfile.write(bindata + "\n")
+                # buffered, one handle per sensor and day (see filewriter)
+                dailyfilewriter.write(path, sensorid, filedate, bindata + "\n", header + "\n")
             except:
                 log.err("OW - datatofile: Error while saving file")
 
         def readTemperature(self, sensor):
+            # blocking read - called by the scheduler in a thread
+            currenttime = datetime.utcnow()
+            return sensor, currenttime, float(sensor.temperature)
 
-            #t = threading.Timer(1.0, self.readTemperature, [sensor])
-            #t.deamon = True
-            #t.start()
+        def publishTemperature(self, result):
+            sensor, currenttime, temp = result
             dispatch_url =  "http://example.com/"+self.hostname+"/ow#"+sensor.id+"-value"
-            currenttime = datetime.utcnow()
             filename = datetime.strftime(currenttime, "%Y-%m-%d")
             actualtime = datetime.strftime(currenttime, "%Y-%m-%dT%H:%M:%S.%f")
             timestamp = datetime.strftime(currenttime, "%Y-%m-%d %H:%M:%S.%f")
@@ -233,10 +291,6 @@ if onewire:
             header = "# MagPyBin %s %s %s %s %s %s %d" % (sensor.id, '[t1]', '[T]', '[degC]', '[1000]', packcode, struct.calcsize(packcode))
 
             try:
-                # Extract data
-                temp = float(sensor.temperature)
-                #print "read Temperature: ", sensor.id, temp
-
                 # extract time data
                 datearray = self.timeToArray(timestamp)
                 try:
@@ -260,6 +314,10 @@ if onewire:
                 except:
                     print "OW - readTemperature: Problem assigning values to dict"
 
+                # unchanged readings are stored but not published
+                if not applypolicy(self.policies.get(sensor.id), self.wsMcuFactory, dispatch_url, currenttime, [30], [temp]):
+                    return
+
                 try:
                     self.wsMcuFactory.dispatch(dispatch_url, evt1)
                     self.wsMcuFactory.dispatch(dispatch_url, evt6)
@@ -270,15 +328,28 @@ if onewire:
                 except ValueError:
                     log.err('Unable to parse data at %s' % actualtime)
             except:
-                log.err('OW - readTemperature: Lost temperature sensor -- reconnecting')
-                global owsensorlist
-                owsensorlist = []
-                self.owConnected()
+                log.err('OW - publishTemperature: Could not process data of %s' % sensor.id)
 
 
         def readBattery(self,sensor,sensortypus):
-            dispatch_url =  "http://example.com/"+self.hostname+"/ow#"+sensor.id+"-value"
+            # blocking read - called by the scheduler in a thread
             currenttime = datetime.utcnow()
+            try:
+                humidity = float(ow.owfs_get('/uncached%s/HIH4000/humidity' % sensor._path))
+            except:
+                humidity = float('nan')
+            temp = float(sensor.temperature)
+            vdd = float(sensor.VDD)
+            vad = float(sensor.VAD)
+            vis = float(sensor.vis)
+            if sensortypus == "pressure":
+                humidity = self.mpxa4100(vad,temp)
+            return sensor, currenttime, [temp, humidity, vdd, vad, vis]
+
+        def publishBattery(self, result):
+            sensor, currenttime, values = result
+            temp, humidity, vdd, vad, vis = values
+            dispatch_url =  "http://example.com/"+self.hostname+"/ow#"+sensor.id+"-value"
             filename = datetime.strftime(currenttime, "%Y-%m-%d")
             actualtime = datetime.strftime(currenttime, "%Y-%m-%dT%H:%M:%S.%f")
             timestamp = datetime.strftime(currenttime, "%Y-%m-%d %H:%M:%S.%f")
@@ -287,27 +358,6 @@ if onewire:
             header = "# MagPyBin %s %s %s %s %s %s %d" % (sensor.id, '[t1,var1,var2,var3,var4]', '[T,rh,vdd,vad,vis]', '[deg_C,per,V,V,V]', '[1000,100,100,100,1]', packcode, struct.calcsize(packcode))
 
             try:
-                # Extract data
-                #print "Sensor: ", sensor.id, sensortypus
-                try:
-                    humidity = float(ow.owfs_get('/uncached%s/HIH4000/humidity' % sensor._path))
-                except:
-                    humidity = float(nan)
-                try:
-                    #print "Battery sens: T = ", sensor.temperature
-                    temp = float(sensor.temperature)
-                    #print "Battery sens: VDD = ", sensor.VDD
-                    vdd = float(sensor.VDD)
-                    #print "Battery sens: VAD = ", sensor.VAD
-                    vad = float(sensor.VAD)
-                    #print "Battery sens: vis = ", sensor.vis
-                    vis = float(sensor.vis)
-                    if sensortypus == "pressure":
-                        #print "Pressure [hPa]: ", self.mpxa4100(vad,temp)
-                        humidity = self.mpxa4100(vad,temp)
-                except:
-                    log.err("OW - readBattery: Could not asign value")
-
                 # Appending data to buffer which contains pcdate, pctime and sensordata
                 # extract time data
                 datearray = self.timeToArray(timestamp)
@@ -343,6 +393,10 @@ if onewire:
                 except:
                     print "OW - readBattery: Problem assigning values to dict"
 
+                # unchanged readings are stored but not published
+                if not applypolicy(self.policies.get(sensor.id), self.wsMcuFactory, dispatch_url, currenttime, [30,33,60,61,62], [temp,evt3['value'],vdd,vad,vis]):
+                    return
+
                 try:
                     self.wsMcuFactory.dispatch(dispatch_url, evt1)
                     self.wsMcuFactory.dispatch(dispatch_url, evt9)
@@ -356,7 +410,4 @@ if onewire:
                 except:
                     log.err('OW - readBattery: Unable to parse data at %s' % actualtime)
             except:
-                log.err('OW - readBattery: Lost battery sensor -- reconnecting')
-                global owsensorlist
-                owsensorlist = []
-                self.owConnected()
+                log.err('OW - publishBattery: Could not process data of %s' % sensor.id)
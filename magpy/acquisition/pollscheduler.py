@@ -0,0 +1,175 @@
+'''
+Filename:               pollscheduler
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Non-blocking polling of instruments which need to be asked for data
+        (1-Wire sensors, serial devices answering commands). Blocking reads
+        are executed in a bounded thread pool, results are processed within
+        the reactor thread (file output and WAMP dispatch are not thread safe).
+        Each sensor has its own poll interval and timeout, latencies are
+        recorded per sensor (stats(), logged every statsinterval seconds).
+
+CONTAINS:
+        LatencyStats:   (Class) per sensor poll/latency statistics
+        PollScheduler:  (Class) schedules polls of many sensors
+
+DEPENDENCIES:
+        twisted
+'''
+
+import time
+from twisted.internet import reactor, task, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+
+class LatencyStats(object):
+    """
+    Records latencies, timeouts and errors for each sensor.
+    stats() returns a dictionary with sensor names as keys.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def _entry(self, name):
+        return self.data.setdefault(name, {'polls': 0, 'timeouts': 0, 'errors': 0, 'skipped': 0,
+                                           'last': 0., 'mean': 0., 'max': 0.})
+
+    def record(self, name, latency):
+        entry = self._entry(name)
+        entry['polls'] += 1
+        entry['last'] = latency
+        entry['mean'] += (latency - entry['mean'])/entry['polls']
+        entry['max'] = max(entry['max'], latency)
+
+    def count(self, name, kind):
+        self._entry(name)[kind] += 1
+
+    def stats(self):
+        return dict([(name, dict(entry)) for name, entry in self.data.items()])
+
+
+class PollScheduler(object):
+    """
+    DEFINITION:
+        Polls sensors with individual intervals. The blocking function
+        (read) is called in a thread pool of maxthreads threads, its result
+        is passed to callback within the reactor thread. A poll is skipped,
+        if the previous poll of the same sensor is not yet finished. Polls
+        not finished within timeout seconds are counted as timeouts and
+        their (late) results are discarded. Following polls of this sensor
+        are skipped until the hanging read returns.
+
+    APPLICATION:
+        scheduler = PollScheduler(maxthreads=4, statsinterval=3600.)
+        scheduler.add('OW_1234', read, callback, interval=10., timeout=5., args=(sensor,))
+        scheduler.stats()
+    """
+    def __init__(self, maxthreads=4, name='PollScheduler', statsinterval=0.):
+        self.name = name
+        self.statsinterval = statsinterval
+        self.statsloop = None
+        self.pool = ThreadPool(minthreads=1, maxthreads=maxthreads, name=name)
+        self.pollers = {}
+        self.running = {}
+        self.latency = LatencyStats()
+        self.started = False
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.pool.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+            if self.statsinterval:
+                self.statsloop = task.LoopingCall(self.logstats)
+                self.statsloop.start(self.statsinterval, now=False)
+
+    def add(self, name, read, callback, interval, timeout=None, args=(), errback=None):
+        """
+        Adds (or replaces) the poller of sensor name.
+        """
+        self.remove(name)
+        self.start()
+        if not timeout:
+            timeout = interval
+        loop = task.LoopingCall(self.poll, name, read, callback, timeout, args, errback)
+        self.pollers[name] = loop
+        loop.start(interval, now=True)
+
+    def remove(self, name):
+        loop = self.pollers.pop(name, None)
+        if loop and loop.running:
+            loop.stop()
+
+    def names(self):
+        return list(self.pollers.keys())
+
+    def poll(self, name, read, callback, timeout, args=(), errback=None):
+        if self.running.get(name):
+            self.latency.count(name, 'skipped')
+            return
+        self.running[name] = True
+        start = time.time()
+        state = {'timedout': False}
+
+        def ontimeout():
+            # the thread is still busy - following polls are skipped until it returns
+            state['timedout'] = True
+            self.latency.count(name, 'timeouts')
+            log.msg('PollScheduler: %s did not respond within %.1f sec' % (name, timeout))
+
+        timer = reactor.callLater(timeout, ontimeout)
+
+        def finished(result):
+            self.running[name] = False
+            if state['timedout']:
+                return
+            timer.cancel()
+            self.latency.record(name, time.time() - start)
+            try:
+                callback(result)
+            except:
+                log.err('PollScheduler: Error while processing data of %s' % name)
+
+        def failed(failure):
+            self.running[name] = False
+            if state['timedout']:
+                return
+            timer.cancel()
+            self.latency.count(name, 'errors')
+            if errback:
+                try:
+                    errback(failure)
+                except:
+                    log.err('PollScheduler: Error while handling failed poll of %s' % name)
+            else:
+                log.msg('PollScheduler: poll of %s failed: %s' % (name, failure.getErrorMessage()))
+
+        d = threads.deferToThreadPool(reactor, self.pool, read, *args)
+        d.addCallbacks(finished, failed)
+        # the deferred is not returned: the LoopingCall would wait for the
+        # read and a hanging read would stop the schedule of the sensor
+
+    def stats(self):
+        """
+        Returns per sensor statistics: amount of polls, timeouts, errors,
+        skipped polls and last, mean and maximal latency in seconds.
+        """
+        return self.latency.stats()
+
+    def logstats(self):
+        for name, entry in sorted(self.stats().items()):
+            log.msg('%s: %s - polls %d, timeouts %d, errors %d, skipped %d, latency mean %.3f max %.3f sec'
+                    % (self.name, name, entry['polls'], entry['timeouts'], entry['errors'], entry['skipped'], entry['mean'], entry['max']))
+
+    def stop(self):
+        if self.statsloop and self.statsloop.running:
+            self.statsloop.stop()
+        self.statsloop = None
+        for name in self.names():
+            self.remove(name)
+        if self.started:
+            self.pool.stop()
+            self.started = False
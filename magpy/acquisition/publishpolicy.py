@@ -0,0 +1,201 @@
+'''
+Filename:               publishpolicy
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Change based publishing of slow sensors (OW, ENV, Kern). Readings
+        are published only if one of the values changed by more than the
+        deadband since the last published reading, or if heartbeat seconds
+        passed since then (so collectors can distinguish constant values
+        from lost data). Optionally min, max and mean of all readings
+        (published or not) are published for each heartbeat interval as
+        batch event (see wampbatch) on the topic
+            module#sensorid-summary-batch
+        with the interval start as time, the means as data and the keys
+        'min', 'max' (lists in the order of the value ids), 'count' and
+        'period' (seconds).
+        Daily files still contain all readings. Collectors can expand the
+        published readings to a fixed resolution (sample and hold, see
+        'expand' of the collectors).
+
+        Configuration: optional fourth column of sensors.txt or sixth
+        column of owlist.csv, items separated by ';', deadbands of several
+        values by ':' (order of the published values):
+            ENV05_1_0001  USB0  9600  deadband=0.05:0.5:0.05;heartbeat=300;summary
+            "A6B154010000","DS18B20","typus","location","info","deadband=0.1;heartbeat=600"
+
+CONTAINS:
+        parsepolicy:    (Func) policy of a configuration string
+        applypolicy:    (Func) check a reading and publish summaries
+        summaryevent:   (Func) batch event of a summary
+        PublishPolicy:  (Class) deadband, heartbeat and summaries of one sensor
+'''
+
+import calendar
+import warnings
+from datetime import datetime
+import numpy as np
+
+from twisted.python import log
+try:
+    from wampbatch import packbatch
+except ImportError:
+    from magpy.acquisition.wampbatch import packbatch
+
+# defaults of configured policies
+POLICYDEADBAND = 0.
+POLICYHEARTBEAT = 600.
+
+
+def parsepolicy(text):
+    """
+    DEFINITION:
+        Returns the PublishPolicy of a configuration string (see above) or
+        None for empty strings.
+    """
+    if not text or not text.strip():
+        return None
+    kwargs = {}
+    for item in text.strip().strip('"').split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        key, sep, value = item.partition('=')
+        key = key.strip().lower()
+        if key == 'deadband':
+            deadband = [float(el) for el in value.split(':')]
+            kwargs['deadband'] = deadband[0] if len(deadband) == 1 else deadband
+        elif key == 'heartbeat':
+            kwargs['heartbeat'] = float(value)
+        elif key == 'summary':
+            kwargs['summary'] = not value.strip().lower() in ['0', 'false', 'no']
+        else:
+            raise ValueError("unknown publication policy item: %s" % item)
+    return PublishPolicy(**kwargs)
+
+
+def applypolicy(policy, factory, topic, t, ids, values):
+    """
+    DEFINITION:
+        Checks a reading (time t, values of ids) of a sensor publishing on
+        topic (module#sensorid-value) and dispatches a completed summary.
+        Suppressed readings are reported to factories providing alive().
+        Returns True if the reading is to be published (always without
+        policy).
+    """
+    if policy is None:
+        return True
+    publish, summary = policy.check(t, values)
+    if summary:
+        try:
+            factory.dispatch(topic.rsplit('-', 1)[0] + '-summary-batch', summaryevent(ids, summary))
+        except:
+            log.err("PublishPolicy: Could not publish summary on %s" % topic)
+    if not publish and hasattr(factory, 'alive'):
+        # supervised workers report suppressed readings (see workersupervisor)
+        factory.alive()
+    return publish
+
+
+def summaryevent(ids, summary):
+    """
+    Batch event of a summary as returned by PublishPolicy.check.
+    """
+    def valid(values):
+        return [None if np.isnan(el) else el for el in values]
+    event = packbatch([1] + list(ids), [[summary['start']]] + [[el] for el in valid(summary['mean'])])
+    event['min'] = valid(summary['min'])
+    event['max'] = valid(summary['max'])
+    event['count'] = summary['count']
+    event['period'] = summary['period']
+    return event
+
+
+def _seconds(t):
+    # epoch seconds of a datetime or of a published time string
+    if not isinstance(t, datetime):
+        t = datetime.strptime(t, "%Y-%m-%d %H:%M:%S.%f")
+    return calendar.timegm(t.utctimetuple()) + t.microsecond/1e6
+
+
+class PublishPolicy(object):
+    """
+    DEFINITION:
+        Publication policy of one sensor.
+
+    PARAMETERS:
+    Kwargs:
+        - deadband:     (float or list) minimal change of the values (one for
+                        all or one per value) to publish a reading
+        - heartbeat:    (float) maximal time in seconds between published
+                        readings, length of the summary intervals
+        - summary:      (bool) calculate min, max and mean of each interval
+
+    APPLICATION:
+        policy = PublishPolicy(deadband=0.05, heartbeat=300, summary=True)
+        publish, summary = policy.check(currenttime, [temp, rh])
+    """
+    def __init__(self, deadband=POLICYDEADBAND, heartbeat=POLICYHEARTBEAT, summary=False):
+        self.deadband = deadband
+        self.heartbeat = float(heartbeat)
+        self.summary = summary
+        self.last = None        # (time, values) of the last published reading
+        self.interval = None    # start of the current summary interval
+        self.values = []        # readings of the current summary interval
+        self.published = 0
+        self.suppressed = 0
+
+    def _changed(self, values):
+        lastvalues = self.last[1]
+        if not len(values) == len(lastvalues):
+            return True
+        deadband = self.deadband
+        if not isinstance(deadband, (list, tuple)):
+            deadband = [deadband]*len(values)
+        for value, lastvalue, band in zip(values, lastvalues, deadband):
+            if np.isnan(value) or np.isnan(lastvalue):
+                if not (np.isnan(value) and np.isnan(lastvalue)):
+                    return True
+            elif abs(value - lastvalue) > band:
+                return True
+        return False
+
+    def check(self, t, values):
+        """
+        DEFINITION:
+            Checks a reading: t as datetime or time string ("%Y-%m-%d
+            %H:%M:%S.%f"), values as list of floats.
+
+        RETURNS:
+            - publish:      (bool) the reading is to be published
+            - summary:      (dict) None or the completed interval preceding
+                            t: start (datetime), period, count, min, max
+                            and mean (lists)
+        """
+        seconds = _seconds(t)
+        values = [float(el) for el in values]
+        summary = None
+        if self.summary:
+            start = seconds - seconds % self.heartbeat
+            if self.interval is not None and not start == self.interval and len(self.values) > 0:
+                data = np.array(self.values, dtype=np.float64)
+                with warnings.catch_warnings():
+                    # columns without valid values are NaN
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    summary = {'start': datetime.utcfromtimestamp(self.interval), 'period': self.heartbeat,
+                               'count': len(self.values), 'min': np.nanmin(data, axis=0).tolist(),
+                               'max': np.nanmax(data, axis=0).tolist(), 'mean': np.nanmean(data, axis=0).tolist()}
+                self.values = []
+            if not start == self.interval:
+                self.interval = start
+                self.values = []
+            if len(self.values) > 0 and not len(self.values[-1]) == len(values):
+                self.values = []
+            self.values.append(values)
+        if self.last is None or seconds < self.last[0] or seconds - self.last[0] >= self.heartbeat or self._changed(values):
+            self.last = (seconds, values)
+            self.published += 1
+            return True, summary
+        self.suppressed += 1
+        return False, summary
@@ -0,0 +1,328 @@
+'''
+Filename:               replay
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Offline replay harness and throughput benchmark for the serial
+        acquisition protocols (LEMI, POS1, GSM90, CS, ENV). Recorded or
+        synthetic serial byte streams are fed into the protocol classes
+        through twisted's StringTransport and a fake wsMcuFactory, without
+        hardware, serial ports or a running reactor.
+        The streams can be impaired by fragmentation, bursts (many records
+        within one read), bit errors and junk bytes. For each protocol and
+        scenario throughput, parse latency (per dataReceived call) and
+        recovery (records lost in addition to the corrupted ones) are
+        reported. Synthetic streams use a fixed seed, so runs are repeatable.
+
+        Run the benchmark suite:
+            python replay.py [records]
+        Replay a recorded serial stream (e.g. cat /dev/ttyUSB0 > lemi.raw):
+            python replay.py lemi lemi.raw
+
+CONTAINS:
+        ReplayFactory:  (Class) fake wsMcuFactory counting published data
+        lemiframes, pos1records, gsm90lines, cslines, envlines:
+                        (Func) synthetic records of the instruments
+        impair:         (Func) apply a scenario to a list of records
+        replay:         (Func) feed chunks into a protocol
+        runbenchmark:   (Func) run protocols and scenarios, returns results
+        report:         (Func) format results as a table
+
+DEPENDENCIES:
+        twisted
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import struct
+import tempfile
+import importlib
+from datetime import datetime, timedelta
+from twisted.test.proto_helpers import StringTransport
+try:
+    from filewriter import dailyfilewriter
+except ImportError:
+    from magpy.acquisition.filewriter import dailyfilewriter
+
+# Impairments of the benchmark suite:
+#   chunk: random read sizes (min, max) of the byte stream
+#   burst: records delivered within one read
+#   ber:   bit error rate (per bit)
+#   junk:  probability of random bytes between two records
+REPLAYSCENARIOS = [
+    {'name': 'clean'},
+    {'name': 'fragmented', 'chunk': (1, 64)},
+    {'name': 'burst', 'burst': 50},
+    {'name': 'biterrors', 'ber': 1e-4},
+    {'name': 'junk', 'junk': 0.01},
+    {'name': 'combined', 'chunk': (1, 256), 'ber': 1e-5, 'junk': 0.005},
+]
+
+
+class ReplayFactory(object):
+    """
+    DEFINITION:
+        Replaces the WAMP server factory of acquisition.py. Counts
+        dispatched events and published samples (end-of-line events of
+        legacy topics, samples of batch events).
+        With subscribed=False, protocols supporting batches publish
+        batch events only (see wampbatch.hassubscribers).
+    """
+    def __init__(self, subscribed=False):
+        self.subscriptions = None if subscribed else {}
+        self.reset()
+
+    def reset(self):
+        self.events = 0
+        self.samples = 0
+
+    def dispatch(self, topic, event, exclude=[], eligible=None):
+        self.events += 1
+        if isinstance(event, dict):
+            if 'ids' in event:
+                self.samples += len(event['data'][0])
+            elif event.get('id') == 99:
+                self.samples += 1
+
+
+# -------------------------------------------------------------------
+# Synthetic records
+# -------------------------------------------------------------------
+
+def _bcd(value):
+    return (value // 10)*16 + value % 10
+
+
+def lemiframes(amount, soltag='L036', start=None):
+    """
+    LEMI025/036 binary frames of 153 bytes (10 samples each).
+    """
+    start = start or datetime(2016, 1, 1)
+    records = []
+    for i in range(amount):
+        t = start + timedelta(seconds=i)
+        values = []
+        for j in range(10):
+            values.extend([21.5+0.001*j, 1.2+0.001*j, 43.7-0.001*j])
+        records.append(struct.pack("<4cB6B8hb30f3BcB",
+                            *([soltag[k:k+1] for k in range(4)] + [0]
+                              + [_bcd(el) for el in [t.year-2000, t.month, t.day, t.hour, t.minute, t.second]]
+                              + [2150, 2230, 0, 0, 0, 100, 200, 300] + [0]
+                              + values + [0, 0, 120] + ['A', 0])))
+    return records
+
+
+def pos1records(amount, start=None):
+    """
+    POS1 records of 44 bytes terminated by a null byte.
+    """
+    start = start or datetime(2016, 1, 1)
+    records = []
+    for i in range(amount):
+        t = start + timedelta(seconds=i)
+        line = "%08d +- %03d [%02d] %s %s" % (48464530+i % 100, 12, 0, t.strftime("%m-%d-%y"), t.strftime("%H:%M:%S.00"))
+        records.append(line[:43].ljust(43) + '\x00')
+    return records
+
+
+def gsm90lines(amount, start=None):
+    start = start or datetime(2016, 1, 1)
+    return ["%s %s %9.2f 99\r\n" % ((start + timedelta(seconds=i)).strftime("%m-%d-%Y"), (start + timedelta(seconds=i)).strftime("%H%M%S"), 48464.53+0.01*(i % 100)) for i in range(amount)]
+
+
+def cslines(amount, start=None):
+    return ["$%9.3f\r\n" % (48464.530+0.001*(i % 1000)) for i in range(amount)]
+
+
+def envlines(amount, start=None):
+    return ["+%05.2fC %05.2f%% +%05.2fC\r\n" % (20.+0.01*(i % 100), 45.1, 8.2) for i in range(amount)]
+
+
+def _module(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return importlib.import_module('magpy.acquisition.' + name)
+
+
+# name: (module, class, sensor id, record generator, samples per record)
+REPLAYPROTOCOLS = {
+    'lemi':  ('lemiprotocol', 'LemiProtocol', 'LEMI036_1_0001', lemiframes, 10),
+    'pos1':  ('pos1protocol', 'Pos1Protocol', 'POS1_N432_0001', pos1records, 1),
+    'gsm90': ('gsm90protocol', 'GSM90Protocol', 'GSM90_6107631_0001', gsm90lines, 1),
+    'cs':    ('csprotocol', 'CsProtocol', 'G823A_1234_0001', cslines, 1),
+    'env':   ('envprotocol', 'EnvProtocol', 'ENV05_1_0001', envlines, 1),
+}
+
+
+def createprotocol(name, factory, outputdir):
+    module, cls, sensor, generator, samples = REPLAYPROTOCOLS[name]
+    protocolclass = getattr(_module(module), cls)
+    if name == 'lemi':
+        return protocolclass(factory, sensor, sensor[0]+sensor[4:7], outputdir)
+    return protocolclass(factory, sensor, outputdir)
+
+
+# -------------------------------------------------------------------
+# Impairments and replay
+# -------------------------------------------------------------------
+
+def impair(records, scenario, rng):
+    """
+    DEFINITION:
+        Applies the impairments of scenario to the records.
+
+    RETURNS:
+        - chunks:       (list) byte strings, one per dataReceived call
+        - corrupted:    (int) amount of records with bit errors
+    """
+    ber = scenario.get('ber', 0.)
+    junk = scenario.get('junk', 0.)
+    corrupted = 0
+    data = []
+    for record in records:
+        if ber:
+            flips = [rng.randrange(len(record)*8) for k in range(_poisson(rng, len(record)*8*ber))]
+            if flips:
+                corrupted += 1
+                record = bytearray(record)
+                for pos in flips:
+                    record[pos//8] ^= 1 << (pos % 8)
+                record = bytes(record)
+        data.append(record)
+        if junk and rng.random() < junk:
+            data.append(bytes(bytearray([rng.randrange(256) for k in range(rng.randint(1, 20))])))
+    if scenario.get('chunk'):
+        stream = b''.join(data)
+        chunks, pos = [], 0
+        low, high = scenario['chunk']
+        while pos < len(stream):
+            size = rng.randint(low, high)
+            chunks.append(stream[pos:pos+size])
+            pos += size
+        return chunks, corrupted
+    if scenario.get('burst'):
+        size = scenario['burst']
+        return [b''.join(data[i:i+size]) for i in range(0, len(data), size)], corrupted
+    return data, corrupted
+
+
+def _poisson(rng, mean):
+    # amount of bit errors of a record
+    amount, limit, product = 0, pow(2.718281828459045, -mean), rng.random()
+    while product > limit:
+        amount += 1
+        product *= rng.random()
+    return amount
+
+
+def replay(protocol, chunks):
+    """
+    DEFINITION:
+        Feeds chunks into protocol.dataReceived (connected to a
+        StringTransport). An empty read at the end lets protocols process
+        data remaining in their buffers.
+
+    RETURNS:
+        - latencies:    (list) duration of each dataReceived call in seconds
+        - exceptions:   (int) calls raising an exception (a serial
+                        connection would be dropped by twisted)
+    """
+    protocol.makeConnection(StringTransport())
+    latencies = []
+    exceptions = 0
+    for chunk in chunks + [b'']:
+        start = time.time()
+        try:
+            protocol.dataReceived(chunk)
+        except Exception:
+            exceptions += 1
+        latencies.append(time.time() - start)
+    return latencies, exceptions
+
+
+def runbenchmark(protocols=None, scenarios=None, records=2000, seed=1, recorded=None):
+    """
+    DEFINITION:
+        Replays synthetic (or recorded) streams of each protocol for each
+        scenario.
+
+    PARAMETERS:
+    Kwargs:
+        - protocols:    (list) names of REPLAYPROTOCOLS (default all)
+        - scenarios:    (list) scenario dictionaries (default REPLAYSCENARIOS)
+        - records:      (int) amount of synthetic records per run
+        - seed:         (int) seed of the impairments
+        - recorded:     (string) raw stream to replay instead of synthetic
+                        records (one protocol only, read in 64 byte blocks,
+                        impairments are applied to these blocks). The
+                        records published in the first scenario (clean)
+                        are the reference for the following ones.
+
+    RETURNS:
+        - results:      (list) one dictionary per protocol and scenario with
+                        records, corrupted, published, lost, collateral
+                        (lost records without errors), exceptions (raised
+                        by dataReceived), rate (records/s),
+                        samplerate (samples/s) and latency mean/p95/max (ms)
+    """
+    protocols = protocols or sorted(REPLAYPROTOCOLS.keys())
+    scenarios = scenarios or REPLAYSCENARIOS
+    outputdir = tempfile.mkdtemp(prefix='replay')
+    results = []
+    try:
+        for name in protocols:
+            samples = REPLAYPROTOCOLS[name][4]
+            if recorded:
+                with open(recorded, 'rb') as fh:
+                    content = fh.read()
+                source = [content[i:i+64] for i in range(0, len(content), 64)]
+            else:
+                source = REPLAYPROTOCOLS[name][3](records)
+            reference = None if recorded else len(source)
+            for scenario in scenarios:
+                rng = random.Random(seed)
+                factory = ReplayFactory()
+                protocol = createprotocol(name, factory, outputdir)
+                chunks, corrupted = impair(source, scenario, rng)
+                start = time.time()
+                latencies, exceptions = replay(protocol, chunks)
+                duration = max(time.time() - start, 1e-9)
+                published = factory.samples // samples
+                if reference is None:
+                    reference = published
+                latencies.sort()
+                results.append({'protocol': name, 'scenario': scenario['name'], 'records': reference,
+                                'corrupted': corrupted, 'published': published,
+                                'lost': max(reference - published, 0),
+                                'collateral': max(reference - corrupted - published, 0),
+                                'exceptions': exceptions,
+                                'rate': published/duration, 'samplerate': factory.samples/duration,
+                                'mean': 1000.*sum(latencies)/len(latencies),
+                                'p95': 1000.*latencies[int(0.95*(len(latencies)-1))],
+                                'max': 1000.*latencies[-1]})
+    finally:
+        dailyfilewriter.close()
+        shutil.rmtree(outputdir, ignore_errors=True)
+    return results
+
+
+def report(results):
+    """
+    Returns the results as a text table.
+    """
+    lines = ["%-6s %-11s %7s %7s %7s %7s %7s %6s %10s %10s %8s %8s %8s" % ('proto', 'scenario', 'records', 'corrupt', 'publ', 'lost', 'collat', 'exc', 'rec/s', 'samples/s', 'mean ms', 'p95 ms', 'max ms')]
+    for res in results:
+        lines.append("%-6s %-11s %7d %7d %7d %7d %7d %6d %10.1f %10.1f %8.3f %8.3f %8.3f" % (res['protocol'], res['scenario'], res['records'], res['corrupted'], res['published'], res['lost'], res['collateral'], res['exceptions'], res['rate'], res['samplerate'], res['mean'], res['p95'], res['max']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        print(report(runbenchmark(protocols=[sys.argv[1]], recorded=sys.argv[2])))
+    else:
+        print(report(runbenchmark(records=int(sys.argv[1]) if len(sys.argv) > 1 else 2000)))
@@ -0,0 +1,326 @@
+'''
+Filename:               ringbuffer
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Keeps the recent samples of each sensor of a MARTAS node in memory
+        (numpy ring buffers covering the last N hours). The buffers are
+        filled from the published WAMP events (see WsMcuFactory.dispatch in
+        acquisition.py) and provided to collectors by WAMP RPC, so that
+        collectors can bootstrap new sensors or fill gaps without copying
+        and reading daily files.
+
+        RPC (registered under http://example.com/<hostname>/buffer#):
+            sensors                   -> {sensorid: [first, last, amount]}
+            get-range(sensorid, start, end, limit, encoding)
+                                      -> batch event (see wampbatch) with
+                                         samples start <= time <= end
+        start and end are epoch nanoseconds (or time strings). Ranges
+        starting before the ring buffer are read from the daily MagPyBin
+        files of the node (if path is given). encoding='b64' returns
+        base64 encoded columns.
+
+CONTAINS:
+        readbinfile:      (Func) read a range of a MagPyBin daily file
+        SensorRingBuffer: (Class) ring buffer of one sensor
+        RingBufferStore:  (Class) buffers of all sensors, collects events
+        RingBufferRpc:    (Class) WAMP RPC methods
+'''
+
+import os
+import re
+import struct
+import numpy as np
+from datetime import datetime, timedelta
+
+try: # version > 0.8.0
+    from autobahn.wamp1.protocol import exportRpc
+except:
+    from autobahn.wamp import exportRpc
+try:
+    from wampbatch import BATCHTIMEIDS, BATCHVERSION, datetime2ns, encodebatch
+except ImportError:
+    from magpy.acquisition.wampbatch import BATCHTIMEIDS, BATCHVERSION, datetime2ns, encodebatch
+
+# ids of events which are not buffered (hostname, date/time strings, eol)
+RINGBUFFERSKIPIDS = [0, 2, 3, 99]
+
+# '# MagPyBin sensorid [keys] [names] [units] [multipliers] packcode size'
+MAGPYBINHEADER = re.compile(r'#\s*MagPyBin\s+(\S+)\s+\[(.*?)\]\s+\[(.*?)\]\s+\[(.*?)\]\s+\[(.*?)\]\s+(\S+)\s+(\d+)')
+
+
+def _timens(value):
+    # epoch nanoseconds of an event time (string, datetime or number)
+    if isinstance(value, datetime):
+        return datetime2ns(value)
+    if isinstance(value, (int, float, np.integer)):
+        return int(value)
+    value = str(value).replace('T', ' ')
+    for fmt in ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            return datetime2ns(datetime.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError("unknown time format: %s" % value)
+
+
+def readbinfile(filename, start=None, end=None):
+    """
+    DEFINITION:
+        Reads the samples start <= time <= end (epoch ns) of a MagPyBin
+        file as written by the protocols (packing as used by readPYBIN).
+        Returns column keys (time first) and columns (times as epoch ns,
+        values divided by the multipliers) or None for other formats.
+    """
+    with open(filename, 'rb') as fh:
+        match = MAGPYBINHEADER.match(fh.readline().decode('ascii', 'replace').strip())
+        if not match:
+            return None
+        content = fh.read()
+    keys = [el.strip() for el in match.group(2).split(',')]
+    multipliers = [float(el) for el in match.group(5).split(',')]
+    packer = struct.Struct('<' + match.group(6))
+    length = max(packer.size, int(match.group(7)) + 1)
+
+    def bintime(data):
+        return datetime2ns(datetime(*data))
+
+    columns = [[] for key in ['time'] + keys]
+    for pos in range(0, len(content) - length + 1, length):
+        data = packer.unpack_from(content, pos)
+        t = bintime(data[:7])
+        if (start is not None and t < start) or (end is not None and t > end):
+            continue
+        columns[0].append(t)
+        idx = 7
+        for i, key in enumerate(keys):
+            if key == 'sectime':
+                columns[i+1].append(bintime(data[idx:idx+7]))
+                idx += 7
+            else:
+                columns[i+1].append(data[idx]/multipliers[i])
+                idx += 1
+    return ['time'] + keys, columns
+
+
+class SensorRingBuffer(object):
+    """
+    DEFINITION:
+        Fixed size ring buffer of one sensor: integer epoch nanoseconds for
+        time ids (1-4, the first one is the primary time) and float values
+        for all other ids. The buffer starts with capacity samples and
+        doubles its size until it covers 'hours' (limited to maxcapacity
+        samples). Afterwards the oldest samples are overwritten.
+    """
+    def __init__(self, ids, hours=4., capacity=1024, maxcapacity=200000):
+        self.ids = list(ids)
+        self.timeids = [el for el in self.ids if el in BATCHTIMEIDS]
+        self.valueids = [el for el in self.ids if not el in BATCHTIMEIDS]
+        self.span = int(hours*3600*1e9)
+        self.maxcapacity = maxcapacity
+        self.times = np.zeros((capacity, len(self.timeids)), dtype=np.int64)
+        self.values = np.zeros((capacity, len(self.valueids)), dtype=np.float64)
+        self.start = 0      # index of the oldest sample
+        self.amount = 0     # number of valid samples
+
+    def __len__(self):
+        return self.amount
+
+    def _grow(self):
+        capacity = min(2*len(self.times), self.maxcapacity)
+        order = self._order()
+        times = np.zeros((capacity, len(self.timeids)), dtype=np.int64)
+        values = np.zeros((capacity, len(self.valueids)), dtype=np.float64)
+        times[:self.amount] = self.times[order]
+        values[:self.amount] = self.values[order]
+        self.times, self.values, self.start = times, values, 0
+
+    def _order(self):
+        # indices of valid samples in time order
+        return (self.start + np.arange(self.amount)) % len(self.times)
+
+    def append(self, times, values):
+        """
+        Appends one sample: times (list of epoch ns, order of timeids) and
+        values (list of floats, order of valueids).
+        """
+        capacity = len(self.times)
+        if self.amount == capacity:
+            newest = self.times[(self.start + self.amount - 1) % capacity, 0]
+            oldest = self.times[self.start, 0]
+            if newest - oldest < self.span and capacity < self.maxcapacity:
+                self._grow()
+                capacity = len(self.times)
+        if self.amount < capacity:
+            index = (self.start + self.amount) % capacity
+            self.amount += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % capacity
+        self.times[index] = times
+        self.values[index] = values
+
+    def coverage(self):
+        """
+        Returns first and last time (epoch ns) and the amount of samples.
+        """
+        if not self.amount > 0:
+            return [None, None, 0]
+        order = self._order()
+        return [int(self.times[order[0], 0]), int(self.times[order[-1], 0]), int(self.amount)]
+
+    def getrange(self, start=None, end=None, limit=None):
+        """
+        Returns a batch event (see wampbatch) with all samples between
+        start and end (epoch ns, inclusive). If limit is given only the
+        first limit samples are returned and 'complete' is False.
+        """
+        order = self._order()
+        primary = self.times[order, 0] if self.amount > 0 else np.array([], dtype=np.int64)
+        first = 0 if start is None else np.searchsorted(primary, _timens(start), side='left')
+        last = len(primary) if end is None else np.searchsorted(primary, _timens(end), side='right')
+        complete = True
+        if limit and last - first > int(limit):
+            last = first + int(limit)
+            complete = False
+        selection = order[first:last]
+        data = [self.times[selection, i].tolist() for i in range(len(self.timeids))]
+        data.extend([self.values[selection, i].tolist() for i in range(len(self.valueids))])
+        return {'v': BATCHVERSION, 'ids': self.timeids + self.valueids, 'data': data, 'complete': complete}
+
+
+class RingBufferStore(object):
+    """
+    DEFINITION:
+        Ring buffers of all sensors of a node. Single value events (legacy
+        format, terminated by id 99) and batch events are collected by
+        event(topic, event).
+    """
+    def __init__(self, hours=4., maxcapacity=200000, path=None):
+        self.hours = hours
+        self.maxcapacity = maxcapacity
+        self.path = path    # directory of the daily files (outputdir/hostname)
+        self.buffers = {}
+        self.lines = {}
+        # called with (topic, sensorid, ids, time, values) for each sample
+        # (e.g. DecimationStore.sample)
+        self.observers = []
+
+    def _sensorid(self, topic):
+        # .../lemi#LEMI036_1_0001-value -> LEMI036_1_0001
+        return topic.split('#')[-1].rsplit('-', 1)[0]
+
+    def _append(self, topic, ids, line):
+        sensorid = self._sensorid(topic)
+        ids = [el for el in ids if not el in RINGBUFFERSKIPIDS]
+        if not len(ids) > 0 or not ids[0] in BATCHTIMEIDS:
+            return
+        buf = self.buffers.get(sensorid)
+        if buf is None or not buf.ids == ids:
+            buf = self.buffers[sensorid] = SensorRingBuffer(ids, hours=self.hours, maxcapacity=self.maxcapacity)
+        times = [_timens(line[el]) for el in buf.timeids]
+        values = []
+        for el in buf.valueids:
+            try:
+                values.append(float(line[el]))
+            except (TypeError, ValueError):
+                values.append(np.nan)
+        buf.append(times, values)
+        for observer in self.observers:
+            observer(topic, sensorid, buf.valueids, times[0], values)
+
+    def event(self, topic, event):
+        """
+        Buffers a published event.
+        """
+        try:
+            if topic.endswith('-batch'):
+                ids = [el for el in event['ids'] if not el in RINGBUFFERSKIPIDS]
+                for line in zip(*[event['data'][event['ids'].index(el)] for el in ids]):
+                    self._append(topic, ids, dict(zip(ids, line)))
+            elif isinstance(event, dict) and 'id' in event:
+                line = self.lines.setdefault(topic, [])
+                if event['id'] == 99:
+                    self.lines[topic] = []
+                    self._append(topic, [el[0] for el in line], dict(line))
+                else:
+                    line.append((event['id'], event['value']))
+        except (KeyError, ValueError, TypeError, IndexError):
+            # incomplete or unknown events are not buffered
+            self.lines[topic] = []
+
+    def sensors(self):
+        return dict([(sensorid, buf.coverage()) for sensorid, buf in self.buffers.items()])
+
+    def getfilerange(self, sensorid, start, end=None, limit=None):
+        """
+        Reads the range from the daily MagPyBin files of the sensor.
+        Returns None if no files are available.
+        """
+        start = _timens(start)
+        end = _timens(end) if end is not None else None
+        epoch = datetime(1970, 1, 1)
+        day = (epoch + timedelta(microseconds=start//1000)).date()
+        lastday = (epoch + timedelta(microseconds=end//1000)).date() if end is not None else datetime.utcnow().date()
+        keys, columns = None, None
+        complete = True
+        while day <= lastday:
+            filename = os.path.join(self.path, sensorid, sensorid + '_' + day.strftime('%Y-%m-%d') + '.bin')
+            day += timedelta(days=1)
+            if not os.path.isfile(filename):
+                continue
+            try:
+                result = readbinfile(filename, start, end)
+            except (IOError, OSError, struct.error, ValueError, TypeError, IndexError):
+                result = None
+            if result is None:
+                continue
+            if keys is None:
+                keys, columns = result
+            elif keys == result[0]:
+                for col, new in zip(columns, result[1]):
+                    col.extend(new)
+            else:
+                # changed file layout: collector continues with a new request
+                complete = False
+                break
+            if limit and len(columns[0]) > int(limit):
+                columns = [col[:int(limit)] for col in columns]
+                complete = False
+                break
+        if keys is None:
+            return None
+        return {'v': BATCHVERSION, 'keys': keys, 'data': columns, 'complete': complete}
+
+    def getrange(self, sensorid, start=None, end=None, limit=None):
+        buf = self.buffers.get(sensorid)
+        if self.path and start is not None:
+            first = buf.coverage()[0] if buf is not None else None
+            if first is None or _timens(start) < first:
+                event = self.getfilerange(sensorid, start, end, limit)
+                if event is not None and len(event['data'][0]) > 0:
+                    return event
+        if buf is None:
+            return {'v': BATCHVERSION, 'ids': [], 'data': [], 'complete': True}
+        return buf.getrange(start, end, limit)
+
+
+class RingBufferRpc(object):
+    """
+    WAMP RPC methods of the ring buffers. Register with
+    registerForRpc(RingBufferRpc(store), "http://example.com/"+hostname+"/buffer#")
+    """
+    def __init__(self, store):
+        self.store = store
+
+    @exportRpc("sensors")
+    def sensors(self):
+        return self.store.sensors()
+
+    @exportRpc("get-range")
+    def getRange(self, sensorid, start=None, end=None, limit=100000, encoding=None):
+        event = self.store.getrange(sensorid, start, end, limit)
+        if encoding == 'b64':
+            event = encodebatch(event)
+        return event
@@ -0,0 +1,165 @@
+'''
+Filename:               wampbatch
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Batched WAMP event format for MARTAS protocols and MARCOS collectors.
+        Legacy protocols publish one event per value ({'id': 11, 'value': x})
+        and an end-of-line event (id 99) on the topic 'module#sensorid-value'.
+        Batched protocols publish one event per frame (or per N samples)
+        on the topic 'module#sensorid-batch':
+            {'v': 1, 'ids': [1, 4, 11, 12, 13, ...], 'data': [[...], [...], ...]}
+        'ids' are the legacy event ids (sensor meta ids, see IDDICT of the
+        collectors), 'data' contains one column per id. Time columns
+        (ids 1-4) are integer epoch nanoseconds. The node adds a sequence
+        number 'seq' per topic, so collectors can detect lost batches.
+
+        Range responses (RPC buffer#get-range, see ringbuffer) use the same
+        format. Data read from daily files are described by column names
+        'keys' (e.g. ['time', 'x', 'y']) instead of 'ids'. For large ranges
+        the columns can be encoded as base64 strings of little endian
+        int64 (time) or float64 values: 'enc': 'b64', 'types': 'qdd'.
+
+        Negotiation: collectors supporting batches subscribe to both topics
+        and unsubscribe from the legacy topic as soon as the first batch
+        arrives. Protocols publish legacy events only while the legacy topic
+        has subscribers (if the factory provides this information), so old
+        collectors keep working unchanged.
+
+CONTAINS:
+        datetime2ns:    (Func) datetime to integer epoch nanoseconds
+        ns2string:      (Func) epoch nanoseconds to time string
+        packbatch:      (Func) create a batch event
+        unpackbatch:    (Func) convert a batch event to legacy lines
+        encodebatch:    (Func) base64 encoding of the data columns
+        decodebatch:    (Func) decoding of encoded batches
+        hassubscribers: (Func) check for subscribers of a topic
+'''
+
+import base64
+import struct
+from datetime import datetime, timedelta
+
+BATCHVERSION = 1
+BATCHTIMEIDS = [1, 2, 3, 4]
+BATCHTIMEKEYS = ['time', 'sectime']
+EPOCH = datetime(1970, 1, 1)
+
+
+def datetime2ns(dt):
+    """
+    Converts a datetime object to integer nanoseconds since 1970-01-01.
+    """
+    delta = dt - EPOCH
+    return ((delta.days*86400 + delta.seconds)*1000000 + delta.microseconds)*1000
+
+
+def ns2string(ns, rounding=True):
+    """
+    Converts integer epoch nanoseconds to a time string of format
+    2013-12-12 23:12:23.122000 (rounded to milliseconds by default,
+    as done by the collectors for the primary time (id 1) of legacy
+    events).
+    """
+    microseconds = int(ns)//1000
+    if rounding:
+        microseconds = int(round(microseconds/1000.))*1000
+    return datetime.strftime(EPOCH + timedelta(microseconds=microseconds), "%Y-%m-%d %H:%M:%S.%f")
+
+
+def packbatch(ids, columns):
+    """
+    Creates a batch event from a list of ids and a list of columns
+    (one list per id with equal lengths). Time columns (ids 1-4) may
+    contain datetime objects or epoch nanoseconds.
+    """
+    data = []
+    for idx, col in zip(ids, columns):
+        if idx in BATCHTIMEIDS:
+            col = [datetime2ns(el) if isinstance(el, datetime) else int(el) for el in col]
+        else:
+            col = list(col)
+        data.append(col)
+    return {'v': BATCHVERSION, 'ids': list(ids), 'data': data}
+
+
+def encodebatch(event):
+    """
+    Returns a copy of the batch event with base64 encoded data columns:
+    time columns as little endian int64, all others as float64.
+    """
+    if event.get('enc'):
+        return event
+    if 'ids' in event:
+        times = [el in BATCHTIMEIDS for el in event['ids']]
+    else:
+        times = [el in BATCHTIMEKEYS for el in event['keys']]
+    types, data = '', []
+    for istime, col in zip(times, event['data']):
+        code = 'q' if istime else 'd'
+        types += code
+        data.append(base64.b64encode(struct.pack('<%d%s' % (len(col), code), *col)).decode('ascii'))
+    encoded = dict(event)
+    encoded.update({'enc': 'b64', 'types': types, 'data': data})
+    return encoded
+
+
+def decodebatch(event):
+    """
+    Returns the batch event with data columns as lists (decodes
+    events created by encodebatch, others are returned unchanged).
+    """
+    if not event.get('enc') == 'b64':
+        return event
+    data = []
+    for code, col in zip(event['types'], event['data']):
+        raw = base64.b64decode(col)
+        data.append(list(struct.unpack('<%d%s' % (len(raw)//8, str(code)), raw)))
+    decoded = dict(event)
+    del decoded['enc'], decoded['types']
+    decoded['data'] = data
+    return decoded
+
+
+def unpackbatch(event, ids=None):
+    """
+    Converts a batch event to a list of lines as assembled by the
+    collectors from legacy events: values are ordered by ids (default
+    all ids of the event), time columns are converted to strings.
+    Returns an empty list for unsupported events.
+    """
+    try:
+        if int(event.get('v', 0)) > BATCHVERSION:
+            return []
+        event = decodebatch(event)
+        evids = list(event['ids'])
+        data = event['data']
+    except (AttributeError, KeyError, TypeError, ValueError, struct.error):
+        return []
+    if ids is None:
+        ids = evids
+    columns = []
+    for idx in ids:
+        if not idx in evids:
+            continue
+        col = data[evids.index(idx)]
+        if idx in BATCHTIMEIDS:
+            # like legacy events only the primary time (id 1) is rounded
+            col = [ns2string(el, rounding=idx == 1) for el in col]
+        columns.append(col)
+    if not len(columns) > 0:
+        return []
+    return [list(line) for line in zip(*columns)]
+
+
+def hassubscribers(factory, topic):
+    """
+    Returns False if the WAMP server factory is known to have no
+    subscribers for topic. If the factory does not provide subscription
+    information, True is returned.
+    """
+    subscriptions = getattr(factory, 'subscriptions', None)
+    if not isinstance(subscriptions, dict):
+        return True
+    return len(subscriptions.get(topic, [])) > 0
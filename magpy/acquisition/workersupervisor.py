@@ -0,0 +1,324 @@
+'''
+Filename:               workersupervisor
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Process per port acquisition. Without supervision all protocols of
+        a node run within the reactor (and the interpreter lock) of
+        acquisition.py, so a busy protocol (e.g. LEMI at 10 Hz) delays the
+        time stamps of the others. With supervision each serial port or
+        bus (OW) is read by its own worker process (acquisition.py
+        --worker SENSORNAME), which time stamps and stores the data like
+        before and forwards all events to the supervisor. The supervisor
+        publishes them by the WAMP factory (ring buffers, decimation and
+        sequence numbers as before) and restarts workers which exit or
+        stay silent for longer than timeout seconds (delay doubling from
+        mindelay to maxdelay, reset after stable seconds of operation).
+        Readings which are not published due to a publication policy
+        (see publishpolicy) are reported by keepalive messages, so
+        workers of constant sensors are not restarted. Events, errors
+        and restarts of the workers are logged every statsinterval seconds.
+
+        Channel (pipes, one JSON object per line):
+            worker fd 3 -> supervisor:  {"topic": ..., "event": ...}
+                                        {"alive": time}
+            supervisor -> worker stdin: {"subscribed": [topics]}
+        The subscribed topics let protocols of workers publish legacy
+        events only if needed (see wampbatch.hassubscribers). Output of
+        workers on stdout/stderr is logged by the supervisor, workers
+        log to Logs/martas_SENSORNAME.log.
+        Posix only (file descriptor 3 of the workers).
+
+CONTAINS:
+        ForwardingFactory:      (Class) wsMcuFactory replacement of workers
+        WorkerChannel:          (Class) worker side of the channel
+        WorkerProcess:          (Class) supervisor side of one worker
+        AcquisitionSupervisor:  (Class) starts and restarts the workers
+
+DEPENDENCIES:
+        twisted
+'''
+
+import os
+import sys
+import json
+import time
+from twisted.internet import reactor, task, protocol, error
+from twisted.internet.stdio import StandardIO
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+# file descriptor of the event channel in the workers
+WORKEREVENTFD = 3
+# minimal seconds between keepalive messages of a worker
+WORKERKEEPALIVE = 10.
+
+
+class ForwardingFactory(object):
+    """
+    DEFINITION:
+        Replaces the WAMP server factory within a worker: dispatched
+        events are forwarded to the supervisor. Protocols of the worker
+        are kept as attributes like in WsMcuFactory.
+    """
+    def __init__(self):
+        # unknown until the first update of the supervisor
+        self.subscriptions = None
+        self.channel = None
+        self.forwarded = 0
+        self.lastalive = 0.
+
+    def connect(self):
+        """
+        Opens the channel to the supervisor (stdin, WORKEREVENTFD).
+        """
+        self.channel = WorkerChannel(self)
+        StandardIO(self.channel, stdin=0, stdout=WORKEREVENTFD)
+        return self.channel
+
+    def dispatch(self, topic, event, exclude=[], eligible=None):
+        if self.channel is None or self.channel.transport is None:
+            return
+        self.channel.sendLine(json.dumps({'topic': topic, 'event': event}).encode('ascii'))
+        self.forwarded += 1
+
+    def alive(self):
+        """
+        Reports readings which are not published (see applypolicy) to the
+        supervisor, at most every WORKERKEEPALIVE seconds.
+        """
+        now = time.time()
+        if self.channel is None or self.channel.transport is None or now - self.lastalive < WORKERKEEPALIVE:
+            return
+        self.lastalive = now
+        self.channel.sendLine(json.dumps({'alive': now}).encode('ascii'))
+
+    def subscribed(self, topics):
+        # subscriptions in the form used by wampbatch.hassubscribers
+        self.subscriptions = dict([(topic, [True]) for topic in topics])
+
+
+class WorkerChannel(LineReceiver):
+    """
+    Worker side of the channel. The worker stops if the supervisor is gone.
+    """
+    delimiter = b'\n'
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line.decode('ascii'))
+            if 'subscribed' in message:
+                self.factory.subscribed(message['subscribed'])
+        except (ValueError, TypeError, UnicodeDecodeError):
+            log.msg("Worker: invalid message of supervisor: %s" % line[:100])
+
+    def connectionLost(self, reason):
+        self.transport = None
+        log.msg("Worker: supervisor disconnected - stopping")
+        if reactor.running:
+            reactor.stop()
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Supervisor side of one worker: events of WORKEREVENTFD are passed to
+    the supervisor, other output is logged.
+    """
+    def __init__(self, supervisor, name):
+        self.supervisor = supervisor
+        self.name = name
+        self.buffers = {}
+
+    def connectionMade(self):
+        self.supervisor.workerStarted(self)
+
+    def childDataReceived(self, childFD, data):
+        lines = (self.buffers.get(childFD, b'') + data).split(b'\n')
+        self.buffers[childFD] = lines.pop()
+        for line in lines:
+            if childFD == WORKEREVENTFD:
+                self.supervisor.received(self, line)
+            elif line.strip():
+                log.msg("%s: %s" % (self.name, line.rstrip().decode('utf-8', 'replace')))
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self, reason)
+
+
+class AcquisitionSupervisor(object):
+    """
+    DEFINITION:
+        Runs one worker process per sensor (serial port or bus) and
+        publishes their events by factory.dispatch.
+
+    PARAMETERS:
+        - factory:      (WsMcuFactory) publishing WAMP factory
+        - script:       (string) acquisition script (started with --worker NAME)
+        - names:        (list) sensor names of sensors.txt, one worker each
+    Kwargs:
+        - python:       (string) interpreter of the workers
+        - timeout:      (float) restart workers without events or keepalive
+                        messages for timeout seconds (0: no watchdog), needs
+                        to exceed the sampling intervals of the sensors
+        - mindelay:     (float) first restart delay in seconds
+        - maxdelay:     (float) maximal restart delay in seconds
+        - stable:       (float) seconds of operation resetting the delay
+        - statsinterval: (float) log stats() every statsinterval seconds (0: never)
+
+    APPLICATION:
+        supervisor = AcquisitionSupervisor(wsMcuFactory, os.path.abspath(__file__), sensorlist, statsinterval=3600.)
+        supervisor.start()
+    """
+    def __init__(self, factory, script, names, python=sys.executable, timeout=600., mindelay=1., maxdelay=60., stable=60., statsinterval=0.):
+        self.factory = factory
+        self.script = script
+        self.names = list(names)
+        self.python = python
+        self.timeout = timeout
+        self.mindelay = mindelay
+        self.maxdelay = maxdelay
+        self.stable = stable
+        self.statsinterval = statsinterval
+        self.lastlog = time.time()
+        self.workers = {}   # name : state of the worker
+        self.subscribed = None
+        self.loop = None
+        self.stopping = False
+
+    def start(self):
+        for name in self.names:
+            self.workers[name] = {'process': None, 'pid': None, 'started': None, 'lastevent': None,
+                                  'events': 0, 'errors': 0, 'restarts': 0, 'delay': self.mindelay, 'pending': None}
+            self.spawn(name)
+        self.loop = task.LoopingCall(self.check)
+        self.loop.start(5., now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, name):
+        worker = self.workers[name]
+        worker['pending'] = None
+        if self.stopping:
+            return
+        process = WorkerProcess(self, name)
+        args = [self.python, self.script, '--worker', name]
+        log.msg("Supervisor: starting worker %s" % name)
+        reactor.spawnProcess(process, self.python, args, env=os.environ, path=os.path.dirname(self.script) or None,
+                             childFDs={0: 'w', 1: 'r', 2: 'r', WORKEREVENTFD: 'r'})
+        worker['process'] = process
+
+    def workerStarted(self, process):
+        worker = self.workers[process.name]
+        worker['pid'] = process.transport.pid
+        worker['started'] = worker['lastevent'] = time.time()
+        if self.subscribed is not None:
+            self.send(process, {'subscribed': self.subscribed})
+
+    def received(self, process, line):
+        worker = self.workers[process.name]
+        worker['lastevent'] = time.time()
+        try:
+            message = json.loads(line.decode('ascii'))
+            if 'alive' in message:
+                return
+            topic, event = message['topic'], message['event']
+        except (ValueError, TypeError, KeyError, UnicodeDecodeError):
+            worker['errors'] += 1
+            return
+        worker['events'] += 1
+        try:
+            self.factory.dispatch(topic, event)
+        except:
+            worker['errors'] += 1
+            log.err("Supervisor: could not publish event of %s" % process.name)
+
+    def workerEnded(self, process, reason):
+        worker = self.workers[process.name]
+        if not worker['process'] is process:
+            return
+        worker['process'] = None
+        worker['pid'] = None
+        if self.stopping:
+            return
+        if worker['started'] and time.time() - worker['started'] >= self.stable:
+            worker['delay'] = self.mindelay
+        log.msg("Supervisor: worker %s ended (%s) - restarting in %.0f sec" % (process.name, reason.getErrorMessage(), worker['delay']))
+        worker['restarts'] += 1
+        worker['pending'] = reactor.callLater(worker['delay'], self.spawn, process.name)
+        worker['delay'] = min(2*worker['delay'], self.maxdelay)
+
+    def send(self, process, message):
+        try:
+            process.transport.write((json.dumps(message) + '\n').encode('ascii'))
+        except (AttributeError, error.ProcessExitedAlready):
+            pass
+
+    def check(self):
+        """
+        DEFINITION:
+            Stops silent workers (restarted by workerEnded), sends the
+            subscribed topics to the workers if they changed and logs the
+            stats every statsinterval seconds.
+        """
+        now = time.time()
+        if self.statsinterval and now - self.lastlog >= self.statsinterval:
+            self.lastlog = now
+            self.logstats()
+        for name, worker in self.workers.items():
+            process = worker['process']
+            if process is None or process.transport is None or not worker['lastevent']:
+                continue
+            if self.timeout and now - worker['lastevent'] > self.timeout:
+                log.msg("Supervisor: no data of worker %s for %.0f sec - stopping it" % (name, now - worker['lastevent']))
+                worker['lastevent'] = now
+                self.kill(process)
+        subscriptions = getattr(self.factory, 'subscriptions', None)
+        if isinstance(subscriptions, dict):
+            subscribed = sorted([topic for topic, clients in subscriptions.items() if len(clients) > 0])
+            if not subscribed == self.subscribed:
+                self.subscribed = subscribed
+                for worker in self.workers.values():
+                    if worker['process'] is not None:
+                        self.send(worker['process'], {'subscribed': subscribed})
+
+    def kill(self, process, signal='TERM'):
+        try:
+            process.transport.signalProcess(signal)
+        except (AttributeError, OSError, error.ProcessExitedAlready):
+            return
+        if signal == 'TERM':
+            # workers blocked in a read do not react to TERM
+            reactor.callLater(10., self.kill, process, 'KILL')
+
+    def stop(self):
+        self.stopping = True
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        for worker in self.workers.values():
+            if worker['pending'] and worker['pending'].active():
+                worker['pending'].cancel()
+            if worker['process'] is not None:
+                self.kill(worker['process'])
+
+    def stats(self):
+        """
+        Returns pid, uptime, events, errors, restarts and seconds since
+        the last event of each worker.
+        """
+        now = time.time()
+        result = {}
+        for name, worker in self.workers.items():
+            result[name] = {'pid': worker['pid'], 'events': worker['events'], 'errors': worker['errors'],
+                            'restarts': worker['restarts'],
+                            'uptime': now - worker['started'] if worker['pid'] else None,
+                            'idle': now - worker['lastevent'] if worker['pid'] else None}
+        return result
+
+    def logstats(self):
+        for name, entry in sorted(self.stats().items()):
+            log.msg('Supervisor: worker %s (pid %s) - events %d, errors %d, restarts %d, uptime %s sec'
+                    % (name, entry['pid'], entry['events'], entry['errors'], entry['restarts'],
+                       '%.0f' % entry['uptime'] if entry['uptime'] is not None else '-'))
@@ -0,0 +1,276 @@
+"""
+Buffered daily MagPyBin writer for MARCOS collectors
+
+Collectors storing data in files (output 'file') appended each sample with
+a trailing newline, opening and closing the daily file for every line.
+DailyBinWriter keeps the samples of each sensor and day in memory (one
+list per column) and writes them as fixed size little endian records
+without separators every flushinterval seconds or when maxrows samples
+are collected. The header layout is unchanged:
+    # MagPyBin sensorid [keys] [names] [units] [multipliers] packcode size
+Files created before (records with newlines) are continued in their
+format. readPYBIN reads both.
+
+Completed days can be converted to compressed PYCDF files (rollup=True),
+optionally removing the binary file afterwards (keepbin=False). Days not
+converted at the rollover (file closed as idle before midnight, collector
+restarted) are converted when the next file of the sensor is opened.
+
+All collectors of a process share the module instance dailybinwriter:
+    from magpy.collector.binwriter import dailybinwriter, BinLayout
+    layout = BinLayout(sensorid, ['x','y','z'], ['X','Y','Z'], ['nT','nT','nT'], [1000,1000,1000], '6hLlll')
+    dailybinwriter.put(path, layout, '2016-01-01', [2016,1,1,0,0,0,0,1000,2000,3000])
+"""
+import os
+import re
+import time
+import struct
+import numpy as np
+from twisted.internet import reactor, task, threads
+from twisted.python import log
+from magpy.lib.format_magpy import _pybinseparated
+
+# numpy types of struct codes (standard sizes)
+BINTYPES = {'b':'i1', 'B':'u1', 'h':'i2', 'H':'u2', 'i':'i4', 'I':'u4', 'l':'i4', 'L':'u4',
+            'q':'i8', 'Q':'u8', 'f':'f4', 'd':'f8'}
+BINDATE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+BINHEADER = re.compile(r'#\s*MagPyBin\s+(\S+)\s+\[(.*?)\]\s+\[(.*?)\]\s+\[(.*?)\]\s+\[(.*?)\]\s+(\S+)\s+(\d+)')
+
+
+class BinLayout(object):
+    """
+    DEFINITION:
+        Record layout of a MagPyBin file: header line and numpy record type
+        (little endian, no padding) of the packing code. Rows contain the
+        seven time elements (year, month, day, hour, minute, second,
+        microsecond) followed by the packed values.
+    """
+    def __init__(self, sensorid, keys, names, units, multipliers, packcode):
+        self.sensorid = sensorid
+        self.packcode = packcode
+        self.size = struct.calcsize('<'+packcode)
+        self.header = "# MagPyBin %s [%s] [%s] [%s] [%s] %s %d" % (sensorid, ','.join(keys), ','.join(names),
+                          ','.join(units), ','.join([str(el) for el in multipliers]), packcode, self.size)
+        codes = re.findall(r'(\d*)([a-zA-Z])', packcode)
+        types = []
+        for count, code in codes:
+            types.extend([BINTYPES[code]]*int(count or 1))
+        self.dtype = np.dtype([('c%d' % i, '<'+el) for i, el in enumerate(types)])
+
+    @classmethod
+    def fromheader(cls, header):
+        """
+        Layout of an existing header line (None for other formats).
+        """
+        match = BINHEADER.match(header.strip())
+        if not match:
+            return None
+        items = [[el.strip().strip("'") for el in match.group(i).split(',')] for i in range(2, 6)]
+        return cls(match.group(1), items[0], items[1], items[2], items[3], match.group(6))
+
+    def pack(self, columns, separator=False):
+        """
+        Returns the records of columns (one list per element) as bytes.
+        """
+        dtype = self.dtype
+        if separator:
+            dtype = np.dtype(dtype.descr + [('sep', 'u1')])
+        data = np.zeros(len(columns[0]), dtype=dtype)
+        for i, col in enumerate(columns):
+            data['c%d' % i] = col
+        if separator:
+            data['sep'] = 10
+        return data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+
+
+class DailyBinWriter(object):
+    """
+    DEFINITION:
+        Buffered writer of daily MagPyBin files path/sensorid_filedate.bin.
+
+    PARAMETERS:
+    Kwargs:
+        - flushinterval:  (float) write collected samples every flushinterval seconds (default 10)
+        - maxrows:        (int) write if maxrows samples of a file are collected (default 5000)
+        - idletime:       (float) close files not written for idletime seconds (default 600)
+        - rollup:         (bool) convert files of completed days to PYCDF (default False)
+        - keepbin:        (bool) keep the binary file after rollup (default True)
+        - rollupdays:     (int) completed days checked for a missing rollup when
+                          opening a file (default 7)
+
+    APPLICATION:
+        writer = DailyBinWriter(rollup=True)
+        writer.put(path, layout, filedate, row)
+    """
+    def __init__(self, flushinterval=10., maxrows=5000, idletime=600., rollup=False, keepbin=True, rollupdays=7):
+        self.flushinterval = flushinterval
+        self.maxrows = maxrows
+        self.idletime = idletime
+        self.rollup = rollup
+        self.keepbin = keepbin
+        self.rollupdays = rollupdays
+        self.files = {}   # (path, sensorid) : file entry
+        self.rolling = set()   # files being converted
+        self.timer = None
+
+    def _start(self):
+        if self.timer is None:
+            self.timer = task.LoopingCall(self.tick)
+            self.timer.start(min(1., self.flushinterval), now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _open(self, path, layout, filedate):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if self.rollup:
+            for filename in self.unrolled(path, layout.sensorid, filedate):
+                self.rollupfile(filename, path, layout.sensorid)
+        filename = os.path.join(path, layout.sensorid+'_'+filedate+'.bin')
+        entry = {'date': filedate, 'name': filename, 'path': path, 'layout': layout, 'separator': False,
+                 'columns': [[] for el in layout.dtype.names], 'first': None, 'lastwrite': time.time()}
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as fh:
+                header = fh.readline().decode('ascii', 'replace')
+                body = fh.read()
+            match = BINHEADER.match(header.strip())
+            if match and match.group(6) == layout.packcode and int(match.group(7)) == layout.size:
+                # continue files written line by line in their format
+                entry['separator'] = len(body) > 0 and _pybinseparated(body, layout.size)
+            else:
+                # other layout or native packing (padding) - keep the file
+                backup = filename + '.old'
+                while os.path.exists(backup):
+                    backup += '.old'
+                log.msg("DailyBinWriter: %s has another layout - moved to %s" % (filename, backup))
+                os.rename(filename, backup)
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            entry['handle'] = open(filename, 'ab')
+        else:
+            entry['handle'] = open(filename, 'ab')
+            entry['handle'].write((layout.header + "\n").encode('ascii'))
+        return entry
+
+    def put(self, path, layout, filedate, row):
+        """
+        DEFINITION:
+            Adds one sample (time elements and values, see BinLayout) to the
+            file of the sensor and day. The layout of a sensor can change with
+            the next day only, samples of other layouts are dropped.
+        """
+        key = (path, layout.sensorid)
+        entry = self.files.get(key)
+        if entry is not None and not entry['date'] == filedate:
+            # rollover: close the file of the previous day
+            self._close(entry)
+            del self.files[key]
+            if self.rollup:
+                self.rollupfile(entry['name'], path, layout.sensorid)
+            entry = None
+        if entry is not None and not entry['layout'].packcode == layout.packcode:
+            if not entry.get('mismatch'):
+                log.msg("DailyBinWriter: layout of %s changed (%s) - dropping samples until %s is completed" % (layout.sensorid, layout.packcode, entry['name']))
+            entry['mismatch'] = entry.get('mismatch', 0) + 1
+            return
+        if entry is None:
+            entry = self.files[key] = self._open(path, layout, filedate)
+            self._start()
+        now = time.time()
+        if not entry['first']:
+            entry['first'] = now
+        for col, value in zip(entry['columns'], row):
+            col.append(value)
+        entry['lastwrite'] = now
+        if len(entry['columns'][0]) >= self.maxrows:
+            self._flush(entry)
+
+    def _flush(self, entry):
+        if not len(entry['columns'][0]) > 0:
+            return
+        try:
+            entry['handle'].write(entry['layout'].pack(entry['columns'], entry['separator']))
+            entry['handle'].flush()
+        except (IOError, OSError, ValueError, OverflowError) as e:
+            log.err("DailyBinWriter: Error while saving file %s: %s" % (entry['name'], e))
+        entry['columns'] = [[] for el in entry['columns']]
+        entry['first'] = None
+
+    def _close(self, entry):
+        self._flush(entry)
+        entry['handle'].close()
+
+    def tick(self):
+        """
+        DEFINITION:
+            Writes collected samples older than flushinterval and closes
+            idle files. Called periodically by the reactor.
+        """
+        now = time.time()
+        for key in list(self.files.keys()):
+            entry = self.files[key]
+            if entry['first'] and now - entry['first'] >= self.flushinterval:
+                self._flush(entry)
+            if now - entry['lastwrite'] >= self.idletime:
+                self._close(entry)
+                del self.files[key]
+                if self.rollup and entry['date'] < time.strftime('%Y-%m-%d', time.gmtime(now)):
+                    # day completed - no rollover will follow
+                    self.rollupfile(entry['name'], entry['path'], entry['layout'].sensorid)
+
+    def close(self):
+        """
+        DEFINITION:
+            Writes all samples and closes all files.
+        """
+        for entry in self.files.values():
+            self._close(entry)
+        self.files = {}
+
+    def unrolled(self, path, sensorid, filedate):
+        """
+        DEFINITION:
+            Daily binary files of sensorid in path of the rollupdays before
+            filedate without an up to date PYCDF file.
+        """
+        prefix = sensorid + '_'
+        names = sorted([el for el in os.listdir(path) if el.startswith(prefix) and el.endswith('.bin')])
+        days = [el[len(prefix):-4] for el in names]
+        completed = [(day, name) for day, name in zip(days, names) if BINDATE.match(day) and day < filedate]
+        unrolled = []
+        for day, name in completed[-self.rollupdays:]:
+            filename = os.path.join(path, name)
+            cdf = filename[:-4] + '.cdf'
+            if filename in self.rolling:
+                continue
+            if os.path.isfile(cdf) and os.path.getmtime(cdf) >= os.path.getmtime(filename):
+                continue
+            unrolled.append(filename)
+        return unrolled
+
+    def rollupfile(self, filename, path, sensorid):
+        """
+        DEFINITION:
+            Converts a daily binary file to a compressed PYCDF file
+            (path/sensorid_filedate.cdf) in a separate thread. Returns a
+            Deferred.
+        """
+        def convert():
+            from magpy.stream import read
+            stream = read(filename)
+            stream.write(path, filenamebegins=sensorid+'_', dateformat='%Y-%m-%d', coverage='day', format_type='PYCDF', mode='replace')
+            if not self.keepbin:
+                os.remove(filename)
+            return filename
+        def failed(failure):
+            log.msg("DailyBinWriter: Rollup of %s failed: %s" % (filename, failure.getErrorMessage()))
+        def done(result):
+            self.rolling.discard(filename)
+            return result
+        self.rolling.add(filename)
+        d = threads.deferToThread(convert)
+        d.addCallbacks(lambda name: log.msg("DailyBinWriter: %s converted to PYCDF" % name), failed)
+        d.addBoth(done)
+        return d
+
+
+# Writer shared by all collectors of a process
+dailybinwriter = DailyBinWriter()
@@ -100,41 +100,18 @@ if __name__ == '__main__':
     # ----------------------------------------------------------
     print "Locating MARCOS directory ..."
     destpath = [path for path, dirs, files in os.walk("/home") if path.endswith('MARCOS')][0]
-    sensfile = os.path.join(martaspath,'sensors.txt')
-    owfile = os.path.join(martaspath,'owlist.csv')
-    destsensfile = os.path.join(destpath,'MoonsSensors',clientname+'_sensors.txt')
-    destowfile = os.path.join(destpath,'MoonsSensors',clientname+'_owlist.csv')
     print "Getting sensor information from ", clientname
     try:
-        scptransfer(scpuser+'@'+clientip+':'+sensfile,destsensfile,scppasswd)
+        s,o = cl.getsensorlists(clientname,clientip,martaspath,destpath,sshcredlst)
     except:
         print "Could not connect to/get sensor info of client %s - aborting" % clientname
         sys.exit()
-    print "Searching for onewire data from ", clientname
-    try:
-        scptransfer(scpuser+'@'+clientip+':'+owfile,destowfile,scppasswd)
-    except:
-        print "No one wire info available on client %s - proceeding" % clientname
-        pass
-
-    s,o = [],[]
-    with open(destsensfile,'rb') as f:
-        reader = csv.reader(f)
-        s = []
-        for line in reader:
-            if len(line) < 2:
-                s.append(line[0].split())
-            else:
-                s.append(line)
     print s
-    with open(destowfile,'rb') as f:
-        reader = csv.reader(f)
-        o = [line for line in reader]
     print o
 
-    factory = WampClientFactory("ws://"+clientip+":9100", debugWamp = False)
+    # reconnects after connection losses, missing data is requested from the client
+    factory = cl.PubSubClientFactory("ws://"+clientip+":9100", debugWamp = False)
     cl.sendparameter(clientname,clientip,destpath,dest,stationid,sshcredlst,s,o,printdata,dbcredlst)
-    factory.protocol = cl.PubSubClient
     connectWS(factory)
 
     reactor.run()
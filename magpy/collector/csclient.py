@@ -1,4 +1,4 @@
-import sys
+import sys, os, socket, struct
 from twisted.python import log
 from twisted.internet import reactor
 try: # version > 0.8.0
@@ -9,6 +9,8 @@ except:
 import collections
 # Database
 import MySQLdb
+from magpy.collector.dbwriter import BufferedDBWriter
+from magpy.collector.binwriter import BinLayout, dailybinwriter
 
 clientname = 'default'
 
@@ -38,21 +40,12 @@ def timeToArray(timestring):
         return []
 
 def dataToFile(outputdir, sensorid, filedate, bindata, header):
-    # File Operations
+    # File Operations: buffered, fixed size records (see binwriter)
     try:
         hostname = socket.gethostname()
         path = os.path.join(outputdir,hostname,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if not os.path.isfile(savefile):
-            with open(savefile, "wb") as myfile:
-                myfile.write(header + "\n")
-                myfile.write(bindata + "\n")
-        else:
-            with open(savefile, "a") as myfile:
-                myfile.write(bindata + "\n")
+        layout = BinLayout.fromheader(header)
+        dailybinwriter.put(path, layout, filedate, struct.unpack(layout.packcode, bindata))
     except:
         log.err("OW - Protocol: Error while saving file")
 
@@ -87,9 +80,17 @@ class PubSubClient(WampClientProtocol):
         self.sensorid = 'MySensor' # Necessary for file output
         self.typ = 'f' # or xyzf or etc
         # Open database connection
-        self.db = MySQLdb.connect("localhost","cobs","passwd","wic" )
+        dbcred = ["localhost","cobs","passwd","wic"]
+        self.db = MySQLdb.connect(dbcred[0],dbcred[1],dbcred[2],dbcred[3])
         # prepare a cursor object using cursor() method
         self.cursor = self.db.cursor()
+        # data lines are written in batches by a separate connection
+        # (one writer per factory, kept over reconnects)
+        self.writer = getattr(self.factory, 'writer', None)
+        if not self.writer:
+            self.writer = self.factory.writer = BufferedDBWriter(dbcred=dbcred)
+            self.writer.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.writer.stop)
         # Initiate subscriptions
         self.line = []
         self.subscribeInst(self.db, self.cursor, clientname, self.output)
@@ -194,28 +195,9 @@ class PubSubClient(WampClientProtocol):
                     paralst.append(var)
                 if self.output == 'db':
                     datainfoid = sensorid+'_0001'
-                    # define insert from provided param
-                    parastr = ', '.join(paralst)
-                    # separate floats and string
-                    nelst = []
-                    for elem in self.line:
-                        if isinstance(elem, str):
-                            elem = "'"+elem+"'"
-                        nelst.append(elem)
-                    linestr = ', '.join(map(str, nelst))
-                    sql = "INSERT INTO %s(%s, flag, typ) VALUES (%s, '0000000000000000-', %s)" % (datainfoid, parastr, linestr, self.typ)
+                    # Queue the line - the writer inserts it together with others
+                    self.writer.put(datainfoid, paralst+['flag','typ'], self.line+['0000000000000000-', self.typ])
                     self.line = []
-                    # Prepare SQL query to INSERT a record into the database.
-                    try:
-                        # Execute the SQL command
-                        self.cursor.execute(sql)
-                        # Commit your changes in the database
-                        self.db.commit()
-                    except:
-                        # No regular output here. Otherwise log-file will be smashed
-                        #log.msg("client: could not append data to table")
-                        # Rollback in case there is any error
-                        self.db.rollback()
                 elif self.output == 'file':
                     """
                     packcode = '6hL'+len(paralst)*'L'
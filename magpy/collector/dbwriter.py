@@ -0,0 +1,466 @@
+"""
+Buffered data base writer for MARCOS collectors
+
+Collectors receive single samples (lines) from MARTAS nodes. Writing each
+line with its own INSERT and commit saturates the data base host for high
+sampling rates and many sensors. BufferedDBWriter collects lines in a
+bounded queue per DataID and writes them by a dedicated thread using
+parameterized multi-row inserts. Queues are flushed when they reach
+a size limit (maxrows) or when their oldest line exceeds an age limit
+(maxage). If the data base is not reachable, batches are spilled to disk
+(spooldir) and replayed as soon as the connection is back. Like writeDB,
+existing rollup tables (see dbrollupupdate) are updated for the time
+range of each written batch.
+
+Usage within a collector:
+    writer = BufferedDBWriter(dbcred=[host,user,passwd,dbname], spooldir='/srv/spool')
+    writer.start()
+    writer.put('MySensor_0001_0001', ['time','x','y','z'], ['2016-01-01 00:00:00.000000', 1., 2., 3.])
+    print(writer.stats())
+    writer.stop()
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+from magpy.database import *
+from magpy.database import _num2dbtime, _dbtime2string
+# after the magpy import - numpy's log would replace twisted's log
+from twisted.python import log
+
+# Error codes of MySQL which indicate a lost or blocked connection
+# (lost connection, server gone, lock wait timeout, deadlock)
+DBOUTAGECODES = [2002, 2003, 2006, 2013, 2055, 1205, 1213]
+
+
+def _isoutage(error):
+    """
+    DEFINITION:
+        Returns True if a data base error indicates an outage (connection
+        lost, server not reachable, locked data base). Such batches
+        are spilled and retried, all other errors are dropped.
+    """
+    try:
+        if isinstance(error, MySQLdb.InterfaceError):
+            return True
+        if isinstance(error, MySQLdb.OperationalError):
+            return len(error.args) > 0 and error.args[0] in DBOUTAGECODES
+    except NameError:
+        pass
+    try:
+        if isinstance(error, sqlite3.OperationalError):
+            return 'locked' in str(error)
+    except NameError:
+        pass
+    return False
+
+
+class BufferedDBWriter(object):
+    """
+    DEFINITION:
+        Thread based data base writer with a bounded queue per DataID.
+
+    PARAMETERS:
+    Kwargs:
+        - dbcred:       (list) host, user, passwd, dbname for MySQLdb.connect
+        - connect:      (callable) returns a new data base connection
+                        (alternative to dbcred, e.g. lambda: dbconnect('sqlite', path=...))
+        - maxrows:      (int) flush a queue when it contains maxrows lines (default 500)
+        - maxage:       (float) flush a queue when its oldest line is older
+                        than maxage seconds (default 5)
+        - maxqueue:     (int) maximal amount of lines per queue. If exceeded
+                        (e.g. during outages), the oldest lines are spilled to
+                        disk or dropped if no spooldir is given (default 50000)
+        - spooldir:     (string) directory for the on-disk spill buffer
+        - retry:        (float) seconds between reconnection attempts (default 10)
+        - statsinterval:(float) seconds between queue statistics log messages,
+                        0 disables logging (default 600)
+        - schemainterval:(float) seconds the time schema of a table (see
+                        dbtimeschema) and the existence of its rollup tables
+                        are cached. Tables might be converted by
+                        dbmigratetimeschema while collecting, so the default 0
+                        checks the schema before each batch
+        - rollup:       (bool) update rollup tables (see dbrollupupdate) after
+                        each batch, default: only if rollup tables exist
+
+    APPLICATION:
+        writer = BufferedDBWriter(dbcred=dbcred, spooldir=spooldir)
+        writer.start()
+        writer.put(datainfoid, paralst, line)
+    """
+    def __init__(self, dbcred=None, connect=None, maxrows=500, maxage=5., maxqueue=50000, spooldir=None, retry=10., statsinterval=600., schemainterval=0., rollup=None):
+        if not connect:
+            if not dbcred:
+                raise ValueError("BufferedDBWriter: provide either dbcred or connect")
+            connect = lambda: MySQLdb.connect(dbcred[0],dbcred[1],dbcred[2],dbcred[3])
+        self.connect = connect
+        self.maxrows = maxrows
+        self.maxage = maxage
+        self.maxqueue = maxqueue
+        self.spooldir = spooldir
+        self.retry = retry
+        self.statsinterval = statsinterval
+        self.schemainterval = schemainterval
+        self.rollup = rollup
+        if spooldir and not os.path.exists(spooldir):
+            os.makedirs(spooldir)
+
+        self.db = None
+        self.queues = {}    # (dataid, columns) : deque of value tuples
+        self.since = {}     # (dataid, columns) : arrival time of oldest queued line
+        self.counters = {}  # dataid : dict of written/spilled/dropped/failed lines
+        self.tables = {}    # dataid : time schema, rollup tables, time of the check
+        self.condition = threading.Condition()
+        self.spoollock = threading.RLock()  # spill files and counters
+        self.running = False
+        self.thread = None
+        self.lastattempt = 0.
+        self.laststats = time.time()
+        self._recover()
+
+    # -------------------------------------------------------------------
+    # Producer side (called from the reactor thread)
+    # -------------------------------------------------------------------
+    def put(self, dataid, columns, values):
+        """
+        DEFINITION:
+            Queues one line (values for columns) for table dataid.
+        """
+        key = (dataid, tuple(columns))
+        with self.condition:
+            que = self.queues.get(key)
+            if que is None:
+                que = self.queues[key] = deque()
+            if not len(que) > 0:
+                self.since[key] = time.time()
+            que.append(tuple(values))
+            if len(que) > self.maxqueue:
+                # queue limit reached: data base is not keeping up
+                batch = [que.popleft() for i in range(min(self.maxrows, len(que)))]
+                self._spill(dataid, columns, batch)
+            if len(que) >= self.maxrows:
+                self.condition.notify()
+
+    def start(self):
+        """
+        DEFINITION:
+            Starts the writer thread.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='BufferedDBWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, flush=True, timeout=60.):
+        """
+        DEFINITION:
+            Stops the writer thread. All queued lines are written
+            (or spilled) before if flush is True.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        if flush:
+            self.flush(force=True)
+        if self.db:
+            try:
+                self.db.close()
+            except:
+                pass
+            self.db = None
+
+    def stats(self):
+        """
+        DEFINITION:
+            Returns queue metrics: a dictionary with DataIDs as keys
+            containing the queue depth, the age of the oldest queued line
+            (seconds) and the amount of written, spilled, dropped and
+            failed lines, as well as the amount of spilled lines on disk.
+        """
+        now = time.time()
+        result = {}
+        with self.condition:
+            for key, que in self.queues.items():
+                dataid = key[0]
+                entry = result.setdefault(dataid, {'queued':0, 'age':0.})
+                entry['queued'] += len(que)
+                if len(que) > 0:
+                    entry['age'] = max(entry['age'], now - self.since.get(key, now))
+        with self.spoollock:
+            for dataid in self.counters:
+                entry = result.setdefault(dataid, {'queued':0, 'age':0.})
+                entry.update(self.counters[dataid])
+        for dataid in self._spoolfiles():
+            entry = result.setdefault(dataid, {'queued':0, 'age':0.})
+            entry['spooled'] = self._spoolsize(dataid)
+        return result
+
+    # -------------------------------------------------------------------
+    # Writer side
+    # -------------------------------------------------------------------
+    def _count(self, dataid, name, amount):
+        with self.spoollock:
+            counter = self.counters.setdefault(dataid, {'written':0, 'spilled':0, 'dropped':0, 'failed':0})
+            counter[name] += amount
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    break
+                self.condition.wait(min(1., self.maxage))
+            try:
+                self.flush()
+                if self.statsinterval and time.time() - self.laststats > self.statsinterval:
+                    self.laststats = time.time()
+                    log.msg("BufferedDBWriter: queue status {}".format(self.stats()))
+            except Exception as e:
+                log.msg("BufferedDBWriter: unexpected error {}".format(e))
+
+    def _due(self, force=False):
+        # get all batches to be written (size or age limit reached)
+        now = time.time()
+        batches = []
+        with self.condition:
+            for key, que in self.queues.items():
+                while len(que) > 0 and (force or len(que) >= self.maxrows or now - self.since.get(key, now) >= self.maxage):
+                    batch = [que.popleft() for i in range(min(self.maxrows, len(que)))]
+                    batches.append((key[0], key[1], batch))
+                    self.since[key] = now
+        return batches
+
+    def flush(self, force=False):
+        """
+        DEFINITION:
+            Writes all queues which reached the size or age limit
+            (all queues if force is True).
+        """
+        batches = self._due(force=force)
+        if not self._connected():
+            for dataid, columns, batch in batches:
+                self._spill(dataid, columns, batch)
+            return
+        self._replay()
+        for dataid, columns, batch in batches:
+            if self.db is None:
+                self._spill(dataid, columns, batch)
+            else:
+                self._write(dataid, columns, batch)
+
+    def _connected(self):
+        if self.db is not None:
+            return True
+        if time.time() - self.lastattempt < self.retry:
+            return False
+        self.lastattempt = time.time()
+        try:
+            self.db = self.connect()
+            log.msg("BufferedDBWriter: connected to data base")
+            return True
+        except Exception as e:
+            log.msg("BufferedDBWriter: data base not reachable - {}".format(e))
+            self.db = None
+            return False
+
+    def _tableinfo(self, dataid):
+        info = self.tables.get(dataid)
+        if info is None or time.time() - info['checked'] > self.schemainterval:
+            rollup = self.rollup
+            if rollup is None:
+                rollup = len(dbcolumns(self.db, dataid + '_' + DBROLLUPS[0][0])) > 0
+            info = {'schema': dbtimeschema(self.db, dataid) or 'char', 'rollup': rollup, 'checked': time.time()}
+            self.tables[dataid] = info
+        return info
+
+    def _timeschema(self, dataid):
+        return self._tableinfo(dataid)['schema']
+
+    def _dbtimes(self, dataid, columns, batch):
+        # collectors provide time strings - convert them for tables
+        # with epoch time key
+        if not 'time' in columns or not self._timeschema(dataid) == 'epoch':
+            return batch
+        idx = list(columns).index('time')
+        times = [el[idx] for el in batch]
+        if all([isinstance(el, basestring) for el in times]):
+            times = _num2dbtime([date2num(datetime.strptime(el, DBTIMEFORMAT)) for el in times], 'epoch')
+            batch = [row[:idx] + (int(t),) + row[idx+1:] for row, t in zip(batch, times)]
+        return batch
+
+    def _insert(self, dataid, columns, batch):
+        try:
+            self._execute(dataid, columns, self._dbtimes(dataid, columns, batch))
+        except Exception as e:
+            if _isoutage(e) or not dataid in self.tables:
+                raise
+            # the table might have been migrated meanwhile
+            try:
+                self.db.rollback()
+            except:
+                pass
+            schema = self.tables.pop(dataid)['schema']
+            if self._timeschema(dataid) == schema:
+                raise
+            log.msg("BufferedDBWriter: time schema of {} changed to {}".format(dataid, self._timeschema(dataid)))
+            self._execute(dataid, columns, self._dbtimes(dataid, columns, batch))
+        self._rollup(dataid, columns, batch)
+
+    def _rollup(self, dataid, columns, batch):
+        # keep rollup tables current for the time range of the batch
+        if not 'time' in columns or not self._tableinfo(dataid)['rollup']:
+            return
+        idx = list(columns).index('time')
+        times = [_dbtime2string(el[idx]) for el in batch]
+        try:
+            dbrollupupdate(self.db, dataid, starttime=min(times), endtime=max(times))
+        except Exception as e:
+            if _isoutage(e):
+                raise
+            log.msg("BufferedDBWriter: could not update rollup tables of {} - {}".format(dataid, e))
+
+    def _execute(self, dataid, columns, batch):
+        # one parameterized multi-row insert - MySQLdb combines executemany
+        # on INSERT statements to a single statement
+        sql = "%s %s(%s) VALUES (%s)" % (dbdialect(self.db).insert('ignore'), dataid, ', '.join(columns), ', '.join(['%s']*len(columns)))
+        cursor = self.db.cursor()
+        try:
+            cursor.executemany(sql, batch)
+            self.db.commit()
+        finally:
+            cursor.close()
+
+    def _write(self, dataid, columns, batch):
+        try:
+            self._insert(dataid, columns, batch)
+            self._count(dataid, 'written', len(batch))
+            return True
+        except Exception as e:
+            try:
+                self.db.rollback()
+            except:
+                pass
+            if _isoutage(e):
+                log.msg("BufferedDBWriter: lost data base connection - spilling data")
+                self._disconnect()
+                self._spill(dataid, columns, batch)
+            else:
+                # no retry: the same error would occur again
+                log.msg("BufferedDBWriter: could not write {} lines to {} - {}".format(len(batch), dataid, e))
+                self._count(dataid, 'failed', len(batch))
+            return False
+
+    def _disconnect(self):
+        try:
+            self.db.close()
+        except:
+            pass
+        self.db = None
+        self.lastattempt = time.time()
+        self.tables = {}
+
+    # -------------------------------------------------------------------
+    # On-disk spill buffer: one file per DataID containing json lines
+    # {"columns": [...], "rows": [[...], ...]}
+    # -------------------------------------------------------------------
+    def _spoolpath(self, dataid):
+        return os.path.join(self.spooldir, dataid + '.spool')
+
+    def _spoolfiles(self):
+        if not self.spooldir or not os.path.isdir(self.spooldir):
+            return []
+        return sorted([el[:-6] for el in os.listdir(self.spooldir) if el.endswith('.spool')])
+
+    def _spoolsize(self, dataid):
+        amount = 0
+        try:
+            with open(self._spoolpath(dataid)) as spool:
+                for line in spool:
+                    amount += len(json.loads(line).get('rows', []))
+        except (IOError, ValueError):
+            pass
+        return amount
+
+    def _spill(self, dataid, columns, batch):
+        if not len(batch) > 0:
+            return
+        if not self.spooldir:
+            self._count(dataid, 'dropped', len(batch))
+            return
+        try:
+            with self.spoollock:
+                with open(self._spoolpath(dataid), 'a') as spool:
+                    spool.write(json.dumps({'columns': list(columns), 'rows': [list(el) for el in batch]}) + '\n')
+            self._count(dataid, 'spilled', len(batch))
+        except (IOError, OSError) as e:
+            log.msg("BufferedDBWriter: could not spill data of {} - {}".format(dataid, e))
+            self._count(dataid, 'dropped', len(batch))
+
+    def _recover(self):
+        # batches of an interrupted replay are put in front of the spill file
+        if not self.spooldir:
+            return
+        for name in os.listdir(self.spooldir):
+            if name.endswith('.spool.replay'):
+                path = os.path.join(self.spooldir, name[:-7])
+                with open(os.path.join(self.spooldir, name)) as spool:
+                    lines = spool.readlines()
+                newer = []
+                if os.path.isfile(path):
+                    with open(path) as spool:
+                        newer = spool.readlines()
+                with open(path, 'w') as spool:
+                    spool.writelines(lines + newer)
+                os.remove(os.path.join(self.spooldir, name))
+
+    def _replay(self):
+        # write spilled batches in their original order, keep the
+        # remaining ones if the connection gets lost again
+        for dataid in self._spoolfiles():
+            path = self._spoolpath(dataid)
+            try:
+                # take over the file - new spills start a new one
+                with self.spoollock:
+                    replaypath = path + '.replay'
+                    os.rename(path, replaypath)
+                with open(replaypath) as spool:
+                    lines = spool.readlines()
+            except (IOError, OSError):
+                continue
+            for idx, line in enumerate(lines):
+                try:
+                    content = json.loads(line)
+                    batch = [tuple(el) for el in content['rows']]
+                except (ValueError, KeyError):
+                    continue
+                try:
+                    self._insert(dataid, content['columns'], batch)
+                    self._count(dataid, 'written', len(batch))
+                except Exception as e:
+                    try:
+                        self.db.rollback()
+                    except:
+                        pass
+                    if _isoutage(e):
+                        self._disconnect()
+                        # keep the original order: remaining lines first
+                        with self.spoollock:
+                            newer = []
+                            if os.path.isfile(path):
+                                with open(path) as spool:
+                                    newer = spool.readlines()
+                            with open(path, 'w') as spool:
+                                spool.writelines(lines[idx:] + newer)
+                        os.remove(replaypath)
+                        return
+                    log.msg("BufferedDBWriter: could not write {} spilled lines to {} - {}".format(len(batch), dataid, e))
+                    self._count(dataid, 'failed', len(batch))
+            os.remove(replaypath)
@@ -0,0 +1,259 @@
+"""
+Collector service for many MARTAS nodes (moons)
+
+collector_moon.py connects one collector process to one moon. Observatories
+with many nodes would need one process, one data base connection and one
+writer per node. CollectorService manages the WAMP sessions of all nodes
+of a configuration file within one process:
+  - each source has its own session (PubSubClient) and reconnecting
+    factory, so sensor lists, sequence numbers and resynchronization state
+    are kept per source and a failing node does not affect the others
+  - all sources share one data base connection pool (metadata requests)
+    and one BufferedDBWriter (batched inserts by a single thread)
+  - per source metrics (lines, rate, lag of the sample times, errors,
+    reconnects) are logged and written to a JSON status file
+
+Configuration (JSON):
+    {
+     "destpath": "/home/cobs/MARCOS",
+     "output": "db",
+     "db": "mydb",
+     "poolsize": 4,
+     "statsinterval": 60,
+     "sources": [
+        {"name": "titan", "ip": "138.22.188.182", "port": 9100,
+         "stationid": "WIC", "martaspath": "/home/cobs/MARTAS", "ssh": "cobs"},
+        {"name": "moon2", "ip": "192.168.178.47", "stationid": "WIC", "ssh": "cobs",
+         "product": "min"},
+        {"name": "moon3", "ip": "192.168.178.48", "stationid": "WIC", "ssh": "cobs",
+         "expand": 30}
+     ]
+    }
+"db" and "ssh" are shortcuts of the credential file (see magpy.opt.cred).
+"product" selects filtered one second ("sec") or one minute ("min") values
+of the moon instead of raw data (see magpy.acquisition.decimation).
+"expand" stores change based published sensors (see
+magpy.acquisition.publishpolicy) at the given resolution in seconds.
+
+Usage:
+    python multicollector.py collector.json
+"""
+import sys
+import os
+import json
+import time
+import calendar
+from datetime import datetime
+
+from twisted.python import log
+from twisted.internet import reactor, task
+try: # autovers > 0.7.0:
+    from autobahn.twisted.websocket import connectWS
+except:
+    from autobahn.websocket import connectWS
+
+from magpy.collector import subscribe2client as cl
+from magpy.collector.dbwriter import BufferedDBWriter
+from magpy.database import DBConnectionPool
+from magpy.opt import cred as mpcred
+
+
+class SourceMetrics(object):
+    """
+    DEFINITION:
+        Metrics of one source, updated by its PubSubClient (via
+        factory.metrics). The lag (arrival time minus sample time) is
+        evaluated at most every lagstep seconds per sensor.
+    """
+    def __init__(self, name, lagstep=1.):
+        self.name = name
+        self.lagstep = lagstep
+        self.lines = 0
+        self.errors = 0
+        self.sessions = 0
+        self.online = False
+        self.lastseen = None
+        self.lag = {}       # sensorid : [lag in seconds, time of evaluation]
+        self.last = (time.time(), 0)
+
+    def connected(self):
+        self.sessions += 1
+        self.online = True
+
+    def disconnected(self):
+        self.online = False
+
+    def error(self):
+        self.errors += 1
+
+    def record(self, sensorid, line):
+        now = time.time()
+        self.lines += 1
+        self.lastseen = now
+        entry = self.lag.get(sensorid)
+        if entry is None or now - entry[1] >= self.lagstep:
+            try:
+                sampletime = calendar.timegm(datetime.strptime(line[0], "%Y-%m-%d %H:%M:%S.%f").utctimetuple())
+                self.lag[sensorid] = [now - sampletime, now]
+            except (TypeError, ValueError, IndexError):
+                pass
+
+    def stats(self):
+        """
+        Returns lines, rate (lines/s since the previous call), lag (maximum
+        of all sensors, seconds), errors, reconnects, connected and the
+        seconds since the last line.
+        """
+        now = time.time()
+        since, lines = self.last
+        self.last = (now, self.lines)
+        lags = [entry[0] for entry in self.lag.values()]
+        return {'lines': self.lines, 'rate': (self.lines - lines)/max(now - since, 1e-9),
+                'lag': max(lags) if lags else None, 'sensors': len(self.lag),
+                'errors': self.errors, 'reconnects': max(self.sessions - 1, 0),
+                'connected': self.online,
+                'idle': now - self.lastseen if self.lastseen else None}
+
+
+class CollectorService(object):
+    """
+    DEFINITION:
+        Collects the data of many moons within one process.
+
+    PARAMETERS:
+        - sources:      (list) dictionaries with name, ip, port (default 9100),
+                        stationid, sshcred ([user, passwd]) and martaspath
+                        (sensor lists are copied from the moon) or
+                        sensorlist/owlist, optional product ('sec', 'min')
+                        and expand (resolution in seconds)
+    Kwargs:
+        - destpath:     (string) MARCOS directory (MoonsSensors, MartasFiles)
+        - output:       (string) 'db' or 'file'
+        - dbcred:       (list) host, user, passwd, db
+        - poolsize:     (int) data base connections (at least one per source)
+        - statsinterval: (float) seconds between metric reports
+        - printdata:    (bool) print received data
+
+    APPLICATION:
+        service = CollectorService(sources, destpath='/home/cobs/MARCOS', dbcred=[...])
+        service.start()
+        reactor.run()
+    """
+    def __init__(self, sources, destpath, output='db', dbcred=None, poolsize=4, statsinterval=60., printdata=False):
+        if output == 'db' and not dbcred:
+            raise ValueError("CollectorService: db output requires dbcred")
+        self.sources = sources
+        self.destpath = destpath
+        self.output = output
+        self.dbcred = dbcred
+        self.poolsize = poolsize
+        self.statsinterval = statsinterval
+        self.printdata = printdata
+        self.statsfile = os.path.join(destpath, 'MartasFiles', 'collector_stats.json')
+        self.pool = None
+        self.writer = None
+        self.factories = {}
+        self.loop = None
+
+    def start(self):
+        if self.output == 'db':
+            host, user, passwd, dbname = self.dbcred
+            # each session keeps one connection for metadata requests
+            self.pool = DBConnectionPool(max(self.poolsize, len(self.sources)), 'mysql', host=host, user=user, passwd=passwd, db=dbname)
+            self.writer = BufferedDBWriter(dbcred=self.dbcred, spooldir=os.path.join(self.destpath, 'MartasFiles', 'spool'))
+            self.writer.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        for source in self.sources:
+            try:
+                self.addsource(source)
+            except:
+                log.err("CollectorService: could not start source %s" % source.get('name'))
+        self.loop = task.LoopingCall(self.report)
+        self.loop.start(self.statsinterval, now=False)
+
+    def addsource(self, source):
+        """
+        Connects to the moon of source and returns its factory.
+        """
+        name = source['name']
+        sensorlist, owlist = source.get('sensorlist'), source.get('owlist')
+        if sensorlist is None:
+            sensorlist, owlist = cl.getsensorlists(name, source['ip'], source['martaspath'], self.destpath, source['sshcred'])
+        factory = cl.PubSubClientFactory("ws://%s:%d" % (source['ip'], int(source.get('port', 9100))), debugWamp=False)
+        factory.source = {'clientname': name, 'clientip': source['ip'], 'output': self.output,
+                          'stationid': source['stationid'], 'sshcred': source.get('sshcred'),
+                          'sensorlist': sensorlist, 'owlist': owlist or [], 'destpath': self.destpath,
+                          'printdata': source.get('printdata', self.printdata), 'dbcred': self.dbcred,
+                          'product': source.get('product'), 'expand': source.get('expand')}
+        factory.writer = self.writer
+        factory.pool = self.pool
+        factory.metrics = SourceMetrics(name)
+        self.factories[name] = factory
+        log.msg("CollectorService: Connecting to %s (%d sensors)" % (name, len(sensorlist)))
+        connectWS(factory)
+        return factory
+
+    def stats(self):
+        """
+        Returns the metrics of all sources and the data base writer.
+        """
+        result = {'time': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                  'sources': dict([(name, factory.metrics.stats()) for name, factory in self.factories.items()])}
+        if self.writer:
+            result['writer'] = self.writer.stats()
+        if self.pool:
+            result['pool'] = dict(self.pool.stats)
+        return result
+
+    def report(self):
+        stats = self.stats()
+        for name in sorted(stats['sources']):
+            entry = stats['sources'][name]
+            log.msg("CollectorService: %s %s - %.1f lines/s, lag %s s, %d errors, %d reconnects" % (name,
+                    'connected' if entry['connected'] else 'DISCONNECTED', entry['rate'],
+                    '%.1f' % entry['lag'] if entry['lag'] is not None else '-', entry['errors'], entry['reconnects']))
+        try:
+            tmpfile = self.statsfile + '.tmp'
+            with open(tmpfile, 'w') as fh:
+                json.dump(stats, fh)
+            os.rename(tmpfile, self.statsfile)
+        except (IOError, OSError) as e:
+            log.msg("CollectorService: could not write %s: %s" % (self.statsfile, e))
+        return stats
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        if self.writer:
+            self.writer.stop()
+        if self.pool:
+            self.pool.closeall()
+
+
+def readconfig(filename):
+    """
+    Reads the JSON configuration and resolves the credential shortcuts.
+    Returns the keyword arguments of CollectorService.
+    """
+    with open(filename) as fh:
+        config = json.load(fh)
+    dbcred = None
+    if config.get('db'):
+        dbcred = [mpcred.lc(config['db'], el) for el in ['host', 'user', 'passwd', 'db']]
+    sources = []
+    for source in config['sources']:
+        source = dict(source)
+        if source.get('ssh'):
+            source['sshcred'] = [mpcred.lc(source['ssh'], 'user'), mpcred.lc(source['ssh'], 'passwd')]
+        source.setdefault('martaspath', '/home/cobs/MARTAS')
+        sources.append(source)
+    return {'sources': sources, 'destpath': config['destpath'], 'output': config.get('output', 'db'),
+            'dbcred': dbcred, 'poolsize': config.get('poolsize', 4),
+            'statsinterval': config.get('statsinterval', 60.), 'printdata': config.get('printdata', False)}
+
+
+if __name__ == '__main__':
+    log.startLogging(sys.stdout)
+    service = CollectorService(**readconfig(sys.argv[1]))
+    service.start()
+    reactor.run()
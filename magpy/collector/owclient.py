@@ -1,4 +1,4 @@
-import sys, os, struct
+import sys, os, socket, struct
 from twisted.python import log
 try: # version > 0.8.0
     from autobahn.wamp1.protocol import WampClientProtocol
@@ -16,12 +16,14 @@ try:
     from magpy.database import stream2db
     from magpy.opt import cred as mpcred
     from magpy.transfer import scptransfer
+    from magpy.collector.binwriter import BinLayout, dailybinwriter
 except:
     sys.path.append('/home/leon/Software/magpy/trunk/src')
     import stream as st
     from magpy.database import stream2db
     from magpy.opt import cred as mpcred
     from magpy.transfer import scptransfer
+    from magpy.collector.binwriter import BinLayout, dailybinwriter
 
 clientname = 'default'
 s = []
@@ -73,23 +75,14 @@ def timeToArray(timestring):
         return []
 
 def dataToFile(outputdir, sensorid, filedate, bindata, header):
-    # File Operations
+    # File Operations: buffered, fixed size records (see binwriter)
     try:
         hostname = socket.gethostname()
         path = os.path.join(outputdir,hostname,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if not os.path.isfile(savefile):
-            with open(savefile, "wb") as myfile:
-                myfile.write(header + "\n")
-                myfile.write(bindata + "\n")
-        else:
-            with open(savefile, "a") as myfile:
-                myfile.write(bindata + "\n")
+        layout = BinLayout.fromheader(header)
+        dailybinwriter.put(path, layout, filedate, struct.unpack(layout.packcode, bindata))
     except:
-        log.msg('collectors owclient: Error while saving file')        
+        log.msg('collectors owclient: Error while saving file')
 
 class PubSubClient(WampClientProtocol):
     """
@@ -1,14 +1,15 @@
 import sys, os, struct
 from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.protocol import ReconnectingClientFactory
 try: # version > 0.8.0
-    from autobahn.wamp1.protocol import WampClientProtocol
+    from autobahn.wamp1.protocol import WampClientFactory, WampClientProtocol
 except:
-    from autobahn.wamp import WampClientProtocol
+    from autobahn.wamp import WampClientFactory, WampClientProtocol
 # For converting Unicode text
 import collections
 # For saving
 import numpy as np
-import multiprocessing
 # Timing
 from datetime import datetime, timedelta
 # Database
@@ -28,20 +29,33 @@ secondary time column in POS1 file was added manually to data base - not availab
 
 try:
     import magpy.stream as st
-    from magpy.database import stream2db
+    from magpy.database import stream2db, writeDB, dbsensorinfo, dbselect, dblasttime
     from magpy.opt import cred as mpcred
     from magpy.transfer import scptransfer
+    from magpy.collector.dbwriter import BufferedDBWriter
+    from magpy.collector.binwriter import BinLayout, dailybinwriter
+    from magpy.acquisition.wampbatch import unpackbatch, decodebatch, datetime2ns, ns2string, BATCHTIMEIDS, BATCHTIMEKEYS
+    from magpy.acquisition.publishpolicy import parsepolicy
 except:
     sys.path.append('/home/leon/Software/magpy/trunk/src')
     import stream as st
-    from magpy.database import stream2db
+    from magpy.database import stream2db, writeDB, dbsensorinfo, dbselect, dblasttime
     from magpy.opt import cred as mpcred
     from magpy.transfer import scptransfer
+    from magpy.collector.dbwriter import BufferedDBWriter
+    from magpy.collector.binwriter import BinLayout, dailybinwriter
+    from magpy.acquisition.wampbatch import unpackbatch, decodebatch, datetime2ns, ns2string, BATCHTIMEIDS, BATCHTIMEKEYS
+    from magpy.acquisition.publishpolicy import parsepolicy
 
 clientname = 'default'
 s = []
 o = []
 marcospath = ''
+# maximal amount of lines per range request (resynchronization)
+RESYNCLIMIT = 50000
+# data revision of filtered products of moon (DataID: sensorid_revision),
+# raw data are stored in revision 0001
+PRODUCTREVISIONS = {'sec': '1001', 'min': '1060'}
 
 
 IDDICT = {0:'clientname',1:'time',2:'date',3:'time',4:'time',5:'coord',
@@ -86,6 +100,46 @@ def sendparameter(cname,cip,marcospath,op,sid,sshc,sensorlist,owlist,pd,dbc=None
     print "Parameters transfered"
     return
 
+def sourceparameter():
+    """
+    Parameters of the source as set by sendparameter (one source per
+    process). Collectors of many sources (see multicollector) provide
+    them as factory.source instead.
+    """
+    return {'clientname': clientname, 'clientip': globals().get('clientip'), 'output': globals().get('output'),
+            'stationid': globals().get('stationid'), 'sshcred': globals().get('sshcred'),
+            'sensorlist': s, 'owlist': o, 'destpath': globals().get('destpath'),
+            'printdata': globals().get('printdata', False), 'dbcred': globals().get('dbcred'),
+            'product': globals().get('product'), 'expand': globals().get('expand')}
+
+def getsensorlists(clientname, clientip, martaspath, destpath, sshcred):
+    """
+    Copies sensors.txt and owlist.csv of the moon to
+    destpath/MoonsSensors (clientname_sensors.txt, clientname_owlist.csv)
+    and returns the sensor list and the one wire list. Raises an exception
+    if the sensor list cannot be obtained, a missing one wire list is
+    returned as empty list.
+    """
+    import csv
+    destsensfile = os.path.join(destpath,'MoonsSensors',clientname+'_sensors.txt')
+    destowfile = os.path.join(destpath,'MoonsSensors',clientname+'_owlist.csv')
+    scptransfer(sshcred[0]+'@'+clientip+':'+os.path.join(martaspath,'sensors.txt'),destsensfile,sshcred[1])
+    try:
+        scptransfer(sshcred[0]+'@'+clientip+':'+os.path.join(martaspath,'owlist.csv'),destowfile,sshcred[1])
+    except:
+        log.msg("collectors client: No one wire info available on client %s - proceeding" % clientname)
+    sensorlist, owlist = [], []
+    with open(destsensfile,'rb') as f:
+        for line in csv.reader(f):
+            if len(line) < 2:
+                sensorlist.append(line[0].split())
+            else:
+                sensorlist.append(line)
+    if os.path.isfile(destowfile):
+        with open(destowfile,'rb') as f:
+            owlist = [line for line in csv.reader(f)]
+    return sensorlist, owlist
+
 def timeToArray(timestring):
     # Converts time string of format 2013-12-12T23:12:23.122324
     # to an array similiat to a datetime object
@@ -102,21 +156,69 @@ def timeToArray(timestring):
         log.msg('collectors owclient: Error while extracting time array')
         return []
 
+def batchkeys(event):
+    """
+    Column names of a (decoded) range response: 'keys' of file based
+    responses or the names of the event ids (time first, further time
+    columns are 'sectime'). None for ids without column.
+    """
+    if 'keys' in event:
+        return list(event['keys'])
+    keys = []
+    for i, idx in enumerate(event['ids']):
+        if idx in BATCHTIMEIDS:
+            keys.append('time' if i == 0 else 'sectime')
+        else:
+            keys.append(IDDICT.get(idx))
+    return keys
+
+def batch2lines(event):
+    """
+    Returns column names and data lines (times as strings, the primary
+    time rounded to milliseconds, NaN as None) of a (decoded) range response.
+    """
+    keys = batchkeys(event)
+    use = [i for i, key in enumerate(keys) if key]
+    columns = []
+    for i in use:
+        if keys[i] in BATCHTIMEKEYS:
+            columns.append([ns2string(el, rounding=keys[i] == 'time') for el in event['data'][i]])
+        else:
+            columns.append([None if np.isnan(el) else el for el in event['data'][i]])
+    return [keys[i] for i in use], [list(line) for line in zip(*columns)]
+
+def batch2stream(events, sensorid, module):
+    """
+    Creates a DataStream from batch events (see wampbatch) as returned
+    by the ring buffers of MARTAS (buffer#get-range).
+    """
+    keys = batchkeys(events[0])
+    columns = [[] for key in keys]
+    for event in events:
+        for i, col in enumerate(event['data']):
+            columns[i].extend(col)
+    array = [np.asarray([]) for key in st.KEYLIST]
+    header = {'SensorID': sensorid}
+    valueids = [idx for idx in MODIDDICT.get(module,[]) if not idx in BATCHTIMEIDS]
+    for i, key in enumerate(keys):
+        if not key in st.KEYLIST:
+            continue
+        if key in BATCHTIMEKEYS:
+            col = [st.date2num(datetime(1970,1,1)+timedelta(microseconds=el//1000)) for el in columns[i]]
+        else:
+            col = columns[i]
+            idx = events[0]['ids'][i] if 'ids' in events[0] else None
+            if idx in valueids and len(NAMEDICT.get(module,[])) == len(valueids):
+                header['col-'+key] = NAMEDICT[module][valueids.index(idx)]
+                header['unit-col-'+key] = UNITDICT[module][valueids.index(idx)]
+        array[st.KEYLIST.index(key)] = np.asarray(col)
+    return st.DataStream([st.LineStruct()], header, np.asarray(array, dtype=object))
+
 def dataToFile(outputdir, sensorid, filedate, bindata, header):
-    # File Operations
+    # File Operations: buffered, fixed size records (see binwriter)
     try:
-        path = os.path.join(outputdir,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if not os.path.isfile(savefile):
-            with open(savefile, "wb") as myfile:
-                myfile.write(header + "\n")
-                myfile.write(bindata + "\n")
-        else:
-            with open(savefile, "a") as myfile:
-                myfile.write(bindata + "\n")
+        layout = BinLayout.fromheader(header)
+        dailybinwriter.put(os.path.join(outputdir,sensorid), layout, filedate, struct.unpack(layout.packcode, bindata))
     except:
         log.msg('collectors owclient: Error while saving file')
 
@@ -126,23 +228,28 @@ class PubSubClient(WampClientProtocol):
     """
     def onSessionOpen(self):
         print "Starting"
-        global clientname
-        global clientip
-        global o
-        global s
-        global destpath
-        global printdata
-        global bufferarray
-        global output
-        global module
-        global stationid
-        global dbcred
-        global sshcred
-        log.msg("Starting " + clientname + " session")
+        # parameters of this source: factory.source or set by sendparameter
+        source = getattr(self.factory, 'source', None) or sourceparameter()
+        self.clientname = source['clientname']
+        self.clientip = source['clientip']
+        self.sshcred = source['sshcred']
+        self.sensorlist = source['sensorlist']
+        self.owlist = source['owlist']
+        self.destpath = source['destpath']
+        self.printdata = source['printdata']
+        log.msg("Starting " + self.clientname + " session")
         # TODO Make all the necessary parameters variable
         # Basic definitions to change
-        self.stationid = stationid
-        self.output = output
+        self.stationid = source['stationid']
+        self.output = source['output']
+        # filtered product of the moon ('sec' or 'min') instead of raw data
+        self.product = source.get('product')
+        # resolution (sec) of change based published sensors (publication
+        # policy in sensors.txt/owlist.csv): values are repeated (sample and
+        # hold) up to the next published reading, None stores them as received
+        self.expand = source.get('expand')
+        self.policies = self.publicationPolicies()
+        self.lastline = {}
         self.sensorid = ''
         self.sensortype = ''
         self.sensorgroup = ''
@@ -156,18 +263,41 @@ class PubSubClient(WampClientProtocol):
         # Open database connection
         self.db = None
         self.cursor = None
-        if not output == 'file':
+        self.writer = None
+        # shared by all sources of a multicollector (optional)
+        self.pool = getattr(self.factory, 'pool', None)
+        self.metrics = getattr(self.factory, 'metrics', None)
+        self.owsensors = {}
+        self.binlayouts = {}
+        self.batched = []   # sensors delivering batch events (see wampbatch)
+        self.sequence = {}  # last batch sequence number of each sensor
+        self.lasttime = {}  # last received time (epoch ns) of batched sensors
+        self.datainfoids = {}
+        if not self.output == 'file':
             log.msg("collectors client: Connecting to DB ...")
-            self.db = MySQLdb.connect(dbcred[0],dbcred[1],dbcred[2],dbcred[3] )
+            dbcred = source['dbcred']
+            if self.pool:
+                self.db = self.pool.acquire()
+            else:
+                self.db = MySQLdb.connect(dbcred[0],dbcred[1],dbcred[2],dbcred[3] )
             # prepare a cursor object using cursor() method
             self.cursor = self.db.cursor()
             log.msg("collectors client: ... DB successfully connected ")
+            # data lines are written in batches by a separate connection:
+            # one writer per factory, kept over reconnects, stopped at shutdown
+            self.writer = getattr(self.factory, 'writer', None)
+            if not self.writer:
+                self.writer = self.factory.writer = BufferedDBWriter(dbcred=dbcred, spooldir=os.path.join(self.destpath,'MartasFiles','spool'))
+                self.writer.start()
+                reactor.addSystemEventTrigger('before', 'shutdown', self.writer.stop)
+        if self.metrics:
+            self.metrics.connected()
         # Initiate subscriptions
         self.line = []
-        for row in s:
+        for row in self.sensorlist:
             module = row[0]
             log.msg("collectors client: Starting subscription for %s" % module)
-            self.subscribeInst(self.db, self.cursor, clientname, module, output)
+            self.subscribeInst(self.db, self.cursor, self.clientname, module, self.output)
 
     def subscribeOw(self, client, output, module, owlist):
         """
@@ -181,7 +311,6 @@ class PubSubClient(WampClientProtocol):
             # ideal way: upload an already existing file from moon for each sensor
             # check client for existing file:
             for row in owlist:
-                subs = True
                 print "collectors owclient: Running for sensor", row[0]
                 # Try to find sensor in db:
                 sql = "SELECT SensorID FROM SENSORS WHERE SensorID LIKE '%s%%'" % row[0]
@@ -198,45 +327,187 @@ class PubSubClient(WampClientProtocol):
                     results = []
                 if len(results) < 1:
                     # Initialize e.g. ow table
-                    log.msg("collectors owclient: No sensors registered so far - Getting file from moon and uploading it")
-                    # if not present then get a file and upload it
-                    #destpath = [path for path, dirs, files in os.walk("/home") if path.endswith('MARCOS')][0]
-                    day = datetime.strftime(datetime.utcnow(),'%Y-%m-%d')
-                    destfile = os.path.join(destpath,'MartasFiles', row[0]+'_'+day+'.bin')
-                    datafile = os.path.join('/srv/ws/', clientname, row[0], row[0]+'_'+day+'.bin')
-                    try:
-                        log.msg("collectors owclient: Downloading data: %s" % datafile)
-                        scptransfer(sshcred[0]+'@'+clientip+':'+datafile,destfile,sshcred[1])
-                        stream = st.read(destfile)
-                        log.msg("collectors owclient: Reading with MagPy... Found: %s datapoints" % str(len(stream)))
-                        stream.header['StationID'] = self.stationid
-                        stream.header['SensorModule'] = 'OW'
-                        stream.header['SensorType'] = row[1]
-                        if not row[2] == 'typus':
-                            stream.header['SensorGroup'] = row[2]
-                        if not row[3] == 'location':
-                            stream.header['DataLocationReference'] = row[3]
-                        if not row[4] == 'info':
-                            stream.header['SensorDescription'] = row[4]
-                        if not len(stream.ndarray[0]) > 0:
-                            stream = stream.linestruct2ndarray()
-                        stream2db(self.db,stream)
-                        log.msg("collectors owclient: Stream uploaded successfully")
-                    except:
-                        log.msg("collectors owclient: Could not upload data to the data base - subscription to %s failed" % row[0])
-                        subs = False
+                    log.msg("collectors owclient: No sensors registered so far - Getting recent data from moon and uploading it")
+                    header = {'StationID': self.stationid, 'SensorModule': 'OW', 'SensorType': row[1]}
+                    if not row[2] == 'typus':
+                        header['SensorGroup'] = row[2]
+                    if not row[3] == 'location':
+                        header['DataLocationReference'] = row[3]
+                    if not row[4] == 'info':
+                        header['SensorDescription'] = row[4]
+                    d = self.bootstrapSensor(client, module, row[0], header, ['bin'])
+                    d.addCallback(self.bootstrapped, module, row[0])
+                    d.addCallback(self.subscribeOwSensor, module, row[0])
                 else:
                     log.msg("collectors owclient: Found sensor(s) in DB - subscribing to the highest revision number")
-                if subs:
-                    subscriptionstring = "%s:%s-value" % (module, row[0])
-                    print "collectors owclient: Subscribing (directing to DB): ", subscriptionstring
-                    self.subscribe(subscriptionstring, self.onEvent)
+                    self.subscribeOwSensor(True, module, row[0])
+                    # data published while not connected
+                    self.datainfoids[row[0]] = results[-1][0]+'_0001'
+                    self.resyncSensor(client, module, row[0])
         elif output == 'file':
-            for row in o:
+            for row in self.owlist:
                 print "collectors owclient: Running for sensor", row[0]
                 subscriptionstring = "%s:%s-value" % (module, row[0])
                 print "collectors owclient: Subscribing (directing to file): ", subscriptionstring
                 self.subscribe(subscriptionstring, self.onEvent)
+                self.subscribe("%s:%s-batch" % (module, row[0]), self.onBatchEvent)
+
+    def subscribeOwSensor(self, success, module, sensorid):
+        if not success:
+            log.msg("collectors owclient: Could not upload data to the data base - subscription to %s failed" % sensorid)
+            return
+        subscriptionstring = "%s:%s-value" % (module, sensorid)
+        print "collectors owclient: Subscribing (directing to DB): ", subscriptionstring
+        self.subscribe(subscriptionstring, self.onEvent)
+        self.subscribe("%s:%s-batch" % (module, sensorid), self.onBatchEvent)
+
+    def uploadStream(self, stream, header, datainfoid=None):
+        for key in header:
+            stream.header[key] = header[key]
+        if not len(stream.ndarray[0]) > 0:
+            stream = stream.linestruct2ndarray()
+        if datainfoid and not datainfoid.endswith('_0001'):
+            # filtered product: own data table, never mixed with raw data
+            self.productInfo(stream.header, datainfoid)
+            writeDB(self.db, stream, tablename=datainfoid)
+            return
+        stream2db(self.db,stream)
+
+    def productInfo(self, header, datainfoid):
+        """
+        Registers the sensor and the DATAINFO row of a filtered product
+        (see PRODUCTREVISIONS) if not yet existing.
+        """
+        dbsensorinfo(self.db, header['SensorID'], header)
+        if len(dbselect(self.db, 'DataID', 'DATAINFO', 'DataID = "%s"' % datainfoid)) > 0:
+            return
+        sql = 'INSERT INTO DATAINFO(DataID, SensorID, StationID, DataSamplingFilter) VALUES ("%s", "%s", "%s", "%s")' % (datainfoid, header['SensorID'], header.get('StationID', self.stationid), self.product)
+        cursor = self.db.cursor()
+        cursor.execute(sql)
+        self.db.commit()
+
+    def uploadFromFile(self, sensorid, header, extensions):
+        """
+        Copies the daily files of sensorid from moon (scp) and uploads them.
+        Returns True if at least one file has been uploaded.
+        """
+        success = False
+        day = datetime.strftime(datetime.utcnow(),'%Y-%m-%d')
+        for exten in extensions:
+            destfile = os.path.join(self.destpath,'MartasFiles', sensorid+'_'+day+'.'+exten)
+            datafile = os.path.join('/srv/ws/', self.clientname, sensorid, sensorid+'_'+day+'.'+exten)
+            try:
+                log.msg("collectors client: Downloading data: %s" % datafile)
+                scptransfer(self.sshcred[0]+'@'+self.clientip+':'+datafile,destfile,self.sshcred[1])
+                stream = st.read(destfile)
+                log.msg("collectors client: Reading with MagPy... Found: %s datapoints" % str(len(stream)))
+                self.uploadStream(stream, header)
+                success = True
+            except:
+                log.msg("collectors client: Could not upload %s to the data base" % datafile)
+        return success
+
+    def rangeid(self, module, sensorid):
+        # id of the ring buffer providing the subscribed data
+        # (one wire sensors are too slow for filtered products)
+        if self.product and not module == 'ow':
+            return sensorid + '-' + self.product
+        return sensorid
+
+    def dataid(self, module, sensorid):
+        # data table of the subscribed data (filtered products are stored
+        # in their own revision, see PRODUCTREVISIONS)
+        if not self.rangeid(module, sensorid) == sensorid:
+            return sensorid + '_' + PRODUCTREVISIONS[self.product]
+        return sensorid + '_0001'
+
+    def uploadFromBuffer(self, client, module, sensorid, header):
+        """
+        Requests the ring buffer of sensorid from moon (RPC buffer#get-range)
+        and uploads it. Returns a Deferred firing True on success.
+        """
+        uri = "http://example.com/" + client + "/buffer#get-range"
+        events = []
+        def received(event):
+            event = decodebatch(self.convertUnicode(event))
+            if len(event['data']) > 0 and len(event['data'][0]) > 0:
+                events.append(event)
+                if not event.get('complete', True):
+                    # limited response - get the rest
+                    d = self.call(uri, self.rangeid(module, sensorid), event['data'][0][-1]+1, None, RESYNCLIMIT, 'b64')
+                    d.addCallback(received)
+                    return d
+            if not len(events) > 0:
+                raise ValueError("no buffered data")
+            stream = batch2stream(events, sensorid, module)
+            log.msg("collectors client: Received %s datapoints of %s from ring buffer" % (str(len(stream.ndarray[0])), sensorid))
+            self.uploadStream(stream, header, self.dataid(module, sensorid))
+            return True
+        d = self.call(uri, self.rangeid(module, sensorid), None, None, RESYNCLIMIT, 'b64')
+        d.addCallback(received)
+        return d
+
+    def bootstrapSensor(self, client, module, sensorid, header, extensions):
+        """
+        Creates the data base entries of a new sensor from the ring buffer of
+        moon, or, if not available, from the daily files (scp).
+        Returns a Deferred firing True on success.
+        """
+        d = self.uploadFromBuffer(client, module, sensorid, header)
+        if not self.rangeid(module, sensorid) == sensorid:
+            # daily files contain raw data
+            return d
+        def fallback(failure):
+            log.msg("collectors client: Ring buffer of %s not available (%s) - getting data file" % (sensorid, failure.getErrorMessage()))
+            return self.uploadFromFile(sensorid, header, extensions)
+        d.addErrback(fallback)
+        return d
+
+    def bootstrapped(self, success, module, sensorid):
+        """
+        Callback of bootstrapSensor: registers the data table of the new
+        sensor, so that gaps are resynchronized (see resyncSensor).
+        """
+        self.datainfoids[sensorid] = self.dataid(module, sensorid)
+        return success
+
+    def resyncSensor(self, client, module, sensorid, start=None, end=None):
+        """
+        Requests the data missing in the data base from moon (ring buffer
+        or daily files, RPC buffer#get-range) and queues them for the
+        writer. Default range: last stored time of the table up to now.
+        Lines already stored are ignored by the writer (INSERT IGNORE).
+        """
+        datainfoid = self.datainfoids.get(sensorid)
+        if not self.writer or not datainfoid:
+            return
+        if start is None:
+            last = dblasttime(self.db, datainfoid)
+            if last is None:
+                return
+            start = datetime2ns(last)
+        uri = "http://example.com/" + client + "/buffer#get-range"
+        amount = [0]
+        def received(event):
+            event = decodebatch(self.convertUnicode(event))
+            if not len(event['data']) > 0:
+                return
+            keys, lines = batch2lines(event)
+            for line in lines:
+                self.writer.put(datainfoid, keys, line)
+            amount[0] += len(lines)
+            if not event.get('complete', True) and len(lines) > 0:
+                d = self.call(uri, self.rangeid(module, sensorid), event['data'][0][-1]+1, end, RESYNCLIMIT, 'b64')
+                d.addCallback(received)
+                return d
+            log.msg("collectors client: Resynchronized %s - %d lines since %s" % (sensorid, amount[0], ns2string(start)))
+        def failed(failure):
+            log.msg("collectors client: Resynchronization of %s failed: %s" % (sensorid, failure.getErrorMessage()))
+            if self.metrics:
+                self.metrics.error()
+        d = self.call(uri, self.rangeid(module, sensorid), start, end, RESYNCLIMIT, 'b64')
+        d.addCallbacks(received, failed)
+        return d
 
     def subscribeSensor(self,client,output,module,sensorshort,sensorid):
         """
@@ -261,46 +532,49 @@ class PubSubClient(WampClientProtocol):
             except:
                 log.msg("collectors client: Unable to fetch SENSOR data from DB")
                 results = []
+            if len(results) > 0 and not self.rangeid(module, sensorid) == sensorid:
+                # sensor is known - check for the data table of the product
+                if not len(dbselect(self.db, 'DataID', 'DATAINFO', 'DataID = "%s"' % self.dataid(module, sensorid))) > 0:
+                    results = []
             if len(results) < 1:
-                # if not present then get a file and upload it
-                log.msg("collectors client: No sensors registered so far - Getting data file from moon and uploading it using stream2db")
-                day = datetime.strftime(datetime.utcnow(),'%Y-%m-%d')
-                for exten in ['bin','asc']:
-                    destfile = os.path.join(destpath,'MartasFiles', sensorid+'_'+day+'.'+exten)
-                    datafile = os.path.join('/srv/ws/', clientname, sensorid, sensorid+'_'+day+'.'+exten)
-                    try:
-                        log.msg("collectors client: Downloading data: %s" % datafile)
-                        scptransfer(sshcred[0]+'@'+clientip+':'+datafile,destfile,sshcred[1])
-                        stream = st.read(destfile)
-                        log.msg("collectors client: Reading with MagPy... Found: %s datapoints" % str(len(stream)))
-                        stream.header['StationID'] = self.stationid
-                        stream.header['SensorModule'] = sensorshort
-                        try:
-                            stream.header['SensorRevision'] = sensorid[-4:]
-                        except:
-                            log.msg("collectors client: Could not extract revision number for %s" % sensorid)
-                            pass
-                        try:
-                            stream.header['SensorSerialNum'] = sensorid.split('_')[-2]
-                        except:
-                            log.msg("collectors client: Could not extract serial number for %s" % sensorid)
-                            pass
-                        if not len(stream.ndarray[0]) > 0:
-                            stream = stream.linestruct2ndarray()
-                        stream2db(self.db,stream)
-                    except:
-                        log.msg("collectors client: Could not upload data to the data base - subscription failed")
+                # if not present then get recent data and upload it
+                log.msg("collectors client: No sensors registered so far - Getting recent data from moon and uploading it using stream2db")
+                header = {'StationID': self.stationid, 'SensorModule': sensorshort}
+                try:
+                    header['SensorRevision'] = sensorid[-4:]
+                except:
+                    log.msg("collectors client: Could not extract revision number for %s" % sensorid)
+                    pass
+                try:
+                    header['SensorSerialNum'] = sensorid.split('_')[-2]
+                except:
+                    log.msg("collectors client: Could not extract serial number for %s" % sensorid)
+                    pass
+                d = self.bootstrapSensor(client, module, sensorid, header, ['bin','asc'])
+                d.addCallback(self.bootstrapped, module, sensorid)
+                d.addCallback(lambda success: self.subscribeValues(module, sensorid))
             else:
                 log.msg("collectors client: Found sensor(s) in DB - subscribing to the highest revision number")
-            subscriptionstring = "%s:%s-value" % (module, sensorid)
-            print "collectors sensor client: Subscribing: ", subscriptionstring
-            self.subscribe(subscriptionstring, self.onEvent)
+                self.subscribeValues(module, sensorid)
+                # data published while not connected
+                self.datainfoids[sensorid] = self.dataid(module, sensorid)
+                self.resyncSensor(client, module, sensorid)
         elif output == 'file':
-            for row in o:
+            for row in self.owlist:
                 print "collectors client: Running for sensor", sensorid
                 subscriptionstring = "%s:%s-value" % (module, sensorid)
                 self.subscribe(subscriptionstring, self.onEvent)
-
+                self.subscribe("%s:%s-batch" % (module, sensorid), self.onBatchEvent)
+
+    def subscribeValues(self, module, sensorid):
+        if self.product:
+            print "collectors sensor client: Subscribing: %s:%s-%s-batch" % (module, sensorid, self.product)
+            self.subscribe("%s:%s-%s-batch" % (module, sensorid, self.product), self.onBatchEvent)
+            return
+        subscriptionstring = "%s:%s-value" % (module, sensorid)
+        print "collectors sensor client: Subscribing: ", subscriptionstring
+        self.subscribe(subscriptionstring, self.onEvent)
+        self.subscribe("%s:%s-batch" % (module, sensorid), self.onBatchEvent)
 
     def subscribeInst(self, db, cursor, client, mod, output):
         """
@@ -330,11 +604,11 @@ class PubSubClient(WampClientProtocol):
             module = sensshort.lower()
         self.module = module
         if module == 'ow':
-            if not len(o) > 0:
+            if not len(self.owlist) > 0:
                 log.msg('collectors client: No OW sensors available')
             else:
                 log.msg('Subscribing all OneWire Sensors ...')
-                self.subscribeOw(client,output,module,o)
+                self.subscribeOw(client,output,module,self.owlist)
         else:
             self.subscribeSensor(client,output,module,sensshort,mod)
 
@@ -350,7 +624,51 @@ class PubSubClient(WampClientProtocol):
         else:
             return data
 
-    def storeDataLine(self, row, paralst,revnumber='0001'):
+    def publicationPolicies(self):
+        # publication policies of the moon's sensors (see publishpolicy)
+        policies = {}
+        rows = [(row, 3) for row in self.sensorlist] + [(row, 5) for row in self.owlist]
+        for row, col in rows:
+            if not len(row) > col:
+                continue
+            try:
+                policy = parsepolicy(row[col])
+            except ValueError as e:
+                log.msg("collectors client: invalid publication policy of %s: %s" % (row[0], e))
+                continue
+            if policy:
+                policies[row[0]] = policy
+        return policies
+
+    def expandLine(self, sensorid, line):
+        """
+        Returns the lines between the previous line of the sensor and line
+        at the resolution self.expand (values of the previous line, as
+        they did not change beyond the deadband) followed by line. Gaps
+        longer than the heartbeat of the sensor are not filled.
+        """
+        try:
+            t = datetime.strptime(line[0], "%Y-%m-%d %H:%M:%S.%f")
+        except (TypeError, ValueError, IndexError):
+            return [line]
+        last = self.lastline.get(sensorid)
+        if last is not None and not t > last[0]:
+            return [line]
+        self.lastline[sensorid] = (t, line)
+        if last is None or not len(last[1]) == len(line):
+            return [line]
+        step = timedelta(seconds=float(self.expand))
+        if t - last[0] > timedelta(seconds=self.policies[sensorid].heartbeat) + 2*step:
+            return [line]
+        lines = []
+        fill = last[0] + step
+        while fill < t - step//2:
+            lines.append([datetime.strftime(fill, "%Y-%m-%d %H:%M:%S.%f")] + list(last[1][1:]))
+            fill += step
+        lines.append(line)
+        return lines
+
+    def storeDataLine(self, row, paralst,revnumber='0001', expanded=False):
         """
         Function which read a row coming from the subscribe command
         and writes the data to a file or database
@@ -358,6 +676,12 @@ class PubSubClient(WampClientProtocol):
         sensorid = row[0]
         module = row[1]
         line = row[2]
+        if self.metrics and not expanded:
+            self.metrics.record(sensorid, line)
+        if not expanded and self.expand and not self.product and sensorid in self.policies:
+            for fill in self.expandLine(sensorid, line):
+                self.storeDataLine([sensorid, module, fill], paralst, revnumber, expanded=True)
+            return
         if self.output == 'file':
             # missing namelst, unitlst and multilst - create dicts for that based on STANDARD
             packcode = '6hL'
@@ -381,41 +705,38 @@ class PubSubClient(WampClientProtocol):
                     pass
 
             keylst = paralst[1:]
-            packcode = packcode + 'l'*len(keylst)
-            multilst = [multiplier]*len(keylst)
-
             if not len(line) == len(paralst):
                 # Output only for testing purpose if you dont want to smash your logs
                 #log.msg("ERRRRRRRRRRRRRRRRRRRRROR")
                 self.line = []
             else:
-                for i, elem in enumerate(line):
-                    if i == 0:
-                        datearray = timeToArray(line[0])
-                    else:
-                        datearray.append(int(line[i]*multiplier))
-                day = datetime.strftime((datetime.strptime(line[0],"%Y-%m-%d %H:%M:%S.%f")),'%Y-%m-%d')
-                line = []
                 try:
-                    header = "# MagPyBin %s %s %s %s %s %s %d" % (sensorid, str(keylst), str(namelst), str(unitlst), str(multilst), packcode, struct.calcsize(packcode))
-                    data_bin = struct.pack(packcode,*datearray)
-                    dataToFile(os.path.join(destpath,'MartasFiles'), sensorid, day, data_bin, header)
+                    day = datetime.strftime((datetime.strptime(line[0],"%Y-%m-%d %H:%M:%S.%f")),'%Y-%m-%d')
+                    layout = self.binLayout(sensorid, keylst, namelst, unitlst, multiplier)
+                    datearray = timeToArray(line[0])
+                    datearray.extend([int(value*multiplier) for key, value in zip(keylst, line[1:]) if not key == 'sectime'])
+                    if 'sectime' in keylst:
+                        datearray.extend(timeToArray(line[keylst.index('sectime')+1]))
+                    dailybinwriter.put(os.path.join(self.destpath,'MartasFiles',sensorid), layout, day, datearray)
                 except:
                     #log.msg("error")
                     pass
+                line = []
         else:
             """
             Please note:
-            Data is always automatically appended to datainfoid 0001
+            Data is always automatically appended to datainfoid 0001,
+            filtered products to their own revision (PRODUCTREVISIONS)
             """
             if module == 'ow':
                 # DB request is necessary as sensorid has no revision information
-                sql = "SELECT SensorID, SensorGroup, SensorType FROM SENSORS WHERE SensorID LIKE '%s%%'" % sensorid
-                self.cursor.execute(sql)
-                results = self.cursor.fetchall()
-                sid = results[-1][0]
-                sgr = results[-1][1]
-                sty = results[-1][2]
+                # (only once per sensor)
+                if not sensorid in self.owsensors:
+                    sql = "SELECT SensorID, SensorGroup, SensorType FROM SENSORS WHERE SensorID LIKE '%s%%'" % sensorid
+                    self.cursor.execute(sql)
+                    results = self.cursor.fetchall()
+                    self.owsensors[sensorid] = results[-1][:3]
+                sid, sgr, sty = self.owsensors[sensorid]
                 datainfoid = sid+'_'+revnumber
                 if sty == 'DS18B20':
                     paralst = ['time','t1']
@@ -428,32 +749,33 @@ class PubSubClient(WampClientProtocol):
                         paralst = ['time', 't1', 'var1', 'var2', 'var3', 'var4']
                 self.typ = 'ow'
             else:
-                datainfoid = sensorid+'_0001'
-
-            # define insert from provided param
-            parastr = ', '.join(paralst)
-            # separate floats and string
-            nelst = []
-            for elem in line:
-                if isinstance(elem, str):
-                    elem = "'"+elem+"'"
-                nelst.append(elem)
-            linestr = ', '.join(map(str, nelst))
-            sql = "INSERT INTO %s(%s) VALUES (%s)" % (datainfoid, parastr, linestr)
-            if printdata:
-                print "!!!!!!!!!!!!!!!! SQL !!!!!!!!!!!!!!", sql
+                datainfoid = self.dataid(module, sensorid)
+
+            if self.printdata:
+                print "!!!!!!!!!!!!!!!! DB !!!!!!!!!!!!!!", datainfoid, paralst, line
             self.line = []
-            # Prepare SQL query to INSERT a record into the database.
-            try:
-                # Execute the SQL command
-                self.cursor.execute(sql)
-                # Commit your changes in the database
-                self.db.commit()
-            except:
-                # No regular output here. Otherwise log-file will be smashed
-                #log.msg("client: could not append data to table")
-                # Rollback in case there is any error
-                self.db.rollback()
+            # Queue the line - the writer inserts it together with others
+            # (errors are logged by the writer, not for each line)
+            self.writer.put(datainfoid, paralst, line)
+
+    def binLayout(self, sensorid, keylst, namelst, unitlst, multiplier):
+        # record layout of the daily files (cached per sensor and keys):
+        # scaled values as 64 bit integers, secondary time at the end
+        layout = self.binlayouts.get((sensorid, tuple(keylst)))
+        if layout is None:
+            keys = [key for key in keylst if not key == 'sectime']
+            names = [namelst[i] if i < len(namelst) else key for i, key in enumerate(keys)]
+            units = [unitlst[i] if i < len(unitlst) else '-' for i, key in enumerate(keys)]
+            multipliers = [multiplier]*len(keys)
+            packcode = '6hL' + 'q'*len(keys)
+            if 'sectime' in keylst:
+                keys.append('sectime')
+                names.append('sectime')
+                units.append('UTC')
+                multipliers.append(1)
+                packcode += '6hL'
+            layout = self.binlayouts[(sensorid, tuple(keylst))] = BinLayout(sensorid, keys, names, units, multipliers, packcode)
+        return layout
 
     def storeData(self,array,paralst):
         for row in array:
@@ -469,6 +791,72 @@ class PubSubClient(WampClientProtocol):
         #     save the subarray
         pass
 
+    def paraList(self, module, ids=None):
+        # column names of the ids of a module (limited to ids if given)
+        paralst = []
+        for elem in MODIDDICT[module]:
+            if ids is not None and not elem in ids:
+                continue
+            var = IDDICT[elem]
+            if var == 'time' and 'time' in paralst:
+                var = 'sectime'
+            paralst.append(var)
+        return paralst
+
+    def onBatchEvent(self, topicUri, event):
+        """
+        Batched events (see magpy.acquisition.wampbatch): one event
+        contains many lines. The legacy subscription of the sensor is
+        dropped with the first batch.
+        """
+        eventdict = self.convertUnicode(event)
+        try:
+            sensorid = topicUri.split('/')[-1].split('-')[0].split('#')[1]
+            module = topicUri.split('/')[-1].split('-')[0].split('#')[0]
+            if not sensorid in self.batched and self.rangeid(module, sensorid) == sensorid:
+                self.batched.append(sensorid)
+                log.msg("collectors client: receiving batches from %s - dropping per value events" % sensorid)
+                self.unsubscribe(topicUri.replace('-batch','-value'))
+            # lost batches: request the missing range
+            seq = eventdict.get('seq')
+            lastseq = self.sequence.get(sensorid)
+            if seq is not None:
+                self.sequence[sensorid] = seq
+                if lastseq is not None and seq > lastseq + 1 and sensorid in self.lasttime:
+                    log.msg("collectors client: %d batches of %s lost - resynchronizing" % (seq-lastseq-1, sensorid))
+                    self.resyncSensor(self.clientname, module, sensorid, self.lasttime[sensorid]+1, eventdict['data'][0][0]-1)
+            self.lasttime[sensorid] = decodebatch(eventdict)['data'][0][-1]
+            if module.startswith('pos') or module.startswith('gsm') or module.startswith('cs'):
+                self.typ = 'f'
+            # filtered products contain the primary time only
+            paralst = self.paraList(module, eventdict['ids'])
+            lines = unpackbatch(eventdict, MODIDDICT[module])
+            if self.printdata:
+                print "Received batch from %s: %d lines" % (sensorid,len(lines))
+            for line in lines:
+                self.storeDataLine([sensorid, module, line], paralst)
+        except:
+            log.msg("collectors client: batch event could not be translated")
+            if self.metrics:
+                self.metrics.error()
+
+    def connectionLost(self, reason):
+        WampClientProtocol.connectionLost(self, reason)
+        if getattr(self, 'metrics', None):
+            self.metrics.disconnected()
+        # the writer of the factory keeps writing queued lines, missing
+        # data is requested after reconnect
+        self.writer = None
+        if getattr(self, 'db', None):
+            try:
+                if self.pool:
+                    self.pool.release(self.db)
+                else:
+                    self.db.close()
+            except:
+                pass
+            self.db = None
+
     def onEvent(self, topicUri, event):
         eventdict = self.convertUnicode(event)
         time = ''
@@ -476,6 +864,9 @@ class PubSubClient(WampClientProtocol):
         try:
             sensorid = topicUri.split('/')[-1].split('-')[0].split('#')[1]
             module = topicUri.split('/')[-1].split('-')[0].split('#')[0]
+            if sensorid in self.batched:
+                # lines are provided by batch events
+                return
             #print sensorid, module
             if module.startswith('pos') or module.startswith('gsm') or module.startswith('cs'):
                 self.typ = 'f'
@@ -492,14 +883,9 @@ class PubSubClient(WampClientProtocol):
                      else:
                          self.line.append(eventdict['value'])
             else:
-                paralst = []
-                for elem in MODIDDICT[module]:
-                    var = IDDICT[elem]
-                    if var == 'time' and 'time' in paralst:
-                        var = 'sectime'
-                    paralst.append(var)
-
-                if printdata:
+                paralst = self.paraList(module)
+
+                if self.printdata:
                     print "Received from %s: %s" % (sensorid,str(self.line))
 
                 row = [sensorid, module, self.line]
@@ -520,18 +906,32 @@ class PubSubClient(WampClientProtocol):
                 else:
                     if self.count == critvalue:
                         # Begin of buffered save
-                        begin = datetime.utcnow()
                         array = self.bufferarray[-self.count:]
-                        print "Lengths", len(array), self.count
                         self.count = 0
-                        #self.storeData(array,paralst)
-                        p1 = multiprocessing.Process(target=self.storeData, args=(array,paralst,))
-                        p2 = multiprocessing.Process(target=self.sortAndFilter, args=(array,))
-                        p1.start()
-                        p2.start()
-                        p1.join()
-                        p2.join()
-                        print "Duration of buffered save", datetime.utcnow()-begin
+                        self.storeData(array,paralst)
 
         except:
-            pass
+            if self.metrics:
+                self.metrics.error()
+
+
+class PubSubClientFactory(ReconnectingClientFactory, WampClientFactory):
+    """
+    Client factory reconnecting to moon after connection losses.
+    PubSubClient resynchronizes the data base after each (re)connect.
+    """
+    protocol = PubSubClient
+    maxDelay = 60
+    writer = None   # BufferedDBWriter shared by all sessions of the factory
+
+    def clientConnectionFailed(self, connector, reason):
+        log.msg("collectors client: Connection failed - retrying")
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        log.msg("collectors client: Connection lost - reconnecting")
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return WampClientFactory.buildProtocol(self, addr)
@@ -8,6 +8,16 @@ from __future__ import print_function
 from magpy.stream import *
 from magpy.absolutes import *
 from magpy.transfer import *
+import numbers
+import tempfile
+import threading
+import itertools
+from contextlib import contextmanager
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 print("Loading python's SQL support")
 try:
@@ -27,10 +37,23 @@ except:
     print("SQL package import failed")
     pass
 
+try:
+    # Loading SQLite functionality (file based data bases, see dbconnect)
+    import sqlite3
+except ImportError:
+    print("Failed to import SQL package 'sqlite3' - SQLite backend not available")
+
 
 """
 AVAILABLE METHODS:
 ---------------------------------
+dbconnect(backend='mysql', **kwargs):
+dbdialect(db):
+dbcolumns(db, tablename):
+DBConnectionPool(size=4, backend='mysql', **kwargs)
+dbcachedselect(db, element, table, condition=None, expert=None):
+dbcacheclear(db=None, table=None, contains=None):
+dbcachestats():
 dbgetfloat(db,tablename,sensorid,columnid,revision=None)
 dbgetstring(db,tablename,sensorid,columnid,revision=None)
 dbupload(db, path,stationid,**kwargs):
@@ -47,14 +70,19 @@ dbsensorinfo(db,sensorid,sensorkeydict=None,sensorrevision = '0001'):
 dbdatainfo(db,sensorid,datakeydict=None,tablenum=None,defaultstation='WIC',updatedb=True):
 writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revision=None, **kwargs):
 dbsetTimesinDataInfo(db, tablename,colstr,unitstr):
+dbtimeschema(db, tablename, column='time'):
+dblasttime(db, tablename):
+dbmigratetimeschema(db, tables=None, schema='epoch', batchsize=100000, keepbackup=True):
+dbrollupupdate(db, dataid, starttime=None, endtime=None):
 stream2db(db, datastream, noheader=None, mode=None, tablename=None, **kwargs):
-readDB(db, table, starttime=None, endtime=None, sql=None):
-db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
+readDB(db, table, starttime=None, endtime=None, sql=None, chunksize=None, resolution=None):
+db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None, chunksize=None, resolution=None):
 diline2db(db, dilinestruct, mode=None, **kwargs):
 db2diline(db,**kwargs):
 getBaselineProperties(db,datastream,pier=None,distream=None):
 flaglist2db(db,flaglist,mode=None,sensorid=None,modificationdate=None):
-db2flaglist(db,sensorid, begin=None, end=None):
+db2flaglist(db,sensorid, begin=None, end=None, key=None):
+dbflagsupgrade(db, keepbackup=True, chunksize=50000):
 string2dict(string): 
 
 """
@@ -207,6 +235,621 @@ dbgetfloat
 
 """
 
+# ----------------------------------------------------------------------------
+#  Part 2.1: Database backends - connection factory and sql dialects
+#      All methods of this module are written in MySQL syntax. Connections
+#      returned by dbconnect(backend='sqlite') translate these statements,
+#      so that dbinit, writeDB, readDB etc. run unchanged on both backends.
+# ----------------------------------------------------------------------------
+
+DBERROR = ()
+DBINTEGRITYERROR = ()
+try:
+    DBERROR += (MySQLdb.Error,)
+    DBINTEGRITYERROR += (MySQLdb.IntegrityError,)
+except NameError:
+    pass
+try:
+    DBERROR += (sqlite3.Error,)
+    DBINTEGRITYERROR += (sqlite3.IntegrityError,)
+except NameError:
+    pass
+
+
+class MySQLDialect(object):
+    """
+    DEFINITION:
+        SQL dialect of MySQL/MariaDB data bases - the native dialect
+        of MagPy's database methods.
+    """
+    name = 'mysql'
+    placeholder = '%s'
+    autoincrement = 'INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY'
+
+    def insert(self, mode=None):
+        """
+        Returns the statement head for mode None (insert), 'replace'
+        (upsert) or 'ignore' (skip existing keys).
+        """
+        if mode == 'replace':
+            return 'REPLACE INTO'
+        elif mode == 'ignore':
+            return 'INSERT IGNORE INTO'
+        return 'INSERT INTO'
+
+    def columns(self, db, tablename):
+        """
+        Returns a list of (columnname, columntype) tuples, empty if table
+        is not existing.
+        """
+        cursor = db.cursor()
+        try:
+            cursor.execute("SHOW COLUMNS FROM " + tablename)
+            rows = [(el[0], el[1]) for el in cursor.fetchall()]
+        except DBERROR:
+            rows = []
+        cursor.close()
+        return rows
+
+    def indexes(self, db, tablename):
+        """
+        Returns the names of all indexes of tablename.
+        """
+        cursor = db.cursor()
+        try:
+            cursor.execute("SHOW INDEX FROM " + tablename)
+            names = [el[2] for el in cursor.fetchall()]
+        except DBERROR:
+            names = []
+        cursor.close()
+        return list(set(names))
+
+    def renametables(self, db, pairs):
+        """
+        Renames tables given as list of (oldname, newname) tuples
+        within one atomic statement.
+        """
+        cursor = db.cursor()
+        cursor.execute("RENAME TABLE " + ", ".join([old + " TO " + new for old, new in pairs]))
+        db.commit()
+        cursor.close()
+
+    def translate(self, sql, params=False):
+        return sql
+
+
+class SQLiteDialect(MySQLDialect):
+    """
+    DEFINITION:
+        SQL dialect of SQLite data bases. MySQL statements are translated
+        by translate (keywords, string quotes, placeholders), SHOW statements
+        are emulated by SQLiteCursor.
+    """
+    name = 'sqlite'
+    placeholder = '?'
+    autoincrement = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+
+    KEYWORDS = [(re.compile(r'\bVALUE\s*\(', re.I), 'VALUES ('),
+                (re.compile(r'\bINSERT\s+IGNORE\b', re.I), 'INSERT OR IGNORE'),
+                (re.compile(r'\bINT\s+UNSIGNED\s+NOT\s+NULL\s+AUTO_INCREMENT\s+PRIMARY\s+KEY\b', re.I), 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+                (re.compile(r'\bAUTO_INCREMENT\b', re.I), 'AUTOINCREMENT'),
+                (re.compile(r'(\bALTER\s+TABLE\s+\w+\s+ADD\s+.*?)\s+AFTER\s+\w+\s*$', re.I), r'\1'),
+                (re.compile(r'\bADDDATE\(\s*NOW\(\)\s*,\s*INTERVAL\s+(-?\d+)\s+(\w+)\s*\)', re.I), r"datetime('now', '\1 \2')"),
+                (re.compile(r'\bNOW\(\)', re.I), "datetime('now')")]
+
+    def insert(self, mode=None):
+        if mode == 'replace':
+            return 'INSERT OR REPLACE INTO'
+        elif mode == 'ignore':
+            return 'INSERT OR IGNORE INTO'
+        return 'INSERT INTO'
+
+    def columns(self, db, tablename):
+        cursor = db.cursor()
+        try:
+            cursor.execute("PRAGMA table_info(" + tablename + ")")
+            rows = [(el[1], el[2]) for el in cursor.fetchall()]
+        except DBERROR:
+            rows = []
+        cursor.close()
+        return rows
+
+    def indexes(self, db, tablename):
+        cursor = db.cursor()
+        try:
+            cursor.execute("PRAGMA index_list(" + tablename + ")")
+            names = [el[1] for el in cursor.fetchall()]
+        except DBERROR:
+            names = []
+        cursor.close()
+        return names
+
+    def renametables(self, db, pairs):
+        # sqlite renames one table per statement - all within one transaction
+        cursor = db.cursor()
+        try:
+            for old, new in pairs:
+                cursor.execute("ALTER TABLE " + old + " RENAME TO " + new)
+            db.commit()
+        except DBERROR:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def translate(self, sql, params=False):
+        """
+        Translates a MySQL statement: double quoted string literals become
+        single quoted ones, backslash escapes are resolved, %s placeholders
+        become ? (if params are given) and MySQL specific keywords are
+        replaced. Keywords within string literals remain untouched.
+        """
+        parts, code, literal = [], [], []
+        quote = None
+        i = 0
+        while i < len(sql):
+            c = sql[i]
+            if quote:
+                if c == '\\' and i+1 < len(sql):
+                    literal.append(sql[i+1])
+                    i += 2
+                    continue
+                if c == quote:
+                    if i+1 < len(sql) and sql[i+1] == quote:
+                        literal.append(c)
+                        i += 2
+                        continue
+                    parts.append("'" + ''.join(literal).replace("'","''") + "'")
+                    literal = []
+                    quote = None
+                else:
+                    literal.append(c)
+            elif c in ['"', "'"]:
+                parts.append(self._translatecode(''.join(code), params))
+                code = []
+                quote = c
+            else:
+                code.append(c)
+            i += 1
+        if quote:
+            # unterminated literal - leave it to sqlite to complain
+            code = [quote] + literal + code
+        parts.append(self._translatecode(''.join(code), params))
+        return ''.join(parts)
+
+    def _translatecode(self, code, params):
+        for pattern, replacement in self.KEYWORDS:
+            code = pattern.sub(replacement, code)
+        if params:
+            code = code.replace('%s','?').replace('%%','%')
+        return code
+
+
+class SQLiteCursor(object):
+    """
+    DEFINITION:
+        Cursor of SQLiteConnection. Translates MySQL statements using
+        SQLiteDialect and emulates 'SHOW COLUMNS FROM table [LIKE "col"]'
+        and 'SHOW TABLES [LIKE "name"]'.
+    """
+    SHOWCOLUMNS = re.compile(r'^\s*SHOW\s+COLUMNS\s+FROM\s+(\w+)(?:\s+LIKE\s+[\'"]([^\'"]*)[\'"])?\s*;?\s*$', re.I)
+    SHOWTABLES = re.compile(r'^\s*SHOW\s+TABLES(?:\s+LIKE\s+[\'"]([^\'"]*)[\'"])?\s*;?\s*$', re.I)
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.connection.cursor()
+        self.dialect = connection.dialect
+        self.rows = None
+
+    def execute(self, sql, args=None):
+        self.rows = None
+        match = self.SHOWCOLUMNS.match(sql)
+        if match:
+            self.cursor.execute("PRAGMA table_info(" + match.group(1) + ")")
+            rows = self.cursor.fetchall()
+            if not len(rows) > 0:
+                raise sqlite3.OperationalError("Table '%s' doesn't exist" % match.group(1))
+            if match.group(2):
+                pattern = match.group(2).replace('%','*').replace('_','?')
+                rows = [el for el in rows if fnmatch.fnmatch(el[1], pattern)]
+            # same layout as MySQL: Field, Type, Null, Key, Default, Extra
+            self.rows = [(el[1], el[2], 'NO' if el[3] else 'YES', 'PRI' if el[5] else '', el[4], '') for el in rows]
+            return len(self.rows)
+        match = self.SHOWTABLES.match(sql)
+        if match:
+            if match.group(1):
+                self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?", (match.group(1),))
+            else:
+                self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            self.rows = self.cursor.fetchall()
+            return len(self.rows)
+        if args is None:
+            self.cursor.execute(self.dialect.translate(sql))
+        else:
+            self.cursor.execute(self.dialect.translate(sql, params=True), tuple(args))
+        return self.cursor.rowcount
+
+    def executemany(self, sql, args):
+        self.rows = None
+        self.cursor.executemany(self.dialect.translate(sql, params=True), args)
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        if self.rows is not None:
+            return self.rows.pop(0) if len(self.rows) > 0 else None
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if self.rows is not None:
+            rows, self.rows = self.rows[:size], self.rows[size:]
+            return rows
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return self.cursor.fetchall()
+
+    @property
+    def description(self):
+        if self.rows is not None:
+            return [(name,None,None,None,None,None,None) for name in ['Field','Type','Null','Key','Default','Extra']]
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        if self.rows is not None:
+            return len(self.rows)
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection(object):
+    """
+    DEFINITION:
+        Wrapper of a sqlite3 connection providing the MySQLdb like
+        interface used by MagPy (cursor, commit, rollback, close).
+        Use dbconnect(backend='sqlite',...) to create it.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.dialect = SQLiteDialect()
+
+    def cursor(self, *args):
+        # cursor classes (e.g. server side cursors) are not needed for sqlite
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+MYSQLDIALECT = MySQLDialect()
+
+def dbdialect(db):
+    """
+    DEFINITION:
+        Returns the sql dialect (MySQLDialect or SQLiteDialect) of a
+        data base connection.
+
+    EXAMPLE:
+        >>> if dbdialect(db).name == 'sqlite': ...
+    """
+    return getattr(db, 'dialect', MYSQLDIALECT)
+
+
+def dbcolumns(db, tablename):
+    """
+    DEFINITION:
+        Returns a list of (columnname, columntype) tuples of a table,
+        independent of the data base backend. Empty list if the table is
+        not existing.
+
+    EXAMPLE:
+        >>> cols = [el[0] for el in dbcolumns(db, 'DATAINFO')]
+    """
+    return dbdialect(db).columns(db, tablename)
+
+
+def dbconnect(backend='mysql', **kwargs):
+    """
+    DEFINITION:
+        Connection factory for the supported data base backends.
+
+    PARAMETERS:
+        - backend:      (string) 'mysql' (default) or 'sqlite'
+    Kwargs:
+        mysql:          all kwargs are passed to MySQLdb.connect (host, user,
+                        passwd, db, ...)
+        sqlite:
+        - path:         (string) data base file, default ':memory:'
+        - wal:          (bool) use write ahead logging (default True), which
+                               allows reading while acquisition is writing
+        - synchronous:  (string) PRAGMA synchronous, default 'NORMAL'
+        - cached_statements: (int) size of the prepared statement cache (default 256)
+        - timeout:      (float) seconds to wait for locks (default 30)
+                        connections may be handed between threads (e.g. by
+                        DBConnectionPool) but must not be used concurrently
+
+    RETURNS:
+        - db:           data base connection usable by all methods of this module
+
+    EXAMPLE:
+        >>> db = dbconnect('mysql', host="localhost", user="user", passwd="secret", db="mysqldb")
+        >>> db = dbconnect('sqlite', path='/home/user/fieldwork.sqlite')
+        >>> dbinit(db)
+    """
+    if backend == 'sqlite':
+        path = kwargs.get('path', ':memory:')
+        wal = kwargs.get('wal', True)
+        synchronous = kwargs.get('synchronous', 'NORMAL')
+        connection = sqlite3.connect(path, timeout=kwargs.get('timeout', 30.), cached_statements=kwargs.get('cached_statements', 256), check_same_thread=False)
+        # numpy scalars are not known to sqlite3
+        for typ in [np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64]:
+            sqlite3.register_adapter(typ, int)
+        for typ in [np.float16, np.float32]:
+            sqlite3.register_adapter(typ, float)
+        sqlite3.register_adapter(np.bool_, bool)
+        if wal and not path == ':memory:':
+            connection.execute("PRAGMA journal_mode=WAL")
+        if synchronous:
+            connection.execute("PRAGMA synchronous=" + synchronous)
+        return SQLiteConnection(connection)
+    elif backend == 'mysql':
+        return MySQLdb.connect(**kwargs)
+    else:
+        loggerdatabase.error("dbconnect: unknown backend {}".format(backend))
+        return None
+
+
+# ----------------------------------------------------------------------------
+#  Part 2.2: Connection pool and metadata cache
+#      Metadata of DATAINFO, SENSORS, STATIONS, PIERS and BASELINE is cached
+#      for DBCACHETTL seconds. Writing methods (dbupdate, dbalter,
+#      dbdatainfo, ...) invalidate the cache of the affected tables.
+# ----------------------------------------------------------------------------
+
+DBCACHE = {}
+DBCACHETTL = 300.
+DBCACHETABLES = ['DATAINFO','SENSORS','STATIONS','PIERS','BASELINE']
+DBCACHESTATS = {'hits':0, 'misses':0, 'invalidations':0}
+DBCACHELOCK = threading.Lock()
+DBCACHEIDS = itertools.count(1)
+
+def _dbcacheid(db):
+    # stable token per connection (id() is reused after garbage collection),
+    # pooled connections share one token. None: connection is not cached
+    cacheid = getattr(db, 'cacheid', None)
+    if cacheid is None:
+        try:
+            db.cacheid = cacheid = 'db%d' % next(DBCACHEIDS)
+        except (AttributeError, TypeError):
+            return None
+    return cacheid
+
+
+def _dbcached(db, table, query, function):
+    """
+    DEFINITION:
+        Returns the cached result of query on table or calls function()
+        to obtain it. Results are kept for DBCACHETTL seconds, empty
+        results (e.g. of not yet existing inputs) are not cached.
+    """
+    cacheid = _dbcacheid(db)
+    if not DBCACHETTL > 0 or not table.upper() in DBCACHETABLES or cacheid is None:
+        return function()
+    key = (cacheid, table.upper(), query)
+    now = time.time()
+    with DBCACHELOCK:
+        entry = DBCACHE.get(key)
+        if entry and now - entry[0] < DBCACHETTL:
+            DBCACHESTATS['hits'] += 1
+            return cp.deepcopy(entry[1])
+        DBCACHESTATS['misses'] += 1
+    result = function()
+    if result is None or (hasattr(result, '__len__') and not len(result) > 0):
+        return result
+    with DBCACHELOCK:
+        DBCACHE[key] = (now, result)
+    return cp.deepcopy(result)
+
+
+def dbcacheclear(db=None, table=None, contains=None):
+    """
+    DEFINITION:
+        Invalidates cached metadata. Called by all methods writing to
+        DATAINFO, SENSORS, STATIONS, PIERS and BASELINE. Call it yourself
+        if these tables are modified by other means.
+
+    PARAMETERS:
+    Kwargs:
+        - db:           (database) only invalidate entries of this connection (pool)
+        - table:        (string) only invalidate entries of this table
+        - contains:     (string) only invalidate entries whose query contains
+                                 this string (e.g. a DataID)
+
+    EXAMPLE:
+        >>> dbcacheclear(table='DATAINFO')
+    """
+    with DBCACHELOCK:
+        for key in list(DBCACHE.keys()):
+            if db is not None and not key[0] == _dbcacheid(db):
+                continue
+            if table is not None and not key[1] == table.upper():
+                continue
+            if contains is not None and str(key[2]).find(contains) < 0:
+                continue
+            del DBCACHE[key]
+        DBCACHESTATS['invalidations'] += 1
+
+
+def dbcachestats():
+    """
+    DEFINITION:
+        Returns hit/miss counters of the metadata cache, i.e. the amount of
+        saved data base round trips.
+
+    RETURNS:
+        - stats:        (dict) hits, misses, invalidations, entries, hitrate
+
+    EXAMPLE:
+        >>> print(dbcachestats())
+    """
+    with DBCACHELOCK:
+        stats = dict(DBCACHESTATS)
+        stats['entries'] = len(DBCACHE)
+    total = stats['hits'] + stats['misses']
+    stats['hitrate'] = float(stats['hits'])/total if total > 0 else 0.0
+    return stats
+
+
+def dbcachedselect(db, element, table, condition=None, expert=None):
+    """
+    DEFINITION:
+        Like dbselect, but results of metadata tables (DBCACHETABLES) are
+        taken from the metadata cache.
+
+    EXAMPLE:
+        >>> stationid = dbcachedselect(db, 'StationID', 'DATAINFO', 'DataID = "MyID_0001"')
+    """
+    query = ('select', element, condition, expert)
+    return _dbcached(db, table, query, lambda: dbselect(db, element, table, condition=condition, expert=expert))
+
+
+def _dbmetarow(db, table, idcolumn, idvalue):
+    """
+    DEFINITION:
+        Returns the first row of table with idcolumn = idvalue as
+        dictionary (column:value) using a single (cached) query.
+        Returns an empty dictionary if nothing is found.
+    """
+    def getrow():
+        cursor = db.cursor()
+        try:
+            cursor.execute('SELECT * FROM ' + table + ' WHERE ' + idcolumn + ' = "' + str(idvalue) + '"')
+            row = cursor.fetchone()
+            names = [el[0] for el in cursor.description]
+        except DBERROR as e:
+            loggerdatabase.error("_dbmetarow: error when reading %s: %s" % (table, e))
+            row = None
+        cursor.close()
+        if not row:
+            return {}
+        return dict(zip(names, row))
+    return _dbcached(db, table, ('row', idcolumn, idvalue), getrow)
+
+
+class DBConnectionPool(object):
+    """
+    DEFINITION:
+        A small thread safe pool of data base connections created by
+        dbconnect. Connections share the metadata cache.
+
+    PARAMETERS:
+        - size:         (int) maximal amount of connections
+        - backend:      (string) 'mysql' or 'sqlite' - see dbconnect
+        - kwargs:       passed to dbconnect
+
+    EXAMPLE:
+        >>> pool = DBConnectionPool(4, 'mysql', host="localhost", user="user", passwd="secret", db="mysqldb")
+        >>> with pool.connection() as db:
+        >>>     stream = readDB(db, 'MyID_0001_0001')
+        >>> pool.closeall()
+    """
+    def __init__(self, size=4, backend='mysql', **kwargs):
+        self.size = max(1, int(size))
+        self.backend = backend
+        self.kwargs = kwargs
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.cacheid = 'pool%d' % next(DBCACHEIDS)
+        self.stats = {'acquired':0, 'created':0, 'reconnects':0, 'waits':0}
+
+    def _create(self):
+        db = dbconnect(self.backend, **self.kwargs)
+        try:
+            db.cacheid = self.cacheid
+        except AttributeError:
+            pass
+        self.stats['created'] += 1
+        return db
+
+    def acquire(self, timeout=None):
+        """
+        Returns an idle connection, creates a new one if less than size
+        connections exist or waits for a released one.
+        """
+        try:
+            db = self.idle.get_nowait()
+        except queue.Empty:
+            db = None
+            with self.lock:
+                if self.created < self.size:
+                    self.created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    db = self._create()
+                except:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                self.stats['waits'] += 1
+                db = self.idle.get(timeout=timeout)
+        if self.backend == 'mysql':
+            try:
+                db.ping(True)
+            except:
+                # connection lost - replace it
+                self.stats['reconnects'] += 1
+                db = self._create()
+        self.stats['acquired'] += 1
+        return db
+
+    def release(self, db):
+        """
+        Returns a connection to the pool. Open transactions are rolled back.
+        """
+        try:
+            db.rollback()
+        except:
+            pass
+        self.idle.put(db)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        db = self.acquire(timeout=timeout)
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def closeall(self):
+        while True:
+            try:
+                db = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                db.close()
+            except:
+                pass
+            with self.lock:
+                self.created -= 1
+
+
 # ----------------------------------------------------------------------------
 #  Part 3: Main methods for mysql database communication --
 #      dbalter, dbsensorinfo, dbdatainfo, dbdict2fields, dbfields2dict and
@@ -230,10 +873,8 @@ def dbgetPier(db,pierid, rp, value, maxdate=None, l=False, dic='DeltaDictionary'
 
         returns deltaD of A7 relative to A2
     """
-    sql = 'SELECT '+ dic +' FROM PIERS WHERE PierID = "' + pierid + '"';
-    cursor = db.cursor()
-    cursor.execute(sql)
-    row = cursor.fetchone()
+    pierrow = _dbmetarow(db, 'PIERS', 'PierID', pierid)
+    row = [pierrow.get(dic)] if pierrow else None
 
     if not row:
         print("dbgetPier: No data found for your selection")
@@ -291,9 +932,9 @@ def dbgetlines(db, tablename, lines):
     headsql = 'SHOW COLUMNS FROM %s' % (tablename)
     try:
         cursor.execute(headsql)
-    except MySQLdb.IntegrityError as message:
+    except DBINTEGRITYERROR as message:
         return message
-    except MySQLdb.Error as message:
+    except DBERROR as message:
         return message
     except:
         return 'dbgetlines: unkown error'
@@ -303,10 +944,10 @@ def dbgetlines(db, tablename, lines):
     getsql = 'SELECT * FROM %s ORDER BY time DESC LIMIT %d' % (tablename, lines)
     try:
         cursor.execute(getsql)
-    except MySQLdb.IntegrityError as message:
+    except DBINTEGRITYERROR as message:
         print(message)
         return stream
-    except MySQLdb.Error as message:
+    except DBERROR as message:
         print(message)
         return stream
     except:
@@ -376,14 +1017,15 @@ def dbupdate(db,tablename, keys, values, condition=None):
     print(updatesql)
     try:
         cursor.execute(updatesql)
-    except MySQLdb.IntegrityError as message:
+    except DBINTEGRITYERROR as message:
         return message
-    except MySQLdb.Error as message:
+    except DBERROR as message:
         return message
     except:
         return 'dbupdate: unkown error'
     db.commit()
     cursor.close()
+    dbcacheclear(table=tablename)
     return 'success'
 
 def dbgetfloat(db,tablename,sensorid,columnid,revision=None):
@@ -402,11 +1044,8 @@ def dbgetfloat(db,tablename,sensorid,columnid,revision=None):
         >>>deltaf =  dbgetfloat(db, 'DATAINFO', Sensor, 'DataDeltaF')
         returns deltaF from the DATAINFO table which matches the Sensor
     """
-    sql = 'SELECT ' + columnid + ' FROM ' + tablename + ' WHERE SensorID = "' + sensorid + '"';
     try:
-        cursor = db.cursor()
-        cursor.execute(sql)
-        row = cursor.fetchone()
+        row = dbcachedselect(db, columnid, tablename, 'SensorID = "' + sensorid + '"')[:1]
         if not row[0] == None:
             try:
                 fl = float(row[0])
@@ -435,10 +1074,7 @@ def dbgetstring(db,tablename,sensorid,columnid,revision=None):
         >>>stationid =  dbgetstring(db, 'DATAINFO', 'LEMI25_22_0001', 'StationID')
         returns the stationid from the DATAINFO table which matches the Sensor
     """
-    sql = 'SELECT ' + columnid + ' FROM ' + tablename + ' WHERE SensorID = "' + sensorid + '"';
-    cursor = db.cursor()
-    cursor.execute(sql)
-    row = cursor.fetchone()
+    row = dbcachedselect(db, columnid, tablename, 'SensorID = "' + sensorid + '"')[:1]
     try:
         fl = float(row[0])
         return fl
@@ -596,13 +1232,6 @@ def dbinit(db):
     datainfostr = ', '.join(FULLDATAKEYLIST)
     createdatainfotablesql = "CREATE TABLE IF NOT EXISTS DATAINFO (%s)" % datainfostr
 
-    # FLAGS TABLE
-    # Create flagging table
-    flagstr = ' CHAR(100), '.join(FLAGSKEYLIST) + ' CHAR(100)'
-    flagstr = flagstr.replace('FlagID CHAR(100)', 'FlagID CHAR(50) NOT NULL PRIMARY KEY')
-    flagstr = flagstr.replace('SensorID CHAR(100)', 'SensorID CHAR(50) NOT NULL')
-    createflagtablesql = "CREATE TABLE IF NOT EXISTS FLAGS (%s)" % flagstr
-
     # BASELINE TABLE
     # Create baseline table
     basestr = ' CHAR(100), '.join(BASELINEKEYLIST) + ' CHAR(100)'
@@ -633,13 +1262,14 @@ def dbinit(db):
     cursor.execute(createsensortablesql)
     cursor.execute(createstationtablesql)
     cursor.execute(createdatainfotablesql)
-    cursor.execute(createflagtablesql)
     cursor.execute(createbaselinetablesql)
     cursor.execute(createiptablesql)
     cursor.execute(createpiertablesql)
 
     db.commit()
     cursor.close ()
+    # FLAGS TABLE (interval indexed)
+    _dbflagscreate(db)
     dbalter(db)
 
 
@@ -730,6 +1360,7 @@ def dbdelete(db,datainfoid,**kwargs):
 
     db.commit()
     cursor.close ()
+    dbcacheclear(table='DATAINFO', contains=datainfoid)
 
 
 def dbdict2fields(db,header_dict,**kwargs):
@@ -785,9 +1416,9 @@ def dbdict2fields(db,header_dict,**kwargs):
         message = ''
         try:
             cursor.execute(sql)
-        except MySQLdb.IntegrityError as message:
+        except DBINTEGRITYERROR as message:
             return message
-        except MySQLdb.Error as message:
+        except DBERROR as message:
             return message
         except:
             return 'unkown error'
@@ -928,6 +1559,7 @@ def dbdict2fields(db,header_dict,**kwargs):
 
     db.commit()
     cursor.close ()
+    dbcacheclear()
 
 
 def dbfields2dict(db,datainfoid):
@@ -954,63 +1586,43 @@ def dbfields2dict(db,datainfoid):
         db = MySQLdb.connect (host = "localhost",user = "user",passwd = "secret",db = "mysqldb")
     """
     metadatadict = {}
-    cursor = db.cursor()
 
-
-    #print "DBfields2dict: Running"
-    #getids = 'SELECT sensorid FROM DATAINFO WHERE DataID = "'+datainfoid+'"'
-    getids = 'SELECT sensorid,stationid FROM DATAINFO WHERE DataID = "'+datainfoid+'"'
-    cursor.execute(getids)
-    ids = cursor.fetchone()
-    if not ids:
+    # one (cached) query per table instead of one per key
+    datainfo = _dbmetarow(db, 'DATAINFO', 'DataID', datainfoid)
+    if not datainfo:
         return {}
+    ids = [datainfo.get('SensorID'), datainfo.get('StationID')]
     loggerdatabase.debug("dbfields2dict: Selected sensorid: %s" % ids[0])
 
     for key in DATAINFOKEYLIST:
         if not key == 'StationID': # Remove that line when included into datainfo
-            getdata = 'SELECT '+ key +' FROM DATAINFO WHERE DataID = "'+datainfoid+'"'
-            try:
-                cursor.execute(getdata)
-                row = cursor.fetchone()
-                loggerdatabase.debug("dbfields2dict: got key from DATAINFO - %s" % getdata)
-                if isinstance(row[0], basestring):
-                    metadatadict[key] = row[0]
-                    if key == 'ColumnContents':
-                        colsstr = row[0]
-                    if key == 'ColumnUnits':
-                        colselstr = row[0]
-                    if key in ['DataAbsFunctionObject','DataBaseValues']:
-                        func = pickle.loads(str(cdf_file.attrs[key]))
-                        stream.header[key] = func
-                else:
-                    if not row[0] == None:
-                        metadatadict[key] = float(row[0])
-            except MySQLdb.Error as e:
-                loggerdatabase.error("dbfields2dict: mysqlerror while adding key %s, %s" % (key,e))
-            except:
-                loggerdatabase.error("dbfields2dict: unkown error while adding key %s" % key)
-
+            if not key in datainfo:
+                loggerdatabase.debug("dbfields2dict: key %s not found in DATAINFO" % key)
+                continue
+            value = datainfo[key]
+            if isinstance(value, basestring):
+                metadatadict[key] = value
+                if key == 'ColumnContents':
+                    colsstr = value
+                if key == 'ColumnUnits':
+                    colselstr = value
+            elif not value == None:
+                try:
+                    metadatadict[key] = float(value)
+                except:
+                    loggerdatabase.error("dbfields2dict: unkown error while adding key %s" % key)
 
+    sensor = _dbmetarow(db, 'SENSORS', 'SensorID', ids[0]) if ids[0] else {}
     for key in SENSORSKEYLIST:
-        getsens = 'SELECT '+ key +' FROM SENSORS WHERE SensorID = "'+ids[0]+'"'
-        try:
-            cursor.execute(getsens)
-            row = cursor.fetchone()
-            if isinstance(row[0], basestring):
-                metadatadict[key] = row[0]
-                if key == 'SensorKeys':
-                    senscolsstr = row[0]
-                if key == 'SensorElements':
-                    senscolselstr = row[0]
-            else:
-                if row[0] == None:
-                    pass
-                    #metadatadict[key] = row[0]
-                else:
-                    metadatadict[key] = float(row[0])
-        except:
-            # if no sensor information is available e.g. BLV data
-            pass
+        # if no sensor information is available e.g. BLV data
+        value = sensor.get(key)
+        if isinstance(value, basestring):
+            metadatadict[key] = value
+        elif not value == None:
+            try:
+                metadatadict[key] = float(value)
+            except:
+                pass
 
     try:
         if colsstr.find(',') >= 0:
@@ -1059,22 +1671,13 @@ def dbfields2dict(db,datainfoid):
     except:
         loggerdatabase.warning("dbfields2dict: Could not assign column name")
     """
+    station = _dbmetarow(db, 'STATIONS', 'StationID', ids[1]) if ids[1] else {}
     for key in STATIONSKEYLIST:
-        getstat = 'SELECT '+ key +' FROM STATIONS WHERE StationID = "'+ids[1]+'"'
-        try:
-            cursor.execute(getstat)
-            row = cursor.fetchone()
-        except:
-            print("dbfields2dict: error when executing %s" % getstat)
-            row = [None]
-        if isinstance(row[0], basestring):
-            metadatadict[key] = row[0]
-        else:
-            if row[0] == None:
-                pass
-                #metadatadict[key] = row[0]
-            else:
-                metadatadict[key] = float(row[0])
+        value = station.get(key)
+        if isinstance(value, basestring):
+            metadatadict[key] = value
+        elif not value == None:
+            metadatadict[key] = float(value)
 
     return metadatadict
 
@@ -1182,6 +1785,7 @@ def dbalter(db):
 
     db.commit()
     cursor.close ()
+    dbcacheclear()
 
 
 def dbselect(db, element, table, condition=None, expert=None):
@@ -1374,6 +1978,7 @@ def dbsensorinfo(db,sensorid,sensorkeydict=None,sensorrevision = '0001'):
 
     db.commit()
     cursor.close ()
+    dbcacheclear(table='SENSORS')
 
     return sensorid
 
@@ -1653,7 +2258,7 @@ def dbdatainfo(db,sensorid,datakeydict=None,tablenum=None,defaultstation='WIC',u
             try:
                 print ("Updating DATAINFO table")
                 cursor.execute(datainfosql)
-            except MySQLdb.Error as e:
+            except DBERROR as e:
                 print ("Failed: {}".format(e))
             except:
                 print ("Failed for unknown reason")
@@ -1661,6 +2266,8 @@ def dbdatainfo(db,sensorid,datakeydict=None,tablenum=None,defaultstation='WIC',u
 
     db.commit()
     cursor.close ()
+    dbcacheclear(table='DATAINFO')
+    dbcacheclear(table='STATIONS')
 
     return datainfoid
 
@@ -1679,11 +2286,25 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
                             mode: replace -- replaces existing table contents with new one, also replaces informations from sensors and station table
                             mode: delete -- deletes existing tables and writes new ones -- remove (or make it extremeley difficult to use) this method after initializing of tables
                             mode: insert -- add data not existing in table from stream
+                            mode: bulk -- only upload data newer than DataMaxTime of DATAINFO
+                                          in batches (see batchsize, loaddata)
 
          - tablename:   (string) provide the tablename to which data is written
                                  SENSORS and STATIONS remain unchanged, DATAINFO data
                                  is updated if existing
          - StationID:   (string) provide the StationID
+         - timeschema:  (string) time key used when creating a new table:
+                                 'char' (default, CHAR(40) strings),
+                                 'datetime' (DATETIME(6)) or 'epoch' (BIGINT
+                                 microseconds since 1970). Existing tables keep
+                                 their schema (see dbtimeschema). The time key
+                                 is the primary key, i.e. the clustered index.
+         - batchsize:   (int) mode bulk: rows per statement and transaction (default 10000)
+         - loaddata:    (bool) mode bulk: use temporary files and LOAD DATA LOCAL INFILE
+                                 instead of multi-row inserts (default False)
+         - progress:    (bool) mode bulk: report progress for each batch (default True)
+         - rollup:      (bool) update rollup tables (see dbrollupupdate) for the new data,
+                                 default: only if rollup tables already exist
     REQUIRES:
         dbdatainfo
 
@@ -1702,6 +2323,12 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
         # DATAINFO is updated however, keeping blanks for sensorid and stationid
         >>> writeDB(db,stream,tablename='myid_0001_0001',noheader=True)
 
+        # Create new tables with a numeric time key
+        >>> writeDB(db,stream,timeschema='epoch')
+
+        # Append new data of large streams in batches of 50000 rows
+        >>> writeDB(db,stream,mode='bulk',batchsize=50000)
+
     APPLICATION:
         db = MySQLdb.connect (host = "localhost",user = "user",passwd = "secret",db = "mysqldb")
         stream = read('/path/to/my/files/*', starttime='2013-01-01',endtime='2013-02-01')
@@ -1711,10 +2338,20 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
         - make it possible to create spezial tables by defining an extension (e.g. _sp2013min) where sp indicates special
     """
 
+    timeschema = kwargs.get('timeschema')
+    batchsize = kwargs.get('batchsize', 10000)
+    loaddata = kwargs.get('loaddata', False)
+    progress = kwargs.get('progress', True)
+    rollup = kwargs.get('rollup')
+
     if not db:
         loggerdatabase.error("stream2DB: No database connected - aborting -- please create and initiate a database first")
         return
 
+    if timeschema and not timeschema in DBTIMESCHEMAS:
+        print ("writeDB: timeschema needs to be one of {} - aborting".format(list(DBTIMESCHEMAS.keys())))
+        return
+
     if not len(datastream.ndarray[0]) > 0:
         print ("writeDB is used for ndarray type - use stream2DB for LineStruct")
         return
@@ -1749,6 +2386,30 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
 
         #print "After", tablename, datastream.header['SensorID']
 
+    existingschema = dbtimeschema(db, tablename)
+    if existingschema:
+        if timeschema and not timeschema == existingschema:
+            print ("writeDB: table {} is using time schema {} - ignoring timeschema {}".format(tablename, existingschema, timeschema))
+        timeschema = existingschema
+    elif not timeschema:
+        timeschema = 'char'
+
+    ndarray = datastream.ndarray
+    if mode == 'bulk' and existingschema:
+        # skip everything up to the last time known to DATAINFO
+        maxtime = dbselect(db, 'DataMaxTime', 'DATAINFO', 'DataID = "' + tablename + '"')
+        if len(maxtime) > 0 and maxtime[0]:
+            try:
+                maxms = np.round((date2num(datastream._testtime(maxtime[0])) - DBEPOCHNUM)*86400000.)
+                keep = np.round((ndarray[0].astype(float) - DBEPOCHNUM)*86400000.) > maxms
+                ndarray = np.asarray([col[keep] if len(col) > 0 else col for col in ndarray], dtype=object)
+                print ("writeDB: skipping {} rows not newer than {}".format(len(keep)-np.sum(keep), maxtime[0]))
+            except:
+                print ("writeDB: could not interpret DataMaxTime {} - uploading all".format(maxtime[0]))
+        if not len(ndarray[0]) > 0:
+            print ("writeDB: no new data for {}".format(tablename))
+            return
+
     # ----------------------------------------------
     #   Putting together all data
     # ----------------------------------------------
@@ -1775,13 +2436,15 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
         return "%s%s" % (s[:-7], temp[1:])
 
     array = [[] for key in KEYLIST]
-    for idx,col in enumerate(datastream.ndarray):
+    for idx,col in enumerate(ndarray):
         key = KEYLIST[idx]
-        if not False in checkEqual3(col) and len(col) > 0:
+        if key == 'time' and len(col) > 0:
+            array[idx] = _num2dbtime(col, timeschema)
+        elif not False in checkEqual3(col) and len(col) > 0:
             if col[0] in ['nan', float('nan'),NaN,'-',None,'']: #remove place holders
                 array[idx] = np.asarray([])
             else: # add as usual
-                array[idx] = datastream.ndarray[idx]
+                array[idx] = ndarray[idx]
                 try:
                     array[idx][np.isnan(array[idx].astype(float))] = None
                 except:
@@ -1791,7 +2454,7 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
             tcol = [trim_time(elem.replace(tzinfo=None)) for elem in tcol]
             array[idx]=np.asarray(tcol)
         elif len(col) > 0: # and KEYLIST[idx] in NUMKEYLIST:
-            array[idx] = datastream.ndarray[idx]
+            array[idx] = ndarray[idx]
             try:
                 array[idx][np.isnan(array[idx].astype(float))] = None
             except:
@@ -1804,18 +2467,16 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
     array = np.asarray([elem for elem in array if len(elem)>0], dtype=object)
     dollarstring = ['%s' for elem in keys]
 
-    values = array.transpose()
-
     insertmanysql = "INSERT INTO %s(%s) VALUES (%s)" % (tablename, ', '.join(keys), ', '.join(dollarstring))
 
-    values = tuple([tuple(list(val)) for val in values])
-
     # ----------------------------------------------
     #   if tablename does not yet exist create table/ add column if not yet existing
     # ----------------------------------------------
     cursor = db.cursor ()
 
-    count = 0
+    # empty if table not existing
+    existingcols = [el[0] for el in dbcolumns(db, tablename)]
+    count = len(existingcols)
     dataheads,collst,unitlst = [],[],[]
     for key in KEYLIST:
         colstr = ''
@@ -1825,7 +2486,7 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
                 dataheads.append(key + ' DOUBLE')
             elif key.endswith('time'):
                 if key == 'time':
-                    dataheads.append(key + ' CHAR(40) NOT NULL PRIMARY KEY')
+                    dataheads.append(key + ' ' + DBTIMESCHEMAS[timeschema] + ' NOT NULL PRIMARY KEY')
                 else:
                     dataheads.append(key + ' CHAR(40)')
             else:
@@ -1838,24 +2499,14 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
                     unitstr = datastream.header[hkey]
 
             #print "Checking key", key
-            try:
-                sql = "SELECT " + key + " FROM " + tablename + " ORDER BY time DESC LIMIT 1"
-                cursor.execute(sql)
-                count +=1
-            except MySQLdb.Error as e:
-                emsg = str(e)
-                if emsg.find("Table") >= 0 and emsg.find("doesn't exist") >= 0:
-                    # if table not existing
-                    pass
-                elif emsg.find("Unknown column") >= 0:
-                    print ("writeDB: key %s not existing - adding it" % key)
-                    # if key not yet existing
-                    addsql = "ALTER TABLE " + tablename + " ADD " + dataheads[-1]
+            if count > 0 and not key in existingcols:
+                print ("writeDB: key %s not existing - adding it" % key)
+                # if key not yet existing
+                addsql = "ALTER TABLE " + tablename + " ADD " + dataheads[-1]
+                try:
                     cursor.execute(addsql)
-                else:
-                    print ("writeDB: unkown MySQL error when checking for existing tables: %s" %e)
-            except:
-                print ("writeDB: unkown error when checking for existing tables")
+                except DBERROR as e:
+                    print ("writeDB: unkown MySQL error when adding column: %s" %e)
 
         if not key=='time':
             collst.append(colstr)
@@ -1875,9 +2526,13 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
     # ----------------------------------------------
 
     #print insertmanysql
-    if mode == 'replace':
-        insertmanysql = insertmanysql.replace("INSERT","REPLACE")
-    cursor.executemany(insertmanysql,values)
+    if mode == 'bulk':
+        _dbbulkinsert(db, tablename, keys, array, batchsize=batchsize, loaddata=loaddata, progress=progress)
+    else:
+        values = tuple([tuple(list(val)) for val in array.transpose()])
+        if mode == 'replace':
+            insertmanysql = insertmanysql.replace("INSERT","REPLACE")
+        cursor.executemany(insertmanysql,values)
 
     # ----------------------------------------------
     #   update DATAINFO - move to a separate method
@@ -1888,6 +2543,103 @@ def writeDB(db, datastream, tablename=None, StationID=None, mode='replace', revi
     db.commit()
     cursor.close ()
 
+    # ----------------------------------------------
+    #   update rollup tables for the new time range
+    # ----------------------------------------------
+
+    if rollup is None:
+        rollup = len(dbcolumns(db, tablename + '_' + DBROLLUPS[0][0])) > 0
+    if rollup:
+        times = ndarray[0].astype(float)
+        dbrollupupdate(db, tablename, starttime=num2date(np.nanmin(times)).replace(tzinfo=None), endtime=num2date(np.nanmax(times)).replace(tzinfo=None))
+
+
+def _dbbulkinsert(db, tablename, keys, array, batchsize=10000, loaddata=False, progress=True):
+    """
+    DEFINITION:
+        Uploads data columns in batches of batchsize rows, each batch
+        within its own transaction. Batches are either send as multi-row
+        INSERT IGNORE statements or, if loaddata is True, as temporary
+        CSV files using LOAD DATA LOCAL INFILE (requires local_infile
+        to be enabled for client and server). Rows already existing
+        (same time key) are ignored.
+
+    PARAMETERS:
+        - db:           (mysql database) defined by MySQLdb.connect().
+        - tablename:    (string) name of the table
+        - keys:         (list) column names
+        - array:        (array) one column of equal length per key
+                                (time already converted to data base format)
+    Kwargs:
+        - batchsize:    (int) rows per statement/transaction
+        - loaddata:     (bool) use LOAD DATA LOCAL INFILE
+        - progress:     (bool) print progress after each batch
+
+    RETURNS:
+        - amount:       (int) number of rows uploaded
+    """
+    if not len(array) > 0:
+        return 0
+    total = len(array[0])
+    batchsize = max(1, int(batchsize))
+
+    # Prepare columns once: python objects, NaN -> NULL
+    columns = []
+    for idx, key in enumerate(keys):
+        col = np.asarray(array[idx])
+        if key in NUMKEYLIST:
+            try:
+                fcol = col.astype(float)
+                col = fcol.astype(object)
+                col[np.isnan(fcol)] = None
+            except (ValueError, TypeError):
+                col = col.astype(object)
+        else:
+            col = col.astype(object)
+        columns.append(col)
+
+    def csvvalue(el):
+        if el is None:
+            return '\\N'
+        elif isinstance(el, float):
+            return repr(el)
+        return str(el).replace('\t',' ').replace('\n',' ')
+
+    if not dbdialect(db).name == 'mysql':
+        loaddata = False
+    insertsql = "%s %s(%s) VALUES (%s)" % (dbdialect(db).insert('ignore'), tablename, ', '.join(keys), ', '.join(['%s' for key in keys]))
+    loadsql = "LOAD DATA LOCAL INFILE '%s' IGNORE INTO TABLE " + tablename + " FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' (" + ', '.join(keys) + ")"
+
+    cursor = db.cursor()
+    amount = 0
+    for start in range(0, total, batchsize):
+        rows = list(zip(*[col[start:start+batchsize].tolist() for col in columns]))
+        try:
+            if loaddata:
+                tmp = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
+                try:
+                    for row in rows:
+                        tmp.write('\t'.join([csvvalue(el) for el in row]) + '\n')
+                    tmp.close()
+                    cursor.execute(loadsql % tmp.name)
+                finally:
+                    tmp.close()
+                    os.remove(tmp.name)
+            else:
+                cursor.executemany(insertsql, rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            loggerdatabase.error("writeDB: bulk upload to {} failed after {} rows: {}".format(tablename, amount, e))
+            print ("writeDB: bulk upload failed after {} of {} rows: {}".format(amount, total, e))
+            break
+        amount += len(rows)
+        if progress:
+            print ("writeDB: uploaded {} of {} rows to {}".format(amount, total, tablename))
+    cursor.close()
+
+    return amount
+
 
 def dbsetTimesinDataInfo(db, tablename,colstr,unitstr):
     """
@@ -1911,12 +2663,375 @@ def dbsetTimesinDataInfo(db, tablename,colstr,unitstr):
     #print rows
     loggerdatabase.info("stream2DB: Table now covering a time range from " + str(rows[0][0]) + " to " + str(rows[0][1]))
     # removed columncontents and units from update
-    updatedatainfotimesql = 'UPDATE DATAINFO SET DataMinTime = "' + rows[0][0] + '", DataMaxTime = "' + rows[0][1] +'", ColumnContents = "' + colstr +'", ColumnUnits = "' + unitstr +'" WHERE DataID = "'+ tablename + '"'
+    updatedatainfotimesql = 'UPDATE DATAINFO SET DataMinTime = "' + _dbtime2string(rows[0][0]) + '", DataMaxTime = "' + _dbtime2string(rows[0][1]) +'", ColumnContents = "' + colstr +'", ColumnUnits = "' + unitstr +'" WHERE DataID = "'+ tablename + '"'
     #print updatedatainfotimesql
     cursor.execute(updatedatainfotimesql)
 
     db.commit()
     cursor.close ()
+    dbcacheclear(table='DATAINFO', contains=tablename)
+
+
+def _dbtimeconversion(source, target, column='time'):
+    """
+    DEFINITION:
+        Returns a sql expression converting column from time schema
+        source to time schema target (used by dbmigratetimeschema).
+        Percent signs are escaped for parameterized execution.
+    """
+    epochstart = "'1970-01-01 00:00:00'"
+    if source == 'epoch':
+        asdatetime = "TIMESTAMPADD(MICROSECOND, " + column + ", " + epochstart + ")"
+    elif source == 'char':
+        asdatetime = "CAST(" + column + " AS DATETIME(6))"
+    else:
+        asdatetime = column
+    if target == 'epoch':
+        return "TIMESTAMPDIFF(MICROSECOND, " + epochstart + ", " + asdatetime + ")"
+    elif target == 'datetime':
+        return asdatetime
+    return "DATE_FORMAT(" + asdatetime + ", '%%Y-%%m-%%d %%H:%%i:%%s.%%f')"
+
+
+def dbmigratetimeschema(db, tables=None, schema='epoch', batchsize=100000, keepbackup=True):
+    """
+    DEFINITION:
+        Online migration of data tables to another time schema (see
+        dbtimeschema). For each table a copy with the new time key is created
+        and filled in batches of batchsize rows ordered by time, one commit per
+        batch, so that tables can be converted while data acquisition is still
+        writing. Rows arriving during the copy are caught up before the tables
+        are exchanged by an atomic RENAME TABLE. The original table is kept
+        as TABLENAME_bak unless keepbackup is False.
+        Please note: rows which are modified (REPLACE) in already copied time
+        ranges while the migration is running are not transferred.
+        Writers need to support the new schema: writeDB and the collectors
+        (BufferedDBWriter) check the schema of the table, other programs
+        inserting time strings will fail on 'epoch' tables.
+
+    PARAMETERS:
+        - db:           (mysql database) defined by MySQLdb.connect().
+    Kwargs:
+        - tables:       (list) DataIDs to convert, default: all DataIDs of DATAINFO
+        - schema:       (string) target schema 'epoch' (BIGINT microseconds),
+                                 'datetime' (DATETIME(6)) or 'char'
+        - batchsize:    (int) rows per batch/transaction
+        - keepbackup:   (bool) keep the original table as TABLENAME_bak
+
+    RETURNS:
+        - converted:    (list) names of the converted tables
+
+    EXAMPLE:
+        >>> dbmigratetimeschema(db, tables=['DIDD_3121331_0002_0001'], schema='epoch')
+    """
+    if not schema in DBTIMESCHEMAS:
+        print ("dbmigratetimeschema: schema needs to be one of {}".format(list(DBTIMESCHEMAS.keys())))
+        return []
+    if not tables:
+        tables = dbselect(db, 'DataID', 'DATAINFO')
+    if isinstance(tables, basestring):
+        tables = [tables]
+
+    def copybatches(cursor, source, target, conversion, cols, last):
+        # copy all rows of source with time > last to target in batches
+        copied = 0
+        while True:
+            if last is None:
+                cursor.execute("SELECT MAX(time) FROM (SELECT time FROM " + source + " ORDER BY time LIMIT " + str(int(batchsize)) + ") AS batch")
+            else:
+                cursor.execute("SELECT MAX(time) FROM (SELECT time FROM " + source + " WHERE time > %s ORDER BY time LIMIT " + str(int(batchsize)) + ") AS batch", (last,))
+            upper = cursor.fetchall()[0][0]
+            if upper is None:
+                break
+            copysql = "INSERT IGNORE INTO " + target + " (" + ','.join(['time']+cols) + ") SELECT " + ','.join([conversion]+cols) + " FROM " + source + " WHERE time <= %s"
+            if last is None:
+                copied += cursor.execute(copysql, (upper,))
+            else:
+                copied += cursor.execute(copysql + " AND time > %s", (upper, last))
+            db.commit()
+            last = upper
+            print ("dbmigratetimeschema: {} - copied {} rows up to {}".format(target, copied, _dbtime2string(last)))
+        return last
+
+    converted = []
+    cursor = db.cursor()
+    for table in tables:
+        current = dbtimeschema(db, table)
+        if not current:
+            print ("dbmigratetimeschema: table {} not existing - skipping".format(table))
+            continue
+        if current == schema:
+            print ("dbmigratetimeschema: table {} already uses schema {}".format(table, schema))
+            continue
+        newtable = table + '_mig'
+        backup = table + '_bak'
+        cursor.execute("SHOW COLUMNS FROM " + table)
+        cols = [el[0] for el in cursor.fetchall() if not el[0] == 'time']
+        conversion = _dbtimeconversion(current, schema)
+        cursor.execute("DROP TABLE IF EXISTS " + newtable)
+        cursor.execute("CREATE TABLE " + newtable + " LIKE " + table)
+        cursor.execute("ALTER TABLE " + newtable + " MODIFY time " + DBTIMESCHEMAS[schema] + " NOT NULL")
+        db.commit()
+
+        # copy existing data, then catch up with data written meanwhile
+        last = copybatches(cursor, table, newtable, conversion, cols, None)
+        last = copybatches(cursor, table, newtable, conversion, cols, last)
+
+        # exchange tables and transfer what arrived in between
+        dbdialect(db).renametables(db, [(table, backup), (newtable, table)])
+        copybatches(cursor, backup, table, conversion, cols, last)
+        if not keepbackup:
+            cursor.execute("DROP TABLE " + backup)
+        db.commit()
+        loggerdatabase.info("dbmigratetimeschema: converted {} from {} to {}".format(table, current, schema))
+        converted.append(table)
+    cursor.close()
+
+    return converted
+
+
+DBROLLUPS = [('min', 60.), ('hour', 3600.), ('day', 86400.)]
+DBROLLUPGAUSSFACTOR = 1.86506   # IAGA recommended gaussian for 1 min values (see stream.filter)
+DBROLLUPCOVERAGE = 0.9          # IAGA: at least 90% of data needed for a mean
+
+def _dbrollupminute(t, v, first, amount, sampling):
+    """
+    DEFINITION:
+        One-minute aggregates of a single column. Means are IAGA-style
+        gaussian filtered values centered on the minute, min/max/count
+        refer to the interval [minute-30s, minute+30s).
+
+    PARAMETERS:
+        - t:            (array) epoch seconds
+        - v:            (array) values (NaN = missing)
+        - first:        (float) first minute label (epoch seconds)
+        - amount:       (int) number of minutes
+        - sampling:     (float) sampling period in seconds
+
+    RETURNS:
+        - mean, vmin, vmax, count: (arrays) of length amount
+    """
+    valid = ~np.isnan(v)
+    bidx = np.floor((t - first + 30.)/60.).astype(np.int64)
+    sel = valid & (bidx >= 0) & (bidx < amount)
+    count = np.bincount(bidx[sel], minlength=amount)[:amount]
+    vmin = np.full(amount, np.nan)
+    vmax = np.full(amount, np.nan)
+    np.fmin.at(vmin, bidx[sel], v[sel])
+    np.fmax.at(vmax, bidx[sel], v[sel])
+
+    window = DBROLLUPGAUSSFACTOR*60.
+    std = 0.83255461*window/(2*np.pi)
+    wsum = np.zeros(amount)
+    vsum = np.zeros(amount)
+    nearest = np.round((t - first)/60.).astype(np.int64)
+    # a sample contributes to the neighbouring minutes within the window
+    for shift in [-1, 0, 1]:
+        idx = nearest + shift
+        dt = t - (first + idx*60.)
+        sel = valid & (idx >= 0) & (idx < amount) & (np.abs(dt) <= window/2.)
+        w = np.exp(-0.5*(dt[sel]/std)**2)
+        wsum += np.bincount(idx[sel], weights=w, minlength=amount)[:amount]
+        vsum += np.bincount(idx[sel], weights=w*v[sel], minlength=amount)[:amount]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = vsum/wsum
+    expected = max(1., 60./sampling)
+    mean[count < DBROLLUPCOVERAGE*expected] = np.nan
+    return mean, vmin, vmax, count
+
+
+def _dbrollupcoarse(labels, mean, vmin, vmax, count, first, amount, resolution):
+    """
+    DEFINITION:
+        Hourly/daily aggregates from one-minute aggregates: the mean is
+        the average of the minute means (IAGA), provided that at least
+        DBROLLUPCOVERAGE of the minutes are available. Labels are the
+        minute labels in epoch seconds, first the start of the first
+        interval.
+    """
+    idx = np.floor((labels - first)/resolution).astype(np.int64)
+    inrange = (idx >= 0) & (idx < amount)
+    sel = inrange & ~np.isnan(mean)
+    nminutes = np.bincount(idx[sel], minlength=amount)[:amount]
+    msum = np.bincount(idx[sel], weights=mean[sel], minlength=amount)[:amount]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cmean = msum/nminutes
+    cmean[nminutes < DBROLLUPCOVERAGE*resolution/60.] = np.nan
+    cmin = np.full(amount, np.nan)
+    cmax = np.full(amount, np.nan)
+    np.fmin.at(cmin, idx[inrange], vmin[inrange])
+    np.fmax.at(cmax, idx[inrange], vmax[inrange])
+    ccount = np.bincount(idx[inrange], weights=count[inrange], minlength=amount)[:amount]
+    return cmean, cmin, cmax, ccount.astype(np.int64)
+
+
+def _dbrollupwrite(db, tablename, timeschema, keys, labels, aggregates):
+    """
+    DEFINITION:
+        Creates rollup table tablename if necessary and replaces the rows
+        of the given labels (epoch seconds of the interval centers).
+    """
+    heads = ['time ' + DBTIMESCHEMAS[timeschema] + ' NOT NULL PRIMARY KEY']
+    cols = []
+    for key in keys:
+        heads.extend([key + ' DOUBLE', key + '_min DOUBLE', key + '_max DOUBLE', key + '_count INT'])
+        cols.extend([key, key + '_min', key + '_max', key + '_count'])
+    cursor = db.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (tablename, ', '.join(heads)))
+    existing = [el[0] for el in dbcolumns(db, tablename)]
+    for idx, col in enumerate(cols):
+        if not col in existing:
+            cursor.execute("ALTER TABLE " + tablename + " ADD " + heads[idx+1])
+
+    # only intervals containing any data
+    hasdata = np.zeros(len(labels), dtype=bool)
+    for key in keys:
+        hasdata = hasdata | (aggregates[key][3] > 0)
+    columns = [_num2dbtime(labels[hasdata]/86400. + DBEPOCHNUM, timeschema).tolist()]
+    for key in keys:
+        mean, vmin, vmax, count = aggregates[key]
+        for arr in [mean, vmin, vmax]:
+            arr = arr[hasdata].astype(object)
+            arr[np.isnan(arr.astype(float))] = None
+            columns.append(arr.tolist())
+        columns.append([int(el) for el in count[hasdata]])
+    rows = list(zip(*columns))
+    if len(rows) > 0:
+        sql = "%s %s(%s) VALUES (%s)" % (dbdialect(db).insert('replace'), tablename, ', '.join(['time']+cols), ', '.join(['%s' for el in ['time']+cols]))
+        cursor.executemany(sql, rows)
+    db.commit()
+    cursor.close()
+    return len(rows)
+
+
+def _dbrollupread(db, tablename, columns, begin, end, timeschema):
+    """
+    DEFINITION:
+        Reads columns of tablename for begin <= time < end (datetimes) and
+        returns epoch seconds and a list of float arrays.
+    """
+    fmt = "%Y-%m-%d %H:%M:%S.%f"
+    sql = "SELECT " + ', '.join(['time'] + columns) + " FROM " + tablename + " WHERE time >= " + _dbtimevalue(begin, timeschema, fmt=fmt) + " AND time < " + _dbtimevalue(end, timeschema, fmt=fmt)
+    rows = []
+    for chunk in _dbfetch(db, sql):
+        rows.extend(chunk)
+    if not len(rows) > 0:
+        return np.asarray([]), [np.asarray([]) for col in columns]
+    data = list(zip(*rows))
+    t = (_dbtime2num(data[0]) - DBEPOCHNUM)*86400.
+    return t, [np.asarray(col, dtype=float) for col in data[1:]]
+
+
+def dbrollupupdate(db, dataid, starttime=None, endtime=None):
+    """
+    DEFINITION:
+        Creates or incrementally updates the rollup tables DATAID_min,
+        DATAID_hour and DATAID_day of data table dataid. For every numerical
+        column they contain mean (IAGA-style: gaussian filtered one-minute
+        values, hourly and daily means of minute values with 90% coverage),
+        minimum, maximum and count (amount of raw data points) in columns
+        key, key_min, key_max and key_count. Time stamps are centered
+        (minute: hh:mm:00, hour: hh:30:00, day: 12:00:00).
+        Only intervals touched by starttime..endtime are recalculated, so
+        that calling it after every upload is cheap (writeDB and the
+        collectors (BufferedDBWriter) do this automatically, if rollup tables
+        exist or rollup=True is given).
+
+    PARAMETERS:
+        - db:           (mysql database) defined by MySQLdb.connect().
+        - dataid:       (string) data table
+    Kwargs:
+        - starttime:    (datetime/string) begin of new data, default DataMinTime
+        - endtime:      (datetime/string) end of new data, default DataMaxTime
+
+    RETURNS:
+        - amount:       (int) number of updated minute intervals
+
+    EXAMPLE:
+        >>> dbrollupupdate(db, 'DIDD_3121331_0002_0001')   # initial build
+        >>> stream = readDB(db, 'DIDD_3121331_0002_0001', starttime='2015-01-01', resolution='hour')
+    """
+    tmp = DataStream()
+    columns = dbcolumns(db, dataid)
+    keys = [el[0] for el in columns if el[0] in NUMKEYLIST]
+    if not len(keys) > 0:
+        print ("dbrollupupdate: no numerical columns found in {}".format(dataid))
+        return 0
+    timeschema = dbtimeschema(db, dataid)
+    if not starttime or not endtime:
+        minmax = dbselect(db, 'MIN(time),MAX(time)', dataid)
+        if not len(minmax) > 0 or minmax[0][0] is None:
+            return 0
+        starttime = starttime if starttime else _dbtime2string(minmax[0][0])
+        endtime = endtime if endtime else _dbtime2string(minmax[0][1])
+    start = (date2num(tmp._testtime(starttime)) - DBEPOCHNUM)*86400.
+    end = (date2num(tmp._testtime(endtime)) - DBEPOCHNUM)*86400.
+
+    def todatetime(sec):
+        return datetime(1970,1,1) + timedelta(seconds=sec)
+
+    updated = 0
+    # process in daily portions to limit memory
+    chunkstart = np.floor(start/86400.)*86400.
+    while chunkstart <= end:
+        chunkend = min(chunkstart + 86400., end)
+        cstart = max(chunkstart, start)
+        # minutes affected by new data (including the gaussian window)
+        firstmin = np.floor((cstart - DBROLLUPGAUSSFACTOR*30.)/60.)*60.
+        lastmin = np.ceil((chunkend + DBROLLUPGAUSSFACTOR*30.)/60.)*60.
+        amount = int((lastmin - firstmin)/60.) + 1
+        t, values = _dbrollupread(db, dataid, keys, todatetime(firstmin - 60.), todatetime(lastmin + 60.), timeschema)
+        if len(t) > 1:
+            sampling = np.median(np.diff(np.sort(t)))
+            sampling = sampling if sampling > 0 else 1.
+            aggregates = {}
+            for idx, key in enumerate(keys):
+                aggregates[key] = _dbrollupminute(t, values[idx], firstmin, amount, sampling)
+            labels = firstmin + np.arange(amount)*60.
+            updated += _dbrollupwrite(db, dataid + '_min', timeschema, keys, labels, aggregates)
+
+            # coarser levels from the minute table
+            for name, resolution in DBROLLUPS[1:]:
+                cfirst = np.floor(firstmin/resolution)*resolution
+                clast = np.floor(lastmin/resolution)*resolution + resolution
+                camount = int(round((clast - cfirst)/resolution))
+                mincols = []
+                for key in keys:
+                    mincols.extend([key, key + '_min', key + '_max', key + '_count'])
+                mt, mvalues = _dbrollupread(db, dataid + '_min', mincols, todatetime(cfirst), todatetime(clast), timeschema)
+                caggregates = {}
+                for idx, key in enumerate(keys):
+                    mean, vmin, vmax, count = mvalues[idx*4:idx*4+4]
+                    caggregates[key] = _dbrollupcoarse(mt, mean, vmin, vmax, np.nan_to_num(count), cfirst, camount, resolution)
+                clabels = cfirst + np.arange(camount)*resolution + resolution/2.
+                _dbrollupwrite(db, dataid + '_' + name, timeschema, keys, clabels, caggregates)
+        chunkstart += 86400.
+
+    loggerdatabase.info("dbrollupupdate: updated {} minutes of {}".format(updated, dataid))
+    return updated
+
+
+def _dbrolluptable(db, table, resolution):
+    """
+    DEFINITION:
+        Returns the coarsest existing rollup table of table with a
+        resolution not larger than the requested one (seconds, timedelta
+        or 'min', 'minute', 'hour', 'day') and its resolution in seconds.
+        Returns (table, None) if no rollup satisfies the request.
+    """
+    if isinstance(resolution, timedelta):
+        resolution = resolution.total_seconds()
+    elif isinstance(resolution, basestring):
+        names = dict(DBROLLUPS)
+        names['minute'] = 60.
+        if not resolution in names:
+            print ("Rollup resolution needs to be one of {} or seconds".format(list(names.keys())))
+            return table, None
+        resolution = names[resolution]
+    for name, res in reversed(DBROLLUPS):
+        if res <= float(resolution) and len(dbcolumns(db, table + '_' + name)) > 0:
+            return table + '_' + name, res
+    return table, None
 
 
 def dbupdateDataInfo(db, tablename, header):
@@ -2439,7 +3554,7 @@ def stream2db(db, datastream, noheader=None, mode=None, tablename=None, **kwargs
             insertsql = insertmanysql
             insertsql = insertsql.replace("INSERT","REPLACE")
             cursor.executemany(insertsql,values)
-        except MySQLdb.Error as e:
+        except DBERROR as e:
             loggerdatabase.error("stream2db: mysqlerror while replacing data: %s" % (e))
         except:
             try:
@@ -2462,16 +3577,269 @@ def stream2db(db, datastream, noheader=None, mode=None, tablename=None, **kwargs
     rows = cursor.fetchall()
     #print rows
     loggerdatabase.info("stream2DB: Table now covering a time range from " + str(rows[0][0]) + " to " + str(rows[0][1]))
-    updatedatainfotimesql = 'UPDATE DATAINFO SET DataMinTime = "' + rows[0][0] + '", DataMaxTime = "' + rows[0][1] +'", ColumnContents = "' + colstr +'", ColumnUnits = "' + unitstr +'" WHERE DataID = "'+ tablename + '"'
+    updatedatainfotimesql = 'UPDATE DATAINFO SET DataMinTime = "' + _dbtime2string(rows[0][0]) + '", DataMaxTime = "' + _dbtime2string(rows[0][1]) +'", ColumnContents = "' + colstr +'", ColumnUnits = "' + unitstr +'" WHERE DataID = "'+ tablename + '"'
     #print updatedatainfotimesql
     cursor.execute(updatedatainfotimesql)
 
     db.commit()
     cursor.close ()
+    dbcacheclear(table='DATAINFO', contains=tablename)
 
     #print "stream2db6: ", datetime.utcnow()
 
-def readDB(db, table, starttime=None, endtime=None, sql=None):
+DBTIMEFORMAT = "%Y-%m-%d %H:%M:%S.%f"
+DBEPOCH = np.datetime64('1970-01-01T00:00:00','us')
+DBEPOCHNUM = date2num(datetime(1970,1,1))
+
+DBTIMESCHEMAS = {'char':'CHAR(40)', 'datetime':'DATETIME(6)', 'epoch':'BIGINT'}
+
+def _dbschemafromtype(typestr):
+    """
+    DEFINITION:
+        Returns the time schema ('char', 'datetime' or 'epoch') belonging
+        to a column type as listed by SHOW COLUMNS.
+    """
+    typestr = str(typestr).lower()
+    if typestr.find('int') >= 0:
+        return 'epoch'
+    elif typestr.find('datetime') >= 0 or typestr.find('timestamp') >= 0:
+        return 'datetime'
+    return 'char'
+
+
+def dbtimeschema(db, tablename, column='time'):
+    """
+    DEFINITION:
+        Identifies the time schema of a data table.
+        Data tables either use the classic 'char' schema (time CHAR(40),
+        millisecond strings), or a numeric time key 'datetime'
+        (DATETIME(6)) or 'epoch' (BIGINT, microseconds since 1970-01-01).
+
+    PARAMETERS:
+        - db:           (mysql database) defined by MySQLdb.connect().
+        - tablename:    (string) name of the table
+        - column:       (string) name of the time column, default 'time'
+
+    RETURNS:
+        - schema:       (string) 'char', 'datetime', 'epoch' or None if
+                                 table/column is not existing
+
+    EXAMPLE:
+        >>> schema = dbtimeschema(db,'DIDD_3121331_0002_0001')
+    """
+    rows = [el for el in dbcolumns(db, tablename) if el[0] == column]
+    if not len(rows) > 0:
+        return None
+    return _dbschemafromtype(rows[0][1])
+
+
+def dblasttime(db, tablename):
+    """
+    DEFINITION:
+        Returns the time of the last data line of a data table (any time
+        schema), e.g. to identify the gap after an interrupted transfer.
+
+    PARAMETERS:
+        - db:           (mysql database) defined by MySQLdb.connect().
+        - tablename:    (string) name of the table
+
+    RETURNS:
+        - lasttime:     (datetime) time of the last line, None if the table
+                                   is empty or not existing
+
+    EXAMPLE:
+        >>> last = dblasttime(db,'DIDD_3121331_0002_0001')
+    """
+    rows = dbselect(db, 'MAX(time)', tablename)
+    if not len(rows) > 0 or rows[0] is None:
+        return None
+    try:
+        return DataStream()._testtime(_dbtime2string(rows[0]))
+    except:
+        print ("dblasttime: could not interpret time {} of {}".format(rows[0], tablename))
+        return None
+
+
+def _num2dbtime(timecol, schema='char'):
+    """
+    DEFINITION:
+        Converts an array of date2num values into data base time values
+        of the given schema, rounded to milliseconds (like trim_time in former
+        versions): 'char' and 'datetime' -> strings '%Y-%m-%d %H:%M:%S.%f',
+        'epoch' -> integer microseconds since 1970-01-01.
+    """
+    col = np.asarray(timecol, dtype=float)
+    ms = np.round((col - DBEPOCHNUM)*86400000.).astype(np.int64)
+    if schema == 'epoch':
+        return ms*1000
+    tcol = np.datetime_as_string(ms.astype('datetime64[ms]'), unit='us')
+    return np.char.replace(tcol.astype(str), 'T', ' ')
+
+
+def _dbtimevalue(t, schema='char', fmt="%Y-%m-%d %H:%M:%S"):
+    """
+    DEFINITION:
+        Returns a sql literal for datetime t to be used in where clauses
+        of a table with the given time schema.
+    """
+    if schema == 'epoch':
+        return str(int(round((date2num(t) - DBEPOCHNUM)*86400000.))*1000)
+    return '"' + datetime.strftime(t, fmt) + '"'
+
+
+def _dbtime2string(value, fmt=DBTIMEFORMAT):
+    """
+    DEFINITION:
+        Converts a single time value as returned from any time schema
+        into the string representation used e.g. in DATAINFO.
+    """
+    if value is None:
+        return value
+    if isinstance(value, datetime):
+        return datetime.strftime(value, fmt)
+    if isinstance(value, numbers.Integral):
+        return datetime.strftime(datetime(1970,1,1) + timedelta(microseconds=int(value)), fmt)
+    return str(value)
+
+
+def _dbtime2num(timecol):
+    """
+    DEFINITION:
+        Converts a column of time values as returned by the data base
+        (strings like '2016-01-01 10:00:00.123000', datetime objects or
+        integer epoch microseconds)
+        into date2num values in a single numpy operation.
+        Elements which do not follow the fixed format are parsed
+        individually using stream._testtime, undecodable ones and NULL
+        become NaN.
+
+    RETURNS:
+        - array:        (numpy float array) date2num values
+    """
+    if len(timecol) == 0:
+        return np.asarray([])
+    first = next((el for el in timecol if el is not None), None)
+    if isinstance(first, numbers.Integral):
+        # epoch schema: microseconds since 1970
+        return np.asarray(timecol, dtype=float)/86400000000. + DBEPOCHNUM
+    try:
+        col = np.asarray(timecol, dtype='datetime64[us]')
+    except:
+        col = None
+    if col is not None:
+        # NULL -> NaT (converted to the smallest int64 otherwise)
+        res = (col - DBEPOCH).astype(np.int64)/86400000000. + DBEPOCHNUM
+        res[np.isnat(col)] = np.nan
+        return res
+    # Slow fallback for non-standard formats
+    tmpstream = DataStream()
+    res = np.empty(len(timecol))
+    for idx, elem in enumerate(timecol):
+        try:
+            res[idx] = date2num(tmpstream._testtime(elem))
+        except:
+            res[idx] = np.nan
+    return res
+
+
+def _dbdecode(rows, keys):
+    """
+    DEFINITION:
+        Decodes a result set (sequence of row tuples) of a data table into
+        a list of numpy columns ordered like KEYLIST. The result set is
+        transposed once, column positions are resolved once and each column
+        is converted as a whole: time columns via _dbtime2num, NUMKEYLIST
+        columns by a single float conversion (NULL -> NaN), all other
+        columns as strings (NULL -> '').
+
+    PARAMETERS:
+        - rows:         (list of tuples) as obtained by cursor.fetchall/fetchmany
+        - keys:         (list) column names of the result set
+
+    RETURNS:
+        - ls:           (list) of len(KEYLIST) numpy arrays
+    """
+    ls = [np.asarray([]) for key in KEYLIST]
+    if len(rows) == 0:
+        return ls
+    columns = list(zip(*rows))
+    for i, key in enumerate(keys):
+        if not key in KEYLIST:
+            continue
+        index = KEYLIST.index(key)
+        col = columns[i]
+        if key.endswith('time'):
+            ls[index] = _dbtime2num(col)
+        elif key in NUMKEYLIST:
+            try:
+                # None is converted to NaN by numpy
+                ls[index] = np.asarray(col, dtype=float)
+            except (ValueError, TypeError):
+                ls[index] = np.asarray([np.nan if el is None or el == 'null' else el for el in col], dtype=float)
+        else:
+            ls[index] = np.asarray(['' if el is None or el == 'null' else el for el in col])
+    return ls
+
+
+def _dbfetch(db, sql, chunksize=None):
+    """
+    DEFINITION:
+        Generator returning the result set of sql in row chunks.
+        If chunksize is given a server side cursor (SSCursor) is used
+        and rows are transferred in portions of chunksize, so that
+        large result sets are never held completely by the client library.
+
+    RETURNS:
+        - rows:         (list of tuples) yields chunks of the result set
+    """
+    if chunksize:
+        try:
+            cursor = db.cursor(MySQLdb.cursors.SSCursor)
+        except:
+            loggerdatabase.warning("_dbfetch: server side cursors not supported - fetching all rows")
+            cursor = db.cursor()
+            chunksize = None
+    else:
+        cursor = db.cursor()
+    try:
+        cursor.execute(sql)
+        if not chunksize:
+            yield list(cursor.fetchall())
+        else:
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield list(rows)
+    finally:
+        cursor.close()
+
+
+def _dbreadcolumns(db, sql, keys, chunksize=None):
+    """
+    DEFINITION:
+        Reads and decodes the result set of sql (selecting keys)
+        chunk by chunk and returns KEYLIST ordered numpy columns and
+        the amount of rows.
+    """
+    chunks = []
+    amount = 0
+    for rows in _dbfetch(db, sql, chunksize=chunksize):
+        amount += len(rows)
+        if len(rows) > 0:
+            chunks.append(_dbdecode(rows, keys))
+    if len(chunks) == 0:
+        return [np.asarray([]) for key in KEYLIST], 0
+    if len(chunks) == 1:
+        return chunks[0], amount
+    ls = []
+    for idx in range(len(KEYLIST)):
+        parts = [chunk[idx] for chunk in chunks if len(chunk[idx]) > 0]
+        ls.append(np.concatenate(parts) if len(parts) > 0 else np.asarray([]))
+    return ls, amount
+
+
+def readDB(db, table, starttime=None, endtime=None, sql=None, chunksize=None, resolution=None):
     """
     sql: provide any additional search criteria
         example: sql = "DataSamplingRate=60 AND DataType='variation'"
@@ -2486,12 +3854,18 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
         - sql:              (string) provide any additional search criteria
                                   example: sql = "x>20000 AND str1='P'"
     Kwargs:
+        - chunksize:        (int) if provided, rows are fetched by a server side
+                                  cursor in portions of chunksize (large tables)
+        - resolution:       (seconds/timedelta/string) required resolution e.g. 3600 or
+                                  'hour': the coarsest rollup table (see dbrollupupdate)
+                                  not coarser than resolution is read instead of raw data
 
     RETURNS:
         data stream
 
     EXAMPLE:
-        >>> db2stream(db,None,None,None,'DIDD_3121331_0002_0001')
+        >>> stream = readDB(db,'DIDD_3121331_0002_0001',starttime='2016-01-01',chunksize=100000)
+        >>> yearstream = readDB(db,'DIDD_3121331_0002_0001',starttime='2015-01-01',resolution='hour')
 
     APPLICATION:
         Requires an existing mysql database (e.g. mydb)
@@ -2514,22 +3888,6 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
     if not table:
         loggerdatabase.error("DB2stream: Aborting ... either sensorid or table must be specified")
         return
-    if starttime:
-        #starttime = stream._testtime(begin)
-        begin = datetime.strftime(stream._testtime(starttime),"%Y-%m-%d %H:%M:%S")
-        wherelist.append('time >= "' + begin + '"')
-    if endtime:
-        end = datetime.strftime(stream._testtime(endtime),"%Y-%m-%d %H:%M:%S")
-        wherelist.append('time <= "' + end + '"')
-    if len(wherelist) > 0:
-        whereclause = ' AND '.join(wherelist)
-    else:
-        whereclause = ''
-    if sql:
-        if len(whereclause) > 0:
-            whereclause = whereclause + ' AND ' + sql
-        else:
-            whereclause = sql
 
     # 1. Try to locate data table with name 'table'
     # --------------------------------------------
@@ -2539,7 +3897,8 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
         cursor.execute(getcols)
         rows = cursor.fetchall()
         keys = [el[0] for el in rows]
-    except MySQLdb.Error as e:
+        types = [el[1] for el in rows]
+    except DBERROR as e:
         # Table does not exist - assume sensor id
         getdatainfo = 'SELECT DataID FROM DATAINFO WHERE SensorID = "' + table + '"'
         cursor.execute(getdatainfo)
@@ -2556,6 +3915,7 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
             cursor.execute('SHOW COLUMNS FROM ' + table)
             rows = cursor.fetchall()
             keys = [el[0] for el in rows]
+            types = [el[1] for el in rows]
         except:
             loggerdatabase.error("readDB: mysqlerror while identifying table: %s" % (e))
             return stream
@@ -2563,45 +3923,51 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
         loggerdatabase.error("readDB: mysqlerror while getting table info: %s" % (e))
         return stream
 
+    # Use pre-aggregated data if a resolution is requested
+    datatable, rollupresolution = table, None
+    if resolution:
+        datatable, rollupresolution = _dbrolluptable(db, table, resolution)
+        if rollupresolution:
+            print ("readDB: reading rollup table {}".format(datatable))
+            rows = dbcolumns(db, datatable)
+            keys = [el[0] for el in rows]
+            types = [el[1] for el in rows]
+
+    # 2. Construct where clause according to the time schema of the table
+    # --------------------------------------------
+    timeschema = 'char'
+    if 'time' in keys:
+        timeschema = _dbschemafromtype(types[keys.index('time')])
+    if starttime:
+        wherelist.append('time >= ' + _dbtimevalue(stream._testtime(starttime), timeschema))
+    if endtime:
+        wherelist.append('time <= ' + _dbtimevalue(stream._testtime(endtime), timeschema))
+    if len(wherelist) > 0:
+        whereclause = ' AND '.join(wherelist)
+    else:
+        whereclause = ''
+    if sql:
+        if len(whereclause) > 0:
+            whereclause = whereclause + ' AND ' + sql
+        else:
+            whereclause = sql
+
 
     def checkEqual3(lst):
         return lst[1:] == lst[:-1]
 
+    ls = [np.asarray([]) for key in KEYLIST]
+    keys = [key for key in keys if key in KEYLIST]
     if len(keys) > 0:
         if len(whereclause) > 0:
-            getdatasql = 'SELECT ' + ','.join(keys) + ' FROM ' + table + ' WHERE ' + whereclause
+            getdatasql = 'SELECT ' + ','.join(keys) + ' FROM ' + datatable + ' WHERE ' + whereclause
         else:
-            getdatasql = 'SELECT ' + ','.join(keys) + ' FROM ' + table
+            getdatasql = 'SELECT ' + ','.join(keys) + ' FROM ' + datatable
         #print getdatasql
-        cursor.execute(getdatasql)
-        rows = list(cursor.fetchall())
-        print ("readDB: Read rows: {}".format(len(rows)))
-        ls = []
-        for i in range(len(KEYLIST)):
-            ls.append([])
-
-        if len(rows) > 0:
-            for ind, line in enumerate(rows):
-                for i, elem in enumerate(line):
-                    index = KEYLIST.index(keys[i])
-                    if keys[i][-4:]=='time':
-                        try:
-                            ls[index].append(date2num(stream._testtime(elem)))
-                        except:
-                            print ("readDB: could not identify time: {a}, {b}".format(a=index,b=elem) )
-                    else:
-                        if keys[i] in NUMKEYLIST:
-                            if elem == None or elem == 'null':
-                                elem = float(NaN)
-                            ls[index].append(float(elem))
-                        else:
-                            if elem == None or elem == 'null':
-                                elem = ''
-                            ls[index].append(elem)
-
-            for idx, elem in enumerate(ls):
-                ls[idx] = np.asarray(elem)
+        ls, amount = _dbreadcolumns(db, getdatasql, keys, chunksize=chunksize)
+        print ("readDB: Read rows: {}".format(amount))
 
+        if amount > 0:
             for key in keys:
                 #print "Reformating key", key
                 index = KEYLIST.index(key)
@@ -2617,6 +3983,9 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
                     ls[index] = np.asarray(col).astype('<f8')
 
             stream.header = dbfields2dict(db,table)
+            if rollupresolution:
+                stream.header['DataSamplingRate'] = rollupresolution
+                stream.header['DataSamplingFilter'] = 'gaussian (IAGA)' if rollupresolution == 60. else 'mean of minute values (IAGA)'
         else:
             print ("No data found")
             pass
@@ -2627,7 +3996,7 @@ def readDB(db, table, starttime=None, endtime=None, sql=None):
     return DataStream([LineStruct],stream.header,stream.ndarray)
 
 
-def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
+def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None, chunksize=None, resolution=None):
     """
     sql: provide any additional search criteria
         example: sql = "DataSamplingRate=60 AND DataType='variation'"
@@ -2642,6 +4011,10 @@ def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
                              example: sql = "DataSamplingRate=60 AND DataType='variation'"
         - datainfoid:       (string) table and dataid
     Kwargs:
+        - chunksize:        (int) if provided, rows are fetched by a server side
+                                  cursor in portions of chunksize (large tables)
+        - resolution:       (seconds/timedelta/string) serve the coarsest rollup table
+                                  not coarser than resolution (see readDB)
 
     RETURNS:
         data stream
@@ -2658,7 +4031,6 @@ def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
         - If sampling rate not given in DATAINFO get it from the datastream
         - begin needs to be string - generalize that
     """
-    wherelist = []
     stream = DataStream()
 
     if not db:
@@ -2670,24 +4042,44 @@ def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
     if not tableext and not sensorid:
         loggerdatabase.error("DB2stream: Aborting ... either sensorid or table must be specified")
         return
-    if begin:
-        #starttime = stream._testtime(begin)
-        #begin = datetime.strftime(starttime,"%Y-%m%d %H:%M%:%S")
-        wherelist.append('time >= "' + begin + '"')
-    if end:
-        wherelist.append('time <= "' + end + '"')
-    if len(wherelist) > 0:
-        whereclause = ' AND '.join(wherelist)
-    else:
-        whereclause = ''
-    if sql:
-        if len(whereclause) > 0:
-            whereclause = whereclause + ' AND ' + sql
+
+    def getwhereclause(tablename):
+        # time conditions depend on the time schema of the table
+        wherelist = []
+        timeschema = dbtimeschema(db, tablename)
+        if begin:
+            if timeschema == 'epoch':
+                wherelist.append('time >= ' + _dbtimevalue(stream._testtime(begin), timeschema))
+            else:
+                wherelist.append('time >= "' + begin + '"')
+        if end:
+            if timeschema == 'epoch':
+                wherelist.append('time <= ' + _dbtimevalue(stream._testtime(end), timeschema))
+            else:
+                wherelist.append('time <= "' + end + '"')
+        if len(wherelist) > 0:
+            whereclause = ' AND '.join(wherelist)
         else:
-            whereclause = sql
+            whereclause = ''
+        if sql:
+            if len(whereclause) > 0:
+                whereclause = whereclause + ' AND ' + sql
+            else:
+                whereclause = sql
+        return whereclause
+
+    def getdatatable(tablename):
+        # rollup table satisfying the requested resolution
+        if resolution:
+            return _dbrolluptable(db, tablename, resolution)
+        return tablename, None
 
-    #print whereclause
+    def setrollupheader(rollupresolution):
+        if rollupresolution:
+            stream.header['DataSamplingRate'] = rollupresolution
+            stream.header['DataSamplingFilter'] = 'gaussian (IAGA)' if rollupresolution == 60. else 'mean of minute values (IAGA)'
 
+    rollupresolution = None
     if not tableext:
         getdatainfo = 'SELECT DataID FROM DATAINFO WHERE SensorID = "' + sensorid + '"'
         cursor.execute(getdatainfo)
@@ -2695,11 +4087,13 @@ def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
         for table in rows:
             revision = table[0].replace(sensorid,'').strip('_')
             loggerdatabase.debug("DB2stream: Extracting field values from table %s" % str(table[0]))
+            datatable, rollupresolution = getdatatable(table[0])
+            whereclause = getwhereclause(datatable)
             if len(whereclause) > 0:
-                getdatasql = 'SELECT * FROM ' + table[0] + ' WHERE ' + whereclause
+                getdatasql = 'SELECT * FROM ' + datatable + ' WHERE ' + whereclause
             else:
-                getdatasql = 'SELECT * FROM ' + table[0]
-            getcolumnnames = 'SHOW COLUMNS FROM ' + table[0]
+                getdatasql = 'SELECT * FROM ' + datatable
+            getcolumnnames = 'SHOW COLUMNS FROM ' + datatable
             # sqlquery to get column names of table - store that in keylst
             keylst = []
             cursor.execute(getcolumnnames)
@@ -2707,31 +4101,21 @@ def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
             for line in rows:
                 keylst.append(line[0])
             # sqlquery to extract data
-            cursor.execute(getdatasql)
-            rows = cursor.fetchall()
-            if len(rows) > 0:
-                for line in rows:
-                    row = LineStruct()
-                    for i, elem in enumerate(line):
-                        if keylst[i]=='time':
-                            setattr(row,keylst[i],date2num(stream._testtime(elem)))
-                        else:
-                            if elem == None or elem == 'null':
-                                elem = float(NaN)
-                            if keylst[i] in NUMKEYLIST:
-                                setattr(row,keylst[i],float(elem))
-                            else:
-                                setattr(row,keylst[i],elem)
-                    stream.add(row)
+            ls, amount = _dbreadcolumns(db, getdatasql, keylst, chunksize=chunksize)
+            if amount > 0:
+                stream.ndarray = np.asarray(ls, dtype=object)
                 #print "Loaded data from table", table[0]
                 stream.header = dbfields2dict(db,table[0])
+                setrollupheader(rollupresolution)
                 break
     else:
+        datatable, rollupresolution = getdatatable(tableext)
+        whereclause = getwhereclause(datatable)
         if len(whereclause) > 0:
-            getdatasql = 'SELECT * FROM ' + tableext + ' WHERE ' + whereclause
+            getdatasql = 'SELECT * FROM ' + datatable + ' WHERE ' + whereclause
         else:
-            getdatasql = 'SELECT * FROM ' + tableext
-        getcolumnnames = 'SHOW COLUMNS FROM ' + tableext
+            getdatasql = 'SELECT * FROM ' + datatable
+        getcolumnnames = 'SHOW COLUMNS FROM ' + datatable
         # sqlquery to get column names of table - store that in keylst
         keylst = []
         cursor.execute(getcolumnnames)
@@ -2739,27 +4123,15 @@ def db2stream(db, sensorid=None, begin=None, end=None, tableext=None, sql=None):
         for line in rows:
             keylst.append(line[0])
         # sqlquery to extract data
-        cursor.execute(getdatasql)
-        rows = cursor.fetchall()
-        for line in rows:
-            row = LineStruct()
-            for i, elem in enumerate(line):
-                if keylst[i]=='time':
-                    setattr(row,keylst[i],date2num(stream._testtime(elem)))
-                else:
-                    if elem == None or elem == 'null':
-                        elem = float(NaN)
-                    if keylst[i] in NUMKEYLIST:
-                        setattr(row,keylst[i],float(elem))
-                    else:
-                        setattr(row,keylst[i],elem)
-            stream.add(row)
+        ls, amount = _dbreadcolumns(db, getdatasql, keylst, chunksize=chunksize)
+        stream.ndarray = np.asarray(ls, dtype=object)
 
     if tableext:
         stream.header = dbfields2dict(db,tableext)
+        setrollupheader(rollupresolution)
 
     cursor.close ()
-    return stream
+    return DataStream([LineStruct()],stream.header,stream.ndarray)
 
 def diline2db(db, dilinestruct, mode=None, **kwargs):
     """
@@ -3041,12 +4413,12 @@ def getBaseline(db,sensorid, date=None):
     if not date:
         where = 'SensorID LIKE "%'+sensorid+'%"'
         print(where)
-        vals = dbselect(db,'*','BASELINE', where)
+        vals = dbcachedselect(db,'*','BASELINE', where)
         vals = np.asarray(vals).transpose()
     else:
         tmp = DataStream()
         where = 'SensorID LIKE "%{a}%" AND "{b}" >= MinTime'.format(a=sensorid,b=datetime.strftime(tmp._testtime(date),"%Y-%m-%d %H:%M:%S"))
-        vals = dbselect(db,'*','BASELINE', where)
+        vals = dbcachedselect(db,'*','BASELINE', where)
         vals = [elem for elem in vals if elem[2]=='' or tmp._testtime(elem[2]) >= tmp._testtime(date)]
         vals = np.asarray(vals).transpose()
 
@@ -3065,6 +4437,100 @@ def getBaseline(db,sensorid, date=None):
     return vals
 
 
+FLAGSTABLESTR = 'FlagID INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, SensorID CHAR(50) NOT NULL, FlagBeginTime {t} NOT NULL, FlagEndTime {t} NOT NULL, FlagComponents CHAR(50) NOT NULL, FlagNum INT, FlagReason TEXT, ModificationDate CHAR(50)'
+
+def _dbflagscreate(db, tablename='FLAGS', timetype='CHAR(50)'):
+    """
+    DEFINITION:
+        Creates an interval indexed flagging table (one row per component)
+        with a unique key on (SensorID, FlagBeginTime, FlagEndTime,
+        FlagComponents) and an index on (SensorID, FlagEndTime), so that
+        overlap queries and upserts are resolved by the data base.
+        Existing tables are not modified (see dbflagsupgrade).
+    """
+    if len(dbcolumns(db, tablename)) > 0:
+        # existing tables (maybe containing joined components or
+        # duplicates) are converted by dbflagsupgrade only
+        return
+    cursor = db.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (tablename, FLAGSTABLESTR.format(t=timetype)))
+    indexes = dbdialect(db).indexes(db, tablename)
+    if not 'flagsinterval' in indexes:
+        cursor.execute("CREATE UNIQUE INDEX flagsinterval ON %s (SensorID, FlagBeginTime, FlagEndTime, FlagComponents)" % tablename)
+    if not 'flagsend' in indexes:
+        cursor.execute("CREATE INDEX flagsend ON %s (SensorID, FlagEndTime)" % tablename)
+    db.commit()
+    cursor.close()
+
+
+def _dbflagsindexed(db, tablename='FLAGS'):
+    # True if tablename uses the interval indexed flagging schema
+    return 'flagsinterval' in dbdialect(db).indexes(db, tablename)
+
+
+def _dbflagtime(value, timeschema='char'):
+    # data base representation of a flag time (datetime or string)
+    if not isinstance(value, datetime):
+        value = DataStream()._testtime(value)
+    if timeschema == 'epoch':
+        return int(round((date2num(value) - DBEPOCHNUM)*86400000.))*1000
+    return datetime.strftime(value, DBTIMEFORMAT)
+
+
+def dbflagsupgrade(db, keepbackup=True, chunksize=50000):
+    """
+    DEFINITION:
+        Converts an existing FLAGS table into the interval indexed schema
+        (see flaglist2db): components joined by underscores are split into
+        separate rows and duplicates (same sensor, begin, end and component)
+        are removed keeping the latest input. The old table is renamed to
+        FLAGS_bak unless keepbackup is False.
+
+    PARAMETERS:
+        - db:           (mysql database) defined by MySQLdb.connect().
+    Kwargs:
+        - keepbackup:   (bool) keep the original table as FLAGS_bak
+        - chunksize:    (int) rows transferred per batch
+
+    EXAMPLE:
+        >>> dbflagsupgrade(db)
+    """
+    columns = dict(dbcolumns(db, 'FLAGS'))
+    if not columns:
+        _dbflagscreate(db)
+        return
+    if _dbflagsindexed(db):
+        print ("dbflagsupgrade: FLAGS table already interval indexed")
+        return
+    timetype = str(columns.get('FlagBeginTime', 'CHAR(50)')).upper()
+    cursor = db.cursor()
+    cursor.execute("DROP TABLE IF EXISTS FLAGS_new")
+    db.commit()
+    cursor.close()
+    _dbflagscreate(db, 'FLAGS_new', timetype=timetype)
+
+    insertsql = dbdialect(db).insert('replace') + " FLAGS_new(SensorID, FlagBeginTime, FlagEndTime, FlagComponents, FlagNum, FlagReason, ModificationDate) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+    selectsql = "SELECT SensorID, FlagBeginTime, FlagEndTime, FlagComponents, FlagNum, FlagReason, ModificationDate FROM FLAGS ORDER BY FlagID+0"
+    cursor = db.cursor()
+    cursor.execute(selectsql)
+    rows = cursor.fetchall()
+    newrows = []
+    for line in rows:
+        for comp in str(line[3]).split('_'):
+            newrows.append((line[0], line[1], line[2], comp, line[4], line[5], line[6]))
+    # input order is kept - later inputs replace earlier ones
+    for idx in range(0, len(newrows), chunksize):
+        cursor.executemany(insertsql, newrows[idx:idx+chunksize])
+        db.commit()
+    amount = len(newrows)
+    dbdialect(db).renametables(db, [('FLAGS','FLAGS_bak'), ('FLAGS_new','FLAGS')])
+    if not keepbackup:
+        cursor.execute("DROP TABLE FLAGS_bak")
+    db.commit()
+    cursor.close()
+    print ("dbflagsupgrade: transferred {} flags".format(amount))
+
+
 def flaglist2db(db,flaglist,mode=None,sensorid=None,modificationdate=None):
     """
     DESCRIPTION:
@@ -3073,6 +4539,11 @@ def flaglist2db(db,flaglist,mode=None,sensorid=None,modificationdate=None):
        Flag Table looks like:
           data base format: flagID, sensorID, starttime, endtime, 
                 components, flagNum, flagReason, ModificationDate
+       New FLAGS tables are interval indexed: one row per component and
+       a unique key on (sensorID, starttime, endtime, component). Inputs
+       are upserted by the data base in one bulk statement. Old tables
+       (components joined by underscores) are still supported and can be
+       converted using dbflagsupgrade.
 
     PARAMETER:
        db: name of the mysql data base
@@ -3081,6 +4552,7 @@ def flaglist2db(db,flaglist,mode=None,sensorid=None,modificationdate=None):
 
     Optional:
        mode: default inserts information if not existing
+             use 'replace' to override existing flags (flagnumber, reason)
              use 'delete' to delete any existing input for the given sensorid
        sensorid: a string with the sensor id, if not provided within the list
        modificationdate: a string with the flagging modificationdate, 
@@ -3098,118 +4570,101 @@ def flaglist2db(db,flaglist,mode=None,sensorid=None,modificationdate=None):
     if not db:
         print("No database connected - aborting")
         return
-    cursor = db.cursor ()
 
     # Check flaglist:
     if not len(flaglist) > 0:
         print("No data found in flaglist - aborting")
         return
     lentype = len(flaglist[0])
-
-    if lentype <= 5:
-        listwithoutcomp = [[elem[0],elem[1],elem[3],elem[4]] for elem in flaglist]
-    else:
-        listwithoutcomp = [[elem[0],elem[1],elem[3],elem[4],elem[5],elem[6]] for elem in flaglist]
-        if sensorid == 'defaultsensor':
-            sensorid = listwithoutcomp[-1][4]
-    newlst = []
-    for elem in listwithoutcomp:
-        elem[0] = datetime.strftime(elem[0],"%Y-%m-%d %H:%M:%S.%f")
-        elem[1] = datetime.strftime(elem[1],"%Y-%m-%d %H:%M:%S.%f")
-        if elem not in newlst:
-            newlst.append(elem)
-
-    # Check whether an identical input already exists in the database
-    existinglst = db2flaglist(db,sensorid)
-
-    newflaglist = []
-    for flag in flaglist:
-        itexists = False
-        ti0 = datetime.strftime(flag[0],"%Y-%m-%d %H:%M:%S.%f")
-        ti1 = datetime.strftime(flag[1],"%Y-%m-%d %H:%M:%S.%f")
-        for exist in existinglst:
-            #print(ti0,exist[0],ti1,exist[1],flag[2],exist[2])
-            if lentype <= 5:
-                if ti1 == exist[0] and ti1 == exist[1] and flag[2] == exist[2]:
-                    itexists = True
-            else:
-                if ti0 == exist[0] and ti1 == exist[1] and flag[2] == exist[2] and flag[5] == exist[5]:
-                    itexists = True
-        if itexists:
-            pass
-        else:
-            newflaglist.append(flag)
-    flaglist = newflaglist
-
-    if len(flaglist) == 0:
-        return
-
-    for elem in newlst:
-        complst = []
-        for elem2 in flaglist:
-            comp = elem2[2]
-            if lentype <= 5:
-                el2 = [datetime.strftime(elem2[0],"%Y-%m-%d %H:%M:%S.%f"),datetime.strftime(elem2[1],"%Y-%m-%d %H:%M:%S.%f"),elem2[3],elem2[4]]
-            else:
-                el2 = [datetime.strftime(elem2[0],"%Y-%m-%d %H:%M:%S.%f"),datetime.strftime(elem2[1],"%Y-%m-%d %H:%M:%S.%f"),elem2[3],elem2[4],elem2[5],elem2[6]]
-            if el2 == elem:
-                complst.append(comp)
-        compstr = '_'.join(complst)
-        if lentype <= 5:
-            elem.extend([sensorid,modificationdate])
-        elem.append(compstr)
+    if lentype > 5 and sensorid == 'defaultsensor':
+        sensorid = flaglist[-1][5]
 
     # Flagging TABLE
-    # Create flagging table
+    # Create flagging table if not existing
+    if not len(dbcolumns(db, 'FLAGS')) > 0:
+        _dbflagscreate(db)
+    cursor = db.cursor ()
     if mode == 'delete':
         print("Executing: DELETE FROM FLAGS WHERE SensorID LIKE '{}'".format(sensorid))
         cursor.execute("DELETE FROM FLAGS WHERE SensorID LIKE '{}'".format(sensorid))
+        db.commit()
 
-    flagstr = 'FlagID INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, SensorID CHAR(50), FlagBeginTime CHAR(50), FlagEndTime CHAR(50), FlagComponents CHAR(50), FlagNum INT, FlagReason TEXT, ModificationDate CHAR(50)'
+    timeschema = dbtimeschema(db, 'FLAGS', column='FlagBeginTime')
 
-    # Check whether table exists
-    flagids = dbselect(db, 'FlagID', 'FLAGS')
-    if not len(flagids) > 0:
-        createflagtablesql = "CREATE TABLE IF NOT EXISTS FLAGS (%s)" % flagstr
-        cursor.execute(createflagtablesql)
-        flagid = 0
-    else:
-        flagids = [int(el) for el in flagids]
-        flagid = max(flagids)
-
-    # add flagging data
-    #if lentype <= 4:
-    #    flaghead = 'FlagID, FlagBeginTime, FlagEndTime, FlagNum, FlagReason, FlagComponents'
-    flaghead = 'FlagID, FlagBeginTime, FlagEndTime, FlagNum, FlagReason, SensorID, ModificationDate, FlagComponents'
-
-    for elem in newlst:
-        flagid = flagid+1
-        ne = [str(flagid)]
-        ne.extend(elem)
-        elem = [str(el) for el in ne]
-        flagsql = "INSERT INTO FLAGS(%s) VALUES (%s)" % (flaghead, '"'+'", "'.join(elem)+'"')
-        #print flagsql
-        if mode == "replace":
-            try:
-                cursor.execute(flagsql.replace("INSERT","REPLACE"))
-            except:
-                print("Write MySQL: Replace failed")
+    # One row per component - duplicates within flaglist: last input wins
+    rows = OrderedDict()
+    for elem in flaglist:
+        if lentype <= 5:
+            sid, moddate = sensorid, modificationdate
         else:
-            try:
-                cursor.execute(flagsql)
-            except:
-                print("Record already existing: use mode 'replace' to override")
-
-    db.commit()
+            sid, moddate = elem[5], elem[6]
+        t0 = _dbflagtime(elem[0], timeschema)
+        t1 = _dbflagtime(elem[1], timeschema)
+        for comp in str(elem[2]).split('_'):
+            key = (str(sid), t0, t1, comp)
+            rows.pop(key, None)
+            rows[key] = [str(sid), t0, t1, comp, int(elem[3]), str(elem[4]), str(moddate)]
+
+    flaghead = 'SensorID, FlagBeginTime, FlagEndTime, FlagComponents, FlagNum, FlagReason, ModificationDate'
+    if _dbflagsindexed(db):
+        # the unique interval key resolves existing inputs
+        flagsql = "%s FLAGS(%s) VALUES (%s)" % (dbdialect(db).insert('replace' if mode == 'replace' else 'ignore'), flaghead, ', '.join(['%s']*7))
+        values = list(rows.values())
+    else:
+        # old table without unique key: get existing inputs with a single
+        # overlap query per sensor and compare sets
+        existing = {}
+        for sid in set([key[0] for key in rows]):
+            keys = [key for key in rows if key[0] == sid]
+            begin = _dbtime2string(min([key[1] for key in keys]))
+            end = _dbtime2string(max([key[2] for key in keys]))
+            for el in db2flaglist(db, sid, begin=begin, end=end):
+                existing[(sid, el[0], el[1], el[2])] = el
+        stringkey = lambda key: (key[0], _dbtime2string(key[1]), _dbtime2string(key[2]), key[3])
+        if mode == 'replace':
+            # old rows join components (x_y_z): delete all rows of the
+            # replaced intervals and insert their other components again
+            intervals = OrderedDict([(key[:3], True) for key in rows if stringkey(key) in existing])
+            if len(intervals) > 0:
+                delsql = "DELETE FROM FLAGS WHERE SensorID = %s AND FlagBeginTime = %s AND FlagEndTime = %s"
+                cursor.executemany(delsql, list(intervals))
+            for interval in intervals:
+                for strkey, el in existing.items():
+                    key = interval + (strkey[3],)
+                    if stringkey(key) == strkey and not key in rows:
+                        rows[key] = [interval[0], interval[1], interval[2], strkey[3], int(el[3]), str(el[4]), str(el[6])]
+            existing = {}
+        flagid = dbselect(db, 'MAX(FlagID+0)', 'FLAGS')
+        flagid = int(flagid[0]) if len(flagid) > 0 and flagid[0] is not None else 0
+        values = []
+        for key in rows:
+            if not stringkey(key) in existing:
+                flagid += 1
+                values.append([str(flagid)] + rows[key])
+        flagsql = "INSERT INTO FLAGS(FlagID, %s) VALUES (%s)" % (flaghead, ', '.join(['%s']*8))
+
+    if len(values) > 0:
+        try:
+            cursor.executemany(flagsql, values)
+            db.commit()
+        except DBERROR as e:
+            db.rollback()
+            print("flaglist2db: writing flags failed - {}".format(e))
     cursor.close ()
 
 
-def db2flaglist(db,sensorid, begin=None, end=None):
+def db2flaglist(db,sensorid, begin=None, end=None, key=None):
     """
     DEFINITION:
         Read flagging information for specified sensor from data base and return a flagging list
+        Only flags overlapping the time range begin - end are selected by the
+        data base (index on SensorID, FlagEndTime for interval indexed tables).
     PARAMETERS:
         sensorid:	   (string) sensorid for flaglist, default is sensorid of self
+    Kwargs:
+        begin:             (string/datetime) return flags ending after begin
+        end:               (string/datetime) return flags starting before end
+        key:               (string) return only flags of this component
     RETURNS:
         flaglist:          flaglist contains start, end , key2flag, flagnumber, comment, sensorid,
                            ModificationDate
@@ -3223,46 +4678,47 @@ def db2flaglist(db,sensorid, begin=None, end=None):
         return []
     cursor = db.cursor ()
 
+    timeschema = dbtimeschema(db, 'FLAGS', column='FlagBeginTime')
     searchsql = 'SELECT FlagBeginTime, FlagEndTime, FlagComponents, FlagNum, FlagReason, SensorID, ModificationDate FROM FLAGS WHERE SensorID = "%s"' % sensorid
     if begin:
         #addbeginsql = ' AND FlagBeginTime >= "%s"' % begin
-        addbeginsql = ' AND FlagEndTime >= "%s"' % begin
+        if timeschema == 'epoch':
+            addbeginsql = ' AND FlagEndTime >= %s' % _dbtimevalue(DataStream()._testtime(begin), timeschema)
+        else:
+            addbeginsql = ' AND FlagEndTime >= "%s"' % begin
     else:
         addbeginsql = ''
     if end:
         #addendsql = ' AND FlagEndTime <= "%s"' % end
-        addendsql = ' AND FlagBeginTime <= "%s"' % end
+        if timeschema == 'epoch':
+            addendsql = ' AND FlagBeginTime <= %s' % _dbtimevalue(DataStream()._testtime(end), timeschema)
+        else:
+            addendsql = ' AND FlagBeginTime <= "%s"' % end
     else:
         addendsql = ''
+    if key:
+        # old tables contain joined components like x_y_z
+        addkeysql = ' AND FlagComponents LIKE "%%%s%%"' % key
+    else:
+        addkeysql = ''
 
-    cursor.execute (searchsql + addbeginsql + addendsql)
+    cursor.execute (searchsql + addbeginsql + addendsql + addkeysql)
     rows = cursor.fetchall()
-
-    res=[]
-    for line in rows:
-        comps = line[2].split('_')
-        for elem in comps:
-            res.append([line[0],line[1],elem,int(line[3]),line[4],line[5],line[6]])
-
     cursor.close ()
 
-    def flagclean(flaglist):
-            ## Cleanup flaglist -- remove all inputs with duplicate start and endtime 
-            ## (use only last input)
-            indicies = []
-            for line in flaglist:
-                inds = [ind for ind,elem in enumerate(flaglist) if elem[0] == line[0] and elem[1] == line[1] and elem[2] == line[2]]
-                if len(inds) > 0:
-                    index = inds[-1]
-                    indicies.append(index)
-            uniqueidx = (list(set(indicies)))
-            uniqueidx.sort()
-            #print(uniqueidx)
-            flaglist = [elem for idx, elem in enumerate(flaglist) if idx in uniqueidx]
-
-            return flaglist
-
-    return flagclean(res)
+    ## Cleanup flaglist -- remove all inputs with duplicate start and endtime
+    ## (use only last input)
+    res = OrderedDict()
+    for line in rows:
+        # numeric time schemas are returned as strings like the char schema
+        t0, t1 = _dbtime2string(line[0]), _dbtime2string(line[1])
+        for elem in line[2].split('_'):
+            if key and not elem == key:
+                continue
+            res.pop((t0,t1,elem), None)
+            res[(t0,t1,elem)] = [t0,t1,elem,int(line[3]),line[4],line[5],line[6]]
+
+    return list(res.values())
 
 
 def string2dict(string):
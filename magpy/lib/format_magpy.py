@@ -669,6 +669,21 @@ def readPYCDF(filename, headonly=False, **kwargs):
     else:
         return DataStream(stream, stream.header,stream.ndarray)
 
+def _pybinseparated(body, size):
+    """
+    Returns True if the records of a MagPyBin body (size bytes each) are
+    followed by a newline (files written line by line), False for
+    fixed size records.
+    """
+    separators = body[size::size+1]
+    if len(body) % (size+1):
+        # incomplete last record
+        separators = separators[:-1]
+    if not len(separators) > 0:
+        return len(body) > size
+    return separators.count(b'\n') == len(separators)
+
+
 def readPYBIN(filename, headonly=False, **kwargs):
     """
     Read binary format of the MagPy package
@@ -793,10 +808,17 @@ def readPYBIN(filename, headonly=False, **kwargs):
             else:
                 length = lengthcode
 
+        body = fh.read()
+        if not _pybinseparated(body, int(h_elem[-1])):
+            # fixed size records (see magpy.collector.binwriter)
+            packstr = '<'+h_elem[-2]
+            length = struct.calcsize(packstr)
+
         if debug:
             print('readPYBIN- unpack info:', packstr, lengthcode, lengthgiven)
 
-        line = fh.read(length)
+        line = body[:length]
+        pos = length
         stream.header['SensorID'] = h_elem[2]
         stream.header['SensorElements'] = ','.join(elemlist)
         stream.header['SensorKeys'] = ','.join(keylist)
@@ -815,7 +837,7 @@ def readPYBIN(filename, headonly=False, **kwargs):
                 stream.header['unit-col-'+elem] = unitlist[idx]
                 # Header info
                 pass
-            while not line == "":
+            while len(line) == length:
                 if debug:
                     print('readPYBIN- debug found line')
                 try:
@@ -864,7 +886,8 @@ def readPYBIN(filename, headonly=False, **kwargs):
                     loggerlib.error("readPYBIN: Error in line while reading data file. Last line at: %s" % str(lastdata))
                     logbaddata = True
                 lastdata = data
-                line = fh.read(length)
+                line = body[pos:pos+length]
+                pos += length
         else:
             print("To be done ...")
             pass
@@ -1021,7 +1021,8 @@ def plotFlag(data,variables=None,figure=False):
 
 
 def plotEMD(stream,key,verbose=False,plottitle=None,
-        outfile=None,sratio=0.25,max_modes=20,hht=True):
+        outfile=None,sratio=0.25,max_modes=20,hht=True,ensemble=False,
+        num_ensembles=100,processes=None,seed=None):
     '''
     DEFINITION:
         NOTE: EXPERIMENTAL FUNCTION ONLY.
@@ -1040,12 +1041,18 @@ def plotEMD(stream,key,verbose=False,plottitle=None,
         - sratio:       (float) Decomposition percentage. Determines how curve
                         is split. Default = 0.25.
         - verbose:      (bool) Print results. Default False.
+        - ensemble:     (bool) Use ensemble EMD (emd.eemd) with adaptive sifting.
+                        Default False.
+        - num_ensembles:(int) Number of noise realizations for EEMD. Default 100.
+        - processes:    (int) Number of worker processes for EEMD. Default None.
+        - seed:         (int) Random seed for reproducible EEMD results.
 
     RETURNS:
         - plot:         (matplotlib plot) Plot depicting the modes.
 
     EXAMPLE:
         >>> plotEMDAnalysis(stream,'x')
+        >>> plotEMD(stream,'x',ensemble=True,processes=4,seed=1)
 
     APPLICATION:
     '''
@@ -1063,7 +1070,16 @@ def plotEMD(stream,key,verbose=False,plottitle=None,
     if verbose:
         print("Amount of values and standard deviation:", len(col), np.std(col))
 
-    res = emd.emd(col,max_modes=max_modes)
+    if ensemble:
+        res = emd.eemd(np.asarray(col).astype(float),num_ensembles=num_ensembles,
+                        processes=processes,seed=seed,adaptive=True)
+        # drop the (noisy) starting value, keep imfs and residual
+        res = res[1:]
+        # adaptive sifting: modes not extracted by any member remain zero
+        used = np.any(res[:-1] != 0, axis=1)
+        res = np.vstack([res[:-1][used], res[-1:]])
+    else:
+        res = emd.emd(col,max_modes=max_modes)
     if verbose:
         print("Found the following amount of decomposed modes:", len(res))
     separate = int(np.round(len(res)*sratio,0))
@@ -1075,6 +1091,7 @@ def plotEMD(stream,key,verbose=False,plottitle=None,
     midcurve = [0]*len(res[0])
     smoothcurve = [0]*len(res[0])
     f, axarr = plt.subplots(len(res), sharex=True)
+    axarr = np.atleast_1d(axarr)
 
     for i, elem in enumerate(res):
         axarr[i].plot(elem)
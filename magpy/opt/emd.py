@@ -45,11 +45,19 @@ def emd(data,max_modes=10):
     # return an array of modes
     return np.asarray(modes)
 
-def eemd(data, noise_std=0.2, num_ensembles=100, num_sifts=10):
+def eemd(data, noise_std=0.2, num_ensembles=100, num_sifts=10,
+         processes=None, seed=None, adaptive=False):
     """
 Ensemble Empirical Mode Decomposition (EEMD)
 
 *** Must still add in post-processing with EMD ***
+
+Each ensemble member uses its own random generator seeded with
+seed+member, so the result is identical for sequential (processes=None)
+and parallel runs (processes=N uses a multiprocessing pool of N workers).
+If adaptive is True, sifting of a mode stops following the criterion of
+_do_sift (at most num_sifts sifts) and no further modes are extracted
+once _done_sifting indicates a monotonic residual.
 """
     # get modes to generate
     num_samples = len(data)
@@ -59,59 +67,97 @@ Ensemble Empirical Mode Decomposition (EEMD)
     dstd = data.std()
     y = data/dstd
 
+    if seed is None:
+        seed = np.random.randint(0, 2**31-1)
+
+    args = [(y, noise_std, num_modes, num_sifts, adaptive, (seed+e) % (2**32))
+            for e in range(num_ensembles)]
+
+    if processes and processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            # map keeps the order -> reproducible summation
+            results = pool.map(_eemd_member, args, chunksize=max(1, num_ensembles//(4*processes)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = (_eemd_member(arg) for arg in args)
+
     # allocate for starting value
     all_modes = np.zeros((num_modes+2,num_samples))
+    for modes in results:
+        all_modes += modes
+
+    # average everything out and renormalize
+    return all_modes*dstd/np.float64(num_ensembles)
+
+def _eemd_member(args):
+    """Decompose one noise realization of the EEMD ensemble."""
+    y, noise_std, num_modes, num_sifts, adaptive, seed = args
+    num_samples = len(y)
+    modes = np.zeros((num_modes+2,num_samples))
 
-    # loop over num_ensembles
-    for e in range(num_ensembles):
-        # perturb starting data
-        x0 = y + np.random.randn(num_samples)*noise_std
+    # perturb starting data
+    rng = np.random.RandomState(seed)
+    x0 = y + rng.randn(num_samples)*noise_std
 
-        # save the starting value
-        all_modes[0] += x0
+    # save the starting value
+    modes[0] = x0
 
-        # loop over modes
-        for m in range(num_modes):
-            # do the sifts
+    # loop over modes
+    for m in range(num_modes):
+        if adaptive and _done_sifting(x0):
+            break
+        # do the sifts
+        if adaptive:
+            imf = _do_sift(x0, max_sifts=num_sifts)[0]
+        else:
             imf = x0
             for s in range(num_sifts):
                 imf = _do_one_sift(imf)
 
-            # save the imf
-            all_modes[m+1] += imf
+        # save the imf
+        modes[m+1] = imf
 
-            # set the residual
-            x0 = x0 - imf
+        # set the residual
+        x0 = x0 - imf
 
-        # save the final residual
-        all_modes[-1] += x0
+    # save the final residual
+    modes[-1] = x0
 
-    # average everything out and renormalize
-    return all_modes*dstd/np.float64(num_ensembles)
+    return modes
 
 def _done_sifting(d):
     """We are done sifting is there a monotonic function."""
-    return np.sum(_localmax(d))+np.sum(_localmax(-d))<=2
+    maxima, minima = _extrema(d)
+    return np.sum(maxima)+np.sum(minima)<=2
 
-def _do_sift(data):
+def _do_sift(data, max_sifts=None):
     """
 This function is modified to use the sifting-stopping criteria
 from Huang et al (2003) (this is the suggestion of Peel et al.,
 2005). Briefly, we sift until the number of extrema and
 zerocrossings differ by at most one, then we continue sifting
 until the number of extrema and ZCs both remain constant for at
-least five sifts."""
+least five sifts. If max_sifts is given, sifting stops after at
+most max_sifts sifts."""
 
     # save the data (may have to copy)
     imf=data
+    count = 0
 
     # sift until num extrema and ZC differ by at most 1
     while True:
         imf=_do_one_sift(imf)
+        count += 1
         numExtrema,numZC = _analyze_imf(imf)
         #print 'numextrema=%d, numZC=%d' % (numExtrema, numZC)
         if abs(numExtrema-numZC)<=1:
             break
+        if max_sifts and count >= max_sifts:
+            return imf, data-imf
 
     # then continue until numExtrema and ZCs are constant for at least
     # 5 sifts (Huang et al., 2003)
@@ -120,7 +166,10 @@ least five sifts."""
     lastNumExtrema = numExtrema
     lastNumZC = numZC
     while numConstant < desiredNumConstant:
+        if max_sifts and count >= max_sifts:
+            break
         imf=_do_one_sift(imf)
+        count += 1
         numExtrema,numZC = _analyze_imf(imf)
         if numExtrema == lastNumExtrema and \
                 numZC == lastNumZC:
@@ -152,8 +201,9 @@ least five sifts."""
 
 def _do_one_sift(data):
 
-    upper=_get_upper_spline(data)
-    lower=-_get_upper_spline(-data)
+    maxima, minima = _extrema(data)
+    upper=_get_upper_spline(data, np.nonzero(maxima)[0])
+    lower=-_get_upper_spline(-data, np.nonzero(minima)[0])
     #upper=jinterp(find(maxes),data(maxes),xs);
     #lower=jinterp(find(mins),data(mins),xs);
 
@@ -167,11 +217,12 @@ def _do_one_sift(data):
     return detail # imf
 
 
-def _get_upper_spline(data):
+def _get_upper_spline(data, maxInds=None):
     """Get the upper spline using the Mirroring algoirthm from Rilling et
-al. (2003)."""
+al. (2003). Indices of the maxima can be passed if already known."""
 
-    maxInds = np.nonzero(_localmax(data))[0]
+    if maxInds is None:
+        maxInds = np.nonzero(_localmax(data))[0]
 
     if len(maxInds) == 1:
         # Special case: if there is just one max, then entire spline
@@ -214,7 +265,8 @@ al. (2003)."""
 
 
 def _analyze_imf(d):
-    numExtrema = np.sum(_localmax(d))+np.sum(_localmax(-d))
+    maxima, minima = _extrema(d)
+    numExtrema = np.sum(maxima)+np.sum(minima)
     numZC = np.sum(np.diff(np.sign(d))!=0)
     return numExtrema,numZC
 
@@ -245,6 +297,30 @@ def _analyze_imf(d):
 
 
 
+def _extrema(d):
+    """Calculate local maxima and minima of a vector in one pass.
+
+    Uses a single sign-of-difference vector for both extrema types. Runs of
+    equal values (plateaus) require the run length coding of _localmax, which
+    is then used as fallback."""
+
+    d = np.asarray(d)
+    diffs = np.diff(d)
+    if len(d) < 2 or not np.all(diffs):
+        return _localmax(d), _localmax(-d)
+
+    # pad like _localmax: first and last point compare against -inf
+    signs = np.sign(diffs)
+    up = np.r_[True, signs > 0]
+    down = np.r_[signs < 0, True]
+    maxima = up & down
+    # for minima the padding is +inf
+    upmin = np.r_[True, signs < 0]
+    downmin = np.r_[signs > 0, True]
+    minima = upmin & downmin
+
+    return maxima, minima
+
 def _localmax(d):
     """Calculate the local maxima of a vector."""
 
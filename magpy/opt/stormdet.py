@@ -21,10 +21,17 @@ CONTAINS:
                         the DWT or FDM method.
         findSSC_AIC:    (Func) Uses data of the geomagnetic field to detect SSCs using
                         the AIC method.
+        scanArchive:    (Func) Scans an archive day by day (optionally in parallel)
+                        and creates a SSC catalogue.
+        writeSSCCatalogue:(Func) Writes detections to a csv catalogue.
     (OPTIONAL/INTERNAL FUNCTIONS...)
         _calcDVals:     (Func) ... internal function used by checkACE.
         _calcProbWithSat:(Func) ... internal function for probability calculations
                         used by findSSC and findSSC_AIC.
+        _detectionFunction:(Func) ... computes the detection function of a method.
+        _evaluateDetection:(Func) ... applies findSSC/findSSC_AIC for a method.
+        _exceedRuns:    (Func) ... periods exceeding a threshold, used by findSSC.
+        _scanDay:       (Func) ... worker of scanArchive.
 
 DEPENDENCIES:
         magpy.stream
@@ -177,63 +184,173 @@ def seekStorm(magdata, satdata_1m=None, satdata_5m=None, method='AIC', variables
     t_ind = KEYLIST.index('time')
     day = datetime.strftime(num2date(magdata.ndarray[t_ind][10]),'%Y-%m-%d')
 
-    a, p = variables[0], variables[1]
+    if not method in ['AIC','DWT2','DWT1','MODWT','FDM']:
+        print("%s is an invalid evaluation function!" % method)
+        detection, ssc_list = False, []
+    else:
+        # compute the detection function once and evaluate it
+        var_stream, var_key = _detectionFunction(magdata, method, dwt_level=dwt_level)
+        detection, ssc_list = _evaluateDetection(var_stream, var_key, method, variables,
+                useACE=useACE, ACE_results=ACE_results, verbose=verbose)
+        if plot_vars == True:
+            if method == 'AIC':
+                plot_new(var_stream,['x','var2','var3'])
+            elif method == 'FDM':
+                plot_new(var_stream,['x','dx'])
+            elif method == 'MODWT':
+                plotStreams([magdata, var_stream],[['x'],['dx','var1']],plottitle=day)
+            else:
+                plotStreams([magdata, var_stream],[['x'],['dx','var1','var2','var3']],plottitle=day)
 
-    # AIC - AKAIKE INFORMATION CRITERION
-    # ----------------------------------
-    if method == 'AIC':
-        AIC_key = 'var2'
-        #AIC_newkey = 'var4'
-        AIC_dkey = 'var3'
-        trange = 30
+    if not returnsat:
+        return detection, ssc_list
+    else:
+        return detection, ssc_list, ACE_results
 
-        magdata = magdata.aic_calc('x',timerange=timedelta(minutes=trange),aic2key=AIC_key)
-        magdata = magdata.differentiate(keys=[AIC_key],put2keys=[AIC_dkey])
 
-        minlen = variables[2]
-        detection, ssc_list = findSSC_AIC(magdata, AIC_key, AIC_dkey, a, p, minlen,
-                useACE=useACE, ACE_results=ACE_results, verbose=verbose)
-        if plot_vars == True:
-            plot_new(magdata,['x',AIC_key,AIC_dkey])
+#####################################################################
+#    ARCHIVE SCANNER:   scanArchive()                               #
+#####################################################################
 
-    # DWT - DISCRETE WAVELET TRANSFORM
-    # --------------------------------
-    elif method == 'DWT2' or method == 'DWT1': # using D2 or D3 detail
-        DWT = magdata.DWT_calc()
-        if method == 'DWT2':
-            var_key = 'var2'
-        elif method == 'DWT1':
-            var_key = 'var1'
-        detection, ssc_list = findSSC(DWT, var_key, a, p, useACE=useACE, ACE_results=ACE_results, verbose=verbose)
-        if plot_vars == True:
-            plotStreams([magdata, DWT],[['x'],['dx','var1','var2','var3']],plottitle=day)
+def scanArchive(path, starttime, endtime, methods=['AIC'], variables=None, satpath_1m=None,
+        satpath_5m=None, overlap=timedelta(hours=2), dwt_level='db4', processes=None,
+        catalogue=None, verbose=False):
+    '''
+    DEFINITION:
+        Scans an archive of magnetic data for storm onsets (SSCs) day by day.
+        Each day is read with an overlap on both sides, the detection function
+        of every requested method is computed once per day and detections are
+        kept if their onset lies within the day itself. Days can be analysed
+        in parallel by a pool of worker processes. The consolidated list of
+        detections is optionally written to a catalogue file (csv).
 
-    # MODWT - MAXIMAL OVERLAP DISCRETE WAVELET TRANSFORM
-    # --------------------------------------------------
-    elif method == 'MODWT': # using D2 or D3 detail
-        MODWT = magdata.MODWT_calc(level=1, wavelet='haar')
-        var_key = 'var1'
-        detection, ssc_list = findSSC(MODWT, var_key, a, p, useACE=useACE, ACE_results=ACE_results, verbose=verbose)
-        if plot_vars == True:
-            plotStreams([magdata, DWT],[['x'],['dx','var1']],plottitle=day)
+    PARAMETERS:
+    Variables:
+        - path:         (str) Path of magnetic data (1s), wildcards allowed,
+                        e.g. '/srv/archive/WIC/LEMI025/LEMI025_*.bin'
+        - starttime:    (datetime/str) Begin of scan (first day)
+        - endtime:      (datetime/str) End of scan (exclusive)
+    Kwargs:
+        - methods:      (list) Evaluation functions, see seekStorm. Default ['AIC']
+        - variables:    (dict) Variables per method. Default funcvars.
+        - satpath_1m:   (str) Path of 1m ACE swepam data (optional)
+        - satpath_5m:   (str) Path of 5m ACE epam data (optional)
+        - overlap:      (timedelta) Data read before and after each day. Default 2 hours.
+        - dwt_level:    (str) Wavelet filter, see seekStorm.
+        - processes:    (int) Number of worker processes. Default None (sequential).
+        - catalogue:    (str) Write the SSC catalogue to this csv file.
+        - verbose:      (bool) If True, progress will be printed.
 
-    # FDM - FIRST DERIVATION METHOD
-    # -----------------------------
-    elif method == 'FDM':
-        FDM_key = 'dx'
-        magdata = magdata.differentiate(keys=['x'],put2keys=[FDM_key])
-        magdata.multiply({FDM_key: 2}, square=True)
-        detection, ssc_list = findSSC(magdata, FDM_key, a, p, useACE=useACE, ACE_results=ACE_results, verbose=verbose)
-        if plot_vars == True:
-            plot_new(magdata,['x','dx'])
+    RETURNS:
+        - ssc_list:     (list[dict]) All detections sorted by time. Dictionaries
+                        as returned by seekStorm with additional 'method' key.
 
-    else:
-        print("%s is an invalid evaluation function!" % method)
+    EXAMPLE:
+        >>> ssc_list = scanArchive('/srv/archive/WIC/LEMI025/*.bin', '2014-01-01',
+                '2015-01-01', methods=['AIC','DWT2'], processes=4,
+                catalogue='/tmp/ssc_2014.csv')
+    '''
 
-    if not returnsat:
-        return detection, ssc_list
+    if not variables:
+        variables = funcvars
+    starttime = test_time(starttime)
+    endtime = test_time(endtime)
+    day = datetime(starttime.year, starttime.month, starttime.day)
+
+    tasks = []
+    while day < endtime:
+        tasks.append((path, day, methods, variables, satpath_1m, satpath_5m,
+                        overlap, dwt_level, verbose))
+        day += timedelta(days=1)
+
+    if processes and processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_scanDay, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        return detection, ssc_list, ACE_results
+        results = [_scanDay(task) for task in tasks]
+
+    ssc_list = [ssc for dayresult in results for ssc in dayresult]
+    ssc_list.sort(key=lambda el: (el['ssctime'], el['method']))
+
+    if catalogue:
+        writeSSCCatalogue(ssc_list, catalogue)
+
+    return ssc_list
+
+
+def writeSSCCatalogue(ssc_list, filename):
+    '''
+    DEFINITION:
+        Writes a list of SSC detections (from scanArchive/seekStorm) to a csv file
+        with columns ssctime, method, amp, duration, probf.
+
+    PARAMETERS:
+    Variables:
+        - ssc_list:     (list[dict]) Detections.
+        - filename:     (str) Path of the catalogue.
+    '''
+
+    with open(filename, 'w') as out:
+        out.write("# ssctime,method,amp,duration,probf\n")
+        for ssc in ssc_list:
+            out.write("%s,%s,%.2f,%s,%.1f\n" % (datetime.strftime(ssc['ssctime'],"%Y-%m-%dT%H:%M:%S"),
+                        ssc.get('method','-'), ssc['amp'], ssc['duration'], ssc['probf']))
+
+
+def _scanDay(task):
+    '''
+    DEFINITION:
+        Worker of scanArchive: analyses one day (plus overlap) with all methods.
+    '''
+
+    path, day, methods, variables, satpath_1m, satpath_5m, overlap, dwt_level, verbose = task
+    nextday = day + timedelta(days=1)
+    results = []
+
+    try:
+        magdata = read(path_or_url=path, starttime=day-overlap, endtime=nextday+overlap)
+    except Exception as e:
+        if verbose:
+            print("scanArchive: no data for %s (%s)" % (day.date(), e))
+        return results
+    if not len(magdata.ndarray[0]) > 10:
+        return results
+
+    useACE, ACE_results = False, []
+    if satpath_1m and satpath_5m:
+        try:
+            sat_1m = read(path_or_url=satpath_1m, starttime=day-overlap, endtime=nextday+overlap)
+            sat_5m = read(path_or_url=satpath_5m, starttime=day-overlap, endtime=nextday+overlap)
+            ACE_detection, ACE_results = checkACE(sat_1m, ACE_5m=sat_5m, verbose=verbose)
+            useACE = True
+        except:
+            if verbose:
+                print("scanArchive: ACE evaluation failed for %s. Continuing without." % day.date())
+
+    for method in methods:
+        try:
+            var_stream, var_key = _detectionFunction(magdata.copy(), method, dwt_level=dwt_level)
+            detection, ssc_list = _evaluateDetection(var_stream, var_key, method,
+                        variables[method], useACE=useACE, ACE_results=ACE_results)
+        except Exception as e:
+            if verbose:
+                print("scanArchive: method %s failed for %s (%s)" % (method, day.date(), e))
+            continue
+        for ssc in ssc_list:
+            # detections within the overlap belong to the neighbouring days
+            if day <= ssc['ssctime'] < nextday:
+                ssc['method'] = method
+                results.append(ssc)
+
+    if verbose:
+        print("scanArchive: %s - %d detection(s)" % (day.date(), len(results)))
+
+    return results
 
 
 #********************************************************************
@@ -585,90 +702,75 @@ def findSSC(var_stream, var_key, a, p, useACE=False, ACE_results=[], dh_bracket=
     x_ind = KEYLIST.index('x')
     x_ar = var_stream.ndarray[x_ind]
 
-    i = 0
-
     # SEARCH FOR PEAK:
     # ----------------
     if verbose == True:
         print("Starting analysis with findSSC().")
-    #for row in var_stream:
-    for i in range(0,len(var_ar)):
-        #var = eval('row.'+var_key)
-        var = var_ar[i]
-
-        # CRITERION #1: Variable must exceed the threshold a
-        # **************************************************
-        if var >= a and possdet == False:
-            #timepin = row.time
-            timepin = t_ar[i]
-            #x1 = row.x
-            x1 = x_ar[i]
-            possdet = True
-        elif var < a and possdet == True:
-            #duration = (num2date(row.time) - num2date(timepin)).seconds
-            duration = (num2date(t_ar[i]) - num2date(timepin)).seconds
-
-            # CRITERION #2: Length of time that variable exceeds a must > p
-            # *************************************************************
-            if duration >= p:
-                #x2 = row.x
-                x2 = x_ar[i]
-                d_amp = x2 - x1
-                ssc_init = num2date(timepin).replace(tzinfo=None)
-                if verbose == True:
-                    print("x1:", x1, ssc_init)
-                    #print "x2:", x2, num2date(row.time)
-                    print("x2:", x2, num2date(t_ar[i]))
-                    print("Possible detection with duration %s at %s with %s nT." % (duration, ssc_init, d_amp))
 
-                # CRITERION #3: Variation in H must exceed a certain value
-                # ********************************************************
-                if d_amp > d_amp_min:
-
-                    if d_amp >= dh_bracket[0] and d_amp < dh_bracket[1]:
-                        dh_prob = 50.
-                    if d_amp >= dh_bracket[1]:
-                        dh_prob = 100.
+    # CRITERION #1: Variable must exceed the threshold a
+    # **************************************************
+    # All periods exceeding a are determined at once, the remaining
+    # criteria are only evaluated for these candidates.
+    for istart, iend in _exceedRuns(var_ar, a):
+        timepin = t_ar[istart]
+        x1 = x_ar[istart]
+        duration = (num2date(t_ar[iend]) - num2date(timepin)).seconds
+
+        # CRITERION #2: Length of time that variable exceeds a must > p
+        # *************************************************************
+        if duration >= p:
+            x2 = x_ar[iend]
+            d_amp = x2 - x1
+            ssc_init = num2date(timepin).replace(tzinfo=None)
+            if verbose == True:
+                print("x1:", x1, ssc_init)
+                print("x2:", x2, num2date(t_ar[iend]))
+                print("Possible detection with duration %s at %s with %s nT." % (duration, ssc_init, d_amp))
 
-                    if verbose == True:
-                        print("Detection at %s with %s nT!" % (ssc_init,str(d_amp)))
+            # CRITERION #3: Variation in H must exceed a certain value
+            # ********************************************************
+            if d_amp > d_amp_min:
 
-                    # CRITERION #4: Storm must have been detected in ACE data
-                    # *******************************************************
-                    if useACE == True and ACE_results != []:
+                if d_amp >= dh_bracket[0] and d_amp < dh_bracket[1]:
+                    dh_prob = 50.
+                if d_amp >= dh_bracket[1]:
+                    dh_prob = 100.
 
-                        # CRITERION #5: ACE storm must have occured 45 (+-20) min before detection
-                        # ************************************************************************
-                        for sat_ssc in ACE_results:
-                            det, final_probf = _calcProbWithSat(ssc_init, sat_ssc,
-                                dh_prob, dh_weight, satprob_weight, estt_weight, verbose=verbose)
-                            if det == True:
-                                break
-
-                    elif useACE == True and ACE_results == []:
-                        detection, det = False, False
-                        if verbose == True:
-                            print("No ACE storm. False detection!")
-                            print(ssc_init, d_amp)
+                if verbose == True:
+                    print("Detection at %s with %s nT!" % (ssc_init,str(d_amp)))
 
-                    elif useACE == False:
-                        detection, det = True, True
-                        final_probf = dh_prob
-                        if verbose == True:
-                            print("No ACE data. Not sure!")
+                # CRITERION #4: Storm must have been detected in ACE data
+                # *******************************************************
+                if useACE == True and ACE_results != []:
 
-                    if det == True:
-                        SSC_dict = {}
-                        SSC_dict['ssctime'] = ssc_init
-                        SSC_dict['amp'] = d_amp
-                        SSC_dict['duration'] = duration
-                        SSC_dict['probf'] = final_probf
-                        SSC_list.append(SSC_dict)
-                        detection = True
+                    # CRITERION #5: ACE storm must have occured 45 (+-20) min before detection
+                    # ************************************************************************
+                    for sat_ssc in ACE_results:
+                        det, final_probf = _calcProbWithSat(ssc_init, sat_ssc,
+                            dh_prob, dh_weight, satprob_weight, estt_weight, verbose=verbose)
+                        if det == True:
+                            break
+
+                elif useACE == True and ACE_results == []:
+                    detection, det = False, False
+                    if verbose == True:
+                        print("No ACE storm. False detection!")
+                        print(ssc_init, d_amp)
 
-            possdet = False
+                elif useACE == False:
+                    detection, det = True, True
+                    final_probf = dh_prob
+                    if verbose == True:
+                        print("No ACE data. Not sure!")
 
-        i += 1
+                if det == True:
+                    SSC_dict = {}
+                    SSC_dict['ssctime'] = ssc_init
+                    SSC_dict['amp'] = d_amp
+                    SSC_dict['duration'] = duration
+                    SSC_dict['probf'] = final_probf
+                    SSC_list.append(SSC_dict)
+                    detection = True
 
     return detection, SSC_list
 
@@ -909,8 +1011,88 @@ def findSSC_AIC(stream, aic_key, aic_dkey, mlowval, monsetval, minlen, useACE=Fa
 #       OPTIONAL FUNCTIONS:                                         #
 #               _calcDVals()                                        #
 #               _calcProbWithSat()                                  #
+#               _detectionFunction()                                #
+#               _evaluateDetection()                                #
+#               _exceedRuns()                                       #
 #--------------------------------------------------------------------
 
+def _detectionFunction(magdata, method, dwt_level='db4'):
+    '''
+    DEFINITION:
+        Computes the detection function of an evaluation method for a
+        magnetic stream.
+
+    RETURNS:
+        - var_stream:   (DataStream) Stream containing the detection function
+        - var_key:      (str) Key of the detection function in var_stream
+                        (for AIC the key of the AIC values, its derivative is in var3)
+    '''
+
+    if method == 'AIC':
+        AIC_key = 'var2'
+        AIC_dkey = 'var3'
+        trange = 30
+        magdata = magdata.aic_calc('x',timerange=timedelta(minutes=trange),aic2key=AIC_key)
+        magdata = magdata.differentiate(keys=[AIC_key],put2keys=[AIC_dkey])
+        return magdata, AIC_key
+    elif method == 'DWT2' or method == 'DWT1': # using D2 or D3 detail
+        DWT = magdata.DWT_calc(wavelet=dwt_level)
+        if method == 'DWT2':
+            return DWT, 'var2'
+        return DWT, 'var1'
+    elif method == 'MODWT':
+        MODWT = magdata.MODWT_calc(level=1, wavelet='haar')
+        return MODWT, 'var1'
+    elif method == 'FDM':
+        FDM_key = 'dx'
+        magdata = magdata.differentiate(keys=['x'],put2keys=[FDM_key])
+        magdata.multiply({FDM_key: 2}, square=True)
+        return magdata, FDM_key
+    raise ValueError("%s is an invalid evaluation function!" % method)
+
+
+def _evaluateDetection(var_stream, var_key, method, variables, useACE=False, ACE_results=[],
+        verbose=False):
+    '''
+    DEFINITION:
+        Applies findSSC (or findSSC_AIC) to a detection function obtained
+        from _detectionFunction.
+    '''
+
+    a, p = variables[0], variables[1]
+    if method == 'AIC':
+        return findSSC_AIC(var_stream, var_key, 'var3', a, p, variables[2],
+                useACE=useACE, ACE_results=ACE_results, verbose=verbose)
+    return findSSC(var_stream, var_key, a, p, useACE=useACE, ACE_results=ACE_results,
+                verbose=verbose)
+
+
+def _exceedRuns(var_ar, a):
+    '''
+    DEFINITION:
+        Finds all periods in which var_ar is >= a. NaN values neither start nor
+        end a period. Periods which do not end within the array are ignored.
+
+    RETURNS:
+        - runs:         (list) of (start index, index of first value < a) tuples
+    '''
+
+    var_ar = np.asarray(var_ar, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        state = np.where(var_ar >= a, 1., np.where(var_ar < a, 0., np.nan))
+    # NaNs keep the previous state
+    valid = ~np.isnan(state)
+    fillidx = np.where(valid, np.arange(len(state)), 0)
+    if len(fillidx) > 0:
+        fillidx = np.maximum.accumulate(fillidx)
+    state = np.where(valid[fillidx], state[fillidx], 0.)
+    change = np.diff(np.r_[0., state])
+    starts = np.nonzero(change > 0)[0]
+    ends = np.nonzero(change < 0)[0]
+
+    return list(zip(starts[:len(ends)], ends))
+
+
 def _calcDVals(stream, key, m, n):
     '''
     DEFINITION:
@@ -952,46 +1134,48 @@ def _calcDVals(stream, key, m, n):
     y = stream._get_column(key)
     t = stream._get_column('time')
 
-    dm = np.zeros(len(y))
-    mean_lo, mean_hi = np.zeros(len(y)), np.zeros(len(y))
-    std_lo, std_hi = np.zeros(len(y)), np.zeros(len(y))
-
+    y = np.asarray(y, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
     array = [[] for key in KEYLIST]
     headers = {}
 
-    for i in range(1,len(y)-1):
-        # DEFINE ARRAYS ABOVE AND BELOW POINT:
-        # ------------------------------------
-        if i < m:
-            s_up = n
-            s_down = i
-        elif i > (len(y)-n):
-            s_up = len(y) - i
-            s_down = m
-        else:
-            s_up = n
-            s_down = m
-        # Note: would be good to build in boundary behaviour here: mirrored, linear?
-
-        y_lo = np.array(y[i-s_down:i], dtype=float64)
-        y_lo = np.ma.masked_array(y_lo,np.isnan(y_lo))
-        y_hi = np.array(y[i:i+s_up], dtype=float64)
-        y_hi = np.ma.masked_array(y_hi,np.isnan(y_hi))
-
-        # CALCULATE MEANS:
-        # ----------------
-        lo_mean, lo_std = np.mean(y_lo), np.std(y_lo)
-        hi_mean, hi_std = np.mean(y_hi), np.std(y_hi)
-
-        # ASSIGN VALUES WITH DIFFERENCES:
-        # -------------------------------
-        array[KEYLIST.index('time')].append(float(t[i]))
-        array[KEYLIST.index('x')].append(float(y[i]))
-        array[KEYLIST.index('dx')].append(float(hi_mean - lo_mean))
-        array[KEYLIST.index('var1')].append(float(lo_mean))
-        array[KEYLIST.index('var2')].append(float(hi_mean))
-        array[KEYLIST.index('var3')].append(float(lo_std))
-        array[KEYLIST.index('var4')].append(float(hi_std))
+    # DEFINE ARRAYS ABOVE AND BELOW POINT:
+    # ------------------------------------
+    # Below: y[max(i-m,0):i], above: y[i:min(i+n,len(y))] for each point i.
+    # Note: would be good to build in boundary behaviour here: mirrored, linear?
+    idx = np.arange(1,len(y)-1)
+    lo_start = np.maximum(idx-m, 0)
+    hi_end = np.minimum(idx+n, len(y))
+
+    # CALCULATE MEANS:
+    # ----------------
+    # NaN aware running sums, data is centered to keep the sums well conditioned
+    valid = ~np.isnan(y)
+    yc = np.where(valid, y - (np.mean(y[valid]) if valid.any() else 0.), 0.)
+    cs = np.r_[0., np.cumsum(yc)]
+    cs2 = np.r_[0., np.cumsum(yc**2)]
+    cn = np.r_[0, np.cumsum(valid)]
+
+    def _window_stats(start, end):
+        num = (cn[end]-cn[start]).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (cs[end]-cs[start])/num
+            var = (cs2[end]-cs2[start])/num - mean**2
+        return mean, np.sqrt(np.maximum(var, 0.))
+
+    lo_mean, lo_std = _window_stats(lo_start, idx)
+    hi_mean, hi_std = _window_stats(idx, hi_end)
+    offset = y[valid].mean() if valid.any() else 0.
+
+    # ASSIGN VALUES WITH DIFFERENCES:
+    # -------------------------------
+    array[KEYLIST.index('time')] = t[idx]
+    array[KEYLIST.index('x')] = y[idx]
+    array[KEYLIST.index('dx')] = hi_mean - lo_mean
+    array[KEYLIST.index('var1')] = lo_mean + offset
+    array[KEYLIST.index('var2')] = hi_mean + offset
+    array[KEYLIST.index('var3')] = lo_std
+    array[KEYLIST.index('var4')] = hi_std
 
     headers['col-x'] = 'X'
     headers['col-dx'] = 'dX'
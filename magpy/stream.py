@@ -37,6 +37,7 @@ try:
     import warnings
     from glob import glob, iglob, has_magic
     from itertools import groupby
+    from collections import deque
     import operator # used for stereoplot legend
     from operator import itemgetter
     # The following packages are not identically available for python3
@@ -356,6 +357,16 @@ PYMAG_SUPPORTED_FORMATS = [
                 'UNKOWN'        # 'Unknown'?
                         ]
 
+# Cache of one-sided segment periodograms used by the spectral engine
+# (DataStream.welch and DataStream.welchgram). Entries are keyed by
+# (sensorid, key, segmentstart, nfft, samplingperiod, window, ntapers,
+# maxgap, missing samples, SPECTRALPROBES samples of the segment) so that
+# rolling analyses only need to transform newly added segments.
+SPECTRALCACHE = {}
+SPECTRALCACHEORDER = deque()
+SPECTRALCACHESIZE = 50000
+SPECTRALPROBES = 16
+
 # ----------------------------------------------------------------------------
 #  Part 3: Main classes -- DataStream, LineStruct and
 #      PyMagLog (To be removed)
@@ -417,7 +428,7 @@ class DataStream(object):
     - stream.delta_f(self, **kwargs):
     - stream.dict2stream(self,dictkey='DataBaseValues')
     - stream.differentiate(self, **kwargs):
-    - stream.eventlogger(self, key, values, compare=None, stringvalues=None, addcomment=None, debugmode=None):
+    - stream.eventlogger(self, key, values, compare=None, stringvalues=None, addcomment=None, debugmode=None, returnevents=False):
     - stream.extract(self, key, value, compare=None, debugmode=None):
     - stream.extrapolate(self, start, end):
     - stream.filter(self, **kwargs):
@@ -447,6 +458,8 @@ class DataStream(object):
     - stream.stream2flaglist(self, userange=True, flagnumber=None, keystoflag=None, sensorid=None, comment=None)
     - stream.trim(self, starttime=None, endtime=None, newway=False):
     - stream.variometercorrection(self, variopath, thedate, **kwargs):
+    - stream.welch(self, key, **kwargs):
+    - stream.welchgram(self, key, **kwargs):
     - stream.write(self, filepath, **kwargs):
 
 
@@ -486,6 +499,8 @@ class DataStream(object):
     - stream.stream2flaglist() -- make flaglist out of stream
     - stream.trim() -- returns stream within new time frame
     - stream.variometercorrection() -- Obtain average DI values at certain timestep(s)
+    - stream.welch() -- Welch/multitaper power spectral density using cached segment spectra
+    - stream.welchgram() -- Gap aware segment spectra (spectrogram) from the spectral engine
     - stream.write() -- Writing Stream to a file
 
     Supporting INTERNAL methods:
@@ -539,6 +554,7 @@ class DataStream(object):
     - find_nearest(array, value) -- find point in array closest to value
     - maskNAN(column) -- Tests for NAN values in array and usually masks them
     - nearestPow2(x) -- Find power of two nearest to x
+    - runlength_encode(array) -- Start, length and value of runs of equal values
 
 *********************************************************************
     Standard function description format:
@@ -1323,6 +1339,32 @@ CALLED BY:
         return aicval
 
 
+    def _aic_all(self, signal):
+        """
+        Vectorized version of _aic: returns the AIC for every split index k of
+        signal (values for k < 2 and k = len(signal) are NaN). Variances of
+        leading and trailing parts are obtained from cumulative sums.
+        """
+        signal = np.asarray(signal, dtype=float)
+        n = len(signal)
+        aicvals = np.empty(n)
+        aicvals.fill(np.nan)
+        if n < 3:
+            return aicvals
+        # remove mean to keep cumulative sums well conditioned
+        x = signal - np.nanmean(signal) if not np.all(np.isnan(signal)) else signal
+        cs = np.r_[0., np.cumsum(x)]
+        cs2 = np.r_[0., np.cumsum(x**2)]
+        k = np.arange(2, n).astype(float)
+        ki = k.astype(int)
+        varlo = cs2[ki]/k - (cs[ki]/k)**2
+        nhi = n - k
+        varhi = (cs2[-1]-cs2[ki])/nhi - ((cs[-1]-cs[ki])/nhi)**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aicvals[2:] = (k-1)*np.log(np.maximum(varlo,0.)) + (nhi-1)*np.log(np.maximum(varhi,0.))
+        return aicvals
+
+
     def harmfit(self,nt, val, fitdegree):
         # method for harminic fit according to Phil McFadden's fortran program
         """
@@ -1333,7 +1375,8 @@ CALLED BY:
     PARAMETERS:
     Kwargs:
         - nt:           (list) Normalized time array.
-        - val:          (list) Value list.
+        - val:          (list) Value list. A 2D array of shape (len(nt), number of
+                               columns) fits all columns at once.
         - fitdegree:    (int) hramonic degree default is 5.
 
     RETURNS:
@@ -1343,34 +1386,25 @@ CALLED BY:
         >>> f_fit = self.harmfit(nt,val, 5)
 
         """
+        nt = np.asarray(nt).astype(float)
+        val = np.asarray(val).astype(float)
         N = len(nt)
+        trend = (nt-nt[0])
+        if val.ndim > 1:
+            trend = trend[:,None]
         coeff = (val[-1]-val[0]) /(nt[-1]-nt[0])
-        newval = [elem-coeff*(nt[i]-nt[0]) for i, elem in enumerate(val)]
-        ReVal = []
-        ImVal = []
-
-        for h in range(0,fitdegree):
-            ReVal.append(newval[0])
-            ImVal.append(0.0)
-            angle = -h*(2.0*np.pi/N)
-            for i in range(1,len(newval)):
-                si = np.sin(i*angle)
-                co = np.cos(i*angle)
-                ReVal[h] = ReVal[h] + newval[i]*co
-                ImVal[h] = ImVal[h] + newval[i]*si
-
-        #print "Parameter:", len(newval)
-        #print len(ReVal), ReVal
+        newval = val - coeff*trend
+
+        # discrete fourier coefficients of the detrended values for h < fitdegree
+        harm = np.arange(0,fitdegree)
+        angle = -np.outer(harm, np.arange(N))*(2.0*np.pi/N)
+        ReVal = np.dot(np.cos(angle), newval)
+        ImVal = np.dot(np.sin(angle), newval)
+
         angle = 2.0*np.pi*(float(N-1)/float(N))/(nt[-1]-nt[0])
-        harmval = []
-        for i,elem in enumerate(newval):
-            harmval.append(ReVal[0])
-            angle2 = (nt[i]-nt[0])*angle
-            for h in range(1,fitdegree):
-                si = np.sin(h*angle2)
-                co = np.cos(h*angle2)
-                harmval[i] = harmval[i]+(2.0*(ReVal[h]*co-ImVal[h]*si))
-            harmval[i] = harmval[i]/float(N)+coeff*(nt[i]-nt[0])
+        angle2 = np.outer((nt-nt[0])*angle, harm[1:])
+        harmval = ReVal[0] + 2.0*(np.dot(np.cos(angle2), ReVal[1:]) - np.dot(np.sin(angle2), ImVal[1:]))
+        harmval = harmval/float(N)+coeff*trend
 
         return np.asarray(harmval)
 
@@ -1822,20 +1856,20 @@ CALLED BY:
             else:
                 currsequence = signal[istart:iend]
                 aicarray = []
-                for idx, el in enumerate(currsequence):
-                    if idx > 1 and idx < len(currsequence):
-                        # CALCULATE AIC
-                        aicval = self._aic(currsequence, idx)/timerange.seconds*3600 # *sp Normalize to sampling rate and timerange
-                        if len(self.ndarray[0]) > 0:
-                            self.ndarray[aic2ind][idx+istart] = aicval
-                        else:
-                            exec('self[idx+istart].'+ aic2key +' = aicval')
-                        if not isnan(aicval):
-                            aicarray.append(aicval)
-                        # store start value - aic: is a measure for the significance of information change
-                        #if idx == 2:
-                        #    aicstart = aicval
-                        #self[idx+istart].var5 = aicstart-aicval
+                # CALCULATE AIC for all split positions of the window at once
+                aicvals = self._aic_all(currsequence)/timerange.seconds*3600 # *sp Normalize to sampling rate and timerange
+                for idx in range(2, len(currsequence)):
+                    aicval = aicvals[idx]
+                    if len(self.ndarray[0]) > 0:
+                        self.ndarray[aic2ind][idx+istart] = aicval
+                    else:
+                        exec('self[idx+istart].'+ aic2key +' = aicval')
+                    if not isnan(aicval):
+                        aicarray.append(aicval)
+                    # store start value - aic: is a measure for the significance of information change
+                    #if idx == 2:
+                    #    aicstart = aicval
+                    #self[idx+istart].var5 = aicstart-aicval
                 maxaic = np.max(aicarray)
                 # determine the relative amplitude as well
                 cnt = 0
@@ -2848,56 +2882,50 @@ CALLED BY:
         i = 0
         loggerstream.info("DWT_calc: Starting Discrete Wavelet Transform of key %s." % key)
 
-        # 1b. Loop for sliding window
-        while True:
-            if i >= (len(data)-window):
-                break
-
-            #row = LineStruct()
+        # 1b. Sliding, non-overlapping windows
+        # The wavelet decomposition and reconstruction of each detail is linear
+        # in the data. The reconstruction operators for a window are therefore
+        # obtained once by transforming the unit vectors and then applied to
+        # all windows in a single matrix product.
+        nwin = int(np.ceil((len(data)-window)/float(window)))
+        if nwin > 0:
+            starts = np.arange(nwin)*window
+            segments = np.asarray(data, dtype=float)[starts[:,None] + np.arange(window)[None,:]]
             # Take the values in the middle of the window (not exact but changes are
             # not extreme over standard 5s window)
-            #row.time = self[i+window/2].time
-            array[t_ind].append(self.ndarray[t_ind][i+window/2])
-            data_cut = data[i:i+window]
-            #row.x = sum(data_cut)/float(window)
-            array[x_ind].append(sum(data_cut)/float(window))
+            array[t_ind] = list(self.ndarray[t_ind][starts+window//2])
+            array[x_ind] = list(np.sum(segments,axis=1)/float(window))
 
-            # 1c. Calculate wavelet transform coefficients
+            # 1c. Calculate wavelet transform operators
             # Wavedec produces results in form: [cA_n, cD_n, cD_n-1, ..., cD2, cD1]
             # (cA_n is a list of coefficients for an approximation for the nth order.
             # All cD_n are coefficients for details n --> 1.)
-            coeffs = pywt.wavedec(data_cut, wavelet, level=level)
-
-            # 1d. Calculate approximation and detail functions from coefficients
-            take = len(data_cut)        # (Length of fn from coeffs = length of original data)
-            functions = []
-            approx = True
-            for item in coeffs:
-                if approx:
-                    part = 'a'  # Calculate approximation function
-                else:
-                    part = 'd'  # Calculate detail function
-                function = pywt.upcoef(part, item, wavelet, level=level, take=take)
-                functions.append(function)
-                approx = False
-
-            # 2. Square the results
-            fin_fns = []
-            for item in functions:
-                item_sq = [j**2 for j in item]
-                # 3. Average over the window
-                val = sum(item_sq)/window
-                fin_fns.append(val)
+            take = window        # (Length of fn from coeffs = length of original data)
+            operators = None
+            for idx, unit in enumerate(np.eye(window)):
+                coeffs = pywt.wavedec(unit, wavelet, level=level)
+                # 1d. Calculate approximation and detail functions from coefficients
+                functions = []
+                approx = True
+                for item in coeffs:
+                    if approx:
+                        part = 'a'  # Calculate approximation function
+                    else:
+                        part = 'd'  # Calculate detail function
+                    functions.append(pywt.upcoef(part, item, wavelet, level=level, take=take))
+                    approx = False
+                if operators is None:
+                    operators = np.zeros((len(functions), window, window))
+                operators[:,idx,:] = functions
 
-            # TODO: This is hard-wired for level=3.
-            #row.dx, row.var1, row.var2, row.var3 = fin_fns
-            array[dx_ind].append(fin_fns[0])
-            array[var1_ind].append(fin_fns[3])
-            array[var2_ind].append(fin_fns[2])
-            array[var3_ind].append(fin_fns[1])
+            # 2. Square the results and 3. average over the window
+            fin_fns = [np.sum(np.dot(segments, op)**2, axis=1)/window for op in operators]
 
-            #DWT_stream.add(row)
-            i += window
+            # TODO: This is hard-wired for level=3.
+            array[dx_ind] = list(fin_fns[0])
+            array[var1_ind] = list(fin_fns[3])
+            array[var2_ind] = list(fin_fns[2])
+            array[var3_ind] = list(fin_fns[1])
 
         loggerstream.info("DWT_calc: Finished DWT.")
 
@@ -2926,7 +2954,7 @@ CALLED BY:
         return DataStream([LineStruct()], headers, np.asarray(array))
 
 
-    def eventlogger(self, key, values, compare=None, stringvalues=None, addcomment=None, debugmode=None):
+    def eventlogger(self, key, values, compare=None, stringvalues=None, addcomment=None, debugmode=None, returnevents=False):
         """
         read stream and log data of which key meets the criteria
         maybe combine with extract
@@ -2948,10 +2976,20 @@ CALLED BY:
 
         :type debugmode: bool
         :param debugmode: provide more information
+        :type returnevents: bool
+        :param returnevents: if true, return (stream, events). events is a list of
+                dicts with 'starttime', 'endtime', 'peak', 'peaktime',
+                'threshold' and 'comment', one for each run of consecutive
+                samples meeting the same (highest) threshold.
+
+        All samples are compared to the thresholds at once, consecutive
+        samples of the same level are combined into one event which is
+        logged once.
 
         example:
         compare is string like ">, <, ==, !="
         st.eventlogger(['var3'],[15,20,30],'>')
+        stream, events = st.eventlogger('var3',[15,20,30],'>',returnevents=True)
         """
         assert type(values) == list
 
@@ -2959,6 +2997,8 @@ CALLED BY:
             compare = '=='
         if not compare in ['<','>','<=','>=','==','!=']:
             loggerstream.warning('Eventlogger: wrong value for compare: needs to be among <,>,<=,>=,==,!=')
+            if returnevents:
+                return self, []
             return self
         if not stringvalues:
             stringvalues = ['Minor storm onset','Moderate storm onset','Major storm onset']
@@ -2966,32 +3006,79 @@ CALLED BY:
             assert type(stringvalues) == list
         if not len(stringvalues) == len(values):
             loggerstream.warning('Eventlogger: Provided comments do not match amount of values')
+            if returnevents:
+                return self, []
             return self
 
-        for elem in self:
-            #evaluationstring = 'elem.' + key + ' ' + compare + ' ' + str(values[0])
-            if eval('elem.'+key+' '+compare+' '+str(values[2])):
-                stormlogger.warning('%s at %s' % (stringvalues[2],num2date(elem.time).replace(tzinfo=None)))
-                if addcomment:
-                    if elem.comment == '-':
-                        elem.comment = stringvalues[2]
-                    else:
-                        elem.comment += ', ' + stringvalues[2]
-            elif eval('elem.'+key+' '+compare+' '+str(values[1])):
-                stormlogger.warning('%s at %s' % (stringvalues[1],num2date(elem.time).replace(tzinfo=None)))
-                if addcomment:
-                    if elem.comment == '-':
-                        elem.comment = stringvalues[1]
-                    else:
-                        elem.comment += ', ' + stringvalues[1]
-            elif eval('elem.'+key+' '+compare+' '+str(values[0])):
-                stormlogger.warning('%s at %s' % (stringvalues[0],num2date(elem.time).replace(tzinfo=None)))
-                if addcomment:
-                    if elem.comment == '-':
-                        elem.comment = stringvalues[0]
-                    else:
-                        elem.comment += ', ' + stringvalues[0]
+        if isinstance(key, list):
+            key = key[0]
+        compfunc = {'<':np.less,'>':np.greater,'<=':np.less_equal,'>=':np.greater_equal,
+                    '==':np.equal,'!=':np.not_equal}[compare]
+
+        t = np.asarray(self._get_column('time')).astype(float)
+        col = np.asarray(self._get_column(key)).astype(float)
+        events = []
+        if not len(col) > 0 or not len(col) == len(t):
+            loggerstream.warning('Eventlogger: no data in column %s' % key)
+            if returnevents:
+                return self, events
+            return self
+
+        # level of each sample: index of the highest threshold met, -1 if none
+        level = -np.ones(len(col), dtype=int)
+        with np.errstate(invalid='ignore'):
+            for idx in range(len(values)):
+                level[compfunc(col, values[idx])] = idx
+
+        starts, lengths, runlevels = runlength_encode(level)
+        ndtype = len(self.ndarray[0]) > 0
+        if addcomment and ndtype:
+            comind = KEYLIST.index('comment')
+            comments = self.ndarray[comind]
+            if not len(comments) == len(col):
+                comments = np.asarray(['-']*len(col), dtype=object)
+            else:
+                comments = comments.astype(object)
+
+        for start, length, lev in zip(starts, lengths, runlevels):
+            if lev < 0:
+                continue
+            end = start + length
+            segment = col[start:end]
+            if compare in ['<','<=']:
+                peakidx = start + np.nanargmin(segment)
+            else:
+                peakidx = start + np.nanargmax(segment)
+            event = {'starttime': num2date(t[start]).replace(tzinfo=None),
+                     'endtime': num2date(t[end-1]).replace(tzinfo=None),
+                     'peak': col[peakidx],
+                     'peaktime': num2date(t[peakidx]).replace(tzinfo=None),
+                     'threshold': values[lev],
+                     'comment': stringvalues[lev]}
+            events.append(event)
+            stormlogger.warning('%s at %s (until %s, peak %s)' % (stringvalues[lev], event['starttime'], event['endtime'], event['peak']))
+            if addcomment:
+                if ndtype:
+                    for idx in range(start, end):
+                        if comments[idx] == '-':
+                            comments[idx] = stringvalues[lev]
+                        else:
+                            comments[idx] += ', ' + stringvalues[lev]
+                else:
+                    for elem in self[start:end]:
+                        if elem.comment == '-':
+                            elem.comment = stringvalues[lev]
+                        else:
+                            elem.comment += ', ' + stringvalues[lev]
+
+        if addcomment and ndtype:
+            self.ndarray[comind] = comments
 
+        if debugmode:
+            print("Eventlogger: found %d events" % len(events))
+
+        if returnevents:
+            return self, events
         return self
 
 
@@ -3456,6 +3543,11 @@ CALLED BY:
     DEFINITION:
         Code for fitting data. Please note: if nans are present in any of the selected keys
         the whole line is dropped before fitting.
+        All keys are fitted on a common normalized time base. The fit (B-spline
+        basis from knotstep, polynomial or harmonic basis) is solved once
+        for each set of keys sharing the same valid (non-NaN) time steps, all
+        of them together as a multi column least-squares problem. Splines are
+        solved as banded system (make_lsq_spline) without a dense design matrix.
 
     PARAMETERS:
     Variables:
@@ -3491,99 +3583,129 @@ CALLED BY:
 
         if knotstep >= 0.5:
             raise ValueError("Knotstep needs to be smaller than 0.5")
+        if not fitfunc in ['spline','poly','harmonic']:
+            loggerstream.warning('Fit: function not valid')
+            return
 
         functionkeylist = {}
 
-        ndtype = False
-        if len(self.ndarray[0]) > 0:
-            ndtype=True
-
         for key in keys:
-            tmpst = self._drop_nans(key)
-            if ndtype:
-                t = tmpst.ndarray[0]
-            else:
-                t = tmpst._get_column('time')
-            if len(t) < 1:
-                break
-
-            nt,sv,ev = self._normalize(t)
-
-            #newlist = []
-            #for kkk in nt:
-            #    if kkk not in newlist:
-            #        newlist.append(kkk)
-            #    else:
-            #        newlist.append(kkk+0.00001)
-            #nt = newlist
-            #nt = np.sort(np.asarray(nt))
-            #print "NT", nt
-            sp = self.get_sampling_period()
-            if sp == 0:  ## if no dominant sampling period can be identified then use minutes
-                sp = 0.0177083333256
             if not key in KEYLIST[1:16]:
                 raise ValueError("Column key not valid")
-            if ndtype:
-                ind = KEYLIST.index(key)
-                val = tmpst.ndarray[ind]
+
+        t = np.asarray(self._get_column('time')).astype(float)
+        if len(t) < 1:
+            loggerstream.warning('Fit: No valid data')
+            return
+        values = np.empty((len(t),len(keys)))
+        for idx, key in enumerate(keys):
+            col = self._get_column(key)
+            if len(col) == len(t):
+                values[:,idx] = np.asarray(col).astype(float)
             else:
-                val = tmpst._get_column(key)
+                values[:,idx] = np.nan
+        valid = np.isfinite(values) & np.isfinite(t)[:,None]
 
-            # interplolate NaN values
-            #nans, xxx= nan_helper(val)
-            #val[nans]= np.interp(xxx(nans), xxx(~nans), val[~nans])
-            #print np.min(nt), np.max(nt), sp, len(self)
-            # normalized sampling rate
-            #print sp
-            sp = sp/(ev-sv) # should be the best?
-            #print sp
-            #sp = (ev-sv)/len(val) # does not work
-            #print sp
+        # common time normalization for all keys
+        usedrows = valid.any(axis=1)
+        if not np.sum(usedrows) > 1:
+            loggerstream.warning('Fit: No valid data')
+            return
+        sv, ev = np.min(t[usedrows]), np.max(t[usedrows])
+
+        sp = self.get_sampling_period()
+        if sp == 0:  ## if no dominant sampling period can be identified then use minutes
+            sp = 0.0177083333256
+        # normalized sampling rate
+        sp = sp/(ev-sv)
+
+        # group keys sharing the same valid time steps -> one design matrix per group
+        groups = {}
+        for idx in range(len(keys)):
+            groups.setdefault(valid[:,idx].tobytes(), []).append(idx)
+
+        for maskstring, keyidx in groups.items():
+            mask = valid[:,keyidx[0]]
+            val = values[mask][:,keyidx]
+            if len(val) <= 1:
+                loggerstream.warning('Fit: No valid data')
+                return
+            nt = (t[mask]-sv)/(ev-sv)
             x = arange(np.min(nt),np.max(nt),sp)
-            #print len(x)
-            if len(val)>1 and fitfunc == 'spline':
-                try:
-                    #print val, sp, knotstep
+            if fitfunc == 'spline':
+                knots = np.array(arange(np.min(nt)+knotstep,np.max(nt)-knotstep,knotstep))
+                if len(knots) > len(val):
+                    knotstep = knotstep*4
                     knots = np.array(arange(np.min(nt)+knotstep,np.max(nt)-knotstep,knotstep))
-                    #print knots, len(knots), len(val)
-                    if len(knots) > len(val):
-                        knotstep = knotstep*4
-                        knots = np.array(arange(np.min(nt)+knotstep,np.max(nt)-knotstep,knotstep))
-                        loggerstream.warning('Too many knots in spline for available data. Please check amount of fitted data in time range. Trying to reduce resolution ...')
-                    #print nt, len(knots), len(val)
-                    ti = interpolate.splrep(nt, val, k=3, s=0, t=knots)
-                except:
-                    loggerstream.error('Value error in fit function - likely reason: no valid numbers or too few numbers for fit')
-                    raise ValueError("Value error in fit function - not enough data or invalid numbers")
-                    return
-                #print nt, val, len(knots), knots
-                #ti = interpolate.interp1d(nt, val, kind='cubic')
-                #print "X", x, np.min(nt),np.max(nt),sp
-                #print "TI", ti
-                f_fit = interpolate.splev(x,ti)
-            elif len(val)>1 and fitfunc == 'poly':
+                    loggerstream.warning('Too many knots in spline for available data. Please check amount of fitted data in time range. Trying to reduce resolution ...')
+                knotvec = np.r_[[np.min(nt)]*4, knots, [np.max(nt)]*4]
+                f_fit = self._bspline_fit(nt, val, knotvec, x)
+            elif fitfunc == 'poly':
                 loggerstream.debug('Selected polynomial fit - amount of data: %d, time steps: %d, degree of fit: %d' % (len(nt), len(val), fitdegree))
-                ti = polyfit(nt, val, fitdegree)
-                f_fit = polyval(ti,x)
-            elif len(val)>1 and fitfunc == 'harmonic':
+                coeffs = np.linalg.lstsq(np.vander(nt, int(fitdegree)+1), val, rcond=-1)[0]
+                f_fit = np.dot(np.vander(x, int(fitdegree)+1), coeffs)
+            else:
                 loggerstream.debug('Selected harmonic fit - using inverse fourier transform')
                 f_fit = self.harmfit(nt, val, fitdegree)
                 # Don't use resampled list for harmonic time series
                 x = nt
-            elif len(val)<=1:
-                loggerstream.warning('Fit: No valid data')
-                return
-            else:
-                loggerstream.warning('Fit: function not valid')
-                return
-            exec('f'+key+' = interpolate.interp1d(x, f_fit, bounds_error=False)')
-            exec('functionkeylist["f'+key+'"] = f'+key)
+            for col, idx in enumerate(keyidx):
+                functionkeylist['f'+keys[idx]] = interpolate.interp1d(x, f_fit[:,col], bounds_error=False)
 
         func = [functionkeylist, sv, ev]
 
         return func
 
 
+    def _bspline_fit(self, nt, val, knotvec, x, k=3):
+        """
+    DEFINITION:
+        Least-squares B-spline fit of the columns of val at nt, evaluated
+        at x. Uses the banded solver of scipy.interpolate.make_lsq_spline
+        (memory linear in len(nt)), older scipy versions the dense design
+        matrix of _bspline_basis.
+        """
+        order = np.argsort(nt, kind='mergesort')
+        try:
+            from scipy.interpolate import make_lsq_spline
+        except ImportError:
+            make_lsq_spline = None
+        if make_lsq_spline:
+            try:
+                spl = make_lsq_spline(nt[order], val[order], knotvec, k=k)
+            except (np.linalg.LinAlgError, ValueError):
+                spl = None
+            if spl is None or not np.all(np.isfinite(spl.c)):
+                loggerstream.error('Value error in fit function - likely reason: no valid numbers or too few numbers for fit')
+                raise ValueError("Value error in fit function - not enough data or invalid numbers")
+            return spl(x)
+        design = self._bspline_basis(nt, knotvec, k=k)
+        coeffs, res, rank, sing = np.linalg.lstsq(design, val, rcond=-1)
+        if rank < design.shape[1]:
+            loggerstream.error('Value error in fit function - likely reason: no valid numbers or too few numbers for fit')
+            raise ValueError("Value error in fit function - not enough data or invalid numbers")
+        return np.dot(self._bspline_basis(x, knotvec, k=k), coeffs)
+
+
+    def _bspline_basis(self, x, knotvec, k=3):
+        """
+    DEFINITION:
+        Design matrix of the B-spline basis defined by the full knot vector
+        knotvec (including boundary knots) evaluated at x.
+
+    RETURNS:
+        - basis:        (array) shape (len(x), len(knotvec)-k-1)
+        """
+        ncoeff = len(knotvec)-k-1
+        basis = np.empty((len(x), ncoeff))
+        unit = np.zeros(len(knotvec))
+        for j in range(ncoeff):
+            unit[:] = 0.
+            unit[j] = 1.
+            basis[:,j] = interpolate.splev(x, (knotvec, unit, k))
+        return basis
+
+
     def flagfast(self,indexarray,flag, comment,keys=None):
         """
     DEFINITION:
@@ -4572,6 +4694,25 @@ CALLED BY:
         if not keys:
             keys = ['x','y','z']
 
+        if len(self.ndarray[0]) > 0:
+            # evaluate the functions for all time steps at once
+            functimearray = (st.ndarray[0].astype(float)-function[1])/(function[2]-function[1])
+            inrange = (functimearray >= 0.) & (functimearray <= 1.)
+            for key in keys:
+                if not key in KEYLIST[1:16]:
+                    raise ValueError("Column key not valid")
+                fkey = 'f'+key
+                ind = KEYLIST.index(key)
+                if fkey in function[0] and len(st.ndarray[ind]) > 0:
+                    ar = st.ndarray[ind].astype(float)
+                    funcval = function[0][fkey](functimearray[inrange])
+                    if order == 0:
+                        ar[inrange] = ar[inrange] - funcval
+                    else:
+                        ar[inrange] = funcval - ar[inrange]
+                    st.ndarray[ind] = ar
+            return st
+
         for elem in st:
             # check whether time step is in function range
             if function[1] <= elem.time <= function[2]:
@@ -6031,7 +6172,7 @@ CALLED BY:
     def obspyspectrogram(self, data, samp_rate, per_lap=0.9, wlen=None, log=False,
                     outfile=None, fmt=None, axes=None, dbscale=False,
                     mult=8.0, cmap=None, zorder=None, title=None, show=True,
-                    sphinx=False, clip=[0.0, 1.0]):
+                    sphinx=False, clip=[0.0, 1.0], spectra=None):
 
         #TODO: Discuss with Ramon which kind of window should be used (cos^2(2*pi (t/T)))
         """
@@ -6079,6 +6220,10 @@ CALLED BY:
         :param clip: adjust colormap to clip at lower and/or upper end. The given
             percentages of the amplitude range (linear or logarithmic depending
             on option `dbscale`) are clipped.
+        :type spectra: tuple
+        :param spectra: precomputed (specgram, freq, time) e.g. from welchgram.
+            specgram has shape (len(freq), len(time)), time is given in seconds
+            relative to the first sample. data is ignored in this case.
         """
 
         # enforce float for samp_rate
@@ -6088,35 +6233,42 @@ CALLED BY:
         if not wlen:
             wlen = samp_rate / 100.
 
-        npts = len(data)
+        if spectra is not None:
+            specgram, freq, time = spectra
+            if len(time) > 1:
+                end = time[-1] + (time[1] - time[0]) / 2.0
+            else:
+                end = time[-1]
+        else:
+            npts = len(data)
 
-        # nfft needs to be an integer, otherwise a deprecation will be raised
-        #XXX add condition for too many windows => calculation takes for ever
-        nfft = int(nearestPow2(wlen * samp_rate))
+            # nfft needs to be an integer, otherwise a deprecation will be raised
+            #XXX add condition for too many windows => calculation takes for ever
+            nfft = int(nearestPow2(wlen * samp_rate))
 
-        if nfft > npts:
-            nfft = int(nearestPow2(npts / 8.0))
+            if nfft > npts:
+                nfft = int(nearestPow2(npts / 8.0))
 
-        if mult != None:
-            mult = int(nearestPow2(mult))
-            mult = mult * nfft
+            if mult != None:
+                mult = int(nearestPow2(mult))
+                mult = mult * nfft
 
-        nlap = int(nfft * float(per_lap))
+            nlap = int(nfft * float(per_lap))
 
-        data = data - data.mean()
-        end = npts / samp_rate
+            data = data - data.mean()
+            end = npts / samp_rate
 
-        # Here we call not plt.specgram as this already produces a plot
-        # matplotlib.mlab.specgram should be faster as it computes only the
-        # arrays
-        # XXX mlab.specgram uses fft, would be better and faster use rfft
+            # Here we call not plt.specgram as this already produces a plot
+            # matplotlib.mlab.specgram should be faster as it computes only the
+            # arrays
+            # XXX mlab.specgram uses fft, would be better and faster use rfft
 
-        if MATPLOTLIB_VERSION >= [0, 99, 0]:
-            specgram, freq, time = mlab.specgram(data, Fs=samp_rate, NFFT=nfft,
-                                                  pad_to=mult, noverlap=nlap)
-        else:
-            specgram, freq, time = mlab.specgram(data, Fs=samp_rate,
-                                                    NFFT=nfft, noverlap=nlap)
+            if MATPLOTLIB_VERSION >= [0, 99, 0]:
+                specgram, freq, time = mlab.specgram(data, Fs=samp_rate, NFFT=nfft,
+                                                      pad_to=mult, noverlap=nlap)
+            else:
+                specgram, freq, time = mlab.specgram(data, Fs=samp_rate,
+                                                        NFFT=nfft, noverlap=nlap)
 
         # db scale and remove zero/offset for amplitude
         if dbscale:
@@ -6132,9 +6284,9 @@ CALLED BY:
             msg = "Invalid parameters for clip option."
             raise ValueError(msg)
 
-        _range = float(specgram.max() - specgram.min())
-        vmin = specgram.min() + vmin * _range
-        vmax = specgram.min() + vmax * _range
+        _range = float(np.nanmax(specgram) - np.nanmin(specgram))
+        vmin = np.nanmin(specgram) + vmin * _range
+        vmax = np.nanmin(specgram) + vmax * _range
         norm = Normalize(vmin, vmax, clip=True)
 
         if not axes:
@@ -6855,6 +7007,10 @@ CALLED BY:
         - marks:        (dict) add some text to the plot
         - returndata:   (bool) return freq and asd
         - freqlevel:    (float) print noise level at that frequency
+        - method:       (str) 'fft' (default, single periodogram of all non-NaN data),
+                              'welch' or 'multitaper' (gap aware spectral engine,
+                              accepts nfft, per_lap, window, ntapers, nw, maxgap
+                              and usecache, see welch)
 
     RETURNS:
         - plot:         (matplotlib plot) A plot of the powerspectrum
@@ -6881,6 +7037,7 @@ CALLED BY:
         returndata = kwargs.get('returndata')
         marks = kwargs.get('marks')
         freqlevel = kwargs.get('freqlevel')
+        method = kwargs.get('method')
 
         if noshow:
             show = False
@@ -6893,6 +7050,16 @@ CALLED BY:
             loggerstream.error("Powerspectrum: Stream of zero length -- aborting")
             raise Exception("Can't analyse stream of zero length!")
 
+        if method in ['welch','multitaper']:
+            engineargs = dict([(el,kwargs.get(el)) for el in ['nfft','per_lap','window','ntapers','nw','maxgap','usecache'] if not kwargs.get(el) is None])
+            if method == 'multitaper' and not engineargs.get('ntapers'):
+                engineargs['ntapers'] = 7
+            freqm, psd = self.welch(key, debugmode=debugmode, **engineargs)
+            # drop the DC component for log plots
+            freqm, asdm = freqm[1:], np.sqrt(psd[1:])
+        else:
+            freqm, asdm = None, None
+
         t = np.asarray(self._get_column('time'))
         val = np.asarray(self._get_column(key))
         mint = np.min(t)
@@ -6906,10 +7073,11 @@ CALLED BY:
 
         #print "NFFT now:", nfft
 
-        for idx, elem in enumerate(val):
-            if not isnan(elem):
-                tnew.append((t[idx]-mint)*24*3600)
-                valnew.append(elem)
+        if freqm is None:
+            for idx, elem in enumerate(val):
+                if not isnan(elem):
+                    tnew.append((t[idx]-mint)*24*3600)
+                    valnew.append(elem)
 
         tnew = np.asarray(tnew)
         valnew = np.asarray(valnew)
@@ -6932,9 +7100,10 @@ CALLED BY:
         else:
             ax = axes
 
-        psdm = mlab.psd(valnew, nfft, 1/dt)
-        asdm = np.sqrt(psdm[0])
-        freqm = psdm[1]
+        if freqm is None:
+            psdm = mlab.psd(valnew, nfft, 1/dt)
+            asdm = np.sqrt(psdm[0])
+            freqm = psdm[1]
 
         ax.loglog(freqm, asdm,'b-')
 
@@ -7785,8 +7954,12 @@ CALLED BY:
         keywords:
         samp_rate_multiplicator: to change the frequency relative to one day (default value is Hz - 24*3600)
         samp_rate_multiplicator : sampling rate give as days -> multiplied by x to create Hz, etc: default 24, which means 1/3600 Hz
+        method: 'mlab' (default) or 'welch'/'multitaper' to use the cached, gap aware
+                spectral engine (see welchgram). Accepts nfft, window, ntapers, nw, maxgap.
+                Gaps appear as missing columns instead of being concatenated.
         """
         samp_rate_multiplicator = kwargs.get('samp_rate_multiplicator')
+        method = kwargs.get('method')
 
         if not samp_rate_multiplicator:
             samp_rate_multiplicator = 24*3600
@@ -7798,6 +7971,32 @@ CALLED BY:
             return
 
         for key in keys:
+            if method in ['welch','multitaper']:
+                engineargs = dict([(el,kwargs.get(el)) for el in ['nfft','window','ntapers','nw','maxgap','usecache'] if not kwargs.get(el) is None])
+                if method == 'multitaper' and not engineargs.get('ntapers'):
+                    engineargs['ntapers'] = 7
+                dt = self.get_sampling_period()*24.*3600.
+                if wlen and not engineargs.get('nfft'):
+                    engineargs['nfft'] = int(nearestPow2(wlen/dt))
+                times, freq, spec = self.welchgram(key, per_lap=per_lap, **engineargs)
+                if not len(times) > 1:
+                    loggerstream.error('Spectrogram: less than two gap free segments for %s' % key)
+                    continue
+                # put segments onto a regular grid, skipped segments become NaN columns
+                segstep = np.min(np.diff(times))
+                segind = np.round((times - times[0])/segstep).astype(int)
+                filled = np.empty((segind[-1]+1, len(freq)))
+                filled.fill(np.nan)
+                filled[segind] = spec
+                spec = filled
+                times = times[0] + np.arange(len(filled))*segstep
+                # time axis in seconds relative to the first sample
+                tsec = (times - np.nanmin(t.astype(float)))*24.*3600.
+                self.obspyspectrogram(None, 1./dt, per_lap=per_lap, wlen=wlen, log=log,
+                    outfile=outfile, fmt=fmt, axes=axes, dbscale=dbscale,
+                    mult=mult, cmap=cmap, zorder=zorder, title=title, show=show,
+                    sphinx=sphinx, clip=clip, spectra=(spec.T, freq, tsec))
+                continue
             val = self._get_column(key)
             val = maskNAN(val)
             dt = self.get_sampling_period()*(samp_rate_multiplicator)
@@ -7814,6 +8013,9 @@ CALLED BY:
             and a selected time window
             neglecting any resets and decreasing trends
             - used for analyzing some rain senors
+            Windows start at the first time step of the stream. Increases
+            between successive samples of the same window are summed
+            (windowed reduction); each sample receives the sum of its window.
         PARAMETERS:
             key:           (key) column on which the process is performed
             timewindow:    (timedelta) define the window e.g. timedelta(minutes=15)
@@ -7821,6 +8023,9 @@ CALLED BY:
             sensitivitylevel:    (float) define a difference which two successive
                                          points need to exceed to be used
                                          (useful if you have some numeric noise)
+            returnwindows:       (bool) if True, additionally return a list of
+                                         dicts with 'starttime', 'endtime' and
+                                         'rise' for each window containing data
 
         RETURNS:
             - column:   (array) column with length of th stream
@@ -7828,78 +8033,51 @@ CALLED BY:
 
         EXAMPLE:
             >>>  col = stream.steadyrise('t1', timedelta(minutes=60),sensitivitylevel=0.002)
+            >>>  col, windows = stream.steadyrise('t1', timedelta(minutes=60),returnwindows=True)
 
 
         """
         sensitivitylevel = kwargs.get('sensitivitylevel')
+        returnwindows = kwargs.get('returnwindows')
 
-        prevval = 9999999999999.0
-        stacked = 0.0
-        count = 0
-        rescol = []
-        testcol = []
-
-        ndtype = False
-        if len(self.ndarray[0]) > 0:
-            ndtype = True
-
-
-        ind = KEYLIST.index(key)
-        if ndtype and len(self.ndarray[ind]) > 0:
-            startt = num2date(np.min(self.ndarray[0]))
-            for idx,val in enumerate(self.ndarray[ind]):
-                if num2date(self.ndarray[0][idx]) < startt+timewindow:
-                    if prevval < val:
-                        diff = val-prevval
-                        if not sensitivitylevel:
-                            stacked += val-prevval
-                        elif diff > sensitivitylevel:
-                            stacked += val-prevval
-                    count += 1
-                else:
-                    for i in range(count+1):
-                        rescol.append(stacked)
-                    count = 0
-                    # now put that results back to a column
-                    startt = startt+timewindow
-                    stacked = 0.0
-                prevval = val
-
-        elif not ndtype:
-            startt = num2date(self[0].time)
-            for elem in self:
-                testcol.append(elem)
-                if num2date(elem.time) < startt+timewindow:
-                    val = eval('elem.'+key)
-                    if prevval < val:
-                        diff = val-prevval
-                        if not sensitivitylevel:
-                            stacked += val-prevval
-                        elif diff > sensitivitylevel:
-                            stacked += val-prevval
-                    count += 1
-                else:
-                    for i in range(count+1):
-                        rescol.append(stacked)
-                    count = 0
-                    # now put that results back to a column
-                    startt = startt+timewindow
-                    val = eval('elem.'+key)
-                    stacked = 0.0
-                prevval = val
+        t = np.asarray(self._get_column('time')).astype(float)
+        try:
+            val = np.asarray(self._get_column(key)).astype(float)
+        except:
+            val = np.asarray([])
 
-        else:
+        if not len(val) > 0 or not len(val) == len(t):
             print("steadyrise: no data found in selected column %s" % key)
             return np.asarray([])
-        # Finally fill the end
-        for i in range(count):
-            rescol.append(stacked)
-
-        if not len(rescol) == len(self) and not len(rescol) == len(self.ndarray[0]) :
-            loggerstream.error('steadrise: An error leading to unequal lengths has been encountered')
-            return []
 
-        return np.asarray(rescol)
+        window = timewindow.total_seconds()/(24.*3600.)
+        # small offset avoids rounding issues for samples exactly at window borders
+        winidx = np.floor((t - np.min(t))/window + 1e-9).astype(int)
+
+        # increase between successive samples, assigned to the later sample
+        diff = np.r_[0., val[1:]-val[:-1]]
+        with np.errstate(invalid='ignore'):
+            use = diff > 0
+            if sensitivitylevel:
+                use = diff > sensitivitylevel
+        # only steps within a window are counted
+        use[1:] = use[1:] & (winidx[1:] == winidx[:-1])
+        increase = np.where(use, diff, 0.)
+
+        winidx = winidx - winidx.min()
+        stacked = np.bincount(winidx, weights=increase)
+        rescol = stacked[winidx]
+
+        if returnwindows:
+            windows = []
+            starttime = num2date(np.min(t)).replace(tzinfo=None)
+            for idx in np.unique(winidx):
+                windows.append({'starttime': starttime + idx*timewindow,
+                                'endtime': starttime + (idx+1)*timewindow,
+                                'rise': stacked[idx]})
+            return rescol, windows
+
+        return rescol
 
     def stereoplot(self, **kwargs):
         """
@@ -8521,6 +8699,235 @@ CALLED BY:
         return absstream
         """
 
+    def _spectral_segments(self, key, nfft=None, per_lap=0.5, window='hanning',
+                           ntapers=None, nw=4.0, maxgap=0.0, usecache=True,
+                           debugmode=None):
+        """
+    DEFINITION:
+        Core of the spectral engine. Cuts the selected column into segments of
+        nfft samples which are aligned to an absolute time grid (multiples of
+        the segment step), rejects segments containing gaps and returns one
+        sided power spectral densities for each valid segment.
+        Segment spectra are stored in SPECTRALCACHE keyed by sensor, key,
+        segment start, maxgap, the amount of missing samples and
+        SPECTRALPROBES equally spaced samples of the segment. Repeated calls
+        on a growing/rolling stream thus only transform the new segments.
+
+    PARAMETERS:
+    Variables:
+        - key:          (str) Key to analyse
+    Kwargs:
+        - nfft:         (int) Number of samples per segment (default: len/8 rounded to a power of two)
+        - per_lap:      (float) Overlap of segments, ranging from 0 to 1 (default 0.5)
+        - window:       (str) hanning, hamming, bartlett, blackman or boxcar
+        - ntapers:      (int) if given, use a multitaper estimate with ntapers dpss tapers
+        - nw:           (float) time-bandwidth product of dpss tapers (default 4)
+        - maxgap:       (float) maximal fraction of missing samples within a segment.
+                                Such gaps are linearly interpolated. Segments with
+                                more missing data are dropped (default 0.0).
+        - usecache:     (bool) use and fill the segment cache (default True)
+
+    RETURNS:
+        - starts:       (array) start times of used segments (date2num)
+        - freq:         (array) frequencies in Hz
+        - spectra:      (array) psd of each segment, shape (len(starts), len(freq))
+        - dt:           (float) sampling period in seconds
+        - nfft:         (int) segment length in samples
+
+    EXAMPLE:
+        >>> starts, freq, spectra, dt, nfft = stream._spectral_segments('x', nfft=4096)
+        """
+
+        if not key in NUMKEYLIST:
+            raise ValueError("Spectral analysis: key %s not valid" % key)
+        ind = KEYLIST.index(key)
+        if len(self.ndarray[0]) > 0:
+            t = self.ndarray[0].astype(float)
+            val = self.ndarray[ind].astype(float)
+        else:
+            t = np.asarray(self._get_column('time')).astype(float)
+            val = np.asarray(self._get_column(key)).astype(float)
+        if not len(t) > 1 or not len(val) == len(t):
+            loggerstream.error("Spectral analysis: no data in column %s -- aborting" % key)
+            raise Exception("Can't analyse stream of zero length!")
+
+        order = np.argsort(t)
+        tsec = t[order]*24.*3600.
+        val = val[order]
+        dt = np.round(self.get_sampling_period()*24.*3600., 6)
+        if not dt > 0:
+            raise Exception("Spectral analysis: could not determine sampling period")
+
+        # Put data onto a regular grid - missing samples become NaN
+        t0 = tsec[0]
+        gridind = np.round((tsec - t0)/dt).astype(int)
+        grid = np.empty(gridind[-1]+1)
+        grid.fill(np.nan)
+        grid[gridind] = val
+
+        if not nfft:
+            nfft = max(int(nearestPow2(len(grid)/8.)), 16)
+        nfft = int(nfft)
+        if nfft > len(grid):
+            nfft = int(nearestPow2(len(grid)/2.))
+        nlap = int(nfft*float(per_lap))
+        if nlap >= nfft:
+            nlap = nfft-1
+        step = (nfft-nlap)*dt
+
+        # Segment starts are multiples of step in absolute time - this
+        # keeps segment boundaries identical between successive calls
+        first = np.ceil(np.round(t0/step, 6))*step
+        segstarts = np.arange(first, tsec[-1]-(nfft-1)*dt+dt/2., step)
+        startind = np.round((segstarts-t0)/dt).astype(int)
+        valid = (startind >= 0) & (startind+nfft <= len(grid))
+        segstarts, startind = segstarts[valid], startind[valid]
+
+        if ntapers:
+            try:
+                from scipy.signal.windows import dpss
+            except ImportError:
+                loggerstream.error("Spectral analysis: multitaper requires scipy >= 1.1")
+                raise
+            tapers = np.atleast_2d(dpss(nfft, nw, int(ntapers)))
+            windowname = 'dpss%s' % str(nw)
+        else:
+            if window == 'boxcar':
+                win = np.ones(nfft)
+            elif window in ['hanning','hamming','bartlett','blackman']:
+                win = getattr(np, window)(nfft)
+            else:
+                raise ValueError("Spectral analysis: window %s not supported" % window)
+            tapers = np.atleast_2d(win/np.sqrt(np.sum(win**2)))
+            windowname = window
+            ntapers = 1
+
+        sensorid = self.header.get('SensorID','')
+        freq = np.arange(nfft//2+1)/(nfft*dt)
+        spectra = np.empty((len(segstarts), len(freq)))
+        used = np.zeros(len(segstarts), dtype=bool)
+        cachekeys = [None]*len(segstarts)
+        if usecache:
+            # some samples are part of the key - other data of the same
+            # sensor and time range (e.g. filtered or scaled) is recalculated
+            # without reading (hashing) all samples of each segment
+            probes = np.unique(np.linspace(0, nfft-1, SPECTRALPROBES).astype(int))
+            probed = grid[startind[:,None] + probes[None,:]]
+            nancount = np.concatenate([[0], np.cumsum(np.isnan(grid))])
+            gaps = nancount[startind+nfft] - nancount[startind]
+            cachekeys = [(sensorid, key, np.round(el, 6), nfft, dt, windowname, int(ntapers), float(maxgap),
+                          int(gap), row.tobytes() if hasattr(row, 'tobytes') else row.tostring())
+                         for el, gap, row in zip(segstarts, gaps, probed)]
+
+        tocalc = []
+        for idx, ck in enumerate(cachekeys):
+            if usecache and ck in SPECTRALCACHE:
+                spectra[idx] = SPECTRALCACHE[ck]
+                used[idx] = True
+            else:
+                tocalc.append(idx)
+
+        if debugmode:
+            print("Spectral analysis: %d segments, %d from cache" % (len(segstarts), len(segstarts)-len(tocalc)))
+
+        if len(tocalc) > 0:
+            tocalc = np.asarray(tocalc)
+            segs = grid[startind[tocalc][:,None] + np.arange(nfft)[None,:]]
+            nans = np.isnan(segs)
+            gapfrac = nans.sum(axis=1)/float(nfft)
+            keep = gapfrac <= maxgap
+            tocalc, segs, nans = tocalc[keep], segs[keep], nans[keep]
+            # linearly interpolate small gaps
+            xs = np.arange(nfft)
+            for row in np.where(nans.any(axis=1))[0]:
+                good = ~nans[row]
+                if good.sum() < 2:
+                    segs[row] = 0.0
+                    continue
+                segs[row][~good] = np.interp(xs[~good], xs[good], segs[row][good])
+            segs = segs - segs.mean(axis=1)[:,None]
+            power = np.zeros((len(segs), len(freq)))
+            for taper in tapers:
+                power += np.abs(np.fft.rfft(segs*taper[None,:], axis=1))**2
+            power = power/float(len(tapers))*dt
+            # one sided spectrum
+            if nfft % 2 == 0:
+                power[:,1:-1] *= 2.
+            else:
+                power[:,1:] *= 2.
+            spectra[tocalc] = power
+            used[tocalc] = True
+            if usecache:
+                for idx, row in zip(tocalc, power):
+                    ck = cachekeys[idx]
+                    if not ck in SPECTRALCACHE:
+                        SPECTRALCACHEORDER.append(ck)
+                    SPECTRALCACHE[ck] = row
+                while len(SPECTRALCACHEORDER) > SPECTRALCACHESIZE:
+                    SPECTRALCACHE.pop(SPECTRALCACHEORDER.popleft(), None)
+
+        return segstarts[used]/(24.*3600.), freq, spectra[used], dt, nfft
+
+
+    def welch(self, key, **kwargs):
+        """
+    DEFINITION:
+        Power spectral density estimate by Welch averaging of overlapping,
+        gap free segments (optionally multitaper). Segment spectra are cached,
+        see _spectral_segments for details and kwargs.
+
+    PARAMETERS:
+    Variables:
+        - key:          (str) Key to analyse
+    Kwargs:
+        - nfft, per_lap, window, ntapers, nw, maxgap, usecache:
+                        see _spectral_segments
+
+    RETURNS:
+        - freq:         (array) frequencies in Hz
+        - psd:          (array) power spectral density in unit**2/Hz
+
+    EXAMPLE:
+        >>> freq, psd = stream.welch('x', nfft=4096, per_lap=0.5, maxgap=0.01)
+        >>> freq, psd = stream.welch('x', nfft=4096, ntapers=7, nw=4)
+        """
+
+        starts, freq, spectra, dt, nfft = self._spectral_segments(key, **kwargs)
+        if not len(starts) > 0:
+            loggerstream.warning("welch: no gap free segment found for key %s" % key)
+            return freq, np.asarray([np.nan]*len(freq))
+
+        return freq, np.mean(spectra, axis=0)
+
+
+    def welchgram(self, key, **kwargs):
+        """
+    DEFINITION:
+        Time resolved segment spectra (spectrogram) obtained from the cached
+        spectral engine. Segments with gaps are skipped.
+
+    PARAMETERS:
+    Variables:
+        - key:          (str) Key to analyse
+    Kwargs:
+        - nfft, per_lap, window, ntapers, nw, maxgap, usecache:
+                        see _spectral_segments
+
+    RETURNS:
+        - times:        (array) center times of segments (date2num)
+        - freq:         (array) frequencies in Hz
+        - spectra:      (array) psd values, shape (len(times), len(freq))
+
+    EXAMPLE:
+        >>> times, freq, spectra = stream.welchgram('x', nfft=1024)
+        """
+
+        starts, freq, spectra, dt, nfft = self._spectral_segments(key, **kwargs)
+        times = starts + (nfft*dt/2.)/(24.*3600.)
+
+        return times, freq, spectra
+
+
     def write(self, filepath, **kwargs):
         """
     DEFINITION:
@@ -9747,6 +10154,30 @@ def _read(filename, dataformat=None, headonly=False, **kwargs):
 
     return stream
 
+def clearSpectralCache(sensorid=None, key=None):
+    """
+    DEFINITION:
+        Remove cached segment spectra of the spectral engine
+        (see DataStream.welch). Without arguments the full cache is cleared.
+
+    PARAMETERS:
+    Kwargs:
+        - sensorid:     (str) only remove entries of this SensorID
+        - key:          (str) only remove entries of this column key
+
+    RETURNS:
+        - int:          number of removed entries
+
+    EXAMPLE:
+        >>> clearSpectralCache(sensorid='LEMI036_1_0002')
+    """
+    global SPECTRALCACHEORDER
+    remove = [ck for ck in SPECTRALCACHE if (sensorid is None or ck[0] == sensorid) and (key is None or ck[1] == key)]
+    for ck in remove:
+        SPECTRALCACHE.pop(ck, None)
+    SPECTRALCACHEORDER = deque([ck for ck in SPECTRALCACHEORDER if ck in SPECTRALCACHE])
+    return len(remove)
+
 def saveflags(mylist=None,path=None):
     """
     DEFINITION:
@@ -11510,6 +11941,29 @@ def nan_helper(y):
     return np.isnan(y), lambda z: z.nonzero()[0]
 
 
+def runlength_encode(array):
+    """
+    Run length encoding of a 1D array.
+
+    Input:
+        - array, 1d numpy array (e.g. boolean mask or integer levels)
+    Output:
+        - starts, indices where runs start
+        - lengths, lengths of the runs
+        - values, value of each run
+    Example:
+        >>> starts, lengths, values = runlength_encode(np.asarray([0,1,1,0]))
+        >>> # starts = [0,1,3], lengths = [1,2,1], values = [0,1,0]
+    """
+    array = np.asarray(array)
+    if len(array) == 0:
+        return np.asarray([],dtype=int), np.asarray([],dtype=int), array
+    changes = np.nonzero(array[1:] != array[:-1])[0] + 1
+    starts = np.r_[0, changes]
+    lengths = np.diff(np.r_[starts, len(array)])
+    return starts, lengths, array[starts]
+
+
 def nearestPow2(x):
     """
     Function taken from ObsPy
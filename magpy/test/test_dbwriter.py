@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Tests of the buffered data base writer of the collectors (sqlite)
+
+Run:  python magpy/test/test_dbwriter.py
+"""
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from magpy.database import dbconnect, dbselect
+from magpy.collector.dbwriter import BufferedDBWriter
+
+COLUMNS = ['time', 'x']
+
+
+def lines(start, amount):
+    return [['2016-01-01 00:%02d:%02d.000000' % divmod(i, 60), float(i)] for i in range(start, start+amount)]
+
+
+class LockedCursor(object):
+    # cursor of a data base which is locked by another process
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def executemany(self, sql, rows):
+        raise sqlite3.OperationalError('database is locked')
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class LockedConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return LockedCursor(self.db.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class TestBufferedDBWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.sqlite')
+        self.spooldir = os.path.join(self.tmpdir, 'spool')
+        self.db = dbconnect('sqlite', path=self.path)
+        cursor = self.db.cursor()
+        cursor.execute("CREATE TABLE TEST_0001_0001 (time CHAR(40) NOT NULL PRIMARY KEY, x FLOAT)")
+        cursor.execute("CREATE TABLE EPOCH_0001_0001 (time BIGINT NOT NULL PRIMARY KEY, x FLOAT)")
+        self.db.commit()
+        self.state = 'up'
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self):
+        if self.state == 'down':
+            raise sqlite3.OperationalError('unable to open database file')
+        db = dbconnect('sqlite', path=self.path)
+        if self.state == 'locked':
+            return LockedConnection(db)
+        return db
+
+    def writer(self, **kwargs):
+        return BufferedDBWriter(connect=self.connect, spooldir=self.spooldir, retry=0., statsinterval=0, **kwargs)
+
+    def count(self, table='TEST_0001_0001'):
+        return dbselect(self.db, 'COUNT(*)', table)[0]
+
+    def test_write(self):
+        writer = self.writer(maxrows=10)
+        for line in lines(0, 25):
+            writer.put('TEST_0001_0001', COLUMNS, line)
+        writer.flush(force=True)
+        self.assertEqual(self.count(), 25)
+        self.assertEqual(writer.stats()['TEST_0001_0001']['written'], 25)
+        # lines already stored are ignored
+        writer.put('TEST_0001_0001', COLUMNS, lines(0, 1)[0])
+        writer.flush(force=True)
+        self.assertEqual(self.count(), 25)
+
+    def test_spill_and_replay(self):
+        self.state = 'down'
+        writer = self.writer()
+        for line in lines(0, 10):
+            writer.put('TEST_0001_0001', COLUMNS, line)
+        writer.flush(force=True)
+        self.assertEqual(self.count(), 0)
+        self.assertEqual(writer.stats()['TEST_0001_0001']['spooled'], 10)
+        self.assertTrue(os.path.isfile(os.path.join(self.spooldir, 'TEST_0001_0001.spool')))
+        # connection is back: spilled lines are written before new ones
+        self.state = 'up'
+        for line in lines(10, 5):
+            writer.put('TEST_0001_0001', COLUMNS, line)
+        writer.flush(force=True)
+        self.assertEqual(self.count(), 15)
+        self.assertEqual(os.listdir(self.spooldir), [])
+
+    def test_outage_during_insert(self):
+        self.state = 'locked'
+        writer = self.writer()
+        for line in lines(0, 10):
+            writer.put('TEST_0001_0001', COLUMNS, line)
+        writer.flush(force=True)
+        stats = writer.stats()['TEST_0001_0001']
+        self.assertEqual(stats['spilled'], 10)
+        self.assertEqual(stats['failed'], 0)
+        self.assertIsNone(writer.db)
+        self.state = 'up'
+        writer.flush(force=True)
+        self.assertEqual(self.count(), 10)
+
+    def test_recover_interrupted_replay(self):
+        os.makedirs(self.spooldir)
+        base = os.path.join(self.spooldir, 'TEST_0001_0001.spool')
+        with open(base + '.replay', 'w') as spool:
+            spool.write(json.dumps({'columns': COLUMNS, 'rows': lines(0, 5)}) + '\n')
+        with open(base, 'w') as spool:
+            spool.write(json.dumps({'columns': COLUMNS, 'rows': lines(5, 5)}) + '\n')
+        writer = self.writer()
+        self.assertFalse(os.path.exists(base + '.replay'))
+        with open(base) as spool:
+            rows = [json.loads(line)['rows'] for line in spool]
+        self.assertEqual([len(el) for el in rows], [5, 5])
+        self.assertEqual(rows[0][0][1], 0.)
+        writer.flush(force=True)
+        self.assertEqual(self.count(), 10)
+
+    def test_epoch_schema(self):
+        writer = self.writer()
+        writer.put('EPOCH_0001_0001', COLUMNS, ['2016-01-01 00:00:01.000000', 1.])
+        writer.flush(force=True)
+        self.assertEqual(dbselect(self.db, 'time', 'EPOCH_0001_0001'), [1451606401000000])
+
+
+if __name__ == '__main__':
+    unittest.main()
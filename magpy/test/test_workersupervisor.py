@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Tests of the acquisition supervisor and its worker processes (posix)
+
+Dummy workers (python script, --worker NAME) use the ForwardingFactory
+and the channel of the supervisor (JSON lines on fd 3 and stdin).
+
+Run:  python magpy/test/test_workersupervisor.py
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import reactor, task
+from twisted.trial.unittest import TestCase
+
+from magpy.acquisition import workersupervisor
+from magpy.acquisition.workersupervisor import AcquisitionSupervisor
+
+WORKER = '''
+import os, sys
+sys.path.insert(0, %r)
+from twisted.internet import reactor, task
+import workersupervisor
+workersupervisor.WORKERKEEPALIVE = 0.1
+from workersupervisor import ForwardingFactory
+
+name = sys.argv[sys.argv.index('--worker')+1]
+topic = 'http://example.com/test/env#' + name + '-value'
+factory = ForwardingFactory()
+factory.connect()
+count = [0]
+
+def tick():
+    count[0] += 1
+    if name == 'CRASH':
+        os._exit(2)
+    elif name == 'CONST':
+        # readings suppressed by a publication policy
+        factory.alive()
+    elif name in ['VALUE', 'EXIT']:
+        subscribed = factory.subscriptions is not None and topic in factory.subscriptions
+        factory.dispatch(topic, {'id': 30, 'value': count[0], 'subscribed': subscribed})
+    if name == 'EXIT' and count[0] >= 6:
+        os._exit(0)
+
+task.LoopingCall(tick).start(0.1)
+reactor.run()
+''' % os.path.dirname(os.path.abspath(workersupervisor.__file__))
+
+
+class DummyFactory(object):
+    # publishing WAMP factory
+    def __init__(self):
+        self.subscriptions = {}
+        self.events = []
+
+    def dispatch(self, topic, event):
+        self.events.append((topic, event))
+
+
+def wait(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+class TestAcquisitionSupervisor(TestCase):
+
+    timeout = 30
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'worker.py')
+        with open(self.script, 'w') as fh:
+            fh.write(WORKER)
+        self.factory = DummyFactory()
+        self.supervisor = None
+        self.watchdog = None
+
+    def supervise(self, names, **kwargs):
+        kwargs.setdefault('timeout', 0.)
+        self.supervisor = AcquisitionSupervisor(self.factory, self.script, names, mindelay=0.1, maxdelay=0.4, **kwargs)
+        self.supervisor.start()
+        # check every 0.1 sec instead of 5 sec
+        self.watchdog = task.LoopingCall(self.supervisor.check)
+        self.watchdog.start(0.1, now=False)
+        return self.supervisor
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        if self.supervisor is None:
+            return
+        self.watchdog.stop()
+        self.supervisor.stop()
+        return self.ended()
+
+    def ended(self, tries=50):
+        # wait for the workers and drop the pending KILL signals
+        running = [el for el in self.supervisor.workers.values() if el['process'] is not None]
+        if running and tries > 0:
+            return wait(0.1).addCallback(lambda ignore: self.ended(tries-1))
+        for call in reactor.getDelayedCalls():
+            if getattr(call.func, '__self__', None) is self.supervisor:
+                call.cancel()
+
+    def stats(self, name):
+        return self.supervisor.stats()[name]
+
+    def test_events(self):
+        supervisor = self.supervise(['VALUE'])
+        def subscribe(ignore):
+            self.assertTrue(len(self.factory.events) > 0)
+            self.assertFalse(self.factory.events[0][1]['subscribed'])
+            # subscribed topics are sent to the workers
+            self.factory.subscriptions = {'http://example.com/test/env#VALUE-value': [True]}
+            return wait(0.5)
+        def check(ignore):
+            topics = set([el[0] for el in self.factory.events])
+            self.assertEqual(topics, set(['http://example.com/test/env#VALUE-value']))
+            self.assertEqual([el[1]['value'] for el in self.factory.events], list(range(1, len(self.factory.events)+1)))
+            self.assertTrue(self.factory.events[-1][1]['subscribed'])
+            stats = self.stats('VALUE')
+            self.assertEqual(stats['events'], len(self.factory.events))
+            self.assertEqual((stats['errors'], stats['restarts']), (0, 0))
+            self.assertIsNotNone(stats['pid'])
+        return wait(1.).addCallback(subscribe).addCallback(check)
+
+    def test_backoff(self):
+        supervisor = self.supervise(['CRASH'], stable=60.)
+        def check(ignore):
+            worker = supervisor.workers['CRASH']
+            self.assertTrue(worker['restarts'] >= 3)
+            # 0.1, 0.2, 0.4, 0.4, ...
+            self.assertEqual(worker['delay'], 0.4)
+            self.assertEqual(self.factory.events, [])
+        return wait(2.).addCallback(check)
+
+    def test_reset(self):
+        supervisor = self.supervise(['EXIT'], stable=0.3)
+        def check(ignore):
+            worker = supervisor.workers['EXIT']
+            self.assertTrue(worker['restarts'] >= 2)
+            # workers running longer than stable restart after mindelay
+            self.assertEqual(worker['delay'], 0.2)
+        return wait(2.5).addCallback(check)
+
+    def test_watchdog(self):
+        supervisor = self.supervise(['SILENT'], timeout=0.5)
+        def check(ignore):
+            self.assertTrue(supervisor.workers['SILENT']['restarts'] >= 1)
+        return wait(2.).addCallback(check)
+
+    def test_keepalive(self):
+        supervisor = self.supervise(['CONST'], timeout=0.5)
+        def check(ignore):
+            stats = self.stats('CONST')
+            self.assertEqual(stats['restarts'], 0)
+            self.assertEqual(stats['events'], 0)
+            self.assertTrue(stats['idle'] < 0.5)
+            self.assertEqual(self.factory.events, [])
+        return wait(2.).addCallback(check)
+
+
+if __name__ == '__main__':
+    unittest.main()